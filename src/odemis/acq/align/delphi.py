@@ -22,6 +22,7 @@ Odemis. If not, see http://www.gnu.org/licenses/.
 
 from __future__ import division
 
+from collections import OrderedDict
 from concurrent.futures._base import CancelledError, CANCELLED, FINISHED, \
     RUNNING
 import cv2
@@ -92,49 +93,36 @@ def list_hw_settings(escan, ccd):
     List all the hardware settings which might be modified during calibration
     return (tuple): hardware settings to be used in restore_hw_settings()
     """
-    et = ccd.exposureTime.value
-    cbin = ccd.binning.value
-    cres = ccd.resolution.value
-
-    eres = escan.resolution.value
-    scale = escan.scale.value
-    trans = escan.translation.value
-    dt = escan.dwellTime.value
-    av = escan.accelVoltage.value
-    sptsz = escan.spotSize.value
-    rot = escan.rotation.value
+    # Read all the settings of each component in one call
+    ccd_settings = ccd.getValues(["binning", "resolution", "exposureTime"])
+    escan_settings = escan.getValues(["scale", "resolution", "translation",
+                                      "dwellTime", "accelVoltage", "spotSize",
+                                      "rotation"])
 
     mdsem = escan.getMetadata()
     for k in list(mdsem.keys()):
         if k not in MD_CALIB_SEM:
             del mdsem[k]
 
-    return et, cbin, cres, eres, scale, trans, dt, av, sptsz, rot, mdsem
+    return ccd_settings, escan_settings, mdsem
 
 
 def restore_hw_settings(escan, ccd, hw_settings):
     """
     Restore all the hardware settings as there were recorded
     """
-    et, cbin, cres, eres, scale, trans, dt, av, sptsz, rot, mdsem = hw_settings
+    ccd_settings, escan_settings, mdsem = hw_settings
 
     # order matters!
-    ccd.binning.value = cbin
-    ccd.resolution.value = cres
-
-    ccd.exposureTime.value = et
+    ccd.setValues(OrderedDict((n, ccd_settings[n]) for n in
+                              ("binning", "resolution", "exposureTime")))
 
     # order matters!
-    escan.scale.value = scale
-    escan.resolution.value = eres
-    escan.translation.value = trans
-
-    escan.dwellTime.value = dt
-    escan.accelVoltage.value = av
-    escan.spotSize.value = sptsz
-
+    escan_names = ["scale", "resolution", "translation", "dwellTime",
+                   "accelVoltage", "spotSize"]
     if not escan.rotation.readonly:
-        escan.rotation.value = rot
+        escan_names.append("rotation")
+    escan.setValues(OrderedDict((n, escan_settings[n]) for n in escan_names))
 
     escan.updateMetadata(mdsem)
 
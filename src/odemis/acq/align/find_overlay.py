@@ -478,29 +478,20 @@ class GridScanner(object):
         self._hw_settings = ()
 
     def _save_hw_settings(self):
-        scale = self.escan.scale.value
-        sem_res = self.escan.resolution.value
-        trans = self.escan.translation.value
-        dt = self.escan.dwellTime.value
+        # Read all the settings of each component in one call
+        escan_settings = self.escan.getValues(["scale", "resolution", "translation", "dwellTime"])
+        ccd_settings = self.ccd.getValues(["binning", "resolution", "exposureTime"])
 
-        binning = self.ccd.binning.value
-        ccd_res = self.ccd.resolution.value
-        et = self.ccd.exposureTime.value
-
-        self._hw_settings = (sem_res, scale, trans, dt, binning, ccd_res, et)
+        self._hw_settings = (escan_settings, ccd_settings)
 
     def _restore_hw_settings(self):
-        sem_res, scale, trans, dt, binning, ccd_res, et = self._hw_settings
+        escan_settings, ccd_settings = self._hw_settings
 
         # order matters!
-        self.escan.scale.value = scale
-        self.escan.resolution.value = sem_res
-        self.escan.translation.value = trans
-        self.escan.dwellTime.value = dt
-
-        self.ccd.binning.value = binning
-        self.ccd.resolution.value = ccd_res
-        self.ccd.exposureTime.value = et
+        self.escan.setValues(OrderedDict((n, escan_settings[n]) for n in
+                                         ("scale", "resolution", "translation", "dwellTime")))
+        self.ccd.setValues(OrderedDict((n, ccd_settings[n]) for n in
+                                       ("binning", "resolution", "exposureTime")))
 
     def _discard_data(self, df, data):
         """
@@ -29,6 +29,7 @@ import math
 from numpy import arange
 from numpy import fft
 
+
 def MeasureShift(previous_img, current_img, precision=1):
     """
     Given two images, it calculates the shift in x and y axis. It first computes
@@ -38,6 +39,7 @@ def MeasureShift(previous_img, current_img, precision=1):
     cross-correlation" by Manuel Guizar, for the corresponding matlab code see
     http://www.mathworks.com/matlabcentral/fileexchange/
     18401-efficient-subpixel-image-registration-by-cross-correlation.
+    To compare several images to the same image, use ShiftEstimator, which is faster.
 
     previous_img (numpy.array): 2d array with the previous frame
     current_img (numpy.array): 2d array with the last frame, must be of same
@@ -45,143 +47,191 @@ def MeasureShift(previous_img, current_img, precision=1):
     precision (1<=int): Calculate drift within 1/precision of a pixel
     returns (tuple of floats): Drift in pixels
     """
-    if precision < 1:
-        raise ValueError("Precision cannot be less than 1, got %s." % (precision,))
-    assert previous_img.shape == current_img.shape, "Prev shape %s != new shape %s" % (previous_img.shape, current_img.shape)
-
-    previous_fft = fft.fft2(previous_img)
-    current_fft = fft.fft2(current_img)
-    m, n = previous_fft.shape
-
-    if precision == 1:
-        # Cross-correlation computation
-        CC = fft.ifft2(previous_fft * current_fft.conj())
-
-        # Locate the peak
-        ACC = abs(CC)
-        loc1 = ACC.argmax(0)
-        max1 = ACC[(loc1, range(ACC.shape[1]))]
-        loc2 = max1.argmax(0)
-
-        rloc = loc1[loc2]
-        cloc = loc2
-
-        # Calculate shift from the peak
-        md2 = m // 2
-        nd2 = n // 2
-        if rloc > md2:
-            row_shift = rloc - m
-        else:
-            row_shift = rloc
-
-        if cloc > nd2:
-            col_shift = cloc - n
-        else:
-            col_shift = cloc
-
-    else:
-        mlarge, nlarge = m * 2, n * 2
-
-        # Upsample by factor of 2 to obtain initial estimation and
-        # embed Fourier data in a 2x larger array
-        CC = numpy.zeros((mlarge, nlarge), dtype=numpy.complex)
-        CC[m - m // 2:m + 1 + (m - 1) // 2,
-           n - n // 2:n + 1 + (n - 1) // 2] = (fft.fftshift(previous_fft) *
-                                               fft.fftshift(current_fft).conj()
-                                              )
-
-        # Cross-correlation computation
-        CC = fft.ifft2(fft.ifftshift(CC))
-
-        # Locate the peak
-        ACC = abs(CC)
-        loc1 = ACC.argmax(0)
-        max1 = ACC[(loc1, range(ACC.shape[1]))]
-        loc2 = max1.argmax(0)
-
-        rloc = loc1[loc2]
-        cloc = loc2
-
-        # Calculate shift in previous pixel grid from the position of the peak
-        (m, n) = CC.shape
-        md2 = m // 2
-        nd2 = n // 2
-
-        if rloc > md2:
-            row_shift = rloc - m
-        else:
-            row_shift = rloc
-
-        if cloc > nd2:
-            col_shift = cloc - n
-        else:
-            col_shift = cloc
-
-        row_shift /= 2
-        col_shift /= 2
-
-        # DFT computation
-        # Initial shift estimation in upsampled grid
-        row_shift = round(row_shift * precision) / precision
-        col_shift = round(col_shift * precision) / precision
-        dft_shift = math.ceil(precision * 1.5) // 2  # Center of output at dft_shift+1
-
-        # Matrix multiply DFT around the current shift estimation
-        CC = (_UpsampledDFT(current_fft * previous_fft.conj(),
-                            math.ceil(precision * 1.5),
-                            math.ceil(precision * 1.5),
-                            precision,
-                            dft_shift - row_shift * precision,
-                            dft_shift - col_shift * precision)
-              ) / (md2 * nd2 * (precision ** 2))
-        # was .conj(), but as we just need the abs(), it's not needed
-
-        # Locate maximum and map back to original pixel grid
-        ACC = abs(CC)
-        loc1 = ACC.argmax(0)
-        max1 = ACC[(loc1, range(ACC.shape[1]))]
-        loc2 = max1.argmax(0)
-
-        rloc = loc1[loc2]
-        cloc = loc2
+    return ShiftEstimator(previous_img, precision).estimate(current_img)
 
-        rloc -= dft_shift
-        cloc -= dft_shift
 
-        row_shift += rloc / precision
-        col_shift += cloc / precision
-
-        if md2 == 1:
-            row_shift = 0
-        if nd2 == 1:
-            col_shift = 0
+class ShiftEstimator(object):
+    """
+    Calculates the shift of images compared to a reference image, in the same
+    way as MeasureShift(). The Fourier transform of the reference image is
+    computed only once, so comparing many images to the same reference (eg, for
+    drift correction) is faster. Several images can also be compared at once,
+    with estimate_batch().
+    As the images are real, only half of their (symmetric) Fourier transform is
+    computed. If the images are complex, only their real part is used.
+    """
 
-    return col_shift, row_shift
+    def __init__(self, ref_img, precision=1):
+        """
+        ref_img (numpy.array): 2d array with the reference frame
+        precision (1<=int): Calculate drift within 1/precision of a pixel
+        """
+        if precision < 1:
+            raise ValueError("Precision cannot be less than 1, got %s." % (precision,))
+        self.shape = ref_img.shape
+        self.precision = precision
+        self._ref_fft = fft.rfft2(numpy.real(ref_img))
+
+    def estimate(self, img):
+        """
+        Calculates the shift of an image compared to the reference image.
+        img (numpy.array): 2d array with the frame, must be of the same shape
+          as the reference image
+        returns (tuple of floats): Drift in pixels (X, Y)
+        """
+        return self.estimate_batch([img])[0]
+
+    def estimate_batch(self, imgs):
+        """
+        Calculates the shift of several images compared to the reference image.
+        It's faster than calling estimate() on each image.
+        imgs (list of numpy.array, or numpy.array of shape N, Y, X): the frames,
+          each of them must be of the same shape as the reference image
+        returns (list of tuple of floats): Drift in pixels (X, Y) of each image
+        """
+        for im in imgs:
+            assert im.shape == self.shape, "Prev shape %s != new shape %s" % (self.shape, im.shape)
+        if len(imgs) == 0:
+            return []
+
+        # Cross-power spectrum of every image, computed all at once
+        cur_fft = fft.rfft2(numpy.real(imgs))
+        prod = self._ref_fft * cur_fft.conj()
+        m, n = self.shape
+
+        if self.precision == 1:
+            # Cross-correlation computation
+            CC = fft.irfft2(prod, s=(m, n))
+            rloc, cloc = _argmax2d(abs(CC))
+
+            # Calculate shift from the peak
+            row_shift = numpy.where(rloc > m // 2, rloc - m, rloc)
+            col_shift = numpy.where(cloc > n // 2, cloc - n, cloc)
+        else:
+            precision = self.precision
+            # Upsample by factor of 2 to obtain initial estimation, by
+            # embedding the Fourier data in a 2x larger array.
+            # Done image per image, as it's faster than on all of them at once
+            # (the arrays are 4x bigger than the images).
+            rloc = numpy.empty(len(prod), dtype=int)
+            cloc = numpy.empty(len(prod), dtype=int)
+            for i, p in enumerate(prod):
+                CC = fft.irfft2(_padSpectrum(p, n), s=(2 * m, 2 * n))
+                rloc[i], cloc[i] = _argmax2d(abs(CC))
+
+            # Calculate shift in previous pixel grid from the position of the peak
+            row_shift = numpy.where(rloc > m, rloc - 2 * m, rloc) / 2
+            col_shift = numpy.where(cloc > n, cloc - 2 * n, cloc) / 2
+
+            # DFT computation
+            # Initial shift estimation in upsampled grid
+            row_shift = numpy.round(row_shift * precision) / precision
+            col_shift = numpy.round(col_shift * precision) / precision
+            usfac = int(math.ceil(precision * 1.5))
+            dft_shift = usfac // 2  # Center of output at dft_shift+1
+
+            # Matrix multiply DFT around the current shift estimation
+            CC = _UpsampledDFT(prod.conj(), usfac, usfac, precision,
+                               dft_shift - row_shift * precision,
+                               dft_shift - col_shift * precision,
+                               nc=n)
+
+            # Locate maximum and map back to original pixel grid
+            rloc, cloc = _argmax2d(abs(CC))
+            row_shift = row_shift + (rloc - dft_shift) / precision
+            col_shift = col_shift + (cloc - dft_shift) / precision
+
+            if m == 1:
+                row_shift[:] = 0
+            if n == 1:
+                col_shift[:] = 0
+
+        return [(float(c), float(r)) for c, r in zip(col_shift, row_shift)]
+
+
+def _argmax2d(a):
+    """
+    Locates the maximum of each 2d array. In case of equality, the first one
+    column by column is picked.
+    a (numpy.array of shape ..., Y, X): the arrays
+    returns (numpy.array of ints of shape ..., numpy.array of ints of shape ...):
+      row and column indices of the maximum of each array
+    """
+    nr = a.shape[-2]
+    loc = a.swapaxes(-1, -2).reshape(a.shape[:-2] + (-1,)).argmax(axis=-1)
+    return loc % nr, loc // nr
 
 
-def _UpsampledDFT(data, nor, noc, precision=1, roff=0, coff=0):
+def _padSpectrum(data, nc):
+    """
+    Embeds half Fourier spectra in spectra twice larger, as if the images were
+    upsampled by a factor of 2.
+    data (numpy.array of shape ..., nr, nc // 2 + 1): half spectra, as returned
+      by rfft2()
+    nc (int): number of columns of the original images
+    returns (numpy.array of shape ..., 2 * nr, nc + 1): half spectra, to pass to
+      irfft2() with s=(2 * nr, 2 * nc)
+    """
+    nr, nhc = data.shape[-2:]
+    padded = numpy.zeros(data.shape[:-2] + (2 * nr, nc + 1), dtype=data.dtype)
+    npos = (nr + 1) // 2  # Number of non-negative frequencies
+    padded[..., :npos, :nhc] = data[..., :npos, :]
+    padded[..., 2 * nr - (nr - npos):, :nhc] = data[..., npos:, :]
+    # The Nyquist frequencies must be split in two, to keep the spectrum symmetric
+    if nr % 2 == 0:
+        padded[..., npos, :nhc] = data[..., npos, :] / 2
+        padded[..., 2 * nr - npos, :nhc] /= 2
+    if nc % 2 == 0:
+        padded[..., nhc - 1] /= 2
+    return padded
+
+
+def _UpsampledDFT(data, nor, noc, precision=1, roff=0, coff=0, nc=None):
     """
     Upsampled DFT by matrix multiplies.
-    data (numpy.array): 2d array
+    data (numpy.array of shape ..., nr, nc): 2d array, or several 2d arrays
     nor, noc (ints): Number of pixels in the output upsampled DFT, in units
     of upsampled pixels
     precision (int): Calculate drift within 1/precision of a pixel
-    roff, coff (ints): Row and column offsets, allow to shift the output array
-                    to a region of interest on the DFT
-    returns (tuple of floats): Drift in pixels
+    roff, coff (floats or numpy.array of shape ...): Row and column offsets,
+      allow to shift the output array to a region of interest on the DFT.
+      If there are several 2d arrays, there is one offset per array.
+    nc (None or int): If data is only the first half of a symmetric spectrum
+      (as returned by rfft2()), the number of columns of the complete spectrum.
+      In such case, only the real part of the DFT is returned.
+    returns (numpy.array of shape ..., nor, noc): upsampled DFT
     """
     z = 1j  # imaginary unit
-    nr, nc = data.shape
+    nr = data.shape[-2]
+    if nc is None:
+        nc = data.shape[-1]
+    roff = numpy.asarray(roff, dtype=float)[..., None, None]
+    coff = numpy.asarray(coff, dtype=float)[..., None, None]
 
-    # Compute kernels and obtain DFT by matrix products
-    kernc = numpy.power(math.e, (-z * 2 * math.pi / (nc * precision)) *
-                                ((fft.ifftshift(arange(0, nc))[:, None]).T - nc // 2) *
-                                (arange(0, noc) - coff)[:, None]
-                       )
-
-    kernr = numpy.power(math.e, (-z * 2 * math.pi / (nr * precision)) *
-                                (fft.ifftshift(arange(0, nr))[:, None] - nr // 2) *
-                                ((arange(0, nor)[:, None]).T - roff)
-                       )
+    # Frequencies of each row and column, in the FFT order
+    freqr = fft.ifftshift(arange(0, nr)) - nr // 2
+    freqc = (fft.ifftshift(arange(0, nc)) - nc // 2)[:data.shape[-1]]
 
-    return numpy.dot(numpy.dot((kernr.transpose()), data), kernc.transpose())
+    # Compute kernels and obtain DFT by matrix products
+    kernc = numpy.exp((-z * 2 * math.pi / (nc * precision)) *
+                      freqc * (arange(0, noc)[:, None] - coff))
+    kernr = numpy.exp((-z * 2 * math.pi / (nr * precision)) *
+                      freqr[:, None] * (arange(0, nor) - roff))
+
+    if data.shape[-1] < nc:
+        # The (missing) negative frequencies are the conjugates of the positive
+        # ones, so their contribution to the real part is the same
+        weights = numpy.full(data.shape[-1], 2)
+        weights[0] = 1
+        if nc % 2 == 0:
+            weights[-1] = 1
+            # The Nyquist frequency is both positive and negative
+            kernc[..., -1] = kernc[..., -1].real
+        kernc = kernc * weights
+        if nr % 2 == 0:
+            kernr[..., nr // 2, :] = kernr[..., nr // 2, :].real
+
+    dft = numpy.matmul(numpy.matmul(kernr.swapaxes(-1, -2), data), kernc.swapaxes(-1, -2))
+    if data.shape[-1] < nc:
+        return dft.real
+    return dft
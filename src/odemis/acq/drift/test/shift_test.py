@@ -25,7 +25,7 @@ import math
 from numpy import fft
 from numpy import random
 import numpy
-from odemis.acq.align.shift import MeasureShift
+from odemis.acq.align.shift import MeasureShift, ShiftEstimator
 from odemis.dataio import hdf5
 import os
 import unittest
@@ -205,5 +205,52 @@ class TestMeasureShift(unittest.TestCase):
         drift = MeasureShift(self.small_data, self.small_data_random_drifted_noisy, 10)
         numpy.testing.assert_almost_equal(drift, (self.small_deltac, self.small_deltar), 0)
 
+
+class TestShiftEstimator(unittest.TestCase):
+    """
+    Test ShiftEstimator
+    """
+
+    def setUp(self):
+        data = hdf5.read_data(os.path.join(DATA_DIR, "example_input.h5"))[0]
+        C, T, Z, Y, X = data.shape
+        data.shape = Y, X
+        self.data = data
+
+        # Same image drifted by known values (with periodic borders)
+        self.drifts = [(0, 0), (2.5, -7.3), (-20.1, 12.8), (0.7, 0.2)]  # X, Y
+        nr, nc = 128, 126  # Not a square, to check the axes
+        self.ref = self.data[200:200 + nr, 150:150 + nc]
+        fy = fft.fftfreq(nr)[:, None]
+        fx = fft.fftfreq(nc)
+        ref_fft = fft.fft2(self.ref)
+        self.imgs = [fft.ifft2(ref_fft * numpy.exp(-2j * math.pi * (fx * dx + fy * dy))).real
+                     for dx, dy in self.drifts]
+
+    def test_estimate(self):
+        for precision in (1, 10, 100):
+            est = ShiftEstimator(self.ref, precision)
+            for img, exp_drift in zip(self.imgs, self.drifts):
+                drift = est.estimate(img)
+                # Same as MeasureShift, which measures the opposite of the drift
+                self.assertEqual(drift, MeasureShift(self.ref, img, precision))
+                numpy.testing.assert_allclose(drift, numpy.negative(exp_drift), atol=0.5)
+                if precision == 100:
+                    numpy.testing.assert_allclose(drift, numpy.negative(exp_drift), atol=0.02)
+
+    def test_batch(self):
+        for precision in (1, 10):
+            est = ShiftEstimator(self.ref, precision)
+            drifts = est.estimate_batch(self.imgs)
+            self.assertEqual(drifts, [est.estimate(im) for im in self.imgs])
+            # Also works with a 3D array
+            drifts = est.estimate_batch(numpy.array(self.imgs))
+            self.assertEqual(drifts, [est.estimate(im) for im in self.imgs])
+
+        self.assertEqual(est.estimate_batch([]), [])
+        with self.assertRaises(ValueError):
+            ShiftEstimator(self.ref, 0)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -21,4 +21,4 @@ from odemis.acq.stitching._constants import REGISTER_GLOBAL_SHIFT, REGISTER_SHIF
 from odemis.acq.stitching._tiledacq import acquireTiledArea, estimateTiledAcquisitionTime, estimateTiledAcquisitionMemory
 from odemis.acq.stitching._registrar import *
 from odemis.acq.stitching._weaver import *
-from odemis.acq.stitching._simple import register, weave
+from odemis.acq.stitching._simple import register, weave, create_registrar, add_tile, update_positions
@@ -29,9 +29,11 @@ content, in other words performing "image registration".
 """
 
 from __future__ import division
+from concurrent.futures import ThreadPoolExecutor, Future
 from odemis.acq.drift import MeasureShift
 import numpy
 import math
+import multiprocessing
 from odemis import model
 import logging
 from scipy.sparse import csr_matrix
@@ -446,9 +448,25 @@ class GlobalShiftRegistrar(object):
     neighbours and performs a global optimization to find the best path connecting the tiles.
     """
 
-    def __init__(self):
+    def __init__(self, max_workers=None):
+        """
+        :param max_workers: (None or int > 0) number of threads computing the shifts
+        between the tiles. If None, one per CPU core. If 1, the shifts are computed
+        immediately when a tile is added.
+        """
         # Store all the tiles. Each cell contains either None or a DataArray
         self.tiles = [[None]]
+        # Average of each tile (id -> float), as it is needed for every neighbour
+        self._tile_avgs = {}
+
+        # The shifts with the neighbours are computed in parallel. Until they
+        # are computed, the shifts contain the Future of the computation.
+        # The executor is only created when needed, and stopped once all the
+        # shifts have been computed.
+        if max_workers is None:
+            max_workers = multiprocessing.cpu_count()
+        self._max_workers = max_workers
+        self._executor = None
 
         # Store the shifts in a data structure with shape num_rows x (num_cols - 1) x 2 for the
         # horizontal shifts and (num_cols - 1) x num_rows x 2 for the vertical shifts. The data
@@ -480,6 +498,7 @@ class GlobalShiftRegistrar(object):
         relative to main tile. Their content and metadata are not used for the computation of the final position.
         """
         row, col = self._insert_tile_to_grid(tile)
+        self._tile_avgs[id(tile)] = numpy.average(tile)
         self._compute_registration(row, col)
 
         if dependent_tiles is not None:
@@ -503,6 +522,7 @@ class GlobalShiftRegistrar(object):
         tile_positions = []
         dep_tile_positions = []
 
+        self._wait_shifts()
         self.registered_positions = self._assemble_mosaic()
         for ti in self.acq_order:
             shift = self.registered_positions[ti[0]][ti[1]]
@@ -630,8 +650,9 @@ class GlobalShiftRegistrar(object):
         else:
             t1, b1 = int(exp_shift[1]), tile.shape[0]
             t2, b2 = 0, tile.shape[0] - int(exp_shift[1])
-        prev_tile_roi = numpy.array(prev_tile)[t1:b1, l1:r1]
-        tile_roi = numpy.array(tile)[t2:b2, l2:r2]
+        # No need to copy the data, it's only read
+        prev_tile_roi = numpy.asarray(prev_tile)[t1:b1, l1:r1]
+        tile_roi = numpy.asarray(tile)[t2:b2, l2:r2]
 
         # If you need to crop the tile without changing the output shift,
         # you can do it here with the pattern tile_roi[t:-b, l:-r]
@@ -639,7 +660,7 @@ class GlobalShiftRegistrar(object):
         shift_total = numpy.subtract(exp_shift, shift)
 
         # Measure accuracy (ncc value)
-        avg = numpy.average(prev_tile), numpy.average(tile)
+        avg = self._tile_avgs[id(prev_tile)], self._tile_avgs[id(tile)]
         dist = prev_tile_roi - avg[0], tile_roi - avg[1]
         covar = numpy.sum(dist[0] * dist[1]) / prev_tile_roi.size
         var = numpy.sum(dist[0] ** 2) / prev_tile_roi.size, numpy.sum(dist[1] ** 2) / tile_roi.size
@@ -684,14 +705,48 @@ class GlobalShiftRegistrar(object):
 
         # Calculate the shifts to all adjacent tiles that have not been calculated yet
         if nbr_left is not None and not shift_left:
-            self.shifts_hor[row][col - 1] = self._get_shift(nbr_left, tile)
+            self.shifts_hor[row][col - 1] = self._start_get_shift(nbr_left, tile)
         if nbr_right is not None and not shift_right:
-            self.shifts_hor[row][col] = self._get_shift(tile, nbr_right)
+            self.shifts_hor[row][col] = self._start_get_shift(tile, nbr_right)
         if nbr_top is not None and not shift_top:
-            self.shifts_ver[row - 1][col] = self._get_shift(nbr_top, tile)
+            self.shifts_ver[row - 1][col] = self._start_get_shift(nbr_top, tile)
         if nbr_bottom is not None and not shift_bottom:
-            self.shifts_ver[row][col] = self._get_shift(tile, nbr_bottom)
-            
+            self.shifts_ver[row][col] = self._start_get_shift(tile, nbr_bottom)
+
+    def _start_get_shift(self, prev_tile, tile):
+        """
+        Starts the computation of the shift between the two tiles, in a separate
+        thread if possible.
+
+        :param prev_tile: (DataArray) static tile to which other tile is compared
+        :param tile: (DataArray) shifted tile
+        :returns: (Future or ((float, float), float)) the computation of the shift,
+        or the shift and ncc (as _get_shift()) if it's computed immediately
+        """
+        if self._max_workers <= 1:
+            return self._get_shift(prev_tile, tile)
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self._max_workers)
+        return self._executor.submit(self._get_shift, prev_tile, tile)
+
+    def _wait_shifts(self):
+        """
+        Waits for all the shifts to be computed, and stores the results
+        :updates self.shifts_hor, self.shifts_ver:
+        :raises ValueError: if the shift of some tiles couldn't be computed
+        """
+        try:
+            for shifts in (self.shifts_hor, self.shifts_ver):
+                for row in shifts:
+                    for i, s in enumerate(row):
+                        if isinstance(s, Future):
+                            row[i] = s.result()
+        finally:
+            # Stop the threads. If more tiles are added, a new executor is created.
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+                self._executor = None
+
     def _assemble_mosaic(self):
         """
         Performs a global optimization to find the best path through the tile grid using 
@@ -17,46 +17,88 @@ You should have received a copy of the GNU General Public License along with Ode
 from __future__ import division
 
 import copy
+import logging
+import numpy
 from odemis import model
 from odemis.acq.stitching._constants import REGISTER_GLOBAL_SHIFT, REGISTER_SHIFT, \
     REGISTER_IDENTITY, WEAVER_MEAN, WEAVER_COLLAGE, WEAVER_COLLAGE_REVERSE
 from odemis.acq.stitching._registrar import ShiftRegistrar, IdentityRegistrar, GlobalShiftRegistrar
 from odemis.acq.stitching._weaver import MeanWeaver, CollageWeaver, CollageWeaverReverse
+import tempfile
 
 
-def register(tiles, method=REGISTER_GLOBAL_SHIFT):
+def register(tiles, method=REGISTER_GLOBAL_SHIFT, max_workers=None):
     """
     tiles (list of DataArray of shape YX or tuples of DataArrays): The tiles to compute the registration. 
     If it's tuples, the first tile of each tuple is the “main tile”, and the following ones are 
     dependent tiles.
     method (REGISTER_*): REGISTER_SHIFT → ShiftRegistrar, REGISTER_IDENTITY → IdentityRegistrar
+    max_workers (None or int > 0): number of threads used to compute the registration
+      (only for REGISTER_GLOBAL_SHIFT). If None, one per CPU core.
     returns:
         tiles (list of DataArray of shape YX or tuples of DataArrays): The tiles as passed, but with updated 
         MD_POS metadata
     """
+    registrar = create_registrar(method, max_workers)
 
+    # Register tiles
+    for ts in tiles:
+        add_tile(registrar, ts)
+
+    # Update positions
+    return update_positions(registrar, tiles)
+
+
+def create_registrar(method=REGISTER_GLOBAL_SHIFT, max_workers=None):
+    """
+    method (REGISTER_*): REGISTER_SHIFT → ShiftRegistrar, REGISTER_IDENTITY → IdentityRegistrar,
+      REGISTER_GLOBAL_SHIFT → GlobalShiftRegistrar
+    max_workers (None or int > 0): number of threads used to compute the registration
+      (only for REGISTER_GLOBAL_SHIFT). If None, one per CPU core.
+    returns (registrar): a new registrar, to pass the tiles one at a time to add_tile()
+    """
     if method == REGISTER_SHIFT:
-        registrar = ShiftRegistrar()
+        return ShiftRegistrar()
     elif method == REGISTER_IDENTITY:
-        registrar = IdentityRegistrar()
+        return IdentityRegistrar()
     elif method == REGISTER_GLOBAL_SHIFT:
-        registrar = GlobalShiftRegistrar()
+        return GlobalShiftRegistrar(max_workers=max_workers)
     else:
         raise ValueError("Invalid registrar %s" % (method,))
 
-    # Register tiles
-    updatedTiles = []
-    for ts in tiles:
-        # Separate tile and dependent_tiles
-        if isinstance(ts, tuple):
-            tile = ts[0]
-            dep_tiles = ts[1:]
-        else:
-            tile = ts
-            dep_tiles = None
-        registrar.addTile(tile, dep_tiles)
 
-    # Update positions
+def add_tile(registrar, ts):
+    """
+    Register one more tile. It can be called as soon as the tile is acquired,
+    while the next tiles are still being acquired.
+    registrar (registrar): as returned by create_registrar()
+    ts (DataArray of shape YX or tuple of DataArrays): the tile. If it's a tuple,
+      the first tile is the “main tile”, and the following ones are dependent tiles.
+    """
+    # Separate tile and dependent_tiles
+    if isinstance(ts, tuple):
+        tile = ts[0]
+        dep_tiles = ts[1:]
+    else:
+        tile = ts
+        dep_tiles = None
+    registrar.addTile(tile, dep_tiles)
+
+
+def update_positions(registrar, tiles):
+    """
+    Compute the final position of all the tiles registered.
+    registrar (registrar): registrar to which all the tiles have been added
+    tiles (list of DataArray of shape YX or tuples of DataArrays): The tiles, in
+      the same order as they were added.
+    returns:
+        tiles (list of DataArray of shape YX or tuples of DataArrays): The tiles as passed, but with updated
+        MD_POS metadata
+    """
+    # The (global) optimisation is done only once, for all the tiles
+    tile_positions, dep_tile_positions = registrar.getPositions()
+
+    updatedTiles = []
     for i, ts in enumerate(tiles):
         # Return tuple of positions if dependent tiles are present
         if isinstance(ts, tuple):
@@ -65,20 +107,20 @@ def register(tiles, method=REGISTER_GLOBAL_SHIFT):
 
             # Update main tile
             md = copy.deepcopy(tile.metadata)
-            md[model.MD_POS] = registrar.getPositions()[0][i]
+            md[model.MD_POS] = tile_positions[i]
             tileUpd = model.DataArray(tile, md)
 
             # Update dependent tiles
             tilesNew = [tileUpd]
             for j, dt in enumerate(dep_tiles):
                 md = copy.deepcopy(dt.metadata)
-                md[model.MD_POS] = registrar.getPositions()[1][i][j]
+                md[model.MD_POS] = dep_tile_positions[i][j]
                 tilesNew.append(model.DataArray(dt, md))
             tileUpd = tuple(tilesNew)
 
         else:
             md = copy.deepcopy(ts.metadata)
-            md[model.MD_POS] = registrar.getPositions()[0][i]
+            md[model.MD_POS] = tile_positions[i]
             tileUpd = model.DataArray(ts, md)
 
         updatedTiles.append(tileUpd)
@@ -86,10 +128,13 @@ def register(tiles, method=REGISTER_GLOBAL_SHIFT):
     return updatedTiles
 
 
-def weave(tiles, method=WEAVER_MEAN):
+def weave(tiles, method=WEAVER_MEAN, max_memory=None):
     """
     tiles (list of DataArray of shape YX): The tiles to draw
     method (WEAVER_*): WEAVER_MEAN → MeanWeaver, WEAVER_COLLAGE → CollageWeaver
+    max_memory (None or int > 0): if the image is bigger (in bytes), it is
+      stored in a temporary file, mapped to memory, instead of being held in RAM.
+      Only supported by WEAVER_MEAN, which computes the image strip by strip.
     return:
         image (DataArray of shape Y'X'): A large image containing all the tiles
     """
@@ -105,6 +150,23 @@ def weave(tiles, method=WEAVER_MEAN):
 
     for t in tiles:
         weaver.addTile(t)
+
+    if max_memory is not None and hasattr(weaver, "getFullImageStrips"):
+        shape, dtype, strips, md = weaver.getFullImageStrips()
+        if numpy.prod(shape) * numpy.dtype(dtype).itemsize > max_memory:
+            logging.info("Stitched image of %s px stored in a temporary file", shape)
+            # The file is deleted as soon as it's closed, but the data stays
+            # accessible until the array is not used anymore.
+            with tempfile.TemporaryFile() as f:
+                out = numpy.memmap(f, dtype=dtype, mode="w+", shape=shape)
+        else:
+            out = numpy.empty(shape, dtype=dtype)
+        y = 0
+        for s in strips:
+            out[y:y + s.shape[0]] = s
+            y += s.shape[0]
+        return model.DataArray(out, md)
+
     stitched_image = weaver.getFullImage()
 
     return stitched_image
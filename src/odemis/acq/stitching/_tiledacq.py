@@ -19,7 +19,7 @@ Odemis. If not, see http://www.gnu.org/licenses/.
 """
 from __future__ import division
 
-from concurrent.futures import CancelledError, TimeoutError
+from concurrent.futures import CancelledError, TimeoutError, ThreadPoolExecutor
 from concurrent.futures._base import RUNNING, FINISHED, CANCELLED
 import copy
 import logging
@@ -29,7 +29,7 @@ from odemis import model, dataio
 from odemis.acq import acqmng
 from odemis.acq.align.autofocus import MeasureOpticalFocus, AutoFocus, MTD_EXHAUSTIVE
 from odemis.acq.stitching._constants import WEAVER_MEAN, REGISTER_IDENTITY, REGISTER_GLOBAL_SHIFT
-from odemis.acq.stitching._simple import register, weave
+from odemis.acq.stitching._simple import register, weave, create_registrar, add_tile, update_positions
 from odemis.acq.stream import Stream, SEMStream, CameraStream, RepetitionStream, EMStream, ARStream, \
     SpectrumStream, FluoStream, MultipleDetectorStream, util, executeAsyncTask, \
     CLStream
@@ -53,6 +53,14 @@ SKIP_TILES = 3
 
 MOVE_SPEED_DEFAULT = 100e-6  # m/s
 
+# Number of threads to process the tiles (focus measurement, saving to disk),
+# while the stage moves to the next tile
+MAX_POSTPROCESS_THREADS = 2
+
+# Stitched images bigger than this (in bytes) are stored in a temporary file,
+# instead of RAM (only with the weavers computing the image strip by strip)
+MAX_STITCH_MEMORY = 512 * 2 ** 20
+
 
 class TiledAcquisitionTask(object):
     """
@@ -60,7 +68,7 @@ class TiledAcquisitionTask(object):
     """
 
     def __init__(self, streams, stage, area, overlap, settings_obs=None, log_path=None, future=None, zlevels=None,
-                 registrar=REGISTER_GLOBAL_SHIFT, weaver=WEAVER_MEAN):
+                 registrar=REGISTER_GLOBAL_SHIFT, weaver=WEAVER_MEAN, pipelined=False):
         """
         :param streams: (Stream) the streams to acquire
         :param stage: (Actuator) the sample stage to move to the possible tiles locations
@@ -73,6 +81,11 @@ class TiledAcquisitionTask(object):
         :param zlevels: (list(float) or None) focus z positions required zstack acquisition
         :param registrar: (REGISTER_*) type of registration method
         :param weaver: (WEAVER_*) type of weaving method
+        :param pipelined: (bool) if True, the stage starts moving to the next tile
+          as soon as a tile is acquired, while the tile is processed. In this
+          case, the focus is measured while moving, and if a tile is out of focus,
+          the autofocus is run before acquiring the next tile (instead of
+          acquiring the tile again).
         """
         self._future = future
         self._streams = streams
@@ -145,6 +158,19 @@ class TiledAcquisitionTask(object):
         self._registrar = registrar
         self._weaver = weaver
 
+        # The tiles are registered in a separate thread, while the next tiles
+        # are acquired. Only one thread, as they must be registered in order.
+        self._registration_executor = None
+        self._registration_futures = []
+        self._tiles_registrar = None  # registrar, created when starting the acquisition
+        self._registration_error = None  # ValueError, if the registration failed
+
+        # Processing of the tiles (focus measurement, saving to disk), which
+        # can be done while the stage moves to the next tile
+        self._pipelined = pipelined
+        self._postprocess_executor = None
+        self._focus_measurement = None  # (int, Future -> float or None): tile index, focus level
+
     def _getFov(self, sd):
         """
         sd (Stream or DataArray): If it's a stream, it must be a live stream,
@@ -243,6 +269,17 @@ class TiledAcquisitionTask(object):
         :param prev_idx: (tuple (float, float)) previous index of tile
         :param tile_size: (tuple (float, float)) total tile size
         """
+        move = self._startMoveToTile(idx, prev_idx, tile_size)
+        self._waitMoveToTile(*move)
+
+    def _startMoveToTile(self, idx, prev_idx, tile_size):
+        """
+        Start moving the stage to the tile position, without waiting for the
+        move to be over.
+        Parameters are the same as _moveToTile()
+        :returns: (Future, tuple (float, float), float) the move, the index of
+          the tile, and the maximum time the move should take (in s)
+        """
         overlap = 1 - self._overlap
         # don't move on the axis that is not supposed to have changed
         m = {}
@@ -253,17 +290,27 @@ class TiledAcquisitionTask(object):
             m["y"] = self._starting_pos["y"] - idx[1] * tile_size[1] * overlap
 
         logging.debug("Moving to tile %s at %s m", idx, m)
-        self._future.running_subf = self._stage.moveAbs(m)
+        f = self._stage.moveAbs(m)
+        self._future.running_subf = f
+        # Don't wait forever for the stage to move: guess the time it should
+        # take and then give a large margin
+        t = math.hypot(abs(idx_change[0]) * tile_size[0] * overlap,
+                       abs(idx_change[1]) * tile_size[1] * overlap) / self._move_speed
+        t = 5 * t + 1  # s
+        return f, idx, t
+
+    def _waitMoveToTile(self, f, idx, timeout):
+        """
+        Wait for the stage to reach the tile position
+        :param f: (Future) the move, as returned by _startMoveToTile()
+        :param idx: (tuple (float, float)) index of the tile
+        :param timeout: (float) maximum time to wait (in s)
+        """
         try:
-            # Don't wait forever for the stage to move: guess the time it should
-            # take and then give a large margin
-            t = math.hypot(abs(idx_change[0]) * tile_size[0] * overlap,
-                           abs(idx_change[1]) * tile_size[1] * overlap) / self._move_speed
-            t = 5 * t + 1  # s
-            self._future.running_subf.result(t)
+            f.result(timeout)
         except TimeoutError:
-            logging.warning("Failed to move to tile %s within %s s", idx, t)
-            self._future.running_subf.cancel()
+            logging.warning("Failed to move to tile %s within %s s", idx, timeout)
+            f.cancel()
             # Continue acquiring anyway... maybe it has moved somewhere near
 
     def _sortDAs(self, das, ss):
@@ -405,15 +452,36 @@ class TiledAcquisitionTask(object):
         return mem_sufficient, mem_est
 
     STITCH_SPEED = 1e8  # px/s
+    FOCUS_SPEED = 5e7  # px/s, to measure the focus level of a tile
+    SAVE_SPEED = 5e7  # px/s, to save a tile to disk
+
+    def _estimateTileProcessingTime(self, i, tile_pxs):
+        """
+        Estimates the duration of the processing of a tile (focus measurement
+        and saving to disk), not counting the registration.
+        :param i: (int) index of the tile
+        :param tile_pxs: (int) number of pixels of the tile (all streams)
+        :returns: (float) estimated required time (in s)
+        """
+        t = 0
+        if self._focus_stream and i % SKIP_TILES == 0:
+            t += self._estimateStreamPixels(self._focus_stream) / self.FOCUS_SPEED
+        if self._log_path:
+            t += tile_pxs / self.SAVE_SPEED
+        return t
 
     def estimateTime(self, remaining=None):
         """
         Estimates duration for acquisition and stitching.
+        In serial mode, each tile is moved to, acquired, and then processed.
+        In pipelined mode, the processing of a tile is done while moving to the
+        next one, and the registration of the tiles while acquiring the next ones.
         :param remaining: (int > 0) The number of remaining tiles
         :returns: (float) estimated required time
         """
+        ntiles = self._nx * self._ny
         if remaining is None:
-            remaining = self._nx * self._ny
+            remaining = ntiles
 
         acq_time = 0
         for stream in self._streams:
@@ -431,14 +499,30 @@ class TiledAcquisitionTask(object):
                 if pxs > max_pxs:
                     max_pxs = pxs
 
-        stitch_time = (self._nx * self._ny * max_pxs * self._overlap) / self.STITCH_SPEED
         try:
-            move_time = max(self._guessSmallestFov(self._streams)) * (remaining - 1) / self._move_speed
-            # current tile is part of remaining, so no need to move there
+            tile_move_time = max(self._guessSmallestFov(self._streams)) / self._move_speed
         except ValueError:  # no current streams
-            move_time = 0.5
+            tile_move_time = 0.5
+
+        tile_pxs = sum(self._estimateStreamPixels(s) for s in self._streams)
+        # Time for moving to the next tile and processing each of the remaining
+        # tiles. After the last tile, there is no move.
+        move_process_time = 0
+        for i in range(ntiles - remaining, ntiles):
+            process_time = self._estimateTileProcessingTime(i, tile_pxs)
+            move_time = tile_move_time if i < ntiles - 1 else 0
+            if self._pipelined:
+                move_process_time += max(move_time, process_time)
+            else:
+                move_process_time += move_time + process_time
 
-        return acq_time * remaining + move_time + stitch_time
+        if self._pipelined:
+            # Only the last tile is left to register once all tiles are acquired
+            stitch_time = (max_pxs * self._overlap) / self.STITCH_SPEED
+        else:
+            stitch_time = (ntiles * max_pxs * self._overlap) / self.STITCH_SPEED
+
+        return acq_time * remaining + move_process_time + stitch_time
 
     def _save_tiles(self, ix, iy, das, stream_cube_id=None):
         """
@@ -455,7 +539,10 @@ class TiledAcquisitionTask(object):
             self._exporter.export(os.path.join(self._log_dir, fn_tile), das)
 
         # Run in a separate thread
-        threading.Thread(target=save_tile, args=(ix, iy, das, stream_cube_id), ).start()
+        if self._postprocess_executor:
+            self._postprocess_executor.submit(save_tile, ix, iy, das, stream_cube_id)
+        else:
+            threading.Thread(target=save_tile, args=(ix, iy, das, stream_cube_id), ).start()
 
     def _acquireStreamCompressedZStack(self, i, ix, iy, stream):
         """
@@ -530,13 +617,27 @@ class TiledAcquisitionTask(object):
          Acquire needed tiles by moving the stage to the tile position then calling acqmng.acquire
         :return: (list of list of DataArrays): list of acquired data for each stream on each tile
         """
-        da_list = []  # for each position, a list of DataArrays
-        prev_idx = [0, 0]
-        i = 0
+        self._startRegistration()
+        self._postprocess_executor = ThreadPoolExecutor(max_workers=MAX_POSTPROCESS_THREADS)
+        self._focus_measurement = None
         # Make sure to begin from starting position
         self._future.running_subf = self._stage.moveAbs(self._starting_pos)
         self._future.running_subf.result()
 
+        if self._pipelined:
+            return self._acquireTilesPipelined()
+        else:
+            return self._acquireTilesSerial()
+
+    def _acquireTilesSerial(self):
+        """
+        Acquire the tiles one after another: move to the tile, acquire it, and
+        check its focus.
+        :return: (list of list of DataArrays): list of acquired data for each stream on each tile
+        """
+        da_list = []  # for each position, a list of DataArrays
+        prev_idx = [0, 0]
+        i = 0
         for ix, iy in self._generateScanningIndices((self._nx, self._ny)):
             logging.debug("Acquiring tile %dx%d", ix, iy)
             self._moveToTile((ix, iy), prev_idx, self._sfov)
@@ -552,50 +653,216 @@ class TiledAcquisitionTask(object):
                 # Adjust focus of current tile and reacquire image
                 das = self._adjustFocus(das, i, ix, iy)
 
-            # Save the das on disk if an log path exists
-            if self._log_path:
-                self._save_tiles(ix, iy, das)
+            self._processTile(ix, iy, das, da_list)
+            i += 1
+        return da_list
+
+    def _acquireTilesPipelined(self):
+        """
+        Acquire the tiles in a pipeline: as soon as a tile is acquired, the
+        stage starts moving to the next tile, and meanwhile the tile is processed.
+        :return: (list of list of DataArrays): list of acquired data for each stream on each tile
+        """
+        da_list = []  # for each position, a list of DataArrays
+        indices = list(self._generateScanningIndices((self._nx, self._ny)))
+        move = self._startMoveToTile(indices[0], (0, 0), self._sfov)
+        for i, (ix, iy) in enumerate(indices):
+            self._waitMoveToTile(*move)
+            if self._focus_stream:
+                # Adjust focus, if the previous tile was out of focus
+                self._adjustFocusFromMeasurement(i)
 
-            # Sort tiles (largest sem on first position)
-            da_list.append(self._sortDAs(das, self._streams))
+            logging.debug("Acquiring tile %dx%d", ix, iy)
+            das = self._getTileDAs(i, ix, iy)
+
+            if i == 0:
+                # Check the FoV is correct using the data, and if not update
+                self._sfov = self._updateFov(das, self._sfov)
+
+            if i + 1 < len(indices):
+                move = self._startMoveToTile(indices[i + 1], (ix, iy), self._sfov)
+
+            if self._focus_stream:
+                if i % SKIP_TILES == 0:
+                    # Measure the focus while moving, to correct it for the next tile
+                    f = self._postprocess_executor.submit(self._measureFocus, das)
+                    self._focus_measurement = i, f
+                else:
+                    logging.debug("Skipping focus adjustment..")
+
+            self._processTile(ix, iy, das, da_list)
 
-            i += 1
         return da_list
 
-    def _adjustFocus(self, das, i, ix, iy):
-        if i % SKIP_TILES != 0:
-            logging.debug("Skipping focus adjustment..")
-            return das
+    def _processTile(self, ix, iy, das, da_list):
+        """
+        Save the tile (if requested), and queue it for registration
+        :param das: (list of DataArrays) the data of each stream of the tile
+        :param da_list: (list of tuples of DataArrays) the tiles acquired so far.
+          The (sorted) tile is appended to it.
+        """
+        # Save the das on disk if an log path exists
+        if self._log_path:
+            self._save_tiles(ix, iy, das)
+
+        # Sort tiles (largest sem on first position)
+        da_list.append(self._sortDAs(das, self._streams))
+
+        # Register the tile while the next tiles are acquired
+        f = self._registration_executor.submit(self._registerTile, da_list[-1])
+        self._registration_futures.append(f)
+
+    def _stopPostprocessing(self):
+        """
+        Release the threads processing the tiles. The tiles being saved are
+        still written to disk.
+        """
+        if self._postprocess_executor is None:
+            return
+        self._postprocess_executor.shutdown(wait=False)
+        self._postprocess_executor = None
+        self._focus_measurement = None
+
+    def _startRegistration(self):
+        """
+        Prepare the registration of the tiles, as they are acquired
+        """
+        self._registration_error = None
+        try:
+            self._tiles_registrar = create_registrar(self._registrar)
+        except ValueError as ex:
+            self._registration_error = ex
+        self._registration_futures = []
+        self._registration_executor = ThreadPoolExecutor(max_workers=1)
+
+    def _stopRegistration(self):
+        """
+        Cancel the registration of the tiles not yet registered, and release the thread
+        """
+        if self._registration_executor is None:
+            return
+        for f in self._registration_futures:
+            f.cancel()
+        self._registration_executor.shutdown(wait=False)
+        self._registration_executor = None
+
+    def _registerTile(self, ts):
+        """
+        Add a tile to the registrar. Runs in the registration thread.
+        :param ts: (tuple of DataArrays) the DataArrays of a tile, as sorted by _sortDAs()
+        """
+        if self._registration_error is not None:
+            return  # Registration already failed, no need to go further
+        try:
+            add_tile(self._tiles_registrar, ts)
+        except ValueError as ex:
+            self._registration_error = ex
+
+    def _getRegisteredTiles(self, da_list):
+        """
+        Wait for all the tiles to be registered, and compute their final position
+        :param da_list: (list of tuples of DataArrays) the tiles, in the acquisition order
+        :return: (list of tuples of DataArrays) the tiles with updated MD_POS
+        :raise ValueError: if the registration failed
+        """
+        if self._tiles_registrar is None:  # Tiles not registered during the acquisition
+            return register(da_list, method=self._registrar)
+
+        for f in self._registration_futures:
+            f.result()
+        if self._registration_error is not None:
+            raise self._registration_error
+        # Only the global optimisation is left
+        return update_positions(self._tiles_registrar, da_list)
+
+    def _measureFocus(self, das):
+        """
+        Measure the focus level of a tile.
+        :param das: (list of DataArrays) the data of each stream of the tile
+        :returns: (float or None) the focus level, or None if it couldn't be measured
+        """
         try:
-            current_focus_level = MeasureOpticalFocus(das[self._streams.index(self._focus_stream)])
+            return MeasureOpticalFocus(das[self._streams.index(self._focus_stream)])
         except IndexError:
             logging.warning("Failed to get image to measure focus on.")
-            return das
+            return None
+
+    def _isOutOfFocus(self, i, focus_level):
+        """
+        Check whether the focus level got worse than permitted
+        :param i: (int) index of the tile on which the focus level was measured.
+          The focus level of the first tile is used as reference.
+        :param focus_level: (float) the focus level, as measured by _measureFocus()
+        :returns: (bool) True if the tile is out of focus
+        """
         if i == 0:
             # Use initial optical focus level to be compared to next tiles
             # TODO: instead of using the first image, use the best 10% images (excluding outliers)
-            self._good_focus_level = current_focus_level
+            self._good_focus_level = focus_level
+        return abs(focus_level - self._good_focus_level) / self._good_focus_level > FOCUS_FIDELITY
+
+    def _runAutoFocus(self, i):
+        """
+        Run the autofocus, and wait for it to be over
+        :param i: (int) index of the tile for which the autofocus is run
+        :returns: (bool) True if the autofocus succeeded
+        :raises CancelledError: if the acquisition was cancelled
+        """
+        try:
+            self._future.running_subf = AutoFocus(self._focus_stream.detector,
+                                                  self._focus_stream.emitter,
+                                                  self._focus_stream.focuser,
+                                                  good_focus=self._good_focus,
+                                                  rng_focus=self._focus_rng,
+                                                  method=MTD_EXHAUSTIVE)
+            self._future.running_subf.result()  # blocks until autofocus is finished
+            if self._future._task_state == CANCELLED:
+                raise CancelledError()
+        except CancelledError:
+            raise
+        except Exception as ex:
+            logging.exception("Running autofocus failed on image i= %s." % i)
+            return False
+        return True
+
+    def _adjustFocus(self, das, i, ix, iy):
+        """
+        Check the focus of a tile, and if it's out of focus, run the autofocus
+        and acquire the tile again.
+        :param das: (list of DataArrays) the data of each stream of the tile
+        :returns: (list of DataArrays) the data of the tile, acquired again if
+          it was out of focus
+        """
+        if i % SKIP_TILES != 0:
+            logging.debug("Skipping focus adjustment..")
+            return das
+        current_focus_level = self._measureFocus(das)
+        if current_focus_level is None:
+            return das
         # Run autofocus if current focus got worse than permitted deviation
-        if abs(current_focus_level - self._good_focus_level) / self._good_focus_level > FOCUS_FIDELITY:
-            try:
-                self._future.running_subf = AutoFocus(self._focus_stream.detector,
-                                                      self._focus_stream.emitter,
-                                                      self._focus_stream.focuser,
-                                                      good_focus=self._good_focus,
-                                                      rng_focus=self._focus_rng,
-                                                      method=MTD_EXHAUSTIVE)
-                self._future.running_subf.result()  # blocks until autofocus is finished
-                if self._future._task_state == CANCELLED:
-                    raise CancelledError()
-            except CancelledError:
-                raise
-            except Exception as ex:
-                logging.exception("Running autofocus failed on image i= %s." % i)
-            else:
-                # Reacquire the out of focus tile (which should be corrected now)
-                das = self._getTileDAs(i, ix, iy)
+        if self._isOutOfFocus(i, current_focus_level) and self._runAutoFocus(i):
+            # Reacquire the out of focus tile (which should be corrected now)
+            das = self._getTileDAs(i, ix, iy)
         return das
 
+    def _adjustFocusFromMeasurement(self, i):
+        """
+        Run the autofocus if the focus measured on a previous tile (while
+        moving to the current one) got worse than permitted. Used in pipelined mode.
+        :param i: (int) index of the tile about to be acquired
+        """
+        if self._focus_measurement is None:
+            return
+        fi, f = self._focus_measurement
+        self._focus_measurement = None
+        current_focus_level = f.result()
+        if current_focus_level is None:
+            return
+        if self._isOutOfFocus(fi, current_focus_level):
+            logging.debug("Focus level of tile %d is %s, will run autofocus before tile %d",
+                          fi, current_focus_level, i)
+            self._runAutoFocus(i)
+
     def _stitchTiles(self, da_list):
         """
         Stitch the acquired tiles to create a complete view of the required total area
@@ -604,9 +871,8 @@ class TiledAcquisitionTask(object):
         st_data = []
         logging.info("Computing big image out of %d images", len(da_list))
 
-        # TODO: Do this registration step in a separate thread while acquiring
         try:
-            das_registered = register(da_list, method=self._registrar)
+            das_registered = self._getRegisteredTiles(da_list)
         except ValueError as exp:
             logging.warning("Registration with %s failed %s. Retrying with identity registrar.", self._registrar, exp)
             das_registered = register(da_list, method=REGISTER_IDENTITY)
@@ -618,10 +884,10 @@ class TiledAcquisitionTask(object):
                 streams = []
                 for da in das_registered:
                     streams.append(da[s])
-                da = weave(streams, self._weaver)
+                da = weave(streams, self._weaver, max_memory=MAX_STITCH_MEMORY)
                 st_data.append(da)
         else:
-            da = weave(das_registered, self._weaver)
+            da = weave(das_registered, self._weaver, max_memory=MAX_STITCH_MEMORY)
             st_data.append(da)
         return st_data
 
@@ -662,6 +928,8 @@ class TiledAcquisitionTask(object):
             self._future.running_subf.cancel()
         finally:
             logging.info("Tiled acquisition ended")
+            self._stopRegistration()
+            self._stopPostprocessing()
             self._stage.moveAbs(self._starting_pos)
             with self._future._task_lock:
                 self._future._task_state = FINISHED
@@ -691,7 +959,7 @@ def estimateTiledAcquisitionMemory(*args, **kwargs):
 
 
 def acquireTiledArea(streams, stage, area, overlap=0.2, settings_obs=None, log_path=None, zlevels=None,
-                     registrar=REGISTER_GLOBAL_SHIFT, weaver=WEAVER_MEAN):
+                     registrar=REGISTER_GLOBAL_SHIFT, weaver=WEAVER_MEAN, pipelined=False):
     """
     Start a tiled acquisition task for the given streams (SEM or FM) in order to
     build a complete view of the TEM grid. Needed tiles are first acquired for
@@ -705,6 +973,10 @@ def acquireTiledArea(streams, stage, area, overlap=0.2, settings_obs=None, log_p
         that should be saved as metadata
     :param log_path: (string) directory and filename pattern to save acquired images for debugging
     :param zlevels: (list(float) or None) focus z positions required zstack acquisition
+    :param registrar: (REGISTER_*) type of registration method
+    :param weaver: (WEAVER_*) type of weaving method
+    :param pipelined: (bool) if True, move to the next tile while processing
+      the current one. See TiledAcquisitionTask.
     :return: (ProgressiveFuture) an object that represents the task, allow to
         know how much time before it is over and to cancel it. It also permits
         to receive the result of the task, which is a list of model.DataArray:
@@ -716,7 +988,7 @@ def acquireTiledArea(streams, stage, area, overlap=0.2, settings_obs=None, log_p
     future._task_lock = threading.Lock()
     # Create a tiled acquisition task
     task = TiledAcquisitionTask(streams, stage, area, overlap, settings_obs, log_path, future=future, zlevels=zlevels,
-                                registrar=registrar, weaver=weaver)
+                                registrar=registrar, weaver=weaver, pipelined=pipelined)
     future.task_canceller = task._cancelAcquisition  # let the future cancel the task
     # Estimate memory and check if it's sufficient to decide on running the task
     mem_sufficient, mem_est = task.estimateMemory()
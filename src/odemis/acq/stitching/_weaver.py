@@ -34,6 +34,10 @@ from odemis.util import img
 # directly copy the image already transformed.
 # TODO: handle higher dimensions by just copying them as-is
 
+# Number of rows of the full image computed at once (by the weavers which support it)
+STRIP_HEIGHT = 1024
+
+
 class Weaver(with_metaclass(ABCMeta, object)):
     """
     Abstract class representing a weaver.
@@ -276,12 +280,84 @@ class MeanWeaver(Weaver):
     """
     Pixels of the final image which are corresponding to several tiles are computed as an 
     average of the pixel of each tile.
+    The full image is computed strip by strip, so that only the tiles and the
+    output image need to be held in memory. The strips can also be directly
+    written to a file (see getFullImageStrips()).
+    Note: the brightness adjustment (adjust_brightness) is not applied.
     """
 
+    def __init__(self, adjust_brightness=False):
+        super(MeanWeaver, self).__init__(adjust_brightness)
+        # Weights and temporary buffers are shared between all the tiles of the same shape
+        self._weights = {}  # shape -> (ndarray of float, ndarray of float): weights, 1 - weights
+        self._buffers = {}  # shape -> (ndarray of float, ndarray of float): same shape as the tile
+
     def getFullImage(self):
         """
         return (2D DataArray): same dtype as the tiles, with shape corresponding to the bounding box. 
         """
+        shape, md, layout = self._computeLayout()
+        out = numpy.empty(shape, dtype=self.tiles[0].dtype)
+
+        # The strips are directly computed inside the output array
+        for _ in self._iterStrips(shape, layout, out, STRIP_HEIGHT):
+            pass
+
+        return model.DataArray(out, md)
+
+    def getFullImageStrips(self, max_height=STRIP_HEIGHT):
+        """
+        Assembles the tiles into a large image, which is returned strip by strip.
+        This allows to write the image to a file (eg, with tiff.export_strips()
+        or a numpy.memmap) without ever holding it in memory.
+        max_height (int > 0): maximum number of rows in each strip
+        return:
+            shape (int, int): shape of the full image (YX)
+            dtype (numpy.dtype): same dtype as the tiles
+            strips (iterator of 2D ndarray): all the rows of the full image, in order
+            md (dict): metadata of the full image
+        """
+        shape, md, layout = self._computeLayout()
+        strips = self._iterStrips(shape, layout, None, max_height)
+        return shape, self.tiles[0].dtype, strips, md
+
+    def _getWeights(self, shape):
+        """
+        Create (or reuse) the weight matrix of a tile, with decreasing values from its center.
+        shape (int, int): shape of the tile
+        return (ndarray of float, ndarray of float): weights, and 1 - weights
+        """
+        try:
+            return self._weights[shape]
+        except KeyError:
+            pass
+
+        hh, hw = shape[0] / 2, shape[1] / 2  # half-height, half-width
+        x = numpy.linspace(-hw, hw, shape[1])
+        y = numpy.linspace(-hh, hh, shape[0])
+        xx, yy = numpy.meshgrid((x / hw) ** 6, (y / hh) ** 6)
+        w = numpy.maximum(xx, yy)
+        # Hardcoding a weight function is quite arbitrary and might result in
+        # suboptimal solutions in some cases.
+        # Alternatively, different weights might be used. One option would be to select
+        # a fixed region on the sides of the image, e.g. 20% (expected overlap), and
+        # only apply a (linear) gradient to these parts, while keeping the new tile for the
+        # rest of the region. However, this approach does not solve the hardcoding problem
+        # since the overlap region is still arbitrary. Future solutions might adaptively
+        # select the this region.
+        self._weights[shape] = w, 1 - w
+        self._buffers[shape] = numpy.empty(shape), numpy.empty(shape)
+        return self._weights[shape]
+
+    def _computeLayout(self):
+        """
+        Compute the position of each tile in the full image.
+        return:
+            shape (int, int): shape of the full image (YX)
+            md (dict): metadata of the full image
+            layout (list of 4 int, number): bounding-box of each tile in pixels
+              (ltrb), and background value
+        """
         tiles = self.tiles
 
         # Compute the bounding box of each tile and the global bounding box
@@ -327,6 +403,34 @@ class MeanWeaver(Weaver):
             # Overlap > 50% or missing tiles
             logging.warning("Global area much bigger than sum of tile areas")
 
+        # Update metadata
+        # TODO: check this is also correct based on lt + half shape * pxs
+        c_phy = ((gbbx_phy[0] + gbbx_phy[2]) / 2,
+                 (gbbx_phy[1] + gbbx_phy[3]) / 2)
+        md = tiles[0].metadata.copy()
+        md[model.MD_POS] = c_phy
+        md[model.MD_DIMS] = "YX"
+
+        shape = gbbx_px[-1], gbbx_px[-2]
+        logging.debug("Generating global image of size %dx%d px",
+                      gbbx_px[-2], gbbx_px[-1])
+        # Use minimum of the values in the tiles for background
+        bg = min(numpy.amin(t) for t in tiles)
+        return shape, md, (tbbx_px, bg)
+
+    def _iterStrips(self, shape, layout, out, max_height):
+        """
+        Weave the tiles, one strip of the full image at a time. As every pixel
+        only depends on the tiles overlapping it, in the order they were added,
+        the result is the same as weaving the whole image at once.
+        shape (int, int): shape of the full image
+        layout: as returned by _computeLayout()
+        out (None or 2D ndarray): if not None, the strips are computed inside this array
+        max_height (int > 0): maximum number of rows in each strip
+        yields (2D ndarray): each strip, in order
+        """
+        tiles = self.tiles
+        tbbx_px, bg = layout
         # Weave tiles by using a smooth gradient. The part of the tile that does not overlap
         # with any previous tiles is inserted into the part of the
         # ovv image that is still empty. This part is determined by a mask, which indicates
@@ -343,58 +447,45 @@ class MeanWeaver(Weaver):
         # complementary weights (1 -  weights) and the weighted overlapping parts of the new tile and
         # the ovv image are added, so the resulting image contains a gradient in the overlapping regions
         # between all the tiles that have been inserted before and the newly inserted tile.
-
-        # Paste each tile
-        logging.debug("Generating global image of size %dx%d px",
-                      gbbx_px[-2], gbbx_px[-1])
-        im = numpy.empty((gbbx_px[-1], gbbx_px[-2]), dtype=tiles[0].dtype)
-        # Use minimum of the values in the tiles for background
-        im[:] = numpy.amin(tiles)
-
-        # The mask is multiplied with the tile, thereby creating a tile with a gradient
-        mask = numpy.zeros((gbbx_px[-1], gbbx_px[-2]), dtype=numpy.bool)
-
-        for b, t in zip(tbbx_px, tiles):
-            # Part of image overlapping with tile
-            roi = im[b[1]:b[1] + t.shape[0], b[0]:b[0] + t.shape[1]]
-            moi = mask[b[1]:b[1] + t.shape[0], b[0]:b[0] + t.shape[1]]
-
-            if self.adjust_brt:
-                self._adjust_brightness(t, tiles)
-            # Insert image at positions that are still empty
-            roi[~moi] = t[~moi]
-
-            # Create gradient in overlapping region. Ratio between old image and new tile values determined by
-            # distance to the center of the tile
-
-            # Create weight matrix with decreasing values from its center that
-            # has the same size as the tile.
-            sz = numpy.array(roi.shape)
-            hh, hw = sz / 2  # half-height, half-width
-            x = numpy.linspace(-hw, hw, sz[1])
-            y = numpy.linspace(-hh, hh, sz[0])
-            xx, yy = numpy.meshgrid((x / hw) ** 6, (y / hh) ** 6)
-            w = numpy.maximum(xx, yy)
-            # Hardcoding a weight function is quite arbitrary and might result in
-            # suboptimal solutions in some cases.
-            # Alternatively, different weights might be used. One option would be to select
-            # a fixed region on the sides of the image, e.g. 20% (expected overlap), and
-            # only apply a (linear) gradient to these parts, while keeping the new tile for the
-            # rest of the region. However, this approach does not solve the hardcoding problem
-            # since the overlap region is still arbitrary. Future solutions might adaptively
-            # select the this region.
-
-            # Use weights to create gradient in overlapping region
-            roi[moi] = (t * (1 - w))[moi] + (roi * w)[moi]
-
-            # Update mask
-            mask[b[1]:b[1] + t.shape[0], b[0]:b[0] + t.shape[1]] = True
-
-        # Update metadata
-        # TODO: check this is also correct based on lt + half shape * pxs
-        c_phy = ((gbbx_phy[0] + gbbx_phy[2]) / 2,
-                 (gbbx_phy[1] + gbbx_phy[3]) / 2)
-        md = tiles[0].metadata.copy()
-        md[model.MD_POS] = c_phy
-        md[model.MD_DIMS] = "YX"
-        return model.DataArray(im, md)
+        for y0 in range(0, shape[0], max_height):
+            y1 = min(y0 + max_height, shape[0])
+            if out is None:
+                strip = numpy.empty((y1 - y0, shape[1]), dtype=tiles[0].dtype)
+            else:
+                strip = out[y0:y1]
+            strip[...] = bg
+            # Parts of the strip which already contain image data
+            mask = numpy.zeros(strip.shape, dtype=bool)
+
+            for b, t in zip(tbbx_px, tiles):
+                # Rows of the tile inside the strip
+                ty0, ty1 = max(b[1], y0), min(b[3], y1)
+                if ty0 >= ty1:
+                    continue
+                rows = slice(ty0 - b[1], ty1 - b[1])
+                tr = t[rows]
+
+                # Part of image overlapping with tile
+                roi = strip[ty0 - y0:ty1 - y0, b[0]:b[2]]
+                moi = mask[ty0 - y0:ty1 - y0, b[0]:b[2]]
+                if moi.any():
+                    # Create gradient in overlapping region. Ratio between old image and new tile values determined by
+                    # distance to the center of the tile
+                    w, wc = self._getWeights(t.shape)
+                    buf0, buf1 = self._buffers[t.shape]
+                    tw, rw = buf0[rows], buf1[rows]
+                    numpy.multiply(tr, wc[rows], out=tw)
+                    numpy.multiply(roi, w[rows], out=rw)
+                    tw += rw
+                    # Use weights to create gradient in overlapping region
+                    numpy.copyto(roi, tw, casting="unsafe", where=moi)
+                    # Insert image at positions that are still empty
+                    numpy.logical_not(moi, out=moi)
+                    numpy.copyto(roi, tr, casting="unsafe", where=moi)
+                else:  # Everything is still empty
+                    numpy.copyto(roi, tr, casting="unsafe")
+
+                # Update mask
+                moi[...] = True
+
+            yield strip
@@ -699,6 +699,26 @@ class TestGlobalShiftRegistrar(unittest.TestCase):
                         "Position %s pxs off for image '%s', " % (max(diff.flatten()) / px_size[0], img_name) +
                         "%s x %s tiles, %s ovlp, %s method." % (num, num, o, a))
 
+    def test_parallel(self):
+        """ Computing the shifts in parallel gives the same positions as sequentially """
+        conv = find_fittest_converter(IMGS[1])
+        data = ensure2DImage(conv.read_data(IMGS[1])[0])
+        tiles, real_pos = decompose_image(data, 0.2, 4, "horizontalZigzag")
+
+        all_pos = []
+        for workers in (1, 4):
+            registrar = GlobalShiftRegistrar(max_workers=workers)
+            for tile in tiles:
+                registrar.addTile(tile)
+            all_pos.append(registrar.getPositions()[0])
+            # The threads are stopped once all the shifts are known
+            self.assertIsNone(registrar._executor)
+
+        numpy.testing.assert_array_equal(all_pos[0], all_pos[1])
+        px_size = tiles[0].metadata[model.MD_PIXEL_SIZE]
+        diff = numpy.absolute(numpy.subtract(all_pos[1], real_pos))
+        self.assertTrue(numpy.all(diff < numpy.multiply(px_size, 5)), "Positions off by %s" % (diff,))
+
     def test_shift_real_manual(self):
         """ Test case not generated by decompose.py file and manually cropped """
 
@@ -26,7 +26,10 @@ import copy
 import numpy
 from odemis import model
 import odemis
-from odemis.acq.stitching import register, weave, REGISTER_IDENTITY, REGISTER_SHIFT, WEAVER_COLLAGE, WEAVER_MEAN
+from odemis.acq.stitching import register, weave, REGISTER_IDENTITY, REGISTER_SHIFT, WEAVER_COLLAGE, WEAVER_MEAN, \
+    create_registrar, add_tile, update_positions, REGISTER_GLOBAL_SHIFT
+from odemis.acq.stitching import _tiledacq
+from odemis.acq.stitching._tiledacq import TiledAcquisitionTask
 from odemis.dataio import find_fittest_converter
 from odemis.util.img import ensure2DImage
 import os
@@ -82,6 +85,113 @@ class TestRegister(unittest.TestCase):
                 self.assertAlmostEqual(calculatedPosition[0], pos[i][0], places=1)
                 self.assertAlmostEqual(calculatedPosition[1], pos[i][1], places=1)
 
+    def test_incremental(self):
+        """
+        Test registering the tiles one at a time finds their actual positions
+        """
+        img = ensure2DImage(find_fittest_converter(IMGS[1]).read_data(IMGS[1])[0])
+        [tiles, pos] = decompose_image(img, 0.2, 3, "horizontalZigzag")
+        all_tiles = [(t, t) for t in tiles]
+
+        registrar = create_registrar(REGISTER_GLOBAL_SHIFT)
+        for ts in all_tiles:
+            add_tile(registrar, ts)
+        upd_tiles = update_positions(registrar, all_tiles)
+
+        self.assertEqual(len(upd_tiles), len(all_tiles))
+        for ts, p in zip(upd_tiles, pos):
+            for t in ts:
+                self.assertAlmostEqual(t.metadata[model.MD_POS][0], p[0], places=1)
+                self.assertAlmostEqual(t.metadata[model.MD_POS][1], p[1], places=1)
+
+        with self.assertRaises(ValueError):
+            create_registrar("not a registrar")
+
+
+class TestTiledAcquisitionRegistration(unittest.TestCase):
+    """
+    Test the registration of the tiles during the tiled acquisition
+    """
+
+    def _create_task(self, registrar):
+        """
+        Create a TiledAcquisitionTask which can only register and stitch tiles
+        (it has no stream, so no hardware is needed).
+        """
+        task = TiledAcquisitionTask.__new__(TiledAcquisitionTask)
+        task._registrar = registrar
+        task._weaver = WEAVER_MEAN
+        task._tiles_registrar = None
+        task._registration_executor = None
+        return task
+
+    def _register_tiles(self, task, tiles):
+        """
+        Register the tiles, the same way as they are during the acquisition
+        return (list of tuples of DataArrays): the registered tiles
+        """
+        task._startRegistration()
+        try:
+            for ts in tiles:
+                f = task._registration_executor.submit(task._registerTile, ts)
+                task._registration_futures.append(f)
+            return task._getRegisteredTiles(tiles)
+        finally:
+            task._stopRegistration()
+
+    def setUp(self):
+        img = ensure2DImage(find_fittest_converter(IMGS[1]).read_data(IMGS[1])[0])
+        tiles, self.pos = decompose_image(img, 0.2, 3, "horizontalZigzag")
+        self.tiles = [(t,) for t in tiles]
+
+    def test_register(self):
+        task = self._create_task(REGISTER_GLOBAL_SHIFT)
+        upd_tiles = self._register_tiles(task, self.tiles)
+        self.assertEqual(len(upd_tiles), len(self.tiles))
+        for (t,), p in zip(upd_tiles, self.pos):
+            self.assertAlmostEqual(t.metadata[model.MD_POS][0], p[0], places=1)
+            self.assertAlmostEqual(t.metadata[model.MD_POS][1], p[1], places=1)
+
+        st_data = task._stitchTiles(self.tiles)
+        self.assertEqual(len(st_data), 1)
+        self.assertEqual(st_data[0].ndim, 2)
+
+    def test_register_failure(self):
+        """
+        If the registration fails, the tiles are stitched at their original positions
+        """
+        # Unknown registrar
+        task = self._create_task("not a registrar")
+        with self.assertRaises(ValueError):
+            self._register_tiles(task, self.tiles)
+
+        # Registrar failing on a tile
+        task = self._create_task(REGISTER_GLOBAL_SHIFT)
+        calls = []
+
+        def add_tile_failing(registrar, ts):
+            calls.append(ts)
+            raise ValueError("Failed to register")
+
+        orig_add_tile = _tiledacq.add_tile
+        try:
+            _tiledacq.add_tile = add_tile_failing
+            with self.assertRaises(ValueError):
+                self._register_tiles(task, self.tiles)
+        finally:
+            _tiledacq.add_tile = orig_add_tile
+        # Only tried once, then the tiles are not registered anymore
+        self.assertEqual(len(calls), 1)
+
+        # The stitching still works, using the identity registrar
+        task._startRegistration()
+        task._registration_error = ValueError("Failed to register")
+        st_data = task._stitchTiles(self.tiles)
+        task._stopRegistration()
+        self.assertEqual(len(st_data), 1)
+        exp_data = weave([t for t, in register(self.tiles, method=REGISTER_IDENTITY)], WEAVER_MEAN)
+        numpy.testing.assert_array_equal(st_data[0], exp_data)
+
     # @unittest.skip("skip")
     def test_dep_tiles(self):
         """
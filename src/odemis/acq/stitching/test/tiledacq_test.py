@@ -27,13 +27,15 @@ import odemis
 import odemis.acq.stream as stream
 from odemis import model
 from odemis.acq.acqmng import SettingsObserver
-from odemis.acq.stitching._tiledacq import TiledAcquisitionTask, acquireTiledArea
+from odemis.acq.stitching._tiledacq import TiledAcquisitionTask, acquireTiledArea, SKIP_TILES
 from odemis.util import test
 from odemis.util.comp import compute_camera_fov, compute_scanner_fov
 from odemis.util.test import assert_pos_almost_equal
 from odemis.acq.stitching import WEAVER_COLLAGE_REVERSE, REGISTER_IDENTITY, \
     WEAVER_MEAN
 import os
+import tempfile
+import threading
 import time
 import unittest
 
@@ -246,6 +248,149 @@ class CRYOSECOMTestCase(unittest.TestCase):
         self.assertIsInstance(data[0], model.DataArray)
         self.assertEqual(len(data[0].shape), 2)
 
+    def test_pipelined(self):
+        """
+        Test the whole procedure (acquire + stitch) in pipelined mode
+        """
+        settings_obs = SettingsObserver([self.stage])
+        fm_fov = compute_camera_fov(self.ccd)
+        area = (0, 0, fm_fov[0] * 3, fm_fov[1] * 3)  # left, top, right, bottom
+        overlap = 0.2
+        self.stage.moveAbs({'x': 0, 'y': 0}).result()
+        future = acquireTiledArea(self.fm_streams, self.stage, area=area, overlap=overlap,
+                                  settings_obs=settings_obs, pipelined=True)
+        data = future.result()
+        self.assertEqual(future._state, FINISHED)
+        self.assertEqual(len(data), 2)
+        self.assertIsInstance(data[0], odemis.model.DataArray)
+        self.assertEqual(len(data[0].shape), 2)
+
+        # With sem stream (no focus adjustment)
+        area = (0, 0, 0.00001, 0.00001)
+        self.stage.moveAbs({'x': 0, 'y': 0}).result()
+        future = acquireTiledArea(self.sem_streams, self.stage, area=area, overlap=overlap,
+                                  pipelined=True)
+        data = future.result()
+        self.assertEqual(future._state, FINISHED)
+        self.assertEqual(len(data), 1)
+        self.assertIsInstance(data[0], model.DataArray)
+
+    def _run_focus_task(self, pipelined, bad_tile):
+        """
+        Run a tiled acquisition in which the tile bad_tile is reported out of focus
+        :returns: (list of int): index of the acquired tiles, in order,
+          (list of int): index of the tiles for which the autofocus was run
+        """
+        fm_fov = compute_camera_fov(self.ccd)
+        area = (0, 0, fm_fov[0] * 2, fm_fov[1] * 2)
+        self.stage.moveAbs({'x': 0, 'y': 0}).result()
+        future = model.ProgressiveFuture()
+        future.running_subf = model.InstantaneousFuture()
+        future._task_lock = threading.Lock()
+        task = TiledAcquisitionTask(self.fm_streams, self.stage, area=area, overlap=0.2,
+                                    future=future, pipelined=pipelined)
+
+        acquired = []
+        autofocused = []
+        orig_get_tile_das = task._getTileDAs
+
+        def get_tile_das(i, ix, iy):
+            acquired.append(i)
+            return orig_get_tile_das(i, ix, iy)
+
+        def measure_focus(das):
+            # The first tile is the reference, the bad tile is far from it
+            return 10 if len(acquired) - 1 == bad_tile else 1
+
+        def run_autofocus(i):
+            autofocused.append(i)
+            return True
+
+        task._getTileDAs = get_tile_das
+        task._measureFocus = measure_focus
+        task._runAutoFocus = run_autofocus
+        data = task.run()
+        self.assertEqual(len(data), 2)
+        return acquired, autofocused
+
+    def test_focus_modes(self):
+        """
+        Check how an out of focus tile is handled in the serial and pipelined modes
+        """
+        # Serial (default): the autofocus is run, and the tile is acquired again
+        # Note: the focus is only checked every SKIP_TILES tiles
+        bad_tile = SKIP_TILES
+        acquired, autofocused = self._run_focus_task(pipelined=False, bad_tile=bad_tile)
+        ntiles = len(set(acquired))
+        self.assertGreater(ntiles, bad_tile + 1)
+        self.assertEqual(acquired, list(range(bad_tile + 1)) + list(range(bad_tile, ntiles)))
+        self.assertEqual(autofocused, [bad_tile])
+
+        # Pipelined: the tile is not acquired again, the autofocus is run before the next tile
+        acquired, autofocused = self._run_focus_task(pipelined=True, bad_tile=bad_tile)
+        self.assertEqual(acquired, list(range(ntiles)))
+        self.assertEqual(autofocused, [bad_tile + 1])
+
+    def test_estimate_time(self):
+        """
+        Check the estimated time decreases with the number of remaining tiles
+        """
+        sem_fov = compute_scanner_fov(self.ebeam)
+        area = (0, 0, sem_fov[0] * 2, sem_fov[1] * 2)
+        task = TiledAcquisitionTask(self.sem_streams, self.stage, area=area, overlap=0.2,
+                                    future=model.InstantaneousFuture())
+        ntiles = task._nx * task._ny
+        self.assertEqual(task.estimateTime(), task.estimateTime(ntiles))
+
+        # Only the stitching is left
+        stitch_time = task.estimateTime(0)
+        self.assertGreaterEqual(stitch_time, 0)
+        # The last tile needs no move: only its acquisition time is added
+        acq_time = task.estimateTime(1) - stitch_time
+        self.assertGreater(acq_time, 0)
+        prev_time = task.estimateTime(1)
+        for remaining in range(2, ntiles + 1):
+            t = task.estimateTime(remaining)
+            # Each tile adds its acquisition time, and a move
+            self.assertGreater(t - prev_time, acq_time)
+            prev_time = t
+
+    def test_estimate_time_pipelined(self):
+        """
+        Check that in pipelined mode, the moves overlap with the processing of the tiles
+        """
+        fm_fov = compute_camera_fov(self.ccd)
+        area = (0, 0, fm_fov[0] * 2, fm_fov[1] * 2)
+        # With a log path, each tile is saved, on top of the focus measurement
+        log_path = os.path.join(tempfile.gettempdir(), "tile.ome.tiff")
+        tasks = {}
+        for pipelined in (False, True):
+            tasks[pipelined] = TiledAcquisitionTask(self.fm_streams, self.stage, area=area, overlap=0.2,
+                                                    future=model.InstantaneousFuture(),
+                                                    log_path=log_path, pipelined=pipelined)
+        serial_task, pipelined_task = tasks[False], tasks[True]
+        ntiles = serial_task._nx * serial_task._ny
+        self.assertGreater(ntiles, 1)
+
+        # Only the stitching is left: the registration was done during the acquisition
+        stitch_diff = serial_task.estimateTime(0) - pipelined_task.estimateTime(0)
+        self.assertGreaterEqual(stitch_diff, 0)
+
+        # Serial: move + processing, pipelined: the longest of both
+        move_time = max(serial_task._guessSmallestFov(self.fm_streams)) / serial_task._move_speed
+        tile_pxs = sum(serial_task._estimateStreamPixels(s) for s in self.fm_streams)
+        overlapped = 0
+        for remaining in range(1, ntiles + 1):
+            i = ntiles - remaining
+            process_time = serial_task._estimateTileProcessingTime(i, tile_pxs)
+            self.assertGreater(process_time, 0)
+            if i < ntiles - 1:  # No move after the last tile
+                overlapped += min(move_time, process_time)
+            diff = serial_task.estimateTime(remaining) - pipelined_task.estimateTime(remaining)
+            self.assertAlmostEqual(diff, stitch_diff + overlapped)
+
+        self.assertLess(pipelined_task.estimateTime(), serial_task.estimateTime())
+
     def test_registrar_weaver(self):
 
         overlap = 0.05  # Little overlap, no registration
@@ -26,11 +26,14 @@ import logging
 import numpy
 from odemis import model
 import odemis
-from odemis.acq.stitching import CollageWeaver, MeanWeaver, CollageWeaverReverse
-from odemis.dataio import find_fittest_converter
+from odemis.acq.stitching import CollageWeaver, MeanWeaver, CollageWeaverReverse, \
+    weave, WEAVER_MEAN
+from odemis.dataio import find_fittest_converter, tiff
 from odemis.util.img import ensure2DImage
+from odemis.util.tilecache import is_memmapped
 import os
 import random
+import tempfile
 import time
 import unittest
 
@@ -347,6 +350,48 @@ class TestMeanWeaver(unittest.TestCase):
             # value than the value of the right pixel
             self.assertLess(row[-1], row[0])
 
+    def test_strips(self):
+        """
+        Test the full image is the same when computed strip by strip, or in a memmap
+        """
+        tiles = []
+        for iy in range(3):
+            for ix in range(4):
+                a = numpy.random.randint(0, 4000, (300, 400)).astype(numpy.uint16)
+                md = {model.MD_PIXEL_SIZE: (1e-6, 1e-6),  # m/px
+                      model.MD_POS: (ix * 320e-6 + random.random() * 3e-6, -iy * 240e-6),  # m
+                      }
+                tiles.append(model.DataArray(a, md))
+
+        weaver = MeanWeaver()
+        for t in tiles:
+            weaver.addTile(t)
+        outd = weaver.getFullImage()
+
+        shape, dtype, strips, md = weaver.getFullImageStrips(max_height=100)
+        self.assertEqual(shape, outd.shape)
+        self.assertEqual(dtype, outd.dtype)
+        self.assertEqual(md, outd.metadata)
+        strips = list(strips)
+        self.assertEqual(len(strips), (shape[0] + 99) // 100)
+        numpy.testing.assert_array_equal(numpy.concatenate(strips), outd)
+
+        # Stored in a temporary file, as it's bigger than the allowed memory
+        outm = weave(tiles, WEAVER_MEAN, max_memory=1000)
+        self.assertTrue(is_memmapped(outm))
+        numpy.testing.assert_array_equal(outm, outd)
+        self.assertEqual(outm.metadata, outd.metadata)
+        outs = weave(tiles, WEAVER_MEAN, max_memory=outd.nbytes)
+        self.assertFalse(is_memmapped(outs))
+        numpy.testing.assert_array_equal(outs, outd)
+
+        # Directly to a (pyramidal) TIFF file
+        fn = tempfile.mktemp(suffix=".ome.tiff")
+        self.addCleanup(os.remove, fn)
+        tiff.export_strips(fn, *weaver.getFullImageStrips())
+        rdata = tiff.read_data(fn)
+        numpy.testing.assert_array_equal(rdata[0], outd)
+
 
 class TestCollageWeaverReverse(unittest.TestCase):
 
@@ -34,6 +34,7 @@ from odemis.model import (MD_POS, MD_PIXEL_SIZE, MD_ROTATION, MD_ACQ_DATE,
                           MD_POL_EY, MD_POL_EZ, MD_POL_DOP, MD_POL_DOLP, MD_POL_DOCP, MD_POL_UP, MD_POL_DS1N,
                           MD_POL_DS2N, MD_POL_DS3N, MD_POL_S1N, MD_POL_S2N, MD_POL_S3N, TINT_FIT_TO_RGB, TINT_RGB_AS_IS)
 from odemis.util import img
+from odemis.util.tilecache import tile_cache
 import threading
 import time
 import weakref
@@ -46,6 +47,10 @@ from odemis.util.transform import AffineTransform
 
 UNDEFINED_ROI = (0, 0, 0, 0)
 
+# Expected error on the ratios of the histogram, when computing it on a subset
+# of a big image (cf img.histogram()). 2.5e-4 => at most 4 Mpx are used.
+HISTOGRAM_MAX_ERROR = 2.5e-4
+
 # use hardcode list of polarization positions necessary for polarimetry analysis
 POL_POSITIONS = (MD_POL_HORIZONTAL, MD_POL_VERTICAL, MD_POL_POSDIAG,
                  MD_POL_NEGDIAG, MD_POL_RHC, MD_POL_LHC)
@@ -161,11 +166,6 @@ class Stream(object):
         else:
             self.raw = raw
 
-        # initialize the projected tiles cache
-        self._projectedTilesCache = {}
-        # initialize the raw tiles cache
-        self._rawTilesCache = {}
-
         # TODO: should better be based on a BufferedDataFlow: subscribing starts
         # acquisition and sends (raw) data to whoever is interested. .get()
         # returns the previous or next image acquired.
@@ -190,6 +190,7 @@ class Stream(object):
 
         # Duplicate VA if requested
         self._hwvas = {}  # str (name of the proxied VA) -> original Hw VA
+        self._hwvacomps = {}  # str (name of the proxied VA) -> (Component, name of the original VA)
         self._hwvasetters = {}  # str (name of the proxied VA) -> setter
         self._lvaupdaters = {}  # str (name of the proxied VA) -> listener
         self._axisvaupdaters = {}  # str (name of the axis VA) -> listener (functools.partial)
@@ -389,6 +390,7 @@ class Stream(object):
 
             # Keep the link between the new VA and the original VA so they can be synchronised
             self._hwvas[newname] = va
+            self._hwvacomps[newname] = (comp, vaname)
             # Keep setters, mostly to not have them dereferenced
             self._hwvasetters[newname] = vasetter
 
@@ -542,12 +544,13 @@ class Stream(object):
                               vaname, lva.value)
 
         # Immediately read the VAs back, to read the actual values accepted by the hardware
+        hwvalues = self._getHwValues([n for n, hwva in hwvas if not hwva.readonly])
         for vaname, hwva in hwvas:
             if hwva.readonly:
                 continue
             lva = getattr(self, vaname)
             try:
-                lva.value = hwva.value
+                lva.value = hwvalues[vaname] if vaname in hwvalues else hwva.value
             except Exception:
                 logging.debug(u"Failed to update VA %s to value %s from hardware",
                               vaname, hwva.value)
@@ -571,6 +574,32 @@ class Stream(object):
         #     self._lvaupdaters[vaname] = updater
         #     hwva.subscribe(updater, init=True)
 
+    def _getHwValues(self, vanames):
+        """
+        Read the current value of multiple hardware VAs, with a single call per
+          component (instead of one call per VA).
+        vanames (list of str): names of the proxied VAs
+        return (dict str -> value): name of the proxied VA -> hardware value.
+          If the values of a component couldn't be read, its VAs are not present.
+        """
+        comp_vas = {}  # str (name of the component) -> (Component, list of (str, str))
+        for vaname in vanames:
+            comp, hwvaname = self._hwvacomps[vaname]
+            comp_vas.setdefault(comp.name, (comp, []))[1].append((vaname, hwvaname))
+
+        ret = {}
+        for comp, names in comp_vas.values():
+            try:
+                values = comp.getValues([hwn for _, hwn in names])
+            except Exception:
+                logging.debug(u"Failed to read VAs of %s, will read them one by one",
+                              comp.name, exc_info=True)
+                continue
+            for vaname, hwvaname in names:
+                ret[vaname] = values[hwvaname]
+
+        return ret
+
     def _unlinkHwVAs(self):
         for vaname, updater in list(self._lvaupdaters.items()):
             hwva = self._hwvas[vaname]
@@ -1065,7 +1094,7 @@ class Stream(object):
         for x in range(num_tiles_x):
             tiles_column = []
             for y in range(num_tiles_y):
-                tile = das.getTile(x, y, z)
+                tile = tile_cache.get_tile(das, x, y, z)
                 tiles_column.append(tile)
             tiles.append(tiles_column)
 
@@ -1202,7 +1231,8 @@ class Stream(object):
         self._updateDRange(data)
 
         # Initially, _drange might be None, in which case it will be guessed
-        hist, edges = img.histogram(data, irange=self._drange)
+        hist, edges = img.histogram(data, irange=self._drange,
+                                    max_error=HISTOGRAM_MAX_ERROR)
         if hist.size > 256:
             chist = img.compactHistogram(hist, 256)
         else:
@@ -35,7 +35,7 @@ from odemis.model import VigilantAttributeBase, MD_POL_NONE
 from odemis.util import img, almost_equal, get_best_dtype_for_acc
 import time
 
-from ._base import Stream, UNDEFINED_ROI, POL_POSITIONS
+from ._base import Stream, UNDEFINED_ROI, POL_POSITIONS, HISTOGRAM_MAX_ERROR
 from ._live import LiveStream
 
 
@@ -235,7 +235,8 @@ class RepetitionStream(LiveStream):
         self._updateDRange(data)
 
         # Initially, _drange might be None, in which case it will be guessed
-        hist, edges = img.histogram(data, irange=self._drange)
+        hist, edges = img.histogram(data, irange=self._drange,
+                                    max_error=HISTOGRAM_MAX_ERROR)
         if hist.size > 256:
             chist = img.compactHistogram(hist, 256)
         else:
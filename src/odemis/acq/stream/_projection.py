@@ -22,6 +22,7 @@ Odemis. If not, see http://www.gnu.org/licenses/.
 
 from __future__ import division
 
+from concurrent.futures import ThreadPoolExecutor
 import threading
 import weakref
 import logging
@@ -40,12 +41,19 @@ except ImportError:
 
 from odemis import model
 from odemis.util import img, angleres
+from odemis.util.tilecache import tile_cache
 from scipy import ndimage
 from odemis.model import MD_PIXEL_SIZE, MD_POL_EPHI, MD_POL_EX, MD_POL_EY, MD_POL_EZ, MD_POL_ETHETA, MD_POL_DS0, \
     MD_POL_S0, MD_POL_DOP, MD_POL_DOLP, MD_POL_UP
 from odemis.acq.stream._static import StaticSpectrumStream
 from abc import abstractmethod
 
+# Number of threads loading and projecting in the background the tiles which
+# are likely to be displayed next (0 disables the prefetching)
+PREFETCH_THREADS = 2
+# Maximum number of tiles prefetched around the current view
+MAX_PREFETCH_TILES = 64
+
 
 class DataProjection(object):
 
@@ -822,16 +830,19 @@ class RGBSpatialProjection(RGBProjection):
     That is the recommended way to create a RGBSpatialProjection.
     """
 
-    def __new__(cls, stream):
+    def __new__(cls, stream, prefetch=True):
 
         if isinstance(stream, StaticSpectrumStream):
             return super(RGBSpatialProjection, cls).__new__(RGBSpatialSpectrumProjection)
         else:
             return super(RGBSpatialProjection, cls).__new__(cls)
 
-    def __init__(self, stream):
+    def __init__(self, stream, prefetch=True):
         '''
         stream (Stream): the Stream to project
+        prefetch (bool): if True, and the image is pyramidal, the tiles around
+          the current view are loaded in advance. Useful when the view is
+          interactively moved, but just extra work for a one-time projection.
         '''
         super(RGBSpatialProjection, self).__init__(stream)
 
@@ -857,21 +868,38 @@ class RGBSpatialProjection(RGBProjection):
             self.rect = model.TupleContinuous(full_rect, rect_range)
             self.mpp.subscribe(self._onMpp)
             self.rect.subscribe(self._onRect)
-            # initialize the projected tiles cache
-            self._projectedTilesCache = {}
-            # initialize the raw tiles cache
-            self._rawTilesCache = {}
-            # When True, the projected tiles cache should be invalidated
+            # The tiles are cached in the (process-wide) tile_cache.
+            # When True, the projection settings have changed, so the tiles
+            # being projected should be projected again.
             self._projectedTilesInvalid = True
 
+            # Tiles around the current view are loaded and projected in advance
+            self._prefetchFutures = []  # Futures of the prefetching not yet done
+            self._prefetchLock = threading.Lock()  # protects the attribute above
+            self._prevViewCenter = None  # (float, float): center of the previous view (in px at zoom 0)
+            self._panDirection = (0, 0)  # (float, float): unit vector of the latest panning
+            if prefetch and PREFETCH_THREADS > 0:
+                self._prefetcher = ThreadPoolExecutor(max_workers=PREFETCH_THREADS)
+                # Stop the threads when the projection is not used anymore
+                weakref.finalize(self, self._prefetcher.shutdown, wait=False)
+            else:
+                self._prefetcher = None
+
         self._shouldUpdateImage()
 
     def _onMpp(self, mpp):
+        self._cancelPrefetch()
         self._shouldUpdateImage()
 
     def _onRect(self, rect):
+        self._cancelPrefetch()
         self._shouldUpdateImage()
 
+    def _shouldUpdateImageEntirely(self):
+        # The tiles waiting to be prefetched would be projected with the old settings
+        self._cancelPrefetch()
+        super(RGBSpatialProjection, self)._shouldUpdateImageEntirely()
+
     def _set_mpp(self, mpp):
         ps0 = self.mpp.range[0]
         exp = math.log(mpp / ps0, 2)
@@ -926,7 +954,7 @@ class RGBSpatialProjection(RGBProjection):
         if isinstance(raw[0], model.DataArrayShadow):
             tx, px = divmod(pixel_pos[0], raw[0].tile_shape[0])
             ty, py = divmod(pixel_pos[1], raw[0].tile_shape[1])
-            raw_tile = raw[0].getTile(tx, ty, 0)
+            raw_tile = tile_cache.get_tile(raw[0], tx, ty, 0)
             return raw_tile[py, px]
         else:
             return raw[0][pixel_pos[1], pixel_pos[0]]
@@ -988,43 +1016,43 @@ class RGBSpatialProjection(RGBProjection):
             int(round(rect[1] / (-ps[1]) + img_shape[1] / 2)) - 1,
         )
 
-    def _getTile(self, x, y, z, prev_raw_cache, prev_proj_cache):
+    def _tileProjectionParams(self):
+        """
+        return (tuple): the settings used to project the tiles, which identify
+          the projected tiles in the cache
+        """
+        tint = self.stream.tint.value
+        if not isinstance(tint, tuple):
+            # A colormap: it might not be hashable
+            tint = (getattr(tint, "name", None), id(tint))
+        irange = tuple(self.stream._getDisplayIRange())
+        if model.hasVA(self.stream, "zIndex"):
+            zidx = self.stream.zIndex.value
+        else:
+            zidx = None
+        return tint, irange, zidx
+
+    def _getTile(self, x, y, z, params):
         """
-        Get a tile from a DataArrayShadow. Uses cache.
-        The cache for projected tiles and the cache for raw tiles has always the same tiles
+        Get a tile from a DataArrayShadow. Uses the tile cache, for the raw and
+        projected tile.
         x (int): X coordinate of the tile
         y (int): Y coordinate of the tile
         z (int): zoom level where the tile is
-        prev_raw_cache (dictionary): raw tiles cache from the
-            last execution of _updateImage
-        prev_proj_cache (dictionary): projected tiles cache from the
-            last execution of _updateImage
+        params (tuple): the current projection settings, as returned by
+          _tileProjectionParams()
         return (DataArray, DataArray): raw tile and projected tile
         """
-        # the key of the tile on the cache
-        tile_key = "%d-%d-%d" % (x, y, z)
+        das = self.stream.raw[0]
+        raw_tile = tile_cache.get_tile(das, x, y, z)
 
-        # if the raw tile has been already cached, read it from the cache
-        if tile_key in prev_raw_cache:
-            raw_tile = prev_raw_cache[tile_key]
-        elif tile_key in self._rawTilesCache:
-            raw_tile = self._rawTilesCache[tile_key]
-        else:
-            # The tile was not cached, so it must be read from the file
-            raw_tile = self.stream.raw[0].getTile(x, y, z)
-
-        # if the projected tile has been already cached, read it from the cache
-        if tile_key in prev_proj_cache:
-            proj_tile = prev_proj_cache[tile_key]
-        elif tile_key in self._projectedTilesCache:
-            proj_tile = self._projectedTilesCache[tile_key]
-        else:
-            # The tile was not cached, so it must be projected again
+        proj_tile = tile_cache.get_rgb(das, x, y, z, params)
+        if proj_tile is None:
             proj_tile = self._projectTile(raw_tile)
+            # Only cache it if the settings haven't changed during the projection
+            if self._tileProjectionParams() == params:
+                tile_cache.put_rgb(das, x, y, z, params, proj_tile)
 
-        # cache raw and projected tiles
-        self._rawTilesCache[tile_key] = raw_tile
-        self._projectedTilesCache[tile_key] = proj_tile
         return raw_tile, proj_tile
 
     def _projectTile(self, tile):
@@ -1062,9 +1090,11 @@ class RGBSpatialProjection(RGBProjection):
 
         return self._projectXY2RGB(tile, tint)
 
-    def _getTilesFromSelectedArea(self):
+    def _getTilesFromSelectedArea(self, prefetch=False):
         """
         Get the tiles inside the region defined by .rect and .mpp
+        prefetch (bool): if True, once the tiles are ready, start loading in
+          the background the tiles likely to be displayed next
         return (DataArray, DataArray): Raw tiles and projected tiles
         """
 
@@ -1075,26 +1105,22 @@ class RGBSpatialProjection(RGBProjection):
 
         das = self.stream.raw[0]
 
-        # store the previous cache to use in this execution
-        prev_raw_cache = self._rawTilesCache
-        prev_proj_cache = self._projectedTilesCache
         # Execute at least once. If mpp and rect changed in
         # the last execution of the loops, execute again
         need_recompute = True
         while need_recompute:
             z = self._zFromMpp()
-            rect = self._rectWorldToPixel(self.rect.value)
+            px_rect = self._rectWorldToPixel(self.rect.value)
             # convert the rect coords to tile indexes
-            rect = [l / (2 ** z) for l in rect]
+            rect = [l / (2 ** z) for l in px_rect]
             rect = [int(math.floor(l / das.tile_shape[0])) for l in rect]
             x1, y1, x2, y2 = rect
-            # the 4 lines below avoids that lots of old tiles
-            # stays in instance caches
-            prev_raw_cache.update(self._rawTilesCache)
-            prev_proj_cache.update(self._projectedTilesCache)
-            # empty current caches
-            self._rawTilesCache = {}
-            self._projectedTilesCache = {}
+            self._projectedTilesInvalid = False
+            params = self._tileProjectionParams()
+            if hasattr(das, "prefetchTiles"):
+                # The image can load multiple tiles in parallel (eg, remote server)
+                das.prefetchTiles([(x, y, z) for x in range(x1, x2 + 1) for y in range(y1, y2 + 1)
+                                   if not tile_cache.has_raw(das, x, y, z)])
 
             raw_tiles = []
             projected_tiles = []
@@ -1105,11 +1131,8 @@ class RGBSpatialProjection(RGBProjection):
                     pt_column = []
 
                     for y in range(y1, y2 + 1):
-                        # the projected tiles cache is invalid
+                        # the projection settings have changed
                         if self._projectedTilesInvalid:
-                            self._projectedTilesCache = {}
-                            prev_proj_cache = {}
-                            self._projectedTilesInvalid = False
                             raise NeedRecomputeException()
 
                         # check if the image changed in the middle of the process
@@ -1119,8 +1142,7 @@ class RGBSpatialProjection(RGBProjection):
                             # but using the cache from the last execution
                             raise NeedRecomputeException()
 
-                        raw_tile, proj_tile = \
-                            self._getTile(x, y, z, prev_raw_cache, prev_proj_cache)
+                        raw_tile, proj_tile = self._getTile(x, y, z, params)
                         rt_column.append(raw_tile)
                         pt_column.append(proj_tile)
 
@@ -1131,8 +1153,115 @@ class RGBSpatialProjection(RGBProjection):
                 # image changed
                 need_recompute = True
 
+        if prefetch and self._prefetcher:
+            self._startPrefetch(z, (x1, y1, x2, y2), px_rect, params)
+
         return tuple(raw_tiles), tuple(projected_tiles)
 
+    def _cancelPrefetch(self):
+        """
+        Cancel the prefetching of the tiles not yet started. The tiles being
+        currently loaded are not waited for.
+        """
+        if not hasattr(self, "_prefetchFutures"):  # Not a pyramidal image
+            return
+        with self._prefetchLock:
+            fs, self._prefetchFutures = self._prefetchFutures, []
+        for f in fs:
+            f.cancel()
+
+    def _startPrefetch(self, z, tile_rect, px_rect, params):
+        """
+        Schedule the loading of the tiles which are likely to be displayed
+        after the current view. In order, these are the ring of tiles around the
+        view (starting with the ones in the direction of the latest panning),
+        the tiles of the view at the next zoom level (zoomed out), and at the
+        previous zoom level (zoomed in).
+        z (int): zoom level of the current view
+        tile_rect (int, int, int, int): x1, y1, x2, y2 indices of the tiles of
+          the view (inclusive)
+        px_rect (int, int, int, int): the view, in pixels at zoom level 0
+        params (tuple): the current projection settings
+        """
+        self._cancelPrefetch()
+
+        das = self.stream.raw[0]
+        md = das.metadata
+        dims = md.get(model.MD_DIMS, "CTZYX"[-das.ndim::])
+        img_shape = (das.shape[dims.index('X')], das.shape[dims.index('Y')])
+        tile_shape = das.tile_shape
+
+        def ntiles(zoom):
+            # number of tiles along X and Y at the given zoom level
+            return tuple(int(math.ceil((s // 2 ** zoom) / ts)) for s, ts in zip(img_shape, tile_shape))
+
+        # Update the panning direction, if the view has moved
+        center = ((px_rect[0] + px_rect[2] + 1) / 2, (px_rect[1] + px_rect[3] + 1) / 2)
+        if self._prevViewCenter is not None:
+            dx, dy = center[0] - self._prevViewCenter[0], center[1] - self._prevViewCenter[1]
+            norm = math.hypot(dx, dy)
+            if norm > 0:
+                self._panDirection = (dx / norm, dy / norm)
+        self._prevViewCenter = center
+
+        def sorted_tiles(zoom, x1, y1, x2, y2, excl=None):
+            """
+            return (list of (int, int, int)): x, y, zoom of the tiles in the
+              rectangle (clipped to the image), excluding the ones in excl
+              (x1, y1, x2, y2), sorted by priority
+            """
+            nx, ny = ntiles(zoom)
+            # center of the view, in tile indices at this zoom level
+            cx = center[0] / (2 ** zoom * tile_shape[0])
+            cy = center[1] / (2 ** zoom * tile_shape[1])
+            tiles = []
+            for x in range(max(x1, 0), min(x2, nx - 1) + 1):
+                for y in range(max(y1, 0), min(y2, ny - 1) + 1):
+                    if excl and excl[0] <= x <= excl[2] and excl[1] <= y <= excl[3]:
+                        continue
+                    vx, vy = x + 0.5 - cx, y + 0.5 - cy
+                    # Ahead of the panning first, then the closest to the center
+                    ahead = vx * self._panDirection[0] + vy * self._panDirection[1]
+                    tiles.append((-ahead, math.hypot(vx, vy), (x, y, zoom)))
+            tiles.sort()
+            return [t[2] for t in tiles]
+
+        x1, y1, x2, y2 = tile_rect
+        to_fetch = sorted_tiles(z, x1 - 1, y1 - 1, x2 + 1, y2 + 1, excl=tile_rect)
+        if z < das.maxzoom:
+            to_fetch += sorted_tiles(z + 1, x1 // 2, y1 // 2, x2 // 2, y2 // 2)
+        if z > 0:
+            to_fetch += sorted_tiles(z - 1, x1 * 2, y1 * 2, x2 * 2 + 1, y2 * 2 + 1)
+
+        # Skip the tiles already in the cache
+        to_fetch = [t for t in to_fetch if not tile_cache.has_rgb(das, t[0], t[1], t[2], params)]
+        # Only pass a weakref, so that the pending tiles don't prevent the
+        # projection from being garbage collected
+        wself = weakref.ref(self)
+        with self._prefetchLock:
+            for x, y, zoom in to_fetch[:MAX_PREFETCH_TILES]:
+                f = self._prefetcher.submit(self._prefetchTile, wself, x, y, zoom, params)
+                self._prefetchFutures.append(f)
+
+    @staticmethod
+    def _prefetchTile(wprojection, x, y, z, params):
+        """
+        Load and project a tile, so that it's in the cache when it's displayed.
+        Runs in a separate thread.
+        wprojection (weakref to RGBSpatialProjection): the projection
+        x (int): X coordinate of the tile
+        y (int): Y coordinate of the tile
+        z (int): zoom level where the tile is
+        params (tuple): the projection settings when the prefetching was requested
+        """
+        projection = wprojection()
+        if projection is None:  # Projection released in the meantime
+            return
+        try:
+            projection._getTile(x, y, z, params)
+        except Exception:
+            logging.debug("Failed to prefetch tile %d,%d,%d", x, y, z, exc_info=True)
+
     def _updateImage(self):
         """ Recomputes the image with all the raw data available
         """
@@ -1144,7 +1273,7 @@ class RGBSpatialProjection(RGBProjection):
         try:
             if isinstance(raw[0], model.DataArrayShadow):
                 # DataArrayShadow => need to get each tile individually
-                self._raw, projected_tiles = self._getTilesFromSelectedArea()
+                self._raw, projected_tiles = self._getTilesFromSelectedArea(prefetch=True)
                 self.image.value = projected_tiles
             else:
                 self.image.value = self._projectTile(raw[0])
@@ -1173,9 +1302,9 @@ class RGBSpatialSpectrumProjection(RGBSpatialProjection):
     RGBSpatialProjection upon class creation in the __new__ function.
     """
 
-    def __init__(self, stream):
+    def __init__(self, stream, prefetch=True):
 
-        super(RGBSpatialSpectrumProjection, self).__init__(stream)
+        super(RGBSpatialSpectrumProjection, self).__init__(stream, prefetch)
         stream.selected_pixel.subscribe(self._on_selected_pixel)
         stream.calibrated.subscribe(self._on_new_spec_data)
         if hasattr(stream, "spectrumBandwidth"):
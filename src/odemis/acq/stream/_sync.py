@@ -169,6 +169,9 @@ class MultipleDetectorStream(with_metaclass(ABCMeta, Stream)):
 
         # currently scanned area location based on px_idx, or None if no scanning
         self._current_scan_area = None  # l,t,r,b (int)
+        # stream index -> histogram of the acquired pixels of the last live data
+        # (if it can be computed incrementally)
+        self._live_hist = {}
 
         # Start threading event for live update overlay
         self._live_update_period = 2
@@ -834,12 +837,14 @@ class MultipleDetectorStream(with_metaclass(ABCMeta, Stream)):
             da = model.DataArray(numpy.zeros(shape=rep[::-1] * numpy.array(tile_shape), dtype=raw_data.dtype), md)
             self._live_data[n].append(da)
             self._acq_mask = numpy.zeros(shape=rep[::-1] * numpy.array(tile_shape), dtype=numpy.bool)
+            self._live_hist.pop(n, None)
 
         self._acq_mask[px_idx[0] * tile_shape[0]:(px_idx[0] + 1) * tile_shape[0],
                        px_idx[1] * tile_shape[1]:(px_idx[1] + 1) * tile_shape[1]] = True
         self._live_data[n][pol_idx][
                        px_idx[0] * tile_shape[0]:(px_idx[0] + 1) * tile_shape[0],
                        px_idx[1] * tile_shape[1]:(px_idx[1] + 1) * tile_shape[1]] = raw_data
+        self._updateLiveHistogram(n, raw_data)
 
     def _assembleLiveData2D(self, n, raw_data, px_idx, rep, pol_idx):
         """
@@ -871,12 +876,51 @@ class MultipleDetectorStream(with_metaclass(ABCMeta, Stream)):
             da = model.DataArray(numpy.zeros(shape=rep[::-1], dtype=raw_data.dtype), md)
             self._live_data[n].append(da)
             self._acq_mask = numpy.zeros(rep[::-1], dtype=numpy.bool)
+            self._live_hist.pop(n, None)
 
         self._acq_mask[px_idx[0]: px_idx[0] + tile_shape[0],
                        px_idx[1]: px_idx[1] + tile_shape[1]] = True
         self._live_data[n][pol_idx][
                            px_idx[0]: px_idx[0] + tile_shape[0],
                            px_idx[1]: px_idx[1] + tile_shape[1]] = raw_data
+        self._updateLiveHistogram(n, raw_data)
+
+    def _updateLiveHistogram(self, n, raw_data):
+        """
+        Add the data just acquired to the histogram of the live data, so that
+        the live image doesn't need to recompute the histogram of all the pixels
+        acquired so far. Only done for data of at most 16 bits, for which the
+        histogram always covers the whole range of the type.
+        :param n: (int) number of the current stream
+        :param raw_data: (DataArray) data just acquired, and copied into the
+          last live data of the stream
+        """
+        if raw_data.dtype.kind != "u" or raw_data.itemsize > 2:
+            return
+        idt = numpy.iinfo(raw_data.dtype)
+        hist, _ = img.histogram(raw_data, (idt.min, idt.max))
+        prev_hist = self._live_hist.get(n)
+        if prev_hist is not None:
+            # A new array, so that the image update thread always gets a
+            # complete histogram.
+            hist = prev_hist + hist
+        self._live_hist[n] = hist
+
+    def _getLiveHistogram(self, data):
+        """
+        Get the histogram of the acquired pixels of a live data, if it has been
+        computed incrementally.
+        :param data: (DataArray) the (last) live data of a stream
+        :return: (ndarray, tuple of 2 numbers) or (None, None): histogram and
+          edges, as returned by img.histogram()
+        """
+        for n, ldas in enumerate(self._live_data):
+            if ldas and ldas[-1] is data:
+                hist = self._live_hist.get(n)
+                if hist is not None:
+                    idt = numpy.iinfo(data.dtype)
+                    return hist, (idt.min, idt.max)
+        return None, None
 
     def _assembleFinalData(self, n, data):
         """
@@ -920,9 +964,10 @@ class MultipleDetectorStream(with_metaclass(ABCMeta, Stream)):
         scan_area = self._current_scan_area
         if scan_area is None:
             return None
-        data_acq = data[acq_mask]
-
-        hist, edges = img.histogram(data_acq)
+        hist, edges = self._getLiveHistogram(data)
+        if hist is None:
+            data_acq = data[acq_mask]
+            hist, edges = img.histogram(data_acq)
         irange = img.findOptimalRange(hist, edges, 1/256)
         rgbim = img.DataArray2RGB(data, irange, tint)
         md = self._find_metadata(data.metadata)
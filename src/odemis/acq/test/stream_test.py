@@ -30,7 +30,7 @@ from odemis import model
 import odemis
 from odemis.acq import stream, calibration, path, leech
 from odemis.acq.leech import ProbeCurrentAcquirer
-from odemis.acq.stream import POL_POSITIONS
+from odemis.acq.stream import POL_POSITIONS, _projection
 from odemis.acq.stream import RGBSpatialSpectrumProjection, \
     SinglePointSpectrumProjection, SinglePointTemporalProjection, \
     LineSpectrumProjection, MeanSpectrumProjection
@@ -5027,6 +5027,9 @@ class StaticStreamsTestCase(unittest.TestCase):
 
         tiff.DataArrayShadowPyramidalTIFF._getTileOldSP = tiff.DataArrayShadowPyramidalTIFF.getTile
         tiff.DataArrayShadowPyramidalTIFF.getTile = getTileMock
+        # Only count the tiles read to display the view
+        self.addCleanup(setattr, _projection, "PREFETCH_THREADS", _projection.PREFETCH_THREADS)
+        _projection.PREFETCH_THREADS = 0
 
         POS = (5.0, 7.0)
         size = (3000, 2000, 3)
@@ -5047,10 +5050,10 @@ class StaticStreamsTestCase(unittest.TestCase):
         pj = stream.RGBSpatialProjection(ss)
         time.sleep(0.5)
 
-        # the maxzoom image has 2 tiles. So far 4 was read: 2 on the constructor, for
-        # _updateHistogram and _updateDRange. And 2 for _updateImage, because .rect
-        # and .mpp are initialized to the maxzoom image
-        self.assertEqual(4, len(read_tiles))
+        # the maxzoom image has 2 tiles. So far only 2 were read: on the constructor,
+        # for _updateHistogram. _updateDRange and _updateImage (because .rect
+        # and .mpp are initialized to the maxzoom image) use the tile cache.
+        self.assertEqual(2, len(read_tiles))
 
         full_image_rect = (POS[0] - 0.0015, POS[1] - 0.001, POS[0] + 0.0015, POS[1] + 0.001)
 
@@ -5059,7 +5062,7 @@ class StaticStreamsTestCase(unittest.TestCase):
         pj.rect.value = full_image_rect
         # Wait a little bit to make sure the image has been generated
         time.sleep(0.5)
-        self.assertEqual(28, len(read_tiles))
+        self.assertEqual(26, len(read_tiles))
         self.assertEqual(len(pj.image.value), 6)
         self.assertEqual(len(pj.image.value[0]), 4)
 
@@ -5067,15 +5070,15 @@ class StaticStreamsTestCase(unittest.TestCase):
         pj.rect.value = (POS[0] - 0.0015, POS[1] - 0.001, POS[0], POS[1] + 0.001)
         # Wait a little bit to make sure the image has been generated
         time.sleep(0.5)
-        self.assertEqual(28, len(read_tiles))
+        self.assertEqual(26, len(read_tiles))
         self.assertEqual(len(pj.image.value), 3)
         self.assertEqual(len(pj.image.value[0]), 4)
 
-        # half image (right side), only the center tiles will are cached
+        # half image (right side), the tiles are still cached
         pj.rect.value = (POS[0], POS[1] - 0.001, POS[0] + 0.0015, POS[1] + 0.001)
         # Wait a little bit to make sure the image has been generated
         time.sleep(0.5)
-        self.assertEqual(40, len(read_tiles))
+        self.assertEqual(26, len(read_tiles))
         self.assertEqual(len(pj.image.value), 4)
         self.assertEqual(len(pj.image.value[0]), 4)
 
@@ -5084,7 +5087,7 @@ class StaticStreamsTestCase(unittest.TestCase):
 
         # Wait a little bit to make sure the image has been generated
         time.sleep(0.5)
-        self.assertEqual(40, len(read_tiles))
+        self.assertEqual(26, len(read_tiles))
         self.assertEqual(len(pj.image.value), 1)
         self.assertEqual(len(pj.image.value[0]), 1)
 
@@ -5106,6 +5109,9 @@ class StaticStreamsTestCase(unittest.TestCase):
 
         tiff.DataArrayShadowPyramidalTIFF._getTileOldSZ = tiff.DataArrayShadowPyramidalTIFF.getTile
         tiff.DataArrayShadowPyramidalTIFF.getTile = getTileMock
+        # Only count the tiles read to display the view
+        self.addCleanup(setattr, _projection, "PREFETCH_THREADS", _projection.PREFETCH_THREADS)
+        _projection.PREFETCH_THREADS = 0
 
         POS = (5.0, 7.0)
         dtype = numpy.uint8
@@ -5137,10 +5143,10 @@ class StaticStreamsTestCase(unittest.TestCase):
         pj = stream.RGBSpatialProjection(ss)
         time.sleep(0.5)
 
-        # the maxzoom image has 2 tiles. So far 4 was read: 2 on the constructor, for
-        # _updateHistogram and _updateDRange. And 2 for _updateImage, because .rect
-        # and .mpp are initialized to the maxzoom image
-        self.assertEqual(4, len(read_tiles))
+        # the maxzoom image has 2 tiles. So far only 2 were read: on the constructor,
+        # for _updateHistogram. _updateDRange and _updateImage (because .rect
+        # and .mpp are initialized to the maxzoom image) use the tile cache.
+        self.assertEqual(2, len(read_tiles))
 
         # delta full rect
         dfr = [-0.0015, -0.001, 0.0015, 0.001]
@@ -5154,17 +5160,17 @@ class StaticStreamsTestCase(unittest.TestCase):
         # Wait a little bit to make sure the image has been generated
         time.sleep(0.2)
         # no tiles are read from the disk
-        self.assertEqual(4, len(read_tiles))
+        self.assertEqual(2, len(read_tiles))
         self.assertEqual(len(pj.image.value), 2)
         self.assertEqual(len(pj.image.value[0]), 1)
         # top-left pixel of the left tile
         numpy.testing.assert_array_equal([0, 0, 0], pj.image.value[0][0][0, 0, :])
         # top-right pixel of the left tile
-        numpy.testing.assert_array_equal([173, 0, 0], pj.image.value[0][0][0, 255, :])
+        numpy.testing.assert_array_equal([174, 0, 0], pj.image.value[0][0][0, 255, :])
         # bottom-left pixel of the left tile
-        numpy.testing.assert_array_equal([0, 254, 0], pj.image.value[0][0][249, 0, :])
+        numpy.testing.assert_array_equal([0, 255, 0], pj.image.value[0][0][249, 0, :])
         # bottom-right pixel of the right tile
-        numpy.testing.assert_array_equal([254, 254, 0], pj.image.value[1][0][249, 117, :])
+        numpy.testing.assert_array_equal([254, 255, 0], pj.image.value[1][0][249, 117, :])
 
         # really small rect on the center, the tile is in the cache
         pj.rect.value = (POS[0], POS[1], POS[0] + 0.00001, POS[1] + 0.00001)
@@ -5172,15 +5178,15 @@ class StaticStreamsTestCase(unittest.TestCase):
         # Wait a little bit to make sure the image has been generated
         time.sleep(0.5)
         # no tiles are read from the disk
-        self.assertEqual(4, len(read_tiles))
+        self.assertEqual(2, len(read_tiles))
         self.assertEqual(len(pj.image.value), 1)
         self.assertEqual(len(pj.image.value[0]), 1)
         # top-left pixel of the only tile
         numpy.testing.assert_array_equal([0, 0, 0], pj.image.value[0][0][0, 0, :])
         # top-right pixel of the only tile
-        numpy.testing.assert_array_equal([173, 0, 0],pj.image.value[0][0][0, 255, :])
+        numpy.testing.assert_array_equal([174, 0, 0],pj.image.value[0][0][0, 255, :])
         # bottom-left pixel of the only tile
-        numpy.testing.assert_array_equal([0, 254, 0], pj.image.value[0][0][249, 0, :])
+        numpy.testing.assert_array_equal([0, 255, 0], pj.image.value[0][0][249, 0, :])
 
         # Now, just the tiny rect again, but at the minimum mpp (= fully zoomed in)
         # => should just need one new tile
@@ -5189,7 +5195,7 @@ class StaticStreamsTestCase(unittest.TestCase):
         # Wait a little bit to make sure the image has been generated
         time.sleep(0.5)
         # only one tile is read
-        self.assertEqual(5, len(read_tiles))
+        self.assertEqual(3, len(read_tiles))
         self.assertEqual(len(pj.image.value), 1)
         self.assertEqual(len(pj.image.value[0]), 1)
         # top-left pixel of the only tile
@@ -5213,23 +5219,24 @@ class StaticStreamsTestCase(unittest.TestCase):
 
         # Wait a little bit to make sure the image has been generated
         time.sleep(0.5)
-        # Only 2 tiles read from disk. It means that the loop inside _updateImage,
-        # triggered by the change on .rect was immediately stopped when .mpp changed
-        if len(read_tiles) == 8:
-            logging.warning("Two tiles read while expected to have just one, but "
+        # No tile read from disk, as the tiles at max mpp are still in the cache.
+        # It means that the loop inside _updateImage, triggered by the change
+        # on .rect was immediately stopped when .mpp changed.
+        if len(read_tiles) == 4:
+            logging.warning("One tile read while expected to have none, but "
                             "this is acceptable as updateImage thread might have "
                             "gone very fast.")
         else:
-            self.assertEqual(7, len(read_tiles))
+            self.assertEqual(3, len(read_tiles))
         self.assertEqual(len(pj.image.value), 2)
         self.assertEqual(len(pj.image.value[0]), 1)
 
         # top-left pixel of the left tile
         numpy.testing.assert_array_equal([0, 0, 0], pj.image.value[0][0][0, 0, :])
         # bottom-right pixel of the left tile
-        numpy.testing.assert_array_equal([173, 0, 0], pj.image.value[0][0][0, 255, :])
+        numpy.testing.assert_array_equal([174, 0, 0], pj.image.value[0][0][0, 255, :])
         # bottom-right pixel of right right
-        numpy.testing.assert_array_equal([254, 254, 0], pj.image.value[1][0][249, 117, :])
+        numpy.testing.assert_array_equal([254, 255, 0], pj.image.value[1][0][249, 117, :])
 
         read_tiles = []  # reset, to keep the numbers simple
 
@@ -5251,11 +5258,11 @@ class StaticStreamsTestCase(unittest.TestCase):
         # top-left pixel of a center tile
         numpy.testing.assert_array_equal([87, 0, 0], pj.image.value[1][0][0, 0, :])
         # top-right pixel of a center tile
-        numpy.testing.assert_array_equal([173, 0, 0], pj.image.value[1][0][0, 255, :])
+        numpy.testing.assert_array_equal([174, 0, 0], pj.image.value[1][0][0, 255, :])
         # bottom-left pixel of a center tile
         numpy.testing.assert_array_equal([87, 130, 0], pj.image.value[1][0][255, 0, :])
         # bottom pixel of a center tile
-        numpy.testing.assert_array_equal([173, 130, 0], pj.image.value[1][0][255, 255, :])
+        numpy.testing.assert_array_equal([174, 130, 0], pj.image.value[1][0][255, 255, :])
 
         delta = [d / 8 for d in dfr]
         # this rect is 1/8 the size of the full image, in the center of the image
@@ -5268,8 +5275,9 @@ class StaticStreamsTestCase(unittest.TestCase):
         # Wait a little bit to make sure the image has been generated
         time.sleep(0.5)
 
-        # reads 4 tiles from the disk, no tile is cached becase the zoom changed
-        self.assertEqual(10, len(read_tiles))
+        # reads 3 tiles from the disk, the center tile is still cached from
+        # the first time the view was at this zoom level
+        self.assertEqual(9, len(read_tiles))
         self.assertEqual(len(pj.image.value), 2)
         self.assertEqual(len(pj.image.value[0]), 2)
         # top-left pixel of the top-left tile
@@ -5284,6 +5292,99 @@ class StaticStreamsTestCase(unittest.TestCase):
         # get the old function back to the class
         tiff.DataArrayShadowPyramidalTIFF.getTile = tiff.DataArrayShadowPyramidalTIFF._getTileOldSZ
 
+    def test_rgb_tiled_stream_prefetch(self):
+        """
+        Check the tiles around the view are loaded in advance, and used when the view moves
+        """
+        read_tiles = []  # (str, (int, int, int)): name of the thread, and x, y, zoom
+        def getTileMock(self, x, y, zoom):
+            read_tiles.append((threading.current_thread().name, (x, y, zoom)))
+            return tiff.DataArrayShadowPyramidalTIFF._getTileOldSPF(self, x, y, zoom)
+
+        tiff.DataArrayShadowPyramidalTIFF._getTileOldSPF = tiff.DataArrayShadowPyramidalTIFF.getTile
+        tiff.DataArrayShadowPyramidalTIFF.getTile = getTileMock
+
+        POS = (5.0, 7.0)
+        md = {
+            model.MD_DIMS: 'YX',
+            model.MD_POS: POS,
+            model.MD_PIXEL_SIZE: (1e-6, 1e-6),
+        }
+        arr = numpy.arange(2000 * 3000, dtype=numpy.uint16).reshape(2000, 3000)
+        data = model.DataArray(arr, metadata=md)
+        tiff.export(FILENAME, data, pyramid=True)
+
+        acd = tiff.open_data(FILENAME)
+        ss = stream.StaticSEMStream("test", acd.content[0])
+        pj = stream.RGBSpatialProjection(ss)
+        time.sleep(0.5)
+
+        def sync_reads():
+            # tiles read to compute the image
+            return [t for n, t in read_tiles if n == "Image computation"]
+
+        # Small view at the center, at zoom 1 (6x4 tiles) => only the tile (2, 1)
+        pj.mpp.value = 2e-6
+        pj.rect.value = (POS[0], POS[1], POS[0] + 1e-5, POS[1] + 1e-5)
+        time.sleep(1)
+        self.assertEqual((2, 1, 1), sync_reads()[-1])
+        nsync = len(sync_reads())
+        prefetched = set(t for n, t in read_tiles if n != "Image computation")
+        # The ring around the view, and the view at zoom levels 0 and 2
+        ring = set((x, y, 1) for x in (1, 2, 3) for y in (0, 1, 2)) - {(2, 1, 1)}
+        self.assertTrue(ring <= prefetched)
+        self.assertIn((1, 0, 2), prefetched)
+        self.assertTrue(set((x, y, 0) for x in (4, 5) for y in (2, 3)) <= prefetched)
+
+        # Pan one tile to the right => the tile is already there
+        dx = 256 * 2e-6
+        pj.rect.value = (POS[0] + dx, POS[1], POS[0] + dx + 1e-5, POS[1] + 1e-5)
+        time.sleep(1)
+        self.assertEqual(nsync, len(sync_reads()))
+        self.assertEqual(len(pj.image.value), 1)
+        numpy.testing.assert_array_equal(pj.raw[0][0], tiff.DataArrayShadowPyramidalTIFF._getTileOldSPF(acd.content[0], 3, 1, 1))
+        self.assertAlmostEqual(pj._panDirection[0], 1)
+        self.assertAlmostEqual(pj._panDirection[1], 0)
+
+        # Changing the display only needs to project again the cached raw tiles
+        ss.tint.value = (255, 0, 0)
+        time.sleep(0.5)
+        nsync = len(sync_reads())
+        pj.rect.value = (POS[0] + 2 * dx, POS[1], POS[0] + 2 * dx + 1e-5, POS[1] + 1e-5)
+        time.sleep(1)
+        self.assertEqual(nsync, len(sync_reads()))
+        numpy.testing.assert_array_equal(pj.image.value[0][0][0, 0], img.DataArray2RGB(pj.raw[0][0][0:1, 0:1], ss._getDisplayIRange(), (255, 0, 0))[0, 0])
+
+        tiff.DataArrayShadowPyramidalTIFF.getTile = tiff.DataArrayShadowPyramidalTIFF._getTileOldSPF
+
+    def test_rgb_tiled_stream_prefetch_release(self):
+        """
+        Check the prefetching can be disabled, and its threads stop with the projection
+        """
+        md = {
+            model.MD_DIMS: 'YX',
+            model.MD_POS: (5.0, 7.0),
+            model.MD_PIXEL_SIZE: (1e-6, 1e-6),
+        }
+        data = model.DataArray(numpy.zeros((2000, 3000), dtype=numpy.uint16), metadata=md)
+        tiff.export(FILENAME, data, pyramid=True)
+
+        acd = tiff.open_data(FILENAME)
+        ss = stream.StaticSEMStream("test", acd.content[0])
+        pj = stream.RGBSpatialProjection(ss, prefetch=False)
+        self.assertIsNone(pj._prefetcher)
+        del pj
+
+        pj = stream.RGBSpatialProjection(ss)
+        time.sleep(0.5)
+        prefetcher = pj._prefetcher
+        self.assertIsNotNone(prefetcher)
+        del pj
+        gc.collect()
+        # The executor is shut down => no more task accepted
+        with self.assertRaises(RuntimeError):
+            prefetcher.submit(time.sleep, 0)
+
     def test_rgb_updatable_stream(self):
         """Test RGBUpdatableStream """
 
@@ -260,10 +260,39 @@ def print_roattributes(component, pretty):
         print_roattribute(name, value, pretty)
 
 def print_data_flow(name, df, pretty):
+    try:
+        stats = df.getStatistics()
+    except Exception:
+        logging.debug("Failed to get statistics of data-flow %s", name, exc_info=True)
+        stats = None
+
     if pretty:
-        print(u"\t" + name + u" (Data-flow)")
+        if stats:
+            dur = stats["duration"]
+            print(u"\t%s (Data-flow)\tpublished: %d arrays (%s, %s), delivered locally: %d" %
+                  (name, stats["published"],
+                   units.readable_str(stats["published"] / dur, "fps", sig=3),
+                   units.readable_str(stats["published_bytes"] / dur, "B/s", sig=3),
+                   stats["delivered"]))
+            # The CLI doesn't subscribe, so show what the subscribers reported
+            print(u"\t\treceived by subscribers: %d arrays, dropped: %d" %
+                  (stats["subscribers_received"], stats["subscribers_dropped"]))
+            if stats["latency_avg"] is not None:
+                print(u"\t\tlatency: %s (max %s)" %
+                      (units.readable_str(stats["latency_avg"], "s", sig=3),
+                       units.readable_str(stats["latency_max"], "s", sig=3)))
+            if stats["callback_time_avg"] is not None:
+                print(u"\t\tcallback time: %s (max %s)" %
+                      (units.readable_str(stats["callback_time_avg"], "s", sig=3),
+                       units.readable_str(stats["callback_time_max"], "s", sig=3)))
+        else:
+            print(u"\t" + name + u" (Data-flow)")
     else:
-        print(u"%s\ttype:data-flow" % (name,))
+        if stats:
+            print(u"%s\ttype:data-flow\t%s" %
+                  (name, u"\t".join(u"%s:%s" % (k, v) for k, v in sorted(stats.items()))))
+        else:
+            print(u"%s\ttype:data-flow" % (name,))
 
 def print_data_flows(component, pretty):
     # find all dataflows
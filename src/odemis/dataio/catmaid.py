@@ -22,12 +22,22 @@ see http://www.gnu.org/licenses/.
 """
 from __future__ import division
 
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import configparser
+import functools
+import errno
+import hashlib
+import json
 import logging
 import math
 import numpy
+import os
 import re
 import requests
+from requests.adapters import HTTPAdapter
+import threading
+import time
 from future.moves.urllib.parse import urlparse, parse_qs
 
 from PIL import Image
@@ -39,6 +49,7 @@ from odemis import model
 from odemis.dataio import AuthenticationError
 from odemis.model import AcquisitionData, DataArrayShadow
 from odemis.util.conversion import get_tile_md_pos
+from odemis.util.tilecache import LRUCache
 
 
 # User-friendly name
@@ -79,6 +90,24 @@ SUPPORTED_CONTENT_TYPES = {
 
 KEY_PATH = "~/.local/share/odemis/catmaid.key"
 
+# Maximum number of tiles downloaded simultaneously, per stack
+MAX_DOWNLOAD_THREADS = 8
+# Maximum size of the downloaded tiles kept in memory until they are read, per
+# stack (in bytes). Above that, the least recently downloaded ones are dropped.
+DOWNLOADED_MAX_SIZE = 64 * 2 ** 20
+
+# The downloaded tiles are kept on disk, to not download them again, even after
+# a restart. When the total size is above CACHE_MAX_SIZE, the least recently
+# used tiles are deleted. The tiles are stored per user (credentials), so that
+# a tile downloaded by a user is never served to another one.
+CACHE_DIR = "~/.cache/odemis/catmaid"
+CACHE_MAX_SIZE = 512 * 2 ** 20  # bytes, 0 disables the disk cache
+# A tile from the disk cache is used as-is if it has been checked with the
+# server less than this period ago (in s). Otherwise, it's revalidated with its
+# ETag (or Last-Modified date), which avoids downloading it again if it hasn't
+# changed.
+CACHE_REVALIDATE_PERIOD = 3600
+
 # Tile Source Types
 FILE_BASED = 1
 REQUEST_QUERY = 2
@@ -169,7 +198,17 @@ class DataArrayShadowPyramidalCatmaid(DataArrayShadow):
         DataArrayShadow.__init__(self, shape, dtype, metadata, maxzoom=maxzoom, tile_shape=tile_shape)
 
         self._base_url = base_url
+        # The connections are kept open and reused, for all the download threads
         self._session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=MAX_DOWNLOAD_THREADS)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+        self._executor = ThreadPoolExecutor(max_workers=MAX_DOWNLOAD_THREADS)
+        self._downloads = {}  # str (URL) -> Future returning the tile as a numpy array
+        self._downloads_lock = threading.Lock()
+        # Tiles downloaded (eg, prefetched) but not yet read: URL -> numpy array
+        self._downloaded = LRUCache(DOWNLOADED_MAX_SIZE)
+        self._disk_cache = get_disk_cache()
         _, username, password = read_config_file(self._base_url, username=True, password=True)
         self._auth = (username, password)
         self._stack_info = stack_info
@@ -187,26 +226,18 @@ class DataArrayShadowPyramidalCatmaid(DataArrayShadow):
         return:
             tile (DataArray): tile containing the image data and the relevant metadata.
         """
-        tile_width, tile_height = self.tile_shape
-        tile_url = format_tile_url(
-            tile_source_type=self._stack_info["mirrors"][0]["tile_source_type"],
-            image_base=self._stack_info["mirrors"][0]["image_base"],
-            zoom=zoom,
-            depth=depth,
-            col=x,
-            row=y,
-            file_extension=self._file_extension,
-            tile_width=tile_width,
-            tile_height=tile_height,
-        )
+        tile_url = self._getTileUrl(x, y, zoom, depth)
         try:
-            image = response_to_array(self._session.get(tile_url, auth=self._auth))
+            image = self._download(tile_url).result()
         except HTTPError as e:
             if e.response.status_code == 401:
                 raise AuthenticationError("Authentication failed while getting tiles at {}".format(tile_url))
             else:
                 logging.error("No tile at %s (error %s), returning blank tile", tile_url, e.response.status_code)
+                tile_width, tile_height = self.tile_shape
                 image = numpy.zeros((tile_width, tile_height), dtype=self.dtype)
+        # Now it's read, no need to keep it
+        self._downloaded.discard(tile_url)
 
         tile = model.DataArray(image, self.metadata.copy())
         orig_pixel_size = self.metadata.get(model.MD_PIXEL_SIZE, (1e-6, 1e-6))
@@ -219,10 +250,120 @@ class DataArrayShadowPyramidalCatmaid(DataArrayShadow):
 
         return tile
 
+    def prefetchTiles(self, tiles, depth=0):
+        """
+        Start downloading tiles in the background, in parallel. The function
+          returns immediately. It allows the following calls to getTile() for
+          these tiles to be faster.
+        tiles (list of (int, int, int)): X index, Y index, and zoom level of each tile
+        depth (0<=int): The Z index of the stack.
+        """
+        for x, y, zoom in tiles:
+            self._download(self._getTileUrl(x, y, zoom, depth))
+
     def getData(self):
         """Abstract method of DataArrayShadow"""
         raise NotImplementedError()
 
+    def _getTileUrl(self, x, y, zoom, depth):
+        """
+        return (str): the URL of the given tile
+        """
+        tile_width, tile_height = self.tile_shape
+        return format_tile_url(
+            tile_source_type=self._stack_info["mirrors"][0]["tile_source_type"],
+            image_base=self._stack_info["mirrors"][0]["image_base"],
+            zoom=zoom,
+            depth=depth,
+            col=x,
+            row=y,
+            file_extension=self._file_extension,
+            tile_width=tile_width,
+            tile_height=tile_height,
+        )
+
+    def _download(self, url):
+        """
+        Schedule the download of a tile, unless it's already being downloaded
+        url (str): the URL of the tile
+        return (Future): returns the tile (numpy array) once downloaded. It
+          raises an HTTPError if the server returned an error.
+        """
+        with self._downloads_lock:
+            f = self._downloads.get(url)
+            if f is None:
+                image = self._downloaded.get(url)
+                if image is not None:
+                    return model.InstantaneousFuture(image)
+                f = self._executor.submit(self._fetchTile, url)
+                self._downloads[url] = f
+                f.add_done_callback(functools.partial(self._onDownloadDone, url))
+        return f
+
+    def _onDownloadDone(self, url, f):
+        """
+        Called when the download of a tile is over. Keeps the tile in memory
+          until it's read.
+        url (str): the URL of the tile
+        f (Future): the download
+        """
+        # Note: it can be called immediately, from _download(), so it cannot take the lock
+        if not f.cancelled() and f.exception() is None:
+            # Stored before removing the Future, so that the tile is always
+            # found by _download()
+            self._downloaded.put(url, f.result())
+        self._downloads.pop(url, None)
+
+    def _getCacheKey(self, url):
+        """
+        return (str): the key of the tile in the disk cache. It contains the
+          credentials, so that a tile is only served to the same user.
+        """
+        username, password = self._auth
+        return "{}:{}@{}".format(username or "", password or "", url)
+
+    def _fetchTile(self, url):
+        """
+        Get a tile, from the disk cache, or from the server
+        url (str): the URL of the tile
+        return (numpy array): the tile
+        raise HTTPError: if the server returned an error
+        """
+        key = self._getCacheKey(url)
+        cached = self._disk_cache.get(key) if self._disk_cache else None
+        headers = {}
+        if cached:
+            content, info = cached
+            if time.time() - info.get("validated", 0) < CACHE_REVALIDATE_PERIOD:
+                return content_to_array(content, info["content_type"])
+            # Only download the tile if it has changed
+            if info.get("etag"):
+                headers["If-None-Match"] = info["etag"]
+            if info.get("last_modified"):
+                headers["If-Modified-Since"] = info["last_modified"]
+
+        try:
+            response = self._session.get(url, auth=self._auth, headers=headers)
+        except requests.ConnectionError:
+            if cached:
+                logging.warning("Failed to connect to %s, using the cached tile", url)
+                return content_to_array(content, info["content_type"])
+            raise
+
+        if cached and response.status_code == 304:  # Not modified
+            info["validated"] = time.time()
+            self._disk_cache.put_info(key, info)
+            return content_to_array(content, info["content_type"])
+
+        image = response_to_array(response)
+        if self._disk_cache:
+            info = {"content_type": response.headers['Content-Type'],
+                    "etag": response.headers.get("ETag"),
+                    "last_modified": response.headers.get("Last-Modified"),
+                    "validated": time.time()}
+            self._disk_cache.put(key, response.content, info)
+        return image
+
 
 class AcquisitionDataCatmaid(AcquisitionData):
     """
@@ -284,10 +425,18 @@ def response_to_array(response):
        image (numpy array): the requested image from the response.
     """
     response.raise_for_status()
-    content_type = response.headers['Content-Type']
+    return content_to_array(response.content, response.headers['Content-Type'])
+
 
+def content_to_array(content, content_type):
+    """
+    content (bytes): the encoded image, as received from the server
+    content_type (str): the MIME type of the image
+    return:
+       image (numpy array): the decoded image
+    """
     if content_type in SUPPORTED_CONTENT_TYPES:
-        buffer = BytesIO(response.content)  # opening directly from raw response doesn't work for JPEGs
+        buffer = BytesIO(content)  # opening directly from raw response doesn't work for JPEGs
         raw_img = Image.open(buffer).convert('L')
         return numpy.array(raw_img)
     else:
@@ -295,6 +444,161 @@ def response_to_array(response):
             content_type.upper().split('/')[1]))
 
 
+class TileDiskCache(object):
+    """
+    Stores the content of URLs in a directory, along with some information about
+      them (as a JSON dict). When the total size is above the maximum size, the
+      least recently used entries are deleted. It is thread-safe.
+    """
+
+    def __init__(self, path, max_size):
+        """
+        path (str): directory where to store the files. It is created if needed.
+        max_size (0<int): maximum total size of the content (in bytes)
+        """
+        self._path = os.path.expanduser(path)
+        self._max_size = max_size
+        self._lock = threading.Lock()
+        try:
+            os.makedirs(self._path)
+        except OSError as ex:
+            if ex.errno != errno.EEXIST:
+                raise
+
+        # Look for the existing entries, the least recently used first
+        self._entries = OrderedDict()  # str (name) -> int (size in bytes)
+        self._size = 0
+        entries = []
+        for fn in os.listdir(self._path):
+            if fn.endswith(".tile"):
+                try:
+                    st = os.stat(os.path.join(self._path, fn))
+                except OSError:  # Deleted in the meantime
+                    continue
+                entries.append((st.st_mtime, fn[:-len(".tile")], st.st_size))
+        for _, name, size in sorted(entries):
+            self._entries[name] = size
+            self._size += size
+        logging.debug("Tile disk cache at %s contains %d tiles, for %d bytes",
+                      self._path, len(self._entries), self._size)
+
+    def _name(self, url):
+        return hashlib.sha1(url.encode("utf-8")).hexdigest()
+
+    def get(self, url):
+        """
+        url (str): the URL of the content
+        return (None or (bytes, dict)): the content and its information, or
+          None if it's not in the cache
+        """
+        name = self._name(url)
+        fn = os.path.join(self._path, name)
+        with self._lock:
+            if name not in self._entries:
+                return None
+            # Mark as recently used
+            self._entries[name] = self._entries.pop(name)
+
+        try:
+            with open(fn + ".tile", "rb") as f:
+                content = f.read()
+            with open(fn + ".json", "r") as f:
+                info = json.load(f)
+            os.utime(fn + ".tile", None)
+        except (IOError, OSError, ValueError):
+            logging.debug("Failed to read cached tile %s", fn, exc_info=True)
+            self._remove(name)
+            return None
+        return content, info
+
+    def put(self, url, content, info):
+        """
+        Store the content of a URL (replacing the previous version, if any)
+        url (str): the URL of the content
+        content (bytes): the content
+        info (dict str -> value): extra information to store, which must be
+          serialisable in JSON
+        """
+        if len(content) > self._max_size:
+            return
+        name = self._name(url)
+        fn = os.path.join(self._path, name)
+        try:
+            # Write via temporary files, so that another reader never sees a
+            # partial file
+            with open(fn + ".tile.tmp", "wb") as f:
+                f.write(content)
+            with open(fn + ".json.tmp", "w") as f:
+                json.dump(info, f)
+            os.rename(fn + ".json.tmp", fn + ".json")
+            os.rename(fn + ".tile.tmp", fn + ".tile")
+        except (IOError, OSError):
+            logging.warning("Failed to store tile in cache %s", fn, exc_info=True)
+            return
+
+        with self._lock:
+            self._size -= self._entries.pop(name, 0)
+            self._entries[name] = len(content)
+            self._size += len(content)
+            to_remove = []
+            while self._size > self._max_size:
+                oname, osize = self._entries.popitem(last=False)
+                self._size -= osize
+                to_remove.append(oname)
+
+        for oname in to_remove:
+            self._delete_files(oname)
+
+    def put_info(self, url, info):
+        """
+        Update the information of a URL already in the cache
+        url (str): the URL of the content
+        info (dict str -> value): the new information
+        """
+        fn = os.path.join(self._path, self._name(url))
+        try:
+            with open(fn + ".json.tmp", "w") as f:
+                json.dump(info, f)
+            os.rename(fn + ".json.tmp", fn + ".json")
+        except (IOError, OSError):
+            logging.warning("Failed to update cached tile info %s", fn, exc_info=True)
+
+    def _remove(self, name):
+        with self._lock:
+            self._size -= self._entries.pop(name, 0)
+        self._delete_files(name)
+
+    def _delete_files(self, name):
+        fn = os.path.join(self._path, name)
+        for ext in (".tile", ".json"):
+            try:
+                os.remove(fn + ext)
+            except OSError:
+                pass  # Already deleted (eg, by another process)
+
+
+_disk_caches = {}  # str (path) -> TileDiskCache
+_disk_caches_lock = threading.Lock()
+
+
+def get_disk_cache():
+    """
+    return (TileDiskCache or None): the disk cache at CACHE_DIR, shared by all
+      the stacks, or None if it's disabled (or cannot be created)
+    """
+    if CACHE_MAX_SIZE <= 0:
+        return None
+    path = os.path.expanduser(CACHE_DIR)
+    with _disk_caches_lock:
+        if path not in _disk_caches:
+            try:
+                _disk_caches[path] = TileDiskCache(path, CACHE_MAX_SIZE)
+            except (IOError, OSError):
+                logging.warning("Failed to open tile cache at %s, will not cache tiles", path, exc_info=True)
+                return None
+        return _disk_caches[path]
+
+
 STACK_URL = "{base_url}/{project_id}/stack/{stack_id}/info"
 
 
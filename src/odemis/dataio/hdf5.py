@@ -27,11 +27,12 @@ import collections
 import h5py
 import json
 import logging
+import math
 import numpy
 from odemis import model
 import odemis
-from odemis.util import spectrum, img, fluo
-from odemis.util.conversion import JsonExtraEncoder
+from odemis.util import spectrum, img, fluo, fileindex
+from odemis.util.conversion import JsonExtraEncoder, get_tile_md_pos
 import os
 import time
 
@@ -43,6 +44,15 @@ EXTENSIONS = [u".h5", u".hdf5"]
 LOSSY = False
 CAN_SAVE_PYRAMID = False
 
+# Layout of the chunks of the datasets
+CHUNK_PIXEL = "pixel"  # All the values of a few pixels (eg, spectra)
+CHUNK_PLANE = "plane"  # Part of one image (ie, one wavelength, one time...)
+# Approximate maximum size of a chunk, in bytes (HDF5 recommends at most 1 MiB)
+MAX_CHUNK_SIZE = 1024 * 1024
+
+# Size (X and Y) of the tiles provided by the DataArrayShadows of 2D images
+TILE_SIZE = 256
+
 # We are trying to follow the same format as SVI, as defined here:
 # http://www.svi.nl/HDF5
 # A file follows this structure:
@@ -140,16 +150,28 @@ def _create_image_dataset(group, dataset_name, image, **kwargs):
     """
     assert(len(image.shape) >= 2)
     image_dataset = group.create_dataset(dataset_name, data=image, **kwargs)
+    _add_image_dataset_attrs(image_dataset, (image.min(), image.max()))
+
+    return image_dataset
+
 
+def _add_image_dataset_attrs(image_dataset, minmax):
+    """
+    Add the attributes to a dataset to respect the HDF5 image specification
+    image_dataset (HDF Dataset): dataset containing the image. It should have
+      at least 2 dimensions
+    minmax (2 numbers): minimum and maximum values of the image
+    """
+    shape = image_dataset.shape
     # numpy.string_ is to force fixed-length string (necessary for compatibility)
     # FIXME: needs to be NULLTERM, not NULLPAD... but h5py doesn't allow to distinguish
     image_dataset.attrs["CLASS"] = numpy.string_("IMAGE")
     # Colour image?
-    if image.ndim == 3 and (image.shape[-3] == 3 or image.shape[-1] == 3):
+    if len(shape) == 3 and (shape[-3] == 3 or shape[-1] == 3):
         # TODO: check dtype is int?
         image_dataset.attrs["IMAGE_SUBCLASS"] = numpy.string_("IMAGE_TRUECOLOR")
         image_dataset.attrs["IMAGE_COLORMODEL"] = numpy.string_("RGB")
-        if image.shape[-3] == 3:
+        if shape[-3] == 3:
             # Stored as [pixel components][height][width]
             image_dataset.attrs["INTERLACE_MODE"] = numpy.string_("INTERLACE_PLANE")
         else: # This is the numpy standard
@@ -158,19 +180,71 @@ def _create_image_dataset(group, dataset_name, image, **kwargs):
     else:
         image_dataset.attrs["IMAGE_SUBCLASS"] = numpy.string_("IMAGE_GRAYSCALE")
         image_dataset.attrs["IMAGE_WHITE_IS_ZERO"] = numpy.array(0, dtype="uint8")
-        image_dataset.attrs["IMAGE_MINMAXRANGE"] = [image.min(), image.max()]
+        image_dataset.attrs["IMAGE_MINMAXRANGE"] = list(minmax)
 
     image_dataset.attrs["DISPLAY_ORIGIN"] = numpy.string_("UL") # not rotated
     image_dataset.attrs["IMAGE_VERSION"] = numpy.string_("1.2")
 
-    return image_dataset
 
+def _get_chunk_shape(shape, dtype, dims, layout):
+    """
+    Compute a chunk shape fitting the way the data will be read.
+    shape (tuple of ints): shape of the dataset
+    dtype (numpy.dtype): type of the data
+    dims (str): name of each dimension, must contain X and Y
+    layout (CHUNK_PIXEL or CHUNK_PLANE): CHUNK_PIXEL for a chunk containing
+      all the values (eg, a spectrum) of a small square of pixels,
+      CHUNK_PLANE for a chunk containing (part of) a single image.
+    returns (tuple of ints or None): the chunk shape, or None if the data is
+      empty.
+    """
+    if 0 in shape:
+        return None
+
+    maxpx = max(1, MAX_CHUNK_SIZE // numpy.dtype(dtype).itemsize)
+    chunk = list(shape)
+    yi, xi = dims.index("Y"), dims.index("X")
+    if layout == CHUNK_PIXEL:
+        depth = int(numpy.prod([l for d, l in zip(dims, shape) if d not in "YX"]))
+        side = max(1, int(math.sqrt(maxpx // depth)))
+        chunk[yi] = min(shape[yi], side)
+        chunk[xi] = min(shape[xi], side)
+    elif layout == CHUNK_PLANE:
+        for i, d in enumerate(dims):
+            if d not in "YX":
+                chunk[i] = 1
+        # As many complete lines as fit
+        chunk[xi] = min(shape[xi], maxpx)
+        chunk[yi] = min(shape[yi], max(1, maxpx // chunk[xi]))
+    else:
+        raise ValueError("Unknown chunk layout %s" % (layout,))
+
+    return tuple(chunk)
 
-def _read_image_dataset(dataset):
+
+def _guess_chunk_layout(da):
     """
-    Get a numpy array from a dataset respecting the HDF5 image specification.
-    returns (numpy.ndimage): it has at least 2 dimensions and if RGB, it has
-     a 3 dimensions and the metadata MD_DIMS indicates the order.
+    Guess how the data is going to be read.
+    da (DataArray): the data (or just its metadata), with the dimensions ordered
+      as in the file
+    returns (CHUNK_PIXEL or CHUNK_PLANE)
+    """
+    md = da.metadata
+    dims = md.get(model.MD_DIMS, "CTZYX"[-da.ndim:])
+    # Spectrum or temporal data is typically read pixel per pixel (for
+    # displaying the spectrum/chronogram) => keep all the values of a pixel
+    # together.
+    for d, mdk in (("C", model.MD_WL_LIST), ("T", model.MD_TIME_LIST)):
+        if d in dims and da.shape[dims.index(d)] > 1 and mdk in md:
+            return CHUNK_PIXEL
+    return CHUNK_PLANE
+
+
+def _read_image_dataset_md(dataset):
+    """
+    Check a dataset respects the HDF5 image specification, and get the metadata
+      it provides, without reading the data.
+    returns (dict str->val): the metadata. If RGB, MD_DIMS indicates the order.
     raises
      IOError: if it doesn't conform to the standard
      NotImplementedError: if the image uses so fancy standard features
@@ -185,7 +259,7 @@ def _read_image_dataset(dataset):
     # conversion is almost entirely different depending on subclass
     subclass = dataset.attrs.get("IMAGE_SUBCLASS", b"IMAGE_GRAYSCALE")
 
-    image = model.DataArray(dataset[...])
+    md = {}
     if subclass == b"IMAGE_GRAYSCALE":
         pass
     elif subclass == b"IMAGE_TRUECOLOR":
@@ -204,9 +278,9 @@ def _read_image_dataset(dataset):
 
         if il_mode == b"INTERLACE_PLANE":
             # colour is first dim
-            image.metadata[model.MD_DIMS] = "CYX"
+            md[model.MD_DIMS] = "CYX"
         elif il_mode == b"INTERLACE_PIXEL":
-            image.metadata[model.MD_DIMS] = "YXC"
+            md[model.MD_DIMS] = "YXC"
         else:
             raise NotImplementedError("Unable to handle images of subclass '%s'" % subclass)
 
@@ -218,7 +292,20 @@ def _read_image_dataset(dataset):
     if dorig != b"UL":
         logging.warning("Image rotation %s not handled", dorig)
 
-    return image
+    return md
+
+
+def _read_image_dataset(dataset):
+    """
+    Get a numpy array from a dataset respecting the HDF5 image specification.
+    returns (numpy.ndimage): it has at least 2 dimensions and if RGB, it has
+     a 3 dimensions and the metadata MD_DIMS indicates the order.
+    raises
+     IOError: if it doesn't conform to the standard
+     NotImplementedError: if the image uses so fancy standard features
+    """
+    md = _read_image_dataset_md(dataset)
+    return model.DataArray(dataset[...], md)
 
 
 def _add_image_info(group, dataset, image):
@@ -620,13 +707,29 @@ def _read_image_info(group):
     return md
 
 
+def _split_first_dim(da):
+    """
+    Separate a DataArray along its first dimension
+    da (DataArray or DataArrayShadowHDF5): the data to separate
+    returns (list of DataArrays or DataArrayShadowHDF5s): one per index of the
+      first dimension, each with a copy of the metadata
+    """
+    if isinstance(da, DataArrayShadowHDF5):
+        return [DataArrayShadowHDF5(da.dataset, da.metadata.copy(), da.index + (i,))
+                for i in range(da.shape[0])]
+    else:
+        # list(da) does almost what we need, but metadata is shared
+        return [model.DataArray(c, da.metadata.copy()) for c in da]
+
+
 def _parse_physical_data(pdgroup, da):
     """
     Parse the metadata found in PhysicalData, and cut the DataArray if necessary.
     pdgroup (HDF Group): the group "PhysicalData" associated to an image
-    da (DataArray): the DataArray that was obtained by reading the ImageData
-    returns (list of DataArrays): The same data, but broken into smaller 
-      DataArrays if necessary, and with additional metadata.
+    da (DataArray or DataArrayShadowHDF5): the DataArray that was obtained by
+      reading the ImageData
+    returns (list of DataArrays or DataArrayShadowHDF5s): The same data, but
+      broken into smaller DataArrays if necessary, and with additional metadata.
     """
     # The information in PhysicalData might be different for each channel (e.g.
     # fluorescence image). In this case, the DA must be separated into smaller
@@ -647,8 +750,7 @@ def _parse_physical_data(pdgroup, da):
                             da.shape[0], n)
             das = [da]
         else:
-            # list(da) does almost what we need, but metadata is shared
-            das = [model.DataArray(c, da.metadata.copy()) for c in da]
+            das = _split_first_dim(da)
     else:
         das = [da]
 
@@ -1171,6 +1273,11 @@ def _add_acquistion_svi(group, data, mds, **kwargs):
     # FIXME: should be done by _h5svi_set_state (and used)
     _h5py_enum_commit(group, b"StateEnumeration", _dtstate)
 
+    if "chunks" not in kwargs:
+        dims = data.metadata.get(model.MD_DIMS, "CTZYX"[-data.ndim:])
+        kwargs["chunks"] = _get_chunk_shape(data.shape, data.dtype, dims,
+                                            _guess_chunk_layout(data))
+
     # TODO: use scaleoffset to store the number of bits used (MD_BPP)
     ids = _create_image_dataset(gi, "Image", data, **kwargs)
     _add_image_info(gi, ids, data)
@@ -1345,14 +1452,13 @@ def _updateRGBMD(da):
     da.metadata[model.MD_DIMS] = dims
 
 
-def _thumbFromHDF5(filename):
+def _thumbFromHDF5(f):
     """
-    Read thumbnails from an HDF5 file.
+    Find the thumbnails in an HDF5 file.
     Expects to find them as IMAGE in Preview/Image.
-    return (list of model.DataArray)
+    f (h5py.File): the root of the file
+    return (list of DataArrayShadowHDF5)
     """
-    f = h5py.File(filename, "r")
-
     thumbs = []
     # look for the Preview directory
     try:
@@ -1366,29 +1472,29 @@ def _thumbFromHDF5(filename):
         # an image? (== has the attribute CLASS: IMAGE)
         if isinstance(ds, h5py.Dataset) and ds.attrs.get("CLASS") == b"IMAGE":
             try:
-                da = _read_image_dataset(ds)
+                md = _read_image_dataset_md(ds)
             except Exception:
                 logging.info("Skipping image '%s' which couldn't be read.", name)
                 continue
 
             if name == "Image":
                 try:
-                    da.metadata = _read_image_info(grp)
+                    md = _read_image_info(grp)
                 except Exception:
                     logging.debug("Failed to parse metadata of acquisition '%s'", name)
                     continue
 
-            thumbs.append(da)
+            thumbs.append(DataArrayShadowHDF5(ds, md))
 
     return thumbs
 
 
 def _dataFromSVIHDF5(f):
     """
-    Read microscopy data from an HDF5 file using the SVI convention.
+    Find the microscopy data in an HDF5 file using the SVI convention.
     Expects to find them as IMAGE in XXX/ImageData/Image + XXX/PhysicalData.
     f (h5py.File): the root of the file
-    return (list of model.DataArray)
+    return (list of DataArrayShadowHDF5)
     """
     data = []
 
@@ -1402,11 +1508,12 @@ def _dataFromSVIHDF5(f):
         except KeyError:
             continue  # not conforming => try next object
 
-        # Read the raw data
+        # Check the raw data (it is only read when requested)
         try:
-            da = _read_image_dataset(image)
+            da = DataArrayShadowHDF5(image, _read_image_dataset_md(image))
         except Exception:
             logging.exception("Failed to read data of acquisition '%s'", obj.name)
+            continue
 
         # TODO: read more metadata
         try:
@@ -1419,14 +1526,12 @@ def _dataFromSVIHDF5(f):
     return data
 
 
-def _dataFromHDF5(filename):
+def _dataFromHDF5(f):
     """
-    Read microscopy data from an HDF5 file.
-    filename (string): path of the file to read
-    return (list of model.DataArray)
+    Find the microscopy data in an HDF5 file.
+    f (h5py.File): the root of the file
+    return (list of DataArrayShadowHDF5)
     """
-    f = h5py.File(filename, "r")
-
     # if follows SVI convention => use the special function
     # If it has at least one directory like XXX/SVIData => it follows SVI conventions
     for obj in f.values():
@@ -1447,15 +1552,136 @@ def _dataFromHDF5(filename):
                 return
             # TODO: if it's an image, open it as an image
             # TODO: try to get some metadata?
-            da = model.DataArray(obj[...])
+            da = DataArrayShadowHDF5(obj, {})
         except Exception:
             logging.info("Skipping '%s' as it doesn't seem a correct data", name)
+            return
         data.append(da)
 
     f.visititems(addIfWorthy)
     return data
 
 
+class DataArrayShadowHDF5(model.DataArrayShadow):
+    """
+    Represents an image stored in an HDF5 dataset. The data is only read from
+    the file when requested, either completely, or just a part of it.
+    If the image is a greyscale 2D image (YX) with a pixel size, it also
+    supports tile access, via getTile(). HDF5 files have no sub-resolution
+    images, so the zoomed-out tiles are read by only picking one pixel out of
+    2**zoom, in X and Y.
+    """
+
+    def __init__(self, dataset, metadata=None, index=()):
+        """
+        dataset (h5py.Dataset): the dataset containing the image
+        metadata (dict str->val): The metadata
+        index (tuple of int): if the dataset contains several images, the index
+          of the image, on the first dimensions
+        """
+        self.dataset = dataset
+        self.index = index
+        shape = dataset.shape[len(index):]
+        metadata = metadata if metadata else {}
+
+        if (len(shape) == 2 and model.MD_PIXEL_SIZE in metadata and
+            metadata.get(model.MD_DIMS, "YX") == "YX"):
+            # Same zoom levels as the pyramidal TIFF files
+            maxzoom = 0
+            while all(s // 2 ** maxzoom >= TILE_SIZE for s in shape):
+                maxzoom += 1
+            model.DataArrayShadow.__init__(self, shape, dataset.dtype, metadata,
+                                           maxzoom=maxzoom, tile_shape=(TILE_SIZE, TILE_SIZE))
+        else:
+            model.DataArrayShadow.__init__(self, shape, dataset.dtype, metadata)
+
+    def getData(self):
+        """
+        Fetches the whole data (at full resolution) of image.
+        return DataArray: the data, with its metadata
+        """
+        return self.getSubData(Ellipsis)
+
+    def getSubData(self, key):
+        """
+        Fetches just a part of the data (aka hyperslab), without reading the rest
+          of the data from the file.
+        key (int, slice, Ellipsis, or tuple of them): the part of the data to
+          read, as with numpy basic indexing. The step of the slices must be
+          positive.
+        return DataArray: the data, with a copy of the metadata. Note that the
+          metadata is not adjusted (ie, MD_POS is still the one of the whole data).
+        """
+        if not isinstance(key, tuple):
+            key = (key,)
+        d = self.dataset[self.index + key]
+        return model.DataArray(d, self.metadata.copy())
+
+    def getTile(self, x, y, zoom):
+        """
+        Fetches one tile. Only available if the image is tiled (ie, has a
+          .maxzoom).
+        x (0<=int): X index of the tile.
+        y (0<=int): Y index of the tile
+        zoom (0<=int): zoom level to use. The total shape of the image is shape / 2**zoom.
+            The number of tiles available in an image is ceil((shape//zoom)/tile_shape)
+        return (DataArray): the tile, of shape at most tile_shape (Y, X), with
+          its MD_POS and MD_PIXEL_SIZE corresponding to the part of the image.
+        """
+        if not 0 <= zoom <= self.maxzoom:
+            raise ValueError("Invalid Z value %d" % (zoom,))
+
+        step = 2 ** zoom
+        key = []
+        # Y, then X
+        for i, s, ts in zip((y, x), self.shape, self.tile_shape[::-1]):
+            start = i * ts
+            length = min(ts, s // step - start)
+            if length <= 0:
+                raise IndexError("Tile %d,%d doesn't exist at zoom %d" % (x, y, zoom))
+            key.append(slice(start * step, (start + length) * step, step))
+
+        tile = self.getSubData(tuple(key))
+        md = tile.metadata
+        ps = md[model.MD_PIXEL_SIZE]
+        md[model.MD_PIXEL_SIZE] = tuple(v * step for v in ps[:2]) + tuple(ps[2:])
+        md[model.MD_POS] = get_tile_md_pos((x, y), self.tile_shape, tile, self)
+        return tile
+
+
+def _get_plane_shadow(das):
+    """
+    Simplifies an image with only one plane (ie, all the dimensions before YX
+      have a length of 1) to a 2D image, so that it supports tile access.
+    das (DataArrayShadowHDF5): the image
+    return (DataArrayShadowHDF5): das itself if it has several planes, otherwise
+      a 2D (YX) shadow of the same data
+    """
+    nhdim = das.ndim - 2
+    if nhdim <= 0 or any(s != 1 for s in das.shape[:nhdim]):
+        return das
+    if model.MD_DIMS in das.metadata:  # Special data (eg, RGB) => don't touch
+        return das
+
+    return DataArrayShadowHDF5(das.dataset, das.metadata, das.index + (0,) * nhdim)
+
+
+class AcquisitionDataHDF5(model.AcquisitionData):
+    """
+    Implements AcquisitionData for HDF5 files
+    """
+    def __init__(self, filename):
+        """
+        filename (string): The name of the HDF5 file
+        """
+        # The file stays opened as long as the data is accessible
+        self._file = h5py.File(filename, "r")
+        # Images with a single plane are provided as 2D images, with tile access
+        data = [_get_plane_shadow(das) for das in _dataFromHDF5(self._file)]
+        thumbnails = _thumbFromHDF5(self._file)
+        model.AcquisitionData.__init__(self, tuple(data), tuple(thumbnails))
+
+
 def _mergeCorrectionMetadata(da):
     """
     Create a new DataArray with metadata updated to with the correction metadata
@@ -1468,6 +1694,20 @@ def _mergeCorrectionMetadata(da):
     return model.DataArray(da, md) # create a view
 
 
+def _add_thumbnail(f, thumbnail, **kwargs):
+    """
+    Adds the thumbnail, in the special group "Preview"
+    f (h5py.File): the root of the file
+    thumbnail (DataArray): see export
+    """
+    thumbnail = _mergeCorrectionMetadata(thumbnail)
+    # Save the image as-is in a special group "Preview"
+    prevg = f.create_group("Preview")
+    _updateRGBMD(thumbnail) # ensure RGB info is there if needed
+    ids = _create_image_dataset(prevg, "Image", thumbnail, **kwargs)
+    _add_image_info(prevg, ids, thumbnail)
+
+
 def _saveAsHDF5(filename, ldata, thumbnail, compressed=True):
     """
     Saves a list of DataArray as a HDF5 (SVI) file.
@@ -1492,12 +1732,7 @@ def _saveAsHDF5(filename, ldata, thumbnail, compressed=True):
         compression = None
 
     if thumbnail is not None:
-        thumbnail = _mergeCorrectionMetadata(thumbnail)
-        # Save the image as-is in a special group "Preview"
-        prevg = f.create_group("Preview")
-        _updateRGBMD(thumbnail) # ensure RGB info is there if needed
-        ids = _create_image_dataset(prevg, "Image", thumbnail, compression=compression)
-        _add_image_info(prevg, ids, thumbnail)
+        _add_thumbnail(f, thumbnail, compression=compression)
 
     # merge correction metadata (as we cannot save them separatly in OME-TIFF)
     ldata = [_mergeCorrectionMetadata(da) for da in ldata]
@@ -1511,8 +1746,202 @@ def _saveAsHDF5(filename, ldata, thumbnail, compressed=True):
     f.close()
 
 
-# TODO: allow to append data to a file, or any other way to allow saving large
-# data without having everything in memory simultaneously.
+class Writer(object):
+    """
+    Writes an HDF5 file progressively, block by block, typically while the data
+    is being acquired. So the whole data doesn't need to be in memory.
+    The shape of each data must be known from the beginning.
+    Typical usage:
+      w = Writer(filename)
+      n = w.add_data(shape, dtype, md)
+      w.write_block(n, (slice(None), 5, slice(0, 10)), data)  # as often as needed
+      w.close(thumbnail)
+    Contrarily to export(), data with the same shape is never merged along C.
+    """
+
+    def __init__(self, filename, compressed=True):
+        """
+        filename (unicode): filename of the file to create (including path).
+          If it already exists, it's overwritten.
+        compressed (bool): whether the data is compressed. As it's compressed
+          while being acquired, a fast compression is used.
+        """
+        # h5py will extend the current file by default, so we want to make sure
+        # there is no file at all.
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+        self._file = h5py.File(filename, "w")
+        if compressed:
+            # The lowest level of gzip is much faster than the default one, and
+            # compresses almost as well. The shuffle filter (ie, group together
+            # the high bytes) helps a lot for data of more than 8 bits.
+            # lzf would be even faster, but only h5py can read it.
+            self._compression = {"compression": "gzip", "compression_opts": 1,
+                                 "shuffle": True}
+        else:
+            self._compression = {}
+
+        # For each data: dict with the group, dataset, shape, dims, metadata,
+        # and min/max values
+        self._data = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def add_data(self, shape, dtype, metadata, chunks=None):
+        """
+        Create a new data (aka acquisition) in the file, initially all 0's
+        shape (tuple of ints): shape of the data (at least 2 dimensions)
+        dtype (numpy.dtype): type of the data (int or float)
+        metadata (dict str->value): metadata of the data. MD_DIMS indicates the
+          order of the dimensions (default to CTZYX). More metadata can be
+          passed later, with update_metadata().
+        chunks (None, CHUNK_PIXEL or CHUNK_PLANE): how the data is going to be
+          read, which defines how it's split into chunks in the file.
+          None will guess it from the metadata (cf _guess_chunk_layout()).
+        returns (int): the index of the data, to be used to write blocks
+        raises ValueError: if the metadata doesn't fit the shape
+        """
+        md = dict(metadata)
+        dims = md.get(model.MD_DIMS, "CTZYX"[-len(shape):])
+        if len(shape) < 2 or len(dims) != len(shape):
+            raise ValueError("Shape %s doesn't match dimensions %s" % (shape, dims))
+        md[model.MD_DIMS] = dims
+
+        # Find the shape in the file, using a "fake" array of the right shape,
+        # which doesn't take any memory.
+        fda = self._get_file_da(shape, dtype, md)
+        fdims = fda.metadata[model.MD_DIMS]
+        if chunks is None:
+            chunks = _guess_chunk_layout(fda)
+        cshape = _get_chunk_shape(fda.shape, dtype, fdims, chunks)
+
+        n = len(self._data)
+        ga = self._file.create_group("Acquisition%d" % n)
+        gi = ga.create_group("ImageData")
+        # TODO: use scaleoffset to store the number of bits used (MD_BPP)
+        ds = gi.create_dataset("Image", shape=fda.shape, dtype=dtype,
+                               chunks=cshape, **self._compression)
+        self._data.append({"group": ga, "dataset": ds, "shape": tuple(shape),
+                           "dims": dims, "fdims": fdims, "md": md,
+                           "minmax": None})
+        return n
+
+    @staticmethod
+    def _get_file_da(shape, dtype, md):
+        """
+        returns (DataArray): array with zero strides, with the shape and
+          dimensions as stored in the file
+        """
+        fake = numpy.broadcast_to(numpy.zeros((), dtype), shape)
+        return _adjustDimensions(model.DataArray(fake, md))
+
+    def update_metadata(self, n, metadata):
+        """
+        Update the metadata of a data. It can be called at any time before close().
+        n (int): index of the data, as returned by add_data()
+        metadata (dict str->value): metadata to add (or replace). MD_DIMS cannot
+          be changed.
+        """
+        d = self._data[n]
+        if metadata.get(model.MD_DIMS, d["dims"]) != d["dims"]:
+            raise ValueError("Dimensions cannot be changed")
+        d["md"].update(metadata)
+
+    def write_block(self, n, index, data):
+        """
+        Write a part of a data.
+        n (int): index of the data, as returned by add_data()
+        index (tuple of int or slice): position of the block in the whole data,
+          in the same order as the dimensions of the data (as in numpy
+          indexing). Missing dimensions at the end are taken completely. The
+          step of the slices must be 1.
+        data (numpy.ndarray): the block. Its shape must match the index (the
+          dimensions indexed by an int can be either dropped or of length 1).
+        raises ValueError: if the index or the data doesn't fit
+        """
+        d = self._data[n]
+        shape, dims, fdims = d["shape"], d["dims"], d["fdims"]
+        if not isinstance(index, tuple):
+            index = (index,)
+        if len(index) > len(shape):
+            raise ValueError("Index %s has more dimensions than the data" % (index,))
+        index += (slice(None),) * (len(shape) - len(index))
+
+        # Convert every index into a slice, to always get all the dimensions
+        sel = {}
+        bshape = []
+        for dim, i, l in zip(dims, index, shape):
+            if isinstance(i, slice):
+                start, stop, step = i.indices(l)
+                if step != 1:
+                    raise ValueError("Slice step must be 1, but got %s" % (i,))
+            else:
+                start = int(i)
+                if start < 0:
+                    start += l
+                if not 0 <= start < l:
+                    raise ValueError("Index %s out of range for dimension %s" % (i, dim))
+                stop = start + 1
+            sel[dim] = slice(start, max(start, stop))
+            bshape.append(max(0, stop - start))
+
+        data = numpy.asarray(data)
+        if data.size != numpy.prod(bshape):
+            raise ValueError("Data of shape %s doesn't fit index %s" % (data.shape, index))
+        # Reorder the dimensions as in the file (the missing ones are of length 1)
+        data = data.reshape(bshape)
+        data = data.transpose([dims.index(dim) for dim in fdims if dim in dims])
+        data = data.reshape([bshape[dims.index(dim)] if dim in dims else 1 for dim in fdims])
+        key = tuple(sel.get(dim, slice(None)) for dim in fdims)
+        d["dataset"][key] = data
+
+        if data.size:
+            mn, mx = data.min(), data.max()
+            if d["minmax"] is not None:
+                mn, mx = min(mn, d["minmax"][0]), max(mx, d["minmax"][1])
+            d["minmax"] = mn, mx
+
+    def close(self, thumbnail=None):
+        """
+        Write the metadata and close the file. Nothing can be written afterwards.
+        thumbnail (None or DataArray): see export
+        """
+        if self._file is None:
+            return
+
+        try:
+            if thumbnail is not None:
+                _add_thumbnail(self._file, thumbnail, **self._compression)
+
+            for d in self._data:
+                ga, ds = d["group"], d["dataset"]
+                md = d["md"]
+                # merge correction metadata (as in export)
+                img.mergeMetadata(md)
+                fda = self._get_file_da(d["shape"], ds.dtype, md)
+
+                minmax = d["minmax"]
+                if minmax is None:  # Nothing written, so it's all 0's
+                    minmax = (0, 0)
+                _add_image_dataset_attrs(ds, minmax)
+
+                # StateEnumeration
+                # FIXME: should be done by _h5svi_set_state (and used)
+                _h5py_enum_commit(ga, b"StateEnumeration", _dtstate)
+                _add_image_info(ga["ImageData"], ds, fda)
+                _add_image_metadata(ga, fda, None)
+                _add_svi_info(ga)
+        finally:
+            self._file.close()
+            self._file = None
+
+
 def export(filename, data, thumbnail=None):
     '''
     Write an HDF5 file with the given image and metadata
@@ -1552,8 +1981,8 @@ def read_data(filename):
     # TODO: support filename to be a File or Stream (but it seems very difficult
     # to do it without looking at the .filename attribute)
     # see http://pytables.github.io/cookbook/inmemory_hdf5_files.html
-
-    return _dataFromHDF5(filename)
+    with h5py.File(filename, "r") as f:
+        return [das.getData() for das in _dataFromHDF5(f)]
 
 
 def read_thumbnail(filename):
@@ -1566,7 +1995,26 @@ def read_thumbnail(filename):
     raises:
         IOError in case the file format is not as expected.
     """
+    # If the file is already indexed, no need to open it. Otherwise, it's
+    # opened once, and indexed for the next time.
+    finfo = fileindex.get_info(filename)
+    if finfo is not None:
+        return finfo.thumbnails
+
+    # Failed to index => read it directly, to report the error
     # TODO: support filename to be a File or Stream
+    with h5py.File(filename, "r") as f:
+        return [das.getData() for das in _thumbFromHDF5(f)]
 
-    return _thumbFromHDF5(filename)
 
+def open_data(filename):
+    """
+    Opens an HDF5 file, and return an AcquisitionData instance. The data is
+    only read when requested (via .getData(), .getSubData() or .getTile()).
+    The images with only one plane are provided as 2D (YX) images.
+    filename (string): path to the file
+    return (AcquisitionData): an opened file
+    raises:
+        IOError in case the file format is not as expected.
+    """
+    return AcquisitionDataHDF5(filename)
@@ -22,13 +22,24 @@ Odemis. If not, see http://www.gnu.org/licenses/.
 """
 from __future__ import division
 
+from future.moves.http.server import BaseHTTPRequestHandler, HTTPServer
+from future.moves.socketserver import ThreadingMixIn
+from io import BytesIO
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
 import unittest
 
+import configparser
 import numpy
+from PIL import Image
 from requests import ConnectionError
 
-from odemis.dataio import AuthenticationError
-from odemis.dataio.catmaid import open_data
+from odemis.dataio import AuthenticationError, catmaid
+from odemis.dataio.catmaid import open_data, TileDiskCache
 
 
 class TestCatmaid(unittest.TestCase):
@@ -92,5 +103,242 @@ class TestCatmaid(unittest.TestCase):
         numpy.testing.assert_array_equal(tile, numpy.zeros(size))
 
 
+class FixtureStackHandler(BaseHTTPRequestHandler):
+    """
+    Serves a Catmaid stack of 1024x768 px, with tiles of 256x256 px, 3 zoom
+    levels, and one plane. The value of each pixel of a tile is
+    version + col + 4 * row + 16 * zoom.
+    """
+    version = 0  # changes the content (and ETag) of all the tiles
+    requests = []  # list of (str, dict): path and headers of each request received
+    lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass  # Silent
+
+    def do_GET(self):
+        with self.lock:
+            self.requests.append((self.path, dict(self.headers)))
+
+        if self.path == "/1/stack/1/info":
+            port = self.server.server_address[1]
+            info = {"dimension": {"x": 1024, "y": 768, "z": 1},
+                    "resolution": {"x": 10, "y": 10, "z": 50},
+                    "num_zoom_levels": 2,
+                    "mirrors": [{"tile_width": 256, "tile_height": 256,
+                                 "tile_source_type": catmaid.FILE_BASED,
+                                 "image_base": "http://localhost:%d/tiles/" % port,
+                                 "file_extension": "png"}],
+                    }
+            self._send(200, "application/json", json.dumps(info).encode("utf-8"))
+            return
+
+        if self.path.startswith("/tiles/0/"):
+            # {image_base}{depth}/{row}_{col}_{zoom}.{file_extension}
+            row, col, zoom = (int(v) for v in self.path[len("/tiles/0/"):-len(".png")].split("_"))
+            # Number of tiles = ceil(size / 2**zoom / 256)
+            if col >= -(-1024 // (256 * 2 ** zoom)) or row >= -(-768 // (256 * 2 ** zoom)):
+                self._send(404, "text/plain", b"No such tile")
+                return
+            etag = '"%d-%d-%d-%d"' % (row, col, zoom, self.version)
+            if self.headers.get("If-None-Match") == etag:
+                self._send(304, None, b"", etag)
+                return
+            val = self.version + col + 4 * row + 16 * zoom
+            buf = BytesIO()
+            Image.fromarray(numpy.full((256, 256), val, dtype=numpy.uint8)).save(buf, "PNG")
+            self._send(200, "image/png", buf.getvalue(), etag)
+            return
+
+        self._send(404, "text/plain", b"Not found")
+
+    def _send(self, code, content_type, content, etag=None):
+        self.send_response(code)
+        if content_type:
+            self.send_header("Content-Type", content_type)
+        if etag:
+            self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class TestCatmaidLocal(unittest.TestCase):
+    """
+    Test reading the tiles from a (fake) Catmaid server running locally
+    """
+
+    def setUp(self):
+        FixtureStackHandler.version = 0
+        FixtureStackHandler.requests = []
+        self.server = ThreadingHTTPServer(("localhost", 0), FixtureStackHandler)
+        self.server_thread = threading.Thread(target=self.server.serve_forever)
+        self.server_thread.daemon = True
+        self.server_thread.start()
+        self.url = "catmaid://localhost:%d/?pid=1&sid0=1" % (self.server.server_address[1],)
+
+        # Use a fresh disk cache
+        self.cache_dir = tempfile.mkdtemp()
+        self._orig_cache = (catmaid.CACHE_DIR, catmaid.CACHE_REVALIDATE_PERIOD,
+                            catmaid.CACHE_MAX_SIZE, catmaid.KEY_PATH)
+        catmaid.CACHE_DIR = self.cache_dir
+        catmaid.KEY_PATH = os.path.join(self.cache_dir, "catmaid.key")  # No credentials
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        (catmaid.CACHE_DIR, catmaid.CACHE_REVALIDATE_PERIOD,
+         catmaid.CACHE_MAX_SIZE, catmaid.KEY_PATH) = self._orig_cache
+        shutil.rmtree(self.cache_dir)
+
+    def tile_requests(self):
+        """
+        return (list of (str, dict)): the requests received for tiles
+        """
+        return [r for r in FixtureStackHandler.requests if r[0].startswith("/tiles/")]
+
+    def test_get_tiles(self):
+        das = open_data(self.url).content[0]
+        self.assertEqual(das.maxzoom, 2)
+        self.assertEqual(das.tile_shape, (256, 256))
+
+        tile = das.getTile(3, 1, 0)
+        self.assertEqual(tile.shape, (256, 256))
+        self.assertEqual(tile[0, 0], 3 + 4 * 1)
+        tile = das.getTile(1, 0, 1)
+        self.assertEqual(tile[0, 0], 1 + 16)
+        self.assertEqual(len(self.tile_requests()), 2)
+
+        # Non existing tile => blank tile
+        tile = das.getTile(10, 10, 0)
+        numpy.testing.assert_array_equal(tile, 0)
+
+    def test_prefetch(self):
+        """
+        The tiles are downloaded in parallel, and only once
+        """
+        das = open_data(self.url).content[0]
+        tiles = [(x, y, 0) for x in range(4) for y in range(3)]
+        das.prefetchTiles(tiles)
+        das.prefetchTiles(tiles)  # Already being downloaded or in the cache => no new request
+        for x, y, z in tiles:
+            tile = das.getTile(x, y, z)
+            self.assertEqual(tile[0, 0], x + 4 * y)
+        self.assertEqual(len(self.tile_requests()), len(tiles))
+
+    def test_prefetch_no_disk_cache(self):
+        """
+        The prefetched tiles are kept in memory until they are read
+        """
+        catmaid.CACHE_MAX_SIZE = 0
+        das = open_data(self.url).content[0]
+        tiles = [(x, y, 0) for x in range(4) for y in range(3)]
+        das.prefetchTiles(tiles)
+        # Wait for all the downloads to be over
+        tend = time.time() + 10
+        while das._downloads:
+            self.assertLess(time.time(), tend, "Downloads didn't finish")
+            time.sleep(0.01)
+        das.prefetchTiles(tiles)  # Already downloaded => no new request
+
+        for x, y, z in tiles:
+            tile = das.getTile(x, y, z)
+            self.assertEqual(tile[0, 0], x + 4 * y)
+        self.assertEqual(len(self.tile_requests()), len(tiles))
+
+        # Once read, the tile is not kept
+        das.getTile(0, 0, 0)
+        self.assertEqual(len(self.tile_requests()), len(tiles) + 1)
+
+    def _write_credentials(self, username, password):
+        config = configparser.ConfigParser()
+        base_url = "http://localhost:%d" % (self.server.server_address[1],)
+        config.add_section(base_url)
+        config.set(base_url, "token", "")
+        config.set(base_url, "username", username)
+        config.set(base_url, "password", password)
+        with open(catmaid.KEY_PATH, "w") as f:
+            config.write(f)
+
+    def test_disk_cache_credentials(self):
+        """
+        A tile in the disk cache is only used for the same credentials
+        """
+        self._write_credentials("alice", "secret1")
+        das = open_data(self.url).content[0]
+        das.getTile(2, 2, 0)
+        self.assertEqual(len(self.tile_requests()), 1)
+
+        # Same user => from the disk cache
+        das = open_data(self.url).content[0]
+        das.getTile(2, 2, 0)
+        self.assertEqual(len(self.tile_requests()), 1)
+
+        # Another user => downloaded again, with the new credentials
+        self._write_credentials("bob", "secret2")
+        das = open_data(self.url).content[0]
+        tile = das.getTile(2, 2, 0)
+        self.assertEqual(tile[0, 0], 2 + 4 * 2)
+        reqs = self.tile_requests()
+        self.assertEqual(len(reqs), 2)
+        self.assertIn("Authorization", reqs[-1][1])
+        self.assertNotEqual(reqs[-1][1]["Authorization"], reqs[0][1]["Authorization"])
+
+    def test_disk_cache(self):
+        das = open_data(self.url).content[0]
+        das.getTile(2, 2, 0)
+        self.assertEqual(len(self.tile_requests()), 1)
+
+        # A new stack uses the disk cache
+        del das
+        das = open_data(self.url).content[0]
+        tile = das.getTile(2, 2, 0)
+        self.assertEqual(tile[0, 0], 2 + 4 * 2)
+        self.assertEqual(len(self.tile_requests()), 1)
+
+        # When the tile needs to be revalidated, the ETag is passed, and the
+        # server returns "Not modified"
+        catmaid.CACHE_REVALIDATE_PERIOD = 0
+        tile = das.getTile(2, 2, 0)
+        self.assertEqual(tile[0, 0], 2 + 4 * 2)
+        reqs = self.tile_requests()
+        self.assertEqual(len(reqs), 2)
+        self.assertEqual(reqs[-1][1].get("If-None-Match"), '"2-2-0-0"')
+
+        # The tile has changed on the server
+        FixtureStackHandler.version = 100
+        tile = das.getTile(2, 2, 0)
+        self.assertEqual(tile[0, 0], 100 + 2 + 4 * 2)
+        tile = das.getTile(2, 2, 0)
+        self.assertEqual(tile[0, 0], 100 + 2 + 4 * 2)
+        self.assertEqual(len(self.tile_requests()), 4)
+
+    def test_disk_cache_eviction(self):
+        cache = TileDiskCache(self.cache_dir, 1000)
+        for i in range(5):
+            cache.put("http://localhost/%d" % i, b"x" * 300, {"i": i})
+        # Only the 3 last ones fit
+        self.assertIsNone(cache.get("http://localhost/0"))
+        self.assertIsNone(cache.get("http://localhost/1"))
+        content, info = cache.get("http://localhost/2")
+        self.assertEqual(content, b"x" * 300)
+        self.assertEqual(info, {"i": 2})
+        self.assertEqual(len([f for f in os.listdir(self.cache_dir) if f.endswith(".tile")]), 3)
+
+        # Accessing 2 makes 3 the least recently used one
+        cache.put("http://localhost/5", b"y" * 300, {"i": 5})
+        self.assertIsNotNone(cache.get("http://localhost/2"))
+        self.assertIsNone(cache.get("http://localhost/3"))
+
+        # The content is found again when reopening the cache
+        cache = TileDiskCache(self.cache_dir, 1000)
+        content, info = cache.get("http://localhost/5")
+        self.assertEqual(content, b"y" * 300)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -487,6 +487,168 @@ class TestHDF5IO(unittest.TestCase):
         self.assertEqual(im[blue[::-1]].tolist(), [0, 0, 255])
         self.assertAlmostEqual(im.metadata[model.MD_POS], thumbnail.metadata[model.MD_POS])
 
+    def testOpenData(self):
+        """
+        Checks that we can open an acquisition and read parts of it lazily
+        """
+        # Spectrum cube, and a fluorescence image with 2 channels (=> split)
+        dtype = numpy.dtype("uint16")
+        spec = model.DataArray(numpy.zeros((20, 1, 1, 30, 40), dtype),
+                               {model.MD_DESCRIPTION: "spectrum",
+                                model.MD_WL_LIST: [400e-9 + i * 10e-9 for i in range(20)]})
+        spec[12, 0, 0, :, :] = 17
+        spec[:, 0, 0, 5, 6] = numpy.arange(20)
+        fluo = []
+        for i in range(2):
+            d = model.DataArray(numpy.zeros((50, 60), dtype) + i,
+                                {model.MD_DESCRIPTION: "fluo%d" % i,
+                                 model.MD_IN_WL: (500e-9 + i * 100e-9, 522e-9 + i * 100e-9),
+                                 model.MD_OUT_WL: (600e-9 + i * 100e-9, 630e-9 + i * 100e-9),
+                                 model.MD_PIXEL_SIZE: (1e-6, 1e-6),
+                                 model.MD_POS: (1e-3, -30e-3),
+                                 model.MD_EXP_TIME: 1.2})
+            fluo.append(d)
+        thumbnail = model.DataArray(numpy.zeros((10, 12, 3), numpy.uint8))
+        thumbnail[:, :, 1] = 255
+        hdf5.export(FILENAME, [spec] + fluo, thumbnail)
+
+        acd = hdf5.open_data(FILENAME)
+        self.assertEqual(len(acd.content), 3)
+        self.assertEqual(len(acd.thumbnails), 1)
+        rdata = hdf5.read_data(FILENAME)
+
+        for das, im in zip(acd.content, rdata):
+            self.assertIsInstance(das, model.DataArrayShadow)
+            # Images with a single plane are simplified to 2D
+            self.assertEqual(das.shape, im.shape[-das.ndim:])
+            self.assertEqual(numpy.prod(das.shape), im.size)
+            self.assertEqual(das.dtype, im.dtype)
+            self.assertEqual(das.metadata[model.MD_DESCRIPTION], im.metadata[model.MD_DESCRIPTION])
+            d = das.getData()
+            numpy.testing.assert_array_equal(d, im.reshape(das.shape))
+            self.assertEqual(d.metadata[model.MD_DESCRIPTION], im.metadata[model.MD_DESCRIPTION])
+
+        # Partial read: one spectrum, and one plane
+        das = [d for d in acd.content if d.metadata[model.MD_DESCRIPTION] == "spectrum"][0]
+        sp = das.getSubData((slice(None), 0, 0, 5, 6))
+        numpy.testing.assert_array_equal(sp, numpy.arange(20))
+        self.assertIn(model.MD_WL_LIST, sp.metadata)
+        plane = das.getSubData(12)
+        self.assertEqual(plane.shape, (1, 1, 30, 40))
+        self.assertEqual(plane[0, 0, 0, 0], 17)
+        self.assertEqual(plane[0, 0, 5, 6], 12)
+
+        # Each channel of the fluo image is separated
+        das = [d for d in acd.content if d.metadata[model.MD_DESCRIPTION] == "fluo1"][0]
+        self.assertEqual(das.metadata[model.MD_EXP_TIME], fluo[1].metadata[model.MD_EXP_TIME])
+        sub = das.getSubData((Ellipsis, slice(10, 20), slice(0, 5)))
+        self.assertEqual(sub.shape[-2:], (10, 5))
+        self.assertTrue(numpy.all(sub == 1))
+        # The spectrum has several planes => no tile access
+        das_spec = [d for d in acd.content if d.metadata[model.MD_DESCRIPTION] == "spectrum"][0]
+        self.assertFalse(hasattr(das_spec, "maxzoom"))
+        # A 2D image can be read tile by tile
+        self.assertEqual(das.shape, (50, 60))
+        self.assertEqual(das.maxzoom, 0)
+        tile = das.getTile(0, 0, 0)
+        self.assertEqual(tile.shape, (50, 60))
+        self.assertTrue(numpy.all(tile == 1))
+        numpy.testing.assert_allclose(tile.metadata[model.MD_POS], (1e-3, -30e-3))
+
+        im = acd.thumbnails[0].getData()
+        self.assertEqual(im.shape, thumbnail.shape)
+        self.assertEqual(im[0, 0].tolist(), [0, 255, 0])
+
+    def testWriter(self):
+        """
+        Checks that we can write data block by block, and read it back
+        """
+        # Spectrum cube, stored as YXC (ie, one spectrum per pixel), and an image
+        wl = [400e-9 + i * 10e-9 for i in range(50)]
+        md_spec = {model.MD_DESCRIPTION: "spectrum",
+                   model.MD_DIMS: "YXC",
+                   model.MD_WL_LIST: wl,
+                   model.MD_PIXEL_SIZE: (1e-6, 1e-6),
+                   model.MD_POS: (1e-3, -30e-3)}
+        md_sem = {model.MD_DESCRIPTION: "sem",
+                  model.MD_PIXEL_SIZE: (1e-6, 1e-6),
+                  model.MD_POS: (1e-3, -30e-3)}
+        spec = numpy.random.randint(0, 4000, (20, 30, 50)).astype(numpy.uint16)
+        sem = numpy.random.random((20, 30))
+
+        with hdf5.Writer(FILENAME) as w:
+            ns = w.add_data(spec.shape, spec.dtype, md_spec)
+            ni = w.add_data(sem.shape, sem.dtype, md_sem)
+            for y in range(spec.shape[0]):
+                for x in range(0, spec.shape[1], 10):
+                    w.write_block(ns, (y, slice(x, x + 10)), spec[y, x:x + 10])
+                w.write_block(ni, (y,), sem[y])
+            w.update_metadata(ni, {model.MD_ACQ_DATE: 1234.5})
+
+        # Check the chunks fit the type of data
+        f = h5py.File(FILENAME, "r")
+        chunks = f["Acquisition0/ImageData/Image"].chunks
+        self.assertEqual(chunks[:3], (50, 1, 1))
+        chunks = f["Acquisition1/ImageData/Image"].chunks
+        self.assertEqual(chunks[:3], (1, 1, 1))
+        f.close()
+
+        rdata = hdf5.read_data(FILENAME)
+        self.assertEqual(len(rdata), 2)
+        rspec, rsem = rdata
+        self.assertEqual(rspec.shape, (50, 1, 1, 20, 30))
+        numpy.testing.assert_array_equal(rspec[:, 0, 0], numpy.moveaxis(spec, 2, 0))
+        numpy.testing.assert_almost_equal(rspec.metadata[model.MD_WL_LIST], wl)
+        self.assertEqual(rspec.metadata[model.MD_POS], md_spec[model.MD_POS])
+        self.assertEqual(rsem.shape, (1, 1, 1, 20, 30))
+        numpy.testing.assert_array_equal(rsem[0, 0, 0], sem)
+        self.assertEqual(rsem.metadata[model.MD_DESCRIPTION], "sem")
+        self.assertEqual(rsem.metadata[model.MD_ACQ_DATE], 1234.5)
+
+        # Wrong blocks
+        with hdf5.Writer(FILENAME) as w:
+            n = w.add_data(sem.shape, sem.dtype, md_sem)
+            with self.assertRaises(ValueError):
+                w.write_block(n, (0, slice(0, 5)), sem[0])
+            with self.assertRaises(ValueError):
+                w.write_block(n, (20,), sem[0])
+
+    def testOpenDataTiles(self):
+        """
+        Checks that a 2D image can be read tile by tile, at different zoom levels
+        """
+        size = (700, 1000)
+        data = model.DataArray(numpy.arange(size[0] * size[1], dtype=numpy.uint32).reshape(size),
+                               {model.MD_PIXEL_SIZE: (1e-6, 2e-6),
+                                model.MD_POS: (1e-3, -30e-3)})
+        hdf5.export(FILENAME, data)
+
+        acd = hdf5.open_data(FILENAME)
+        das = acd.content[0]
+        self.assertEqual(das.shape, size)
+        self.assertEqual(das.maxzoom, 2)  # 700 -> 350 -> 175 < 256
+
+        # Top-left tile at full resolution
+        tile = das.getTile(0, 0, 0)
+        numpy.testing.assert_array_equal(tile, data[:256, :256])
+        self.assertEqual(tile.metadata[model.MD_PIXEL_SIZE], (1e-6, 2e-6))
+
+        # Last tile of the first row, at zoom 1 (=> one pixel out of 2)
+        tile = das.getTile(1, 0, 1)
+        self.assertEqual(tile.shape, (256, 500 - 256))
+        numpy.testing.assert_array_equal(tile, data[0:512:2, 512:1000:2])
+        self.assertEqual(tile.metadata[model.MD_PIXEL_SIZE], (2e-6, 4e-6))
+
+        # Whole image in one tile at the max zoom
+        tile = das.getTile(0, 0, 2)
+        self.assertEqual(tile.shape, (175, 250))
+        numpy.testing.assert_allclose(tile.metadata[model.MD_POS], (1e-3, -30e-3))
+
+        with self.assertRaises(IndexError):
+            das.getTile(1, 0, 2)
+        with self.assertRaises(ValueError):
+            das.getTile(0, 0, 3)
+
     def testReadAndSaveMDSpec(self):
         """
         Checks that we can save and read back the metadata of a spectrum image.
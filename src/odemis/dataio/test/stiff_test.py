@@ -246,6 +246,62 @@ class TestTiffIO(unittest.TestCase):
             # No thumbnail handling for now, so assert that is empty
             self.assertEqual(rthumbnail, [])
 
+    def testMissingMultiPlane(self):
+        """
+        Check the data after a missing file containing multiple planes is
+        still associated to the right metadata.
+        """
+        size = (64, 32)
+        ldata = []
+        self.no_of_images = 3
+        for i in range(self.no_of_images):
+            md = {model.MD_EXP_TIME: 0.1 * (i + 1)}  # s
+            if i == 1:  # A spectrum => 5 IFDs in the file
+                shape = (5, 1, 1) + size[::-1]
+                md[model.MD_WL_LIST] = [500e-9 + j * 10e-9 for j in range(5)]
+            else:
+                shape = size[::-1]
+            ldata.append(model.DataArray(numpy.full(shape, i, dtype=numpy.uint16), md))
+
+        stiff.export(FILENAME, ldata)
+        rdata = tiff.read_data(FILENAME)
+        self.assertEqual([d.shape for d in rdata], [d.shape for d in ldata])
+
+        tokens = FILENAME.split(".0.", 1)
+        os.remove(tokens[0] + ".1." + tokens[1])
+        rdata = tiff.read_data(FILENAME)
+        self.assertEqual(len(rdata), 2)
+        for rd, ld in zip(rdata, ldata[::2]):
+            self.assertEqual(rd.shape, ld.shape)
+            self.assertAlmostEqual(rd.metadata[model.MD_EXP_TIME], ld.metadata[model.MD_EXP_TIME])
+            numpy.testing.assert_array_equal(rd, ld)
+
+    def testManyFiles(self):
+        """
+        Check that an acquisition split over many files can be opened from any
+        of the files.
+        """
+        size = (64, 32)
+        ldata = []
+        self.no_of_images = 20
+        for i in range(self.no_of_images):
+            md = {model.MD_EXP_TIME: 0.01 * (i + 1),  # s
+                  model.MD_POS: (i * 1e-3, 0),  # m
+                  }
+            ldata.append(model.DataArray(numpy.full(size[::-1], i, dtype=numpy.uint16), md))
+
+        stiff.export(FILENAME, ldata)
+
+        tokens = FILENAME.split(".0.", 1)
+        for i in (0, 7, self.no_of_images - 1):
+            fname = tokens[0] + "." + str(i) + "." + tokens[1]
+            acd = tiff.open_data(fname)
+            self.assertEqual(len(acd.content), self.no_of_images)
+            for rd, ld in zip(acd.content, ldata):
+                self.assertAlmostEqual(rd.metadata[model.MD_EXP_TIME], ld.metadata[model.MD_EXP_TIME])
+                numpy.testing.assert_allclose(rd.metadata[model.MD_POS], ld.metadata[model.MD_POS])
+                numpy.testing.assert_array_equal(rd.getData(), ld)
+
     def testExportCube(self):
         """
         Check it's possible to export a 3D data (typically: 2D area with full
@@ -1860,12 +1860,14 @@ class TestTiffIO(unittest.TestCase):
         # read the subimage
         subimage = im.read_image()
         self.assertEqual(subimage.shape, (147, 128))
-        # Checking the values in the corner of the tile. The downsampling uses
-        # the neighbour pixels to calculate a pixel in the resized image.
-        self.assertEqual(subimage[0][0], 130)
-        self.assertEqual(subimage[0][-1], 385)
-        self.assertEqual(subimage[-1][0], 9893)
-        self.assertEqual(subimage[-1][-1], 10148)
+        # Each pixel of the resized image is the mean of 2x2 pixels (the last
+        # row and column are dropped when the size is odd).
+        full = full_image[:294, :256].astype(numpy.int64)
+        exp_subimage = (full[0::2, 0::2] + full[1::2, 0::2] +
+                        full[0::2, 1::2] + full[1::2, 1::2] + 2) // 4
+        numpy.testing.assert_array_equal(subimage, exp_subimage)
+        self.assertEqual(subimage[0][0], 129)
+        self.assertEqual(subimage[-1][-1], 9891)
 
     def testExportThinPyramid(self):           
         """
@@ -1896,6 +1898,44 @@ class TestTiffIO(unittest.TestCase):
         self.assertEqual(full_image[-1][0], 4096)
         self.assertEqual(full_image[-1][-1], 4097)
 
+    def testExportStrips(self):
+        """
+        Checks that a pyramidal image can be written strip by strip, and read back
+        """
+        for shape, dtype, dims in (((500, 1030), numpy.uint16, "YX"),
+                                   ((520, 300), numpy.float32, "YX"),
+                                   ((600, 511, 3), numpy.uint8, "YXC")):
+            arr = numpy.random.randint(0, 200, shape).astype(dtype)
+            md = {model.MD_DIMS: dims,
+                  model.MD_PIXEL_SIZE: (1e-6, 1e-6),
+                  model.MD_POS: (1e-3, -2e-3)}
+            # Strips of various sizes
+            strips = [arr[y:y + 97] for y in range(0, shape[0], 97)]
+            tiff.export_strips(FILENAME, shape, dtype, strips, md)
+
+            rdata = tiff.open_data(FILENAME)
+            da = rdata.content[0]
+            self.assertEqual(da.shape, shape)
+            self.assertEqual(da.dtype, dtype)
+            self.assertEqual(da.maxzoom, 1)
+            numpy.testing.assert_array_equal(da.getData(), arr)
+            self.assertEqual(da.metadata[model.MD_PIXEL_SIZE], (1e-6, 1e-6))
+
+            # Zoom level 1 is the mean of every 2x2 pixels
+            half = arr[:shape[0] // 2 * 2, :shape[1] // 2 * 2].astype(numpy.float64)
+            half = (half[0::2, 0::2] + half[1::2, 0::2] + half[0::2, 1::2] + half[1::2, 1::2]) / 4
+            tile = da.getTile(0, 0, 1)
+            numpy.testing.assert_allclose(tile, half[:256, :256], atol=0.5)
+
+        # Too many rows
+        with self.assertRaises(ValueError):
+            tiff.export_strips(FILENAME, (300, 300), numpy.uint8,
+                               [numpy.zeros((200, 300), numpy.uint8)] * 2)
+        # Not enough rows
+        with self.assertRaises(ValueError):
+            tiff.export_strips(FILENAME, (300, 300), numpy.uint8,
+                               [numpy.zeros((200, 300), numpy.uint8)])
+
     def testExportMultiArrayPyramid(self):
         """
         Checks that we can export and read back the metadata and data of 1 SEM image,
@@ -2074,6 +2114,89 @@ class TestTiffIO(unittest.TestCase):
         self.assertEqual(num_rows, len(tile))
         self.assertEqual(num_cols, len(tile[0]))
 
+    def testReadTileMultiPlane(self):
+        """
+        Checks that the tiles of pyramidal data with multiple planes (TZ) can be read
+        """
+        size = (1, 2, 3, 600, 700)
+        arr = numpy.random.randint(0, 1000, size).astype(numpy.uint16)
+        md = {model.MD_DIMS: "CTZYX",
+              model.MD_PIXEL_SIZE: (1e-6, 1e-6, 2e-6),
+              model.MD_POS: (1e-3, 2e-3, 5e-6)}
+        tiff.export(FILENAME, model.DataArray(arr, md), pyramid=True)
+
+        rdata = tiff.open_data(FILENAME)
+        self.assertEqual(len(rdata.content), 1)
+        das = rdata.content[0]
+        self.assertEqual(das.shape, size)
+        self.assertEqual(das.maxzoom, 2)
+
+        # All the planes at once
+        tile = das.getTile(2, 1, 0)
+        self.assertEqual(tile.shape, size[:3] + (256, 700 - 512))
+        numpy.testing.assert_array_equal(tile, arr[..., 256:512, 512:])
+        # Only the XY pixel size changes with the zoom
+        tile = das.getTile(0, 0, 1)
+        self.assertEqual(tile.shape, size[:3] + (256, 256))
+        self.assertEqual(tile.metadata[model.MD_PIXEL_SIZE], (2e-6, 2e-6, 2e-6))
+        self.assertEqual(tile.metadata[model.MD_POS][2], 5e-6)
+
+        # Just one plane
+        tile = das.getTile(1, 2, 0, index=(0, 1, 2))
+        self.assertEqual(tile.shape, (600 - 512, 256))
+        self.assertEqual(tile.metadata[model.MD_DIMS], "YX")
+        numpy.testing.assert_array_equal(tile, arr[0, 1, 2, 512:, 256:512])
+        tile_all = das.getTile(1, 2, 0)
+        numpy.testing.assert_almost_equal(tile.metadata[model.MD_POS], tile_all.metadata[model.MD_POS])
+        tile = das.getTile(0, 0, 2, index=(0, 1, 0))
+        self.assertEqual(tile.shape, (150, 175))
+
+        with self.assertRaises(IndexError):
+            das.getTile(0, 0, 0, index=(0, 2, 0))
+
+    def testReadMemmap(self):
+        """
+        Checks that uncompressed data is read directly from the file, as memory-mapped arrays
+        """
+        def is_memmap(a):
+            while a is not None:
+                if isinstance(a, numpy.memmap):
+                    return True
+                a = a.base
+            return False
+
+        md = {model.MD_PIXEL_SIZE: (1e-6, 1e-6)}
+        arr = numpy.random.randint(0, 6000, (600, 700)).astype(numpy.uint16)
+        rgb = numpy.random.randint(0, 255, (600, 700, 3)).astype(numpy.uint8)
+        for data, pyramid in ((arr, False), (arr, True), (rgb, True)):
+            dmd = md.copy()
+            if data.ndim == 3:
+                dmd[model.MD_DIMS] = "YXC"
+            tiff.export(FILENAME, model.DataArray(data, dmd), compressed=False, pyramid=pyramid)
+            das = tiff.open_data(FILENAME).content[0]
+
+            if pyramid:
+                tile = das.getTile(2, 2, 0)
+                self.assertTrue(is_memmap(tile))
+                numpy.testing.assert_array_equal(tile, data[512:, 512:])
+                tile = das.getTile(1, 0, 1)
+                self.assertEqual(tile.shape[:2], (256, 350 - 256))
+                with self.assertRaises(ValueError):
+                    das.getTile(3, 0, 0)
+            else:
+                im = das.getData()
+                self.assertTrue(is_memmap(im))
+                numpy.testing.assert_array_equal(im, data)
+                # Modifying the data doesn't change the file
+                im[0, 0] += 1
+                self.assertEqual(das.getData()[0, 0], data[0, 0])
+
+        # Compressed data is read by libtiff
+        tiff.export(FILENAME, model.DataArray(arr, md), compressed=True)
+        im = tiff.open_data(FILENAME).content[0].getData()
+        self.assertFalse(is_memmap(im))
+        numpy.testing.assert_array_equal(im, arr)
+
     def testAcquisitionDataTIFF(self):
 
         def getSubData(dast, zoom, rect):
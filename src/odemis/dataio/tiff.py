@@ -25,28 +25,47 @@ from past.builtins import basestring
 from builtins import range
 
 import calendar
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import ctypes
 from datetime import datetime
 import json
 from libtiff import TIFF
 import logging
 import math
+import multiprocessing
 import numpy
 from odemis import model, util
 import odemis
 from odemis.model import DataArrayShadow, AcquisitionData
-from odemis.util import spectrum, img, fluo
+from odemis.util import spectrum, img, fluo, fileindex
 from odemis.util.conversion import get_tile_md_pos, JsonExtraEncoder
 import operator
 import os
 import re
 import sys
+import tempfile
 import threading
 import time
 import uuid
+import zlib
 
 import libtiff.libtiff_ctypes as T  # for the constant names
 import xml.etree.ElementTree as ET
 
+# To find the position of the strips/tiles in the file (with 64-bit offsets),
+# for mapping the uncompressed data directly to memory. Only available since
+# libtiff 4.1.
+try:
+    T.libtiff.TIFFGetStrileOffset.restype = ctypes.c_uint64
+    T.libtiff.TIFFGetStrileOffset.argtypes = [T.TIFF, ctypes.c_uint32]
+    T.libtiff.TIFFGetStrileByteCount.restype = ctypes.c_uint64
+    T.libtiff.TIFFGetStrileByteCount.argtypes = [T.TIFF, ctypes.c_uint32]
+    CAN_MEMMAP = True
+except AttributeError:
+    logging.info("libtiff doesn't support reading strile offsets, will not use memory-mapping")
+    CAN_MEMMAP = False
+
 #pylint: disable=E1101
 # Note about libtiff: it's a pretty ugly library, with 2 different wrappers.
 # We use only the C wrapper (not the Python implementation).
@@ -69,6 +88,10 @@ STIFF_SPLIT = ".0."  # pattern to replace with the "stiff" multiple file
 
 CAN_SAVE_PYRAMID = True # indicates the support for pyramidal export
 TILE_SIZE = 256 # Tile size of pyramidal images
+# Maximum number of tiles waiting to be written, per compression thread
+MAX_PENDING_TILES_PER_THREAD = 4
+# Maximum number of files opened simultaneously when reading a multiple files acquisition
+MAX_OPEN_THREADS = 8
 LOSSY = False
 
 # We try to make it as much as possible looking like a normal (multi-page) TIFF,
@@ -243,6 +266,100 @@ def _isThumbnail(tfile):
     return False
 
 
+def _getMemmapLayout(tfile):
+    """
+    Locate the image of the current directory in the file, if the data is
+      stored in a way which allows to map it directly to memory: uncompressed,
+      with samples of whole bytes, in native byte order, and with all the
+      samples of a pixel together.
+    tfile (tiff handle): the file, with the directory selected
+    return (None or dict): None if the data cannot be mapped. Otherwise:
+      "filename" (bytes), "dtype" (numpy.dtype), "shape" (tuple of ints): shape
+      of the image (YX or YXC). For an image in strips, "offset" (int) is the
+      position of the image in the file. For a tiled image, "offsets" (ndarray
+      of int) is the position of each tile (by tile index Y, X), and
+      "tile_shape" (tuple of ints) is the shape of every tile.
+    """
+    if not CAN_MEMMAP or tfile.IsByteSwapped():
+        return None
+    if _GetFieldDefault(tfile, T.TIFFTAG_COMPRESSION, T.COMPRESSION_NONE) != T.COMPRESSION_NONE:
+        return None
+    if _GetFieldDefault(tfile, T.TIFFTAG_ORIENTATION, T.ORIENTATION_TOPLEFT) != T.ORIENTATION_TOPLEFT:
+        return None
+    if _GetFieldDefault(tfile, T.TIFFTAG_PHOTOMETRIC, T.PHOTOMETRIC_MINISBLACK) not in (
+            T.PHOTOMETRIC_MINISBLACK, T.PHOTOMETRIC_RGB):
+        return None
+    spp = _GetFieldDefault(tfile, T.TIFFTAG_SAMPLESPERPIXEL, 1)
+    if spp > 1 and _GetFieldDefault(tfile, T.TIFFTAG_PLANARCONFIG, T.PLANARCONFIG_CONTIG) != T.PLANARCONFIG_CONTIG:
+        return None
+    if _GetFieldDefault(tfile, T.TIFFTAG_IMAGEDEPTH, 1) != 1:
+        return None
+    bits = _GetFieldDefault(tfile, T.TIFFTAG_BITSPERSAMPLE, 1)
+    if bits not in (8, 16, 32, 64):
+        return None
+    try:
+        dtype = numpy.dtype(tfile.get_numpy_type(bits, tfile.GetField(T.TIFFTAG_SAMPLEFORMAT)))
+    except Exception:
+        return None
+
+    height = tfile.GetField(T.TIFFTAG_IMAGELENGTH)
+    width = tfile.GetField(T.TIFFTAG_IMAGEWIDTH)
+    pxshape = (spp,) if spp > 1 else ()
+    if tfile.IsTiled():
+        nstriles = T.libtiff.TIFFNumberOfTiles(tfile).value
+        tshape = (tfile.GetField(T.TIFFTAG_TILELENGTH), tfile.GetField(T.TIFFTAG_TILEWIDTH))
+        ntiles = (int(math.ceil(height / tshape[0])), int(math.ceil(width / tshape[1])))
+        stshape = tshape  # shape of each strile
+    else:
+        nstriles = T.libtiff.TIFFNumberOfStrips(tfile).value
+        rps = min(_GetFieldDefault(tfile, T.TIFFTAG_ROWSPERSTRIP, height), height)
+        stshape = (rps, width)
+    stsize = int(numpy.prod(stshape)) * spp * dtype.itemsize
+    if nstriles == 0 or stsize == 0:
+        return None
+
+    if tfile.IsTiled():
+        lastsize = stsize
+    else:  # The last strip only contains the remaining rows
+        lastsize = height * width * spp * dtype.itemsize - stsize * (nstriles - 1)
+    offsets = numpy.empty(nstriles, dtype=numpy.int64)
+    for i in range(nstriles):
+        offsets[i] = T.libtiff.TIFFGetStrileOffset(tfile, i)
+        bc = T.libtiff.TIFFGetStrileByteCount(tfile, i)
+        if bc < (stsize if i < nstriles - 1 else lastsize):
+            return None
+
+    layout = {"filename": tfile.FileName(), "dtype": dtype,
+              "shape": (height, width) + pxshape}
+    if tfile.IsTiled():
+        # Each tile can be anywhere
+        if nstriles != ntiles[0] * ntiles[1]:
+            return None
+        layout["offsets"] = offsets.reshape(ntiles)
+        layout["tile_shape"] = tshape + pxshape
+    else:
+        # The strips must follow each other, to form one continuous image (which
+        # is normally the case, as libtiff writes them in order)
+        if numpy.any(offsets != offsets[0] + stsize * numpy.arange(nstriles)):
+            return None
+        layout["offset"] = int(offsets[0])
+    return layout
+
+
+def _memmap(layout, offset, shape):
+    """
+    Map part of a file to memory
+    layout (dict): as returned by _getMemmapLayout()
+    offset (int): position of the data in the file
+    shape (tuple of ints): shape of the data
+    return (numpy.memmap): the data, with the dtype of the layout
+    """
+    # Copy on write, so that the array can be modified, without changing the
+    # file (nor the other arrays mapped).
+    return numpy.memmap(layout["filename"], dtype=layout["dtype"], mode="c",
+                        offset=offset, shape=shape)
+
+
 def _guessModelName(das):
     """
     Detect the model of the Delmic microscope from the type of images acquired
@@ -1834,6 +1951,322 @@ def _genResizedShapes(data):
     return resized_shapes
 
 
+def _downscale_half(data):
+    """
+    Reduce an image by 2 in each dimension, by averaging every 2x2 pixels.
+    The last row and column are dropped if the size is odd.
+    data (ndarray of shape YXC): the image
+    return (ndarray of shape YXC): the image of half the size, and same dtype
+    """
+    h, w = data.shape[0] // 2 * 2, data.shape[1] // 2 * 2
+    if numpy.issubdtype(data.dtype, numpy.integer) and data.itemsize < 8:
+        acc = data[0:h:2, 0:w:2].astype(numpy.int64)
+    else:
+        acc = data[0:h:2, 0:w:2].astype(numpy.float64)
+    acc += data[1:h:2, 0:w:2]
+    acc += data[0:h:2, 1:w:2]
+    acc += data[1:h:2, 1:w:2]
+    if acc.dtype.kind == "i":
+        acc += 2  # round half up
+        acc //= 4
+    else:
+        acc /= 4
+        if not numpy.issubdtype(data.dtype, numpy.floating):
+            numpy.round(acc, out=acc)
+    return acc.astype(data.dtype)
+
+
+def _encode_tile(band, x, sample, predictor, compress):
+    """
+    Extract one tile from a band of rows, and encode it as stored in the file.
+    band (ndarray of shape YXC): the rows of the tile (Y <= TILE_SIZE)
+    x (int): position of the left of the tile in the band
+    sample (None or int): if an int, only this sample (C) is stored (for planar
+      separate)
+    predictor (boolean): whether the horizontal differencing is applied
+    compress (boolean): whether the tile is deflate compressed
+    return (bytes): the tile data
+    """
+    if sample is None:
+        sub = band[:, x:x + TILE_SIZE]
+    else:
+        sub = band[:, x:x + TILE_SIZE, sample:sample + 1]
+    # The tiles on the border are padded with 0's
+    tile = numpy.zeros((TILE_SIZE, TILE_SIZE, sub.shape[2]), dtype=band.dtype)
+    tile[:sub.shape[0], :sub.shape[1]] = sub
+
+    if predictor:
+        # Each sample is replaced by its difference with the previous one (of
+        # the same channel), with wrap-around
+        u = tile.view("u%d" % tile.itemsize)
+        diff = u[:, 1:] - u[:, :-1]
+        u[:, 1:] = diff
+
+    data = tile.tobytes()
+    if compress:
+        # zlib releases the GIL, so the tiles are actually compressed in parallel.
+        # The fastest level is used, as higher levels hardly reduce the size
+        # of (noisy) images, but are several times slower.
+        data = zlib.compress(data, 1)
+    return data
+
+
+class _PyramidLevel(object):
+    """
+    Information about a zoom level being written by a PyramidalWriter
+    """
+    def __init__(self, shape):
+        self.shape = shape  # YX
+        self.rows = []  # list of ndarray of YXC: the rows not yet written
+        self.nrows = 0  # total number of rows in .rows
+        self.y = 0  # position of the next band of rows to write
+        # tile index -> offset, size: tiles stored in the temporary file
+        self.tiles = {}
+
+
+class PyramidalWriter(object):
+    """
+    Writes an image in a TIFF file, tiled, with its lower resolution zoom levels
+    as SubIFDs. The image is passed as consecutive strips, and each zoom level
+    is computed on the fly, by averaging 2x2 pixels of the level above. So the
+    full image is never held in memory: only a band of TILE_SIZE rows per
+    level, and the tiles being compressed.
+    The tiles are compressed in parallel, with deflate (if compressed), and
+    directly written in the file. As the SubIFDs can only be written after the
+    main image, the (compressed) tiles of the lower levels are stored in a
+    temporary file until close() is called.
+    """
+
+    def __init__(self, f, shape, dtype, compression=None, write_rgb=False):
+        """
+        f (libtiff file handle): handle of a TIFF file, opened for writing. The
+          tags of the image (apart from the ones related to the data format)
+          should already be set (or be set before close()).
+        shape (tuple of ints): shape of the image: YX, or if write_rgb, YXC or CYX
+          (with C = 3 or 4 for YXC).
+        dtype (numpy.dtype): type of the data
+        compression (None or str): None for no compression, otherwise the
+          image is deflate compressed.
+        write_rgb (boolean): True if the image is RGB, False if the image is
+          greyscale
+        raise ValueError: if the shape or dtype is not supported
+        """
+        self._f = f
+        self._dtype = numpy.dtype(dtype)
+        if self._dtype.kind == "b" or self._dtype.kind == "u":
+            self._sample_format = T.SAMPLEFORMAT_UINT
+        elif self._dtype.kind == "i":
+            self._sample_format = T.SAMPLEFORMAT_INT
+        elif self._dtype.kind == "f":
+            self._sample_format = T.SAMPLEFORMAT_IEEEFP
+        else:
+            raise ValueError("Data type %s not supported" % (self._dtype,))
+
+        self._separate = False
+        if len(shape) == 2:
+            height, width = shape
+            self._spp = 1
+        elif len(shape) == 3 and write_rgb:
+            # Same convention as libtiff.write_image()
+            if shape[2] in (3, 4):
+                height, width, self._spp = shape
+            else:
+                self._spp, height, width = shape
+                self._separate = True
+        else:
+            raise ValueError("Shape %s not supported" % (shape,))
+        self._shape = shape
+        self._rgb = write_rgb
+
+        self._compress = compression is not None
+        # libtiff only supports the horizontal predictor up to 32 bits
+        self._predictor = (self._compress and self._dtype.kind in "biu" and
+                           self._dtype.itemsize <= 4)
+
+        # Same zoom levels as _genResizedShapes()
+        self._levels = [_PyramidLevel((height, width))]
+        fullh, fullw = height, width
+        z = 0
+        while width >= TILE_SIZE and height >= TILE_SIZE:
+            z += 1
+            height, width = fullh // 2 ** z, fullw // 2 ** z
+            self._levels.append(_PyramidLevel((height, width)))
+
+        # do not write the SUBIFD tag when there are no subimages
+        if len(self._levels) > 1:
+            # LibTIFF will automatically write the next N directories as subdirectories
+            # when this tag is present.
+            f.SetField(T.TIFFTAG_SUBIFD, [0] * (len(self._levels) - 1))
+            self._tmpfile = tempfile.TemporaryFile()
+        else:
+            self._tmpfile = None
+        self._set_format_fields(self._levels[0].shape)
+
+        self._nthreads = multiprocessing.cpu_count()
+        self._executor = ThreadPoolExecutor(max_workers=self._nthreads)
+        self._pending = deque()  # level, tile index, future returning the tile data
+
+    def _set_format_fields(self, shape):
+        """
+        Set the TIFF tags describing the format of an image (of the current
+          directory)
+        shape (int, int): the size of the image (YX)
+        """
+        f = self._f
+        if self._compress:
+            f.SetField(T.TIFFTAG_COMPRESSION, T.COMPRESSION_ADOBE_DEFLATE)
+            if self._predictor:
+                f.SetField(T.TIFFTAG_PREDICTOR, T.PREDICTOR_HORIZONTAL)
+        else:
+            f.SetField(T.TIFFTAG_COMPRESSION, T.COMPRESSION_NONE)
+        f.SetField(T.TIFFTAG_BITSPERSAMPLE, self._dtype.itemsize * 8)
+        f.SetField(T.TIFFTAG_SAMPLEFORMAT, self._sample_format)
+        f.SetField(T.TIFFTAG_ORIENTATION, T.ORIENTATION_TOPLEFT)
+        f.SetField(T.TIFFTAG_TILEWIDTH, TILE_SIZE)
+        f.SetField(T.TIFFTAG_TILELENGTH, TILE_SIZE)
+        f.SetField(T.TIFFTAG_IMAGEWIDTH, shape[1])
+        f.SetField(T.TIFFTAG_IMAGELENGTH, shape[0])
+        if self._rgb:
+            f.SetField(T.TIFFTAG_PHOTOMETRIC, T.PHOTOMETRIC_RGB)
+            f.SetField(T.TIFFTAG_SAMPLESPERPIXEL, self._spp)
+            if self._separate:
+                f.SetField(T.TIFFTAG_PLANARCONFIG, T.PLANARCONFIG_SEPARATE)
+            else:
+                f.SetField(T.TIFFTAG_PLANARCONFIG, T.PLANARCONFIG_CONTIG)
+            if self._spp == 4:  # RGBA
+                f.SetField(T.TIFFTAG_EXTRASAMPLES, [T.EXTRASAMPLE_UNASSALPHA], count=1)
+            elif self._spp > 4:
+                f.SetField(T.TIFFTAG_EXTRASAMPLES, [T.EXTRASAMPLE_UNSPECIFIED] * (self._spp - 3),
+                           count=(self._spp - 3))
+        else:
+            f.SetField(T.TIFFTAG_PHOTOMETRIC, T.PHOTOMETRIC_MINISBLACK)
+            f.SetField(T.TIFFTAG_PLANARCONFIG, T.PLANARCONFIG_CONTIG)
+
+    def write_strip(self, strip):
+        """
+        Add the next rows of the image. The strips can have any number of rows,
+          but all the rows of the image must be passed, in order, before close().
+        strip (ndarray): part of the image, with the same dimensions and dtype
+          as the image, and all the columns.
+        raise ValueError: if the strip doesn't fit the image
+        """
+        if strip.dtype != self._dtype:
+            raise ValueError("Strip has dtype %s, while image has %s" % (strip.dtype, self._dtype))
+        if self._separate:
+            # CYX -> YXC
+            rows = numpy.ascontiguousarray(numpy.moveaxis(strip, 0, -1))
+        else:
+            # Copy, as the data is used (later) by the compression threads
+            rows = numpy.array(strip, copy=True)
+            if rows.ndim == 2:
+                rows.shape += (1,)
+        top = self._levels[0]
+        if (rows.shape[1:] != (top.shape[1], self._spp) or
+            top.y + top.nrows + rows.shape[0] > top.shape[0]):
+            raise ValueError("Strip of shape %s doesn't fit in image of shape %s" %
+                             (strip.shape, self._shape))
+
+        self._add_rows(0, rows)
+
+    def _add_rows(self, z, rows):
+        """
+        Add rows to a level, and write them when a complete band of tiles is
+          available.
+        """
+        lvl = self._levels[z]
+        lvl.rows.append(rows)
+        lvl.nrows += rows.shape[0]
+        while lvl.nrows >= TILE_SIZE:
+            if len(lvl.rows) > 1:
+                rows = numpy.concatenate(lvl.rows)
+            else:
+                rows = lvl.rows[0]
+            lvl.rows = [rows[TILE_SIZE:]]
+            lvl.nrows = rows.shape[0] - TILE_SIZE
+            self._write_band(z, rows[:TILE_SIZE])
+
+    def _write_band(self, z, band):
+        """
+        Compress and write a band of rows of a level, and pass it (reduced) to
+          the next level
+        band (ndarray of YXC): the rows, with Y <= TILE_SIZE
+        """
+        lvl = self._levels[z]
+        ntx = int(math.ceil(lvl.shape[1] / TILE_SIZE))
+        nty = int(math.ceil(lvl.shape[0] / TILE_SIZE))
+        ty = lvl.y // TILE_SIZE
+        samples = range(self._spp) if self._separate else [None]
+        for s in samples:
+            for tx in range(ntx):
+                # Same index as TIFFComputeTile()
+                idx = ((s or 0) * nty + ty) * ntx + tx
+                f = self._executor.submit(_encode_tile, band, tx * TILE_SIZE, s,
+                                          self._predictor, self._compress)
+                self._pending.append((z, idx, f))
+                self._flush_pending(MAX_PENDING_TILES_PER_THREAD * self._nthreads)
+        lvl.y += band.shape[0]
+
+        if z + 1 < len(self._levels):
+            half = _downscale_half(band)
+            if half.shape[0] > 0:
+                self._add_rows(z + 1, half)
+
+    def _flush_pending(self, n):
+        """
+        Write the compressed tiles, until there are at most n tiles pending
+        """
+        while len(self._pending) > n:
+            z, idx, f = self._pending.popleft()
+            data = f.result()
+            if z == 0:
+                self._write_raw_tile(idx, data)
+            else:
+                # Only appended to, until close()
+                self._levels[z].tiles[idx] = (self._tmpfile.tell(), len(data))
+                self._tmpfile.write(data)
+
+    def _write_raw_tile(self, idx, data):
+        r = T.libtiff.TIFFWriteRawTile(self._f, idx, data, len(data))
+        if r.value < 0:
+            raise IOError("Failed to write tile %d" % (idx,))
+
+    def close(self):
+        """
+        Write the remaining tiles and the zoom levels. The file itself is not
+          closed.
+        raise ValueError: if not the whole image was passed
+        """
+        try:
+            top = self._levels[0]
+            if top.y + top.nrows != top.shape[0]:
+                raise ValueError("Only %d rows received, while image has %d rows" %
+                                 (top.y + top.nrows, top.shape[0]))
+            # Write the last (partial) bands. Each level feeds the next one, so
+            # they have to be done in order.
+            for z, lvl in enumerate(self._levels):
+                if lvl.nrows > 0:
+                    rows = numpy.concatenate(lvl.rows)
+                    lvl.rows = []
+                    lvl.nrows = 0
+                    self._write_band(z, rows)
+            self._flush_pending(0)
+            self._f.WriteDirectory()
+
+            # The next directories are the SubIFDs
+            for lvl in self._levels[1:]:
+                self._f.SetField(T.TIFFTAG_SUBFILETYPE, T.FILETYPE_REDUCEDIMAGE)
+                self._set_format_fields(lvl.shape)
+                for idx in sorted(lvl.tiles):
+                    offset, size = lvl.tiles[idx]
+                    self._tmpfile.seek(offset)
+                    self._write_raw_tile(idx, self._tmpfile.read(size))
+                self._f.WriteDirectory()
+        finally:
+            self._executor.shutdown(wait=False)
+            if self._tmpfile:
+                self._tmpfile.close()
+
+
 def write_image(f, arr, compression=None, write_rgb=False, pyramid=False):
     """
     f (libtiff file handle): Handle of a TIFF file
@@ -1848,30 +2281,64 @@ def write_image(f, arr, compression=None, write_rgb=False, pyramid=False):
         f.write_image(arr, compression=compression, write_rgb=write_rgb)
         return
 
-    # TODO: for pyramidal images, we should follow the OME-TIFF 6 format
+    # The zoom levels follow the OME-TIFF 6 format for sub-resolutions: they
+    # are stored as SubIFDs of the full resolution plane, in decreasing size,
+    # with NewSubfileType = reduced image. So for data with multiple planes
+    # (CTZ), each plane has its own zoom levels.
     # https://docs.openmicroscopy.org/ome-model/6.0.1/ome-tiff/specification.html#sub-resolutions
-    # (It should be very similar to the current implementation)
+    # The image is passed band by band, so that only the current band of each
+    # zoom level is held in memory.
+    writer = PyramidalWriter(f, arr.shape, arr.dtype, compression, write_rgb)
+    if arr.ndim == 3 and arr.shape[2] not in (3, 4):  # CYX
+        for y in range(0, arr.shape[1], TILE_SIZE):
+            writer.write_strip(arr[:, y:y + TILE_SIZE])
+    else:
+        for y in range(0, arr.shape[0], TILE_SIZE):
+            writer.write_strip(arr[y:y + TILE_SIZE])
+    writer.close()
 
-    # generate the sizes of the zoom levels to be generated and saved
-    resized_shapes = _genResizedShapes(arr)
 
-    # do not write the SUBIFD tag when there are no subimages
-    if len(resized_shapes) > 0:
-        # LibTIFF will automatically write the next N directories as subdirectories
-        # when this tag is present.
-        f.SetField(T.TIFFTAG_SUBIFD, [0] * len(resized_shapes))
+def export_strips(filename, shape, dtype, strips, metadata=None, compressed=True):
+    """
+    Write a pyramidal TIFF file with one image, passed as consecutive strips.
+    The full image is never held in memory, so this allows to save images
+    larger than the memory.
+    filename (unicode): filename of the file to create (including path)
+    shape (tuple of ints): shape of the image, either YX, or YXC for RGB(A)
+      (in which case MD_DIMS must be "YXC").
+    dtype (numpy.dtype): type of the data
+    strips (iterable of ndarrays): all the rows of the image, in order. Each
+      strip can have any number of rows.
+    metadata (dict str->value or None): metadata of the image
+    compressed (boolean): whether the file is compressed or not.
+    """
+    # Metadata-only array, to generate the tags
+    fake = numpy.broadcast_to(numpy.zeros((), dtype), shape)
+    da = _mergeCorrectionMetadata(model.DataArray(fake, metadata or {}))
+    write_rgb = (len(shape) == 3)
+    if write_rgb and da.metadata.get(model.MD_DIMS) != "YXC":
+        raise ValueError("3D images must be RGB, with MD_DIMS = YXC")
+
+    if compressed and da.dtype not in (numpy.int64, numpy.uint64):
+        compression = "deflate"
+    else:
+        compression = None
 
-    # write the original image
-    f.write_tiles(arr, TILE_SIZE, TILE_SIZE, compression, write_rgb)
-    # generate the rescaled images and write the tiled image
-    for resized_shape in resized_shapes:
-        # rescale the image
-        subim = img.rescale_hq(arr, resized_shape)
+    f = TIFF.open(filename, mode='w')
+    try:
+        f.SetField(T.TIFFTAG_IMAGEDESCRIPTION, _convertToOMEMD([da], fname=filename))
+        for key, val in _convertToTiffTag(da.metadata).items():
+            try:
+                f.SetField(key, val)
+            except Exception:
+                logging.exception("Failed to store tag %s with value '%s'", key, val)
 
-        # Before writting the actual data, we set the special metadata
-        f.SetField(T.TIFFTAG_SUBFILETYPE, T.FILETYPE_REDUCEDIMAGE)
-        # write the tiled image to the TIFF file
-        f.write_tiles(subim, TILE_SIZE, TILE_SIZE, compression, write_rgb)
+        writer = PyramidalWriter(f, shape, dtype, compression, write_rgb)
+        for s in strips:
+            writer.write_strip(s)
+        writer.close()
+    finally:
+        f.close()
 
 
 def export(filename, data, thumbnail=None, compressed=True, multiple_files=False, pyramid=False):
@@ -1941,6 +2408,13 @@ def read_thumbnail(filename):
     raises:
         IOError in case the file format is not as expected.
     """
+    # If the file is already indexed, no need to open it. Otherwise, it's
+    # opened once, and indexed for the next time.
+    finfo = fileindex.get_info(filename)
+    if finfo is not None:
+        return finfo.thumbnails
+
+    # Failed to index => read it directly, to report the error
     acd = open_data(filename)
     return [acd.thumbnails[n].getData() for n in range(len(acd.thumbnails))]
 
@@ -2021,11 +2495,44 @@ class DataArrayShadowTIFF(DataArrayShadow):
             'lock' (threading.Lock): The lock that controls the access to the TIFF file
         return (numpy.array): The image
         """
+        layout = self._getLayout(tiff_info, 0)
+        if layout and "offset" in layout:
+            return _memmap(layout, layout["offset"], layout["shape"])
+
         with tiff_info['lock']:
             tiff_info['handle'].SetDirectory(tiff_info['dir_index'])
             image = tiff_info['handle'].read_image()
         return image
 
+    @staticmethod
+    def _getLayout(tiff_info, zoom):
+        """
+        Get the memory-mapped data of an image, if it's possible.
+        The layout is computed the first time, and then cached in tiff_info,
+        so that afterwards the data can be read without locking the file.
+        tiff_info (dictionary): Information about the source tiff file and directory
+        zoom (0<=int): the zoom level (0 is the main image)
+        return (None or dict): see _getMemmapLayout()
+        """
+        layouts = tiff_info.setdefault('layouts', {})
+        try:
+            return layouts[zoom]
+        except KeyError:
+            pass
+
+        with tiff_info['lock']:
+            tfile = tiff_info['handle']
+            try:
+                tfile.SetDirectory(tiff_info['dir_index'])
+                if zoom != 0:
+                    tfile.SetSubDirectory(tfile.GetField(T.TIFFTAG_SUBIFD)[zoom - 1])
+                layout = _getMemmapLayout(tfile)
+            except Exception:
+                logging.exception("Failed to map image %d to memory", tiff_info['dir_index'])
+                layout = None
+        layouts[zoom] = layout
+        return layout
+
     def _readAndMergeImages(self):
         """
         Read the images from file, and merge them into a higher dimension DataArray.
@@ -2065,45 +2572,52 @@ class DataArrayShadowPyramidalTIFF(DataArrayShadowTIFF):
         """
         self.tiff_info = tiff_info
         if isinstance(tiff_info, list):
-            tiff_info0 = tiff_info[0]
+            tiff_infos = tiff_info
         else:
-            tiff_info0 = tiff_info
-        tiff_file = tiff_info0['handle']
+            tiff_infos = [tiff_info]
+        tiff_file = tiff_infos[0]['handle']
 
         num_tcols = tiff_file.GetField(T.TIFFTAG_TILEWIDTH)
         num_trows = tiff_file.GetField(T.TIFFTAG_TILELENGTH)
         if num_tcols is None or num_trows is None:
             raise ValueError("The image is not tiled")
 
-        with tiff_info0['lock']:
-            tiff_file.SetDirectory(tiff_info0['dir_index'])
-            sub_ifds = tiff_file.GetField(T.TIFFTAG_SUBIFD)
-
-        # add the number of subdirectories, and the main image
-        if sub_ifds:
-            maxzoom = len(sub_ifds)
-        else:
-            maxzoom = 0
+        # Each plane has its own zoom levels (as SubIFDs). They should all have
+        # the same number, but in case some are missing, only provide the ones
+        # available in every plane.
+        maxzoom = None
+        for ti in tiff_infos:
+            with ti['lock']:
+                ti['handle'].SetDirectory(ti['dir_index'])
+                sub_ifds = ti['handle'].GetField(T.TIFFTAG_SUBIFD)
+            # add the number of subdirectories, and the main image
+            nzoom = len(sub_ifds) if sub_ifds else 0
+            if maxzoom is not None and nzoom != maxzoom:
+                logging.warning("Plane %s has %d zoom levels, while the previous ones have %d",
+                                ti.get('hdim_index'), nzoom, maxzoom)
+            maxzoom = nzoom if maxzoom is None else min(maxzoom, nzoom)
 
         tile_shape = (num_tcols, num_trows)
 
         DataArrayShadow.__init__(self, shape, dtype, metadata, maxzoom, tile_shape)
 
-    def getTile(self, x, y, zoom):
-        '''
-        Fetches one tile
-        x (0<=int): X index of the tile.
-        y (0<=int): Y index of the tile
-        zoom (0<=int): zoom level to use. The total shape of the image is shape / 2**zoom.
-            The number of tiles available in an image is ceil((shape//zoom)/tile_shape)
-        return (DataArray): the shape of the DataArray is typically of shape
-        '''
-        # get information about how to retrieve the actual pixels from the TIFF file
-        tiff_info = self.tiff_info
-        if isinstance(tiff_info, list):
-            # TODO Implement the reading of the subdata when tiff_info is a list.
-            # It is the case when the DataArray has multiple pixelData (eg, when data has more than 2D).
-            raise NotImplementedError("DataArray has multiple pixelData")
+    def _readTile(self, tiff_info, x, y, zoom):
+        """
+        Reads one tile of the image of a given directory
+        tiff_info (dictionary): Information about the source tiff file and
+          directory from which the image should be read (cf DataArrayShadowTIFF)
+        x, y, zoom (0<=int): see getTile()
+        return (numpy.array): The tile
+        """
+        layout = self._getLayout(tiff_info, zoom)
+        if layout and "offsets" in layout:
+            offsets = layout["offsets"]
+            if not (0 <= y < offsets.shape[0] and 0 <= x < offsets.shape[1]):
+                raise ValueError("Invalid tile position %d, %d" % (x, y))
+            # Directly from the file, cropped on the border
+            tile = _memmap(layout, int(offsets[y, x]), layout["tile_shape"])
+            th, tw = tile.shape[:2]
+            return tile[:layout["shape"][0] - y * th, :layout["shape"][1] - x * tw]
 
         with tiff_info['lock']:
             tiff_file = tiff_info['handle']
@@ -2115,24 +2629,69 @@ class DataArrayShadowPyramidalTIFF(DataArrayShadowTIFF):
                 if not sub_ifds:
                     raise ValueError("Image does not have zoom levels")
 
-                if not (0 <= zoom <= len(sub_ifds)):
-                    raise ValueError("Invalid Z value %d" % (zoom,))
-
                 # set the offset of the subimage. Z=0 is the main image
                 tiff_file.SetSubDirectory(sub_ifds[zoom - 1])
 
-            orig_pixel_size = self.metadata.get(model.MD_PIXEL_SIZE, (1, 1))
-
-            # calculate the pixel size of the tile for the zoom level
-            tile_pixel_size = tuple(ps * 2 ** zoom for ps in orig_pixel_size)
-
             xp = x * self.tile_shape[0]
             yp = y * self.tile_shape[1]
-            tile = tiff_file.read_one_tile(xp, yp)
-            tile = model.DataArray(tile, self.metadata.copy())
-            tile.metadata[model.MD_PIXEL_SIZE] = tile_pixel_size
-            # calculate the center of the tile
-            tile.metadata[model.MD_POS] = get_tile_md_pos((x, y), self.tile_shape, tile, self)
+            return tiff_file.read_one_tile(xp, yp)
+
+    def getTile(self, x, y, zoom, index=None):
+        '''
+        Fetches one tile
+        x (0<=int): X index of the tile.
+        y (0<=int): Y index of the tile
+        zoom (0<=int): zoom level to use. The total shape of the image is shape / 2**zoom.
+            The number of tiles available in an image is ceil((shape//zoom)/tile_shape)
+        index (None or tuple of 0<=int): for data with multiple planes (ie,
+            dimensions before YX, such as CTZ), the position of the plane to
+            read. If None, the tile of every plane is read.
+        return (DataArray): the shape of the DataArray is typically of shape
+            tile_shape (Y, X). If the data has multiple planes, and index is
+            None, the high dimensions are the same as the data (eg, CTZYX).
+        raise IndexError: if the index doesn't correspond to a plane
+        '''
+        if not 0 <= zoom <= self.maxzoom:
+            raise ValueError("Invalid Z value %d" % (zoom,))
+
+        # get information about how to retrieve the actual pixels from the TIFF file
+        tiff_info = self.tiff_info
+        md = self.metadata.copy()
+        if isinstance(tiff_info, list):
+            # The DataArray has multiple planes, each with its own zoom levels
+            nhdim = len(tiff_info[0]['hdim_index'])
+            if index is None:
+                tile = None
+                for ti in tiff_info:
+                    ptile = self._readTile(ti, x, y, zoom)
+                    if tile is None:
+                        tile = numpy.empty(self.shape[:nhdim] + ptile.shape, dtype=ptile.dtype)
+                    tile[ti['hdim_index']] = ptile
+            else:
+                index = tuple(index)
+                for ti in tiff_info:
+                    if ti['hdim_index'] == index:
+                        break
+                else:
+                    raise IndexError("No plane at index %s" % (index,))
+                tile = self._readTile(ti, x, y, zoom)
+                if model.MD_DIMS in md:
+                    md[model.MD_DIMS] = md[model.MD_DIMS][nhdim:]
+        else:
+            if index:
+                raise IndexError("No plane at index %s" % (index,))
+            tile = self._readTile(tiff_info, x, y, zoom)
+
+        # calculate the pixel size of the tile for the zoom level (only the
+        # X & Y dimensions are reduced)
+        orig_pixel_size = md.get(model.MD_PIXEL_SIZE, (1, 1))
+        tile_pixel_size = (tuple(ps * 2 ** zoom for ps in orig_pixel_size[:2]) +
+                           tuple(orig_pixel_size[2:]))
+        md[model.MD_PIXEL_SIZE] = tile_pixel_size
+
+        tile = model.DataArray(tile, md)
+        # calculate the center of the tile
+        tile.metadata[model.MD_POS] = get_tile_md_pos((x, y), self.tile_shape, tile, self)
 
         return tile
 
@@ -2165,11 +2724,13 @@ class AcquisitionDataTIFF(AcquisitionData):
 
         AcquisitionData.__init__(self, tuple(data), tuple(thumbnails))
 
-    def _getAllDataArrayShadows(self, tfile, lock):
+    def _getAllDataArrayShadows(self, tfile, lock, ndirs=None):
         """
         Create the all DataArrayShadows for the given TIFF file
         tfile (tiff handle): Handle for the TIFF file
         lock (threading.Lock): The lock that controls the access to the TIFF file
+        ndirs (None or int): number of directories to read, from the first one.
+          If None, all the directories of the file are read.
         return:
             data (list of DataArrayShadows or None): DataArrayShadows
                for each IFD representing a proper image. None are inserted for
@@ -2180,7 +2741,7 @@ class AcquisitionDataTIFF(AcquisitionData):
         data = []
         thumbnails = []
         # iterates all the directories of the TIFF file
-        for dir_index in self._iterDirectories(tfile):
+        for dir_index in self._iterDirectories(tfile, ndirs):
             das, is_thumb = self._createDataArrayShadows(tfile, dir_index, lock)
             if is_thumb:
                 data.append(None)
@@ -2218,41 +2779,38 @@ class AcquisitionDataTIFF(AcquisitionData):
         data, thumbnails = [], []
         try:
             # take care of multiple file distribution
-            # Keep track of the UUID/files that were already opened
-            uuids_read = {}  # str -> str: UUID -> file path
-            for tiff_data in omeroot.findall("Image/Pixels/TiffData"):
-                uuide = tiff_data.find("UUID")
-                if uuide is None:
-                    # uuid attribute is only part of multiple files distribution
-                    continue
-
+            ome_files = self._getOMEFiles(omeroot)
+            if ome_files:
                 try:
-                    u = uuid.UUID(uuide.text)
-                    ofn = uuide.get("FileName")
-                except (ValueError, KeyError) as ex:
-                    logging.warning("Failed to decode UUID %s: %s", uuide.text, ex)
-                    continue
-
-                if u in uuids_read:
-                    continue  # Already done
+                    root_uuid = uuid.UUID(omeroot.attrib["UUID"])
+                except (KeyError, ValueError):
+                    root_uuid = None
 
-                try:
+                def open_ome_file(u, ofn, ndirs):
+                    if u == root_uuid:  # No need to reopen the file
+                        return self._getAllDataArrayShadows(tfile, self._lock, ndirs)
                     sfn, stfile = self._findFileByUUID(u, ofn, filename)
-                except LookupError:
-                    logging.warning("File '%s' enlisted in the OME-XML header is missing.", u)
-                    # To keep the metadata update synchronised, we need to
-                    # put a place-holder.
-                    # TODO: instead of guessing the "IFD" based on the order
-                    # in the Pixels, we should use the IFD + UUID of each
-                    # TiffData and map it to the file/IFD.
-                    data.append(None)
-                    continue
+                    # Each file has its own handle, so it can be accessed in parallel
+                    return self._getAllDataArrayShadows(stfile, threading.Lock(), ndirs)
 
-                # TODO: we could have a separate lock per file?
-                d, t = self._getAllDataArrayShadows(stfile, self._lock)
-                data.extend(d)
-                thumbnails.extend(t)
-                uuids_read[u] = sfn
+                # The files are opened in parallel, as for large acquisitions
+                # (eg, tiled acquisitions), there can be hundreds of them.
+                nthreads = max(1, min(MAX_OPEN_THREADS, len(ome_files)))
+                with ThreadPoolExecutor(max_workers=nthreads) as executor:
+                    futures = [executor.submit(open_ome_file, u, ofn, ndirs)
+                               for u, (ofn, ndirs) in ome_files.items()]
+
+                for (u, (ofn, ndirs)), f in zip(ome_files.items(), futures):
+                    try:
+                        d, t = f.result()
+                    except LookupError:
+                        logging.warning("File '%s' enlisted in the OME-XML header is missing.", u)
+                        # To keep the metadata update synchronised, we need to
+                        # put a place-holder for each IFD of the file.
+                        data.extend([None] * ndirs)
+                        continue
+                    data.extend(d)
+                    thumbnails.extend(t)
 
             if not data:
                 # Nothing loading (not even the current file) => load this file
@@ -2268,6 +2826,38 @@ class AcquisitionDataTIFF(AcquisitionData):
         data = [i for i in data if i is not None]
         return data, thumbnails
 
+    @staticmethod
+    def _getOMEFiles(omeroot):
+        """
+        List the files referenced in the OME XML, for data distributed over
+          multiple files.
+        omeroot (ET.Element): the root (i.e., OME) element of the XML description
+        return (OrderedDict UUID -> (str, int)): for each file, in the order they
+          are first referenced, the file name as recorded in the OME XML, and the
+          number of directories (IFDs) which contain the data referenced. Empty
+          if the data is all in the same file.
+        """
+        ome_files = OrderedDict()
+        for tiff_data in omeroot.findall("Image/Pixels/TiffData"):
+            uuide = tiff_data.find("UUID")
+            if uuide is None:
+                # uuid attribute is only part of multiple files distribution
+                continue
+
+            try:
+                u = uuid.UUID(uuide.text)
+                ofn = uuide.attrib["FileName"]
+                # Same as in _getIFDsFromOME()
+                last_ifd = int(tiff_data.get("IFD", "0")) + int(tiff_data.get("PlaneCount", "1"))
+            except (TypeError, ValueError, KeyError) as ex:
+                logging.warning("Failed to decode UUID %s: %s", uuide.text, ex)
+                continue
+
+            ofn, ndirs = ome_files.get(u, (ofn, 0))
+            ome_files[u] = ofn, max(ndirs, last_ifd)
+
+        return ome_files
+
     def _findFileByUUID(self, suuid, orig_fn, root_fn):
         """
         Find the file with the given UUID. In addition to immediately
@@ -2295,16 +2885,15 @@ class AcquisitionDataTIFF(AcquisitionData):
                 raise LookupError("File not found")
 
             try:
-                omeroot = self._getOMEXML(tfile)
-                fuuid = uuid.UUID(omeroot.attrib["UUID"])
-            except (LookupError, KeyError, ValueError):
+                fuuid = self._getOMEUUID(tfile)
+            except LookupError:
                 logging.info("Found file %s, but couldn't read UUID", fn)
                 raise LookupError("File has not UUID")
 
             if fuuid != suuid:
                 logging.warning("Found file %s, but UUID is %s instead of %s",
                                 fn, fuuid, suuid)
-            return full_fn, tfile
+            return fn, tfile
 
         # Look in the same directory as the root file
         full_fn = os.path.join(path, orig_bn)
@@ -2329,6 +2918,29 @@ class AcquisitionDataTIFF(AcquisitionData):
 
         raise LookupError("Failed to find file with UUID %s" % (suuid,))
 
+    @staticmethod
+    def _getOMEUUID(tfile):
+        """
+        Read the UUID of an OME-TIFF file. The OME XML is not fully parsed, as
+          it's (almost) identical in every file of a multiple files acquisition,
+          and would be slow to parse for each of them.
+        return (uuid.UUID): the UUID of the file
+        raise LookupError: if no UUID found
+        """
+        tfile.SetDirectory(0)
+        desc = tfile.GetField(T.TIFFTAG_IMAGEDESCRIPTION)
+        if not desc:
+            raise LookupError("No OME XML data found")
+
+        # The UUID is an attribute of the root element
+        m = re.search(br"<ome\s[^>]*\bUUID\s*=\s*[\"']([^\"']*)[\"']", desc, re.IGNORECASE)
+        if not m:
+            raise LookupError("No UUID found in the OME XML")
+        try:
+            return uuid.UUID(m.group(1).decode("ascii"))
+        except (ValueError, UnicodeDecodeError):
+            raise LookupError("Failed to decode UUID %s" % (m.group(1),))
+
     def _getOMEXML(self, tfile):
         """
         return (xml.Element): the OME XML root in the given file
@@ -2528,8 +3140,6 @@ class AcquisitionDataTIFF(AcquisitionData):
         if len(tiff_info_list) == 1:
             # Optimisation: if there is actually only one (because it's split
             # over C), make it a simple DAS.
-            # That's especially useful for now, as Pyramidal DAS don't support
-            # high dimensions yet.
             tiff_info_list = tiff_info_list[0]
             del tiff_info_list['hdim_index']
             tshape = fim.shape
@@ -2539,16 +3149,22 @@ class AcquisitionDataTIFF(AcquisitionData):
         return mergedDataArrayShadow
 
     @staticmethod
-    def _iterDirectories(tiff_file):
+    def _iterDirectories(tiff_file, ndirs=None):
         """
         Iterate on the directories of a tiff file
         tiff_file (tiff handle): The tiff file handle to be iterated on
+        ndirs (None or int): maximum number of directories to iterate on. If None,
+          all the directories are iterated.
         return (int): The index of the directory
         """
+        if ndirs == 0:
+            return
         tiff_file.SetDirectory(0)
         dir_index = 0
         yield dir_index
         while not tiff_file.LastDirectory():
+            if ndirs is not None and dir_index + 1 >= ndirs:
+                break
             tiff_file.ReadDirectory()
             dir_index += 1
             yield dir_index
@@ -2166,7 +2166,8 @@ def images_to_export_data(streams, view_hfw, view_pos,
 
     def _ensure_proj_mpp(projection, min_mpp):
         img_received = threading.Event()
-        new_proj = RGBSpatialProjection(projection.stream)
+        # Only projected once => no need to load the tiles around
+        new_proj = RGBSpatialProjection(projection.stream, prefetch=False)
         new_proj.rect.value = projection.rect.value
         new_proj.mpp.value = new_proj.mpp.clip(min_mpp)  # set pixel size to desired number
         streams[stream_idx] = new_proj
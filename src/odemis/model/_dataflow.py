@@ -27,17 +27,49 @@ from __future__ import division, print_function
 
 from past.builtins import basestring
 import Pyro4
+from Pyro4.core import oneway
+import collections
+import copy
+import itertools
 import logging
+import mmap
 import numpy
 from odemis.model import _metadata
 from odemis.util import inspect_getmembers
 from odemis.util.weak import WeakMethod, WeakRefLostError
 import os
+import struct
 import threading
 import time
 import zmq
 
 from . import _core
+from ._dispatcher import Deliverer, Subscription, get_dispatcher
+
+
+# Directory where the shared memory ring buffers are created. It must be a
+# tmpfs, so that the data never goes to the disk.
+SHM_DIRECTORY = "/dev/shm"
+# Arrays smaller than this are sent directly over 0MQ, as for them the cost of
+# the copy is lower than the cost of going through the shared memory.
+SHM_MIN_SIZE = 64 * 1024  # B
+# Number of arrays which can be stored simultaneously in the ring buffer.
+SHM_RING_LENGTH = 4
+# Prefix of the remote listener name, to indicate it can read the shared memory
+SHM_LISTENER_PREFIX = "shm:"
+
+# The metadata is sent in full only when needed, otherwise only the values
+# which differ from the last full metadata are sent.
+# Maximum time between two full metadata, for the subscribers which missed it.
+MD_SNAPSHOT_PERIOD = 1  # s
+# Time after a new subscription during which the full metadata is always sent,
+# as 0MQ needs a little while before the new subscriber receives the messages.
+MD_SUBSCRIBE_DELAY = 0.5  # s
+# Number of full metadata kept by the publisher, for the subscribers which
+# missed one and request it.
+MD_SNAPSHOT_KEEP = 4
+# Maximum time between two reports of the statistics of a proxy to its DataFlow
+STATS_REPORT_PERIOD = 5  # s
 
 
 class DataArray(numpy.ndarray):
@@ -96,6 +128,68 @@ class DataArray(numpy.ndarray):
     #     return numpy.ndarray.__array_wrap__(self, out_arr, context)
 
 
+class _DataFlowStatistics(object):
+    """
+    Counters about the arrays passing through a DataFlow, to find out which
+    one is falling behind.
+    The counters are not protected by a lock, as they can be slightly
+    inaccurate.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.start = time.time()
+        self.published = 0  # arrays sent to the remote listeners
+        self.published_bytes = 0
+        self.received = 0  # arrays received from the remote DataFlow
+        self.received_bytes = 0
+        self.dropped = 0  # arrays received but not passed to the listeners
+        self.subscribers_received = 0  # arrays received by the remote listeners
+        self.subscribers_dropped = 0  # arrays dropped by the remote listeners
+        self.delivered = 0  # arrays passed to the (local) listeners
+        self.latency_sum = 0
+        self.latency_count = 0
+        self.latency_max = 0
+        self.callback_sum = 0
+        self.callback_max = 0
+
+    def add_delivered(self, latency, callback_time):
+        """
+        latency (float or None): time between the acquisition of the array
+          and the delivery to the listeners (s)
+        callback_time (float): time spent in the listeners (s)
+        """
+        self.delivered += 1
+        if latency is not None:
+            self.latency_sum += latency
+            self.latency_count += 1
+            self.latency_max = max(self.latency_max, latency)
+        self.callback_sum += callback_time
+        self.callback_max = max(self.callback_max, callback_time)
+
+    def to_dict(self):
+        """
+        return (dict str -> number): all the counters, and the averages
+        """
+        return {
+            "duration": time.time() - self.start,
+            "published": self.published,
+            "published_bytes": self.published_bytes,
+            "received": self.received,
+            "received_bytes": self.received_bytes,
+            "dropped": self.dropped,
+            "subscribers_received": self.subscribers_received,
+            "subscribers_dropped": self.subscribers_dropped,
+            "delivered": self.delivered,
+            "latency_avg": self.latency_sum / self.latency_count if self.latency_count else None,
+            "latency_max": self.latency_max if self.latency_count else None,
+            "callback_time_avg": self.callback_sum / self.delivered if self.delivered else None,
+            "callback_time_max": self.callback_max if self.delivered else None,
+        }
+
+
 class DataFlowBase(object):
     """
     This is an abstract class that must be extended by each detector which
@@ -107,6 +201,34 @@ class DataFlowBase(object):
     def __init__(self):
         self._listeners = set()
         self._lock = threading.RLock()  # need to be acquired to modify the set
+        self._stats = _DataFlowStatistics()
+
+    def getStatistics(self):
+        """
+        Report how many arrays went through the DataFlow, and how fast.
+        return (dict str -> number or None): the counters since the creation
+          (or the last reset), with the following keys:
+          * duration (s): time the counters have been running
+          * published/published_bytes: arrays (and their size) sent to remote listeners
+          * received/received_bytes: arrays (and their size) received from a
+            remote DataFlow (only for proxies)
+          * dropped: arrays received but discarded, as a newer one was already
+            available (only for proxies)
+          * subscribers_received/subscribers_dropped: sum of the received and
+            dropped arrays, as reported by the remote listeners (proxies). They
+            report it periodically, and when they unsubscribe.
+          * delivered: arrays passed to the listeners
+          * latency_avg/latency_max (s): time between the acquisition date
+            (MD_ACQ_DATE) and the delivery to the listeners
+          * callback_time_avg/callback_time_max (s): time spent in the listeners
+        """
+        return self._stats.to_dict()
+
+    def resetStatistics(self):
+        """
+        Set back all the counters of getStatistics() to 0
+        """
+        self._stats.reset()
 
     # to be overridden
     # not defined at all so that the proxy version automatically does a remote call
@@ -183,6 +305,7 @@ class DataFlowBase(object):
 
         # to allow modify the set while calling
         snapshot_listeners = frozenset(self._listeners)
+        start = time.time()
         for l in snapshot_listeners:
             try:
                 l(self, data)
@@ -192,6 +315,300 @@ class DataFlowBase(object):
                 # we cannot abort just because one listener failed
                 logging.exception("Exception when notifying a data_flow")
 
+        if snapshot_listeners:
+            try:
+                latency = start - data.metadata[_metadata.MD_ACQ_DATE]
+            except (AttributeError, KeyError, TypeError):
+                latency = None
+            self._stats.add_delivered(latency, time.time() - start)
+
+
+class _SharedMemoryRing(object):
+    """
+    Ring buffer stored in a file of the shared memory, used to pass the arrays
+    to the subscribers on the same computer, without pushing them through the
+    0MQ socket (and so the kernel).
+    Each slot starts with a header containing the sequence number of the array
+    it holds (0 while it is being written), followed by the raw data. The
+    reader checks the sequence number before and after copying the data, so
+    that it can detect if the slot was overwritten in the mean time.
+    Only to be used by the owner of the DataFlow (the writer).
+    """
+    HEADER_SIZE = 64  # B, keeps the data aligned
+    _counter = itertools.count(1)
+
+    def __init__(self, slot_size, length=SHM_RING_LENGTH):
+        """
+        slot_size (int > 0): maximum size of an array (in bytes)
+        length (int > 0): number of slots
+        raise EnvironmentError: if the shared memory cannot be created
+        """
+        # Round up to a page, to keep each slot aligned
+        slot_size += self.HEADER_SIZE
+        slot_size = -(-slot_size // mmap.PAGESIZE) * mmap.PAGESIZE
+        self.slot_size = slot_size
+        self.data_size = slot_size - self.HEADER_SIZE
+        self.length = length
+        self._next_slot = 0
+        self._seq = 0
+
+        self.path = os.path.join(SHM_DIRECTORY, "odemis-df-%d-%d" %
+                                 (os.getpid(), next(self._counter)))
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o660)
+        try:
+            os.ftruncate(fd, slot_size * length)
+            self._mmap = mmap.mmap(fd, slot_size * length)
+        except Exception:
+            os.unlink(self.path)
+            raise
+        finally:
+            os.close(fd)
+        logging.debug("Created shared memory ring %s of %d x %d B",
+                      self.path, length, slot_size)
+
+    def write(self, data):
+        """
+        Copy the array in the next slot
+        data (numpy.ndarray): the array to share. It must fit in a slot, but
+          doesn't need to be contiguous.
+        return (str, int, int): path, offset, and sequence number, to be passed to
+          the reader.
+        """
+        assert data.nbytes <= self.data_size
+        offset = self._next_slot * self.slot_size
+        self._next_slot = (self._next_slot + 1) % self.length
+        self._seq += 1
+
+        # Invalidate the slot, copy the data, and then mark it as valid
+        struct.pack_into("<Q", self._mmap, offset, 0)
+        dst = numpy.frombuffer(self._mmap, dtype=data.dtype, count=data.size,
+                               offset=offset + self.HEADER_SIZE)
+        dst.shape = data.shape
+        dst[...] = data  # Also takes care of the strides
+        del dst  # Release the buffer, otherwise the mmap cannot be closed
+        struct.pack_into("<Q", self._mmap, offset, self._seq)
+        return self.path, offset, self._seq
+
+    def close(self):
+        try:
+            os.unlink(self.path)
+        except OSError:
+            logging.warning("Failed to delete shared memory %s", self.path)
+        try:
+            self._mmap.close()
+        except BufferError:
+            # Should never happen, but if some array still uses it, it will
+            # eventually be garbage collected.
+            logging.warning("Shared memory %s still in use", self.path)
+
+
+class _SharedMemoryReader(object):
+    """
+    Reads arrays from a _SharedMemoryRing (possibly of another process).
+    """
+
+    def __init__(self):
+        self._path = None
+        self._mmap = None
+
+    def _open(self, path):
+        self.close()
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            size = os.fstat(fd).st_size
+            self._mmap = mmap.mmap(fd, size, access=mmap.ACCESS_READ)
+        finally:
+            os.close(fd)
+        self._path = path
+
+    def read(self, location, dtype, shape):
+        """
+        Copy an array out of the shared memory
+        location (str, int, int): path, offset and sequence number, as returned by
+          _SharedMemoryRing.write()
+        dtype (str): numpy type of the array
+        shape (tuple of int): shape of the array
+        return (numpy.ndarray or None): a copy of the array, or None if it's not
+          available anymore (ie, it has already been overwritten by a newer array).
+        """
+        path, offset, seq = location
+        if path != self._path:
+            try:
+                self._open(path)
+            except EnvironmentError as ex:
+                # Most likely, the ring has been replaced by a new one
+                logging.debug("Failed to open shared memory %s: %s", path, ex)
+                return None
+
+        hdr_size = _SharedMemoryRing.HEADER_SIZE
+        count = int(numpy.prod(shape))
+        if offset + hdr_size + count * numpy.dtype(dtype).itemsize > len(self._mmap):
+            logging.warning("Shared memory %s too small for array of shape %s",
+                            path, shape)
+            return None
+
+        if struct.unpack_from("<Q", self._mmap, offset)[0] != seq:
+            return None
+        src = numpy.frombuffer(self._mmap, dtype=dtype, count=count,
+                               offset=offset + hdr_size)
+        array = src.copy()
+        del src  # Release the buffer, otherwise the mmap cannot be closed
+        # Check it hasn't been overwritten while copying
+        if struct.unpack_from("<Q", self._mmap, offset)[0] != seq:
+            return None
+        array.shape = shape
+        return array
+
+    def close(self):
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                pass
+            self._mmap = None
+            self._path = None
+
+
+def _can_read_shm():
+    """
+    return (bool): True if the arrays can be received via the shared memory
+    """
+    return os.access(SHM_DIRECTORY, os.R_OK | os.X_OK)
+
+
+def _md_value_equal(a, b):
+    """
+    Compare two metadata values
+    return (bool): True if they are for sure the same
+    """
+    if a is b:
+        return True
+    if type(a) is not type(b):
+        return False
+    try:
+        if isinstance(a, numpy.ndarray):
+            return a.dtype == b.dtype and numpy.array_equal(a, b)
+        return bool(a == b)
+    except Exception:  # Typically, a tuple containing arrays
+        return False
+
+
+class _MetadataEncoder(object):
+    """
+    Converts the metadata of each array into a small message. As the metadata
+    of a live stream rarely changes between arrays (apart from MD_ACQ_DATE), it
+    only sends the full metadata (a "snapshot") when needed, and otherwise only
+    the values which differ from the last snapshot.
+    Each message is a tuple of (int, bool, dict): the snapshot ID, whether
+    it's a full metadata, and the metadata (or the differences).
+    The last snapshots are kept, so that a subscriber which missed one can
+    request it with get_snapshot().
+    """
+
+    def __init__(self):
+        self._snapshot = None  # dict str -> value, copy of the last full metadata
+        self._snapshot_id = 0
+        self._snapshot_time = 0
+        self._full_until = 0  # time until which the full metadata is sent
+        # int -> dict: snapshot ID -> full metadata, for the last snapshots
+        self._snapshots = collections.OrderedDict()
+        self._snapshots_lock = threading.Lock()
+
+    def reset(self):
+        """
+        Force sending the full metadata for a little while (eg, because there
+        is a new subscriber)
+        """
+        self._full_until = time.time() + MD_SUBSCRIBE_DELAY
+
+    def encode(self, md):
+        """
+        md (dict str -> value): the metadata of the array
+        return (int, bool, dict): message to send
+        """
+        now = time.time()
+        snapshot = self._snapshot
+        if (snapshot is not None and now < self._snapshot_time + MD_SNAPSHOT_PERIOD
+            and now > self._full_until and md.keys() == snapshot.keys()):
+            diff = {k: v for k, v in md.items() if not _md_value_equal(v, snapshot[k])}
+            # If most of the metadata is different, it's not worthy
+            if len(diff) <= len(md) // 2:
+                return self._snapshot_id, False, diff
+
+        # Deep copy, in case the caller modifies the values afterwards
+        self._snapshot = copy.deepcopy(md)
+        self._snapshot_id += 1
+        self._snapshot_time = now
+        with self._snapshots_lock:
+            self._snapshots[self._snapshot_id] = self._snapshot
+            while len(self._snapshots) > MD_SNAPSHOT_KEEP:
+                self._snapshots.popitem(last=False)
+        return self._snapshot_id, True, md
+
+    def get_snapshot(self, snapshot_id):
+        """
+        Return a full metadata recently sent
+        snapshot_id (int): the ID of the snapshot, as sent in the messages
+        return (dict or None): the full metadata, or None if it's too old
+        """
+        with self._snapshots_lock:
+            return self._snapshots.get(snapshot_id)
+
+
+class _MetadataDecoder(object):
+    """
+    Rebuilds the full metadata from the messages created by _MetadataEncoder
+    """
+
+    def __init__(self, fetch=None):
+        """
+        fetch (None or callable int -> dict or None): function to get a full
+          metadata from the publisher, when it was missed. It's passed the
+          snapshot ID, and returns None if that snapshot is not available.
+        """
+        self._snapshot = None
+        self._snapshot_id = None
+        self._fetch = fetch
+        self._fetch_failed_id = None  # ID of the last snapshot which couldn't be fetched
+        self._lock = threading.Lock()
+
+    def decode(self, msg, fetch=False):
+        """
+        msg (int, bool, dict): message received
+        fetch (bool): if True and the full metadata was missed, get it from
+          the publisher (which is slow, but avoids dropping the array)
+        return (dict or None): the full metadata, or None if it cannot be
+          reconstructed (because the last full metadata was not received)
+        """
+        snapshot_id, full, md = msg
+        with self._lock:
+            if full:
+                self._snapshot = md
+                self._snapshot_id = snapshot_id
+                return md.copy()  # The listeners might modify it
+            elif snapshot_id == self._snapshot_id:
+                fullmd = self._snapshot.copy()
+                fullmd.update(md)
+                return fullmd
+            elif not fetch or self._fetch is None or snapshot_id == self._fetch_failed_id:
+                return None
+
+        # Call the publisher without the lock, as the lock is also used by
+        # the thread receiving the messages of all the DataFlows.
+        snapshot = self._fetch(snapshot_id)
+        with self._lock:
+            if snapshot is None:
+                # Don't try again for every array
+                self._fetch_failed_id = snapshot_id
+                return None
+            # Snapshot IDs are increasing: don't replace a newer snapshot
+            if self._snapshot_id is None or snapshot_id > self._snapshot_id:
+                self._snapshot = snapshot
+                self._snapshot_id = snapshot_id
+        fullmd = snapshot.copy()
+        fullmd.update(md)
+        return fullmd
+
 
 # DataFlow object to create on the server (in a component)
 class DataFlow(DataFlowBase):
@@ -211,6 +628,13 @@ class DataFlow(DataFlowBase):
         self.pipe = None
         self._max_discard = max_discard
 
+        # Shared memory used to send the large arrays to the local listeners
+        self._shm_ring = None
+        self._shm_lock = threading.Lock()  # to create/close the ring
+        self._shm_failed = False  # True if the shared memory is not available
+
+        self._md_encoder = _MetadataEncoder()
+
     def _getproxystate(self):
         """
         Equivalent to __getstate__() of the proxy version
@@ -296,6 +720,7 @@ class DataFlow(DataFlowBase):
             self.pipe = None
             self._ctx.term()
             self._ctx = None
+        self._close_shm()
 
     def _count_listeners(self):
         return len(self._listeners) + len(self._remote_listeners)
@@ -338,6 +763,8 @@ class DataFlow(DataFlowBase):
             # add string to listeners if listener is string
             if isinstance(listener, basestring):
                 self._remote_listeners.add(listener)
+                # It needs the full metadata to start
+                self._md_encoder.reset()
             else:
                 assert callable(listener)
                 self._listeners.add(WeakMethod(listener))
@@ -372,6 +799,64 @@ class DataFlow(DataFlowBase):
             if count_before > 0 and count_after == 0:
                 self.stop_generate()
 
+            if not self._remote_listeners:
+                # Free the memory, as it's not going to be used for a while
+                self._close_shm()
+
+    def _close_shm(self):
+        with self._shm_lock:
+            if self._shm_ring:
+                self._shm_ring.close()
+                self._shm_ring = None
+
+    def _write_shm(self, data):
+        """
+        Pass the array via the shared memory, if it's possible and worthy
+        data (numpy.ndarray): the array to send
+        return (None or tuple): None if the array should be sent over 0MQ,
+          otherwise the location of the array in the shared memory.
+        """
+        # Only for big arrays, and when the listeners are fine with losing some
+        # arrays, as the ring buffer might overwrite them before they are read.
+        if (self._shm_failed or self._max_discard == 0 or
+            data.nbytes < SHM_MIN_SIZE):
+            return None
+        # All the listeners must support it, as they all receive the same message
+        if not all(l.startswith(SHM_LISTENER_PREFIX) for l in frozenset(self._remote_listeners)):
+            return None
+
+        with self._shm_lock:
+            try:
+                if self._shm_ring is None or self._shm_ring.data_size < data.nbytes:
+                    if self._shm_ring:
+                        self._shm_ring.close()
+                        self._shm_ring = None
+                    self._shm_ring = _SharedMemoryRing(data.nbytes)
+                return self._shm_ring.write(data)
+            except EnvironmentError as ex:
+                logging.warning("Failed to use shared memory for dataflow %s, will use 0MQ: %s",
+                                self._global_name, ex)
+                self._shm_failed = True
+                return None
+
+    @oneway
+    def reportStatistics(self, received, dropped):
+        """
+        Used by the remote listeners to report the arrays they received
+        received (int): number of arrays received since the previous report
+        dropped (int): number of arrays dropped since the previous report
+        """
+        self._stats.subscribers_received += received
+        self._stats.subscribers_dropped += dropped
+
+    def getMetadataSnapshot(self, snapshot_id):
+        """
+        Used by the remote listeners which missed a full metadata
+        snapshot_id (int): the ID of the full metadata, as received with the arrays
+        return (dict or None): the full metadata, or None if it's not available anymore
+        """
+        return self._md_encoder.get_snapshot(snapshot_id)
+
     def notify(self, data):
         # publish the data remotely
         if self.pipe and len(self._remote_listeners) > 0:
@@ -384,21 +869,30 @@ class DataFlow(DataFlowBase):
 
             # TODO thread-safe for self.pipe ?
             dformat = {"dtype": str(data.dtype), "shape": data.shape}
+            shm_location = self._write_shm(data)
+            if shm_location:
+                dformat["shm"] = shm_location
             self.pipe.send_pyobj(dformat, zmq.SNDMORE)
-            self.pipe.send_pyobj(data.metadata, zmq.SNDMORE)
-            try:
-                if not data.flags["C_CONTIGUOUS"]:
-                    # if not in C order, it will be received incorrectly
-                    # TODO: if it's just rotated, send the info to reconstruct it
-                    # and avoid the memory copy
-                    raise TypeError("Need C ordered array")
-                self.pipe.send(memoryview(data), copy=False)
-            except TypeError:
-                # not all buffers can be sent zero-copy (e.g., has strides)
-                # try harder by copying (which removes the strides)
-                logging.debug("Failed to send data with zero-copy")
-                data = numpy.require(data, requirements=["C_CONTIGUOUS"])
-                self.pipe.send(memoryview(data), copy=False)
+            self.pipe.send_pyobj(self._md_encoder.encode(data.metadata), zmq.SNDMORE)
+            self._stats.published += 1
+            self._stats.published_bytes += data.nbytes
+            if shm_location:
+                # Only a small notice goes through 0MQ, the data is in the ring
+                self.pipe.send(b"")
+            else:
+                try:
+                    if not data.flags["C_CONTIGUOUS"]:
+                        # if not in C order, it will be received incorrectly
+                        # TODO: if it's just rotated, send the info to reconstruct it
+                        # and avoid the memory copy
+                        raise TypeError("Need C ordered array")
+                    self.pipe.send(memoryview(data), copy=False)
+                except TypeError:
+                    # not all buffers can be sent zero-copy (e.g., has strides)
+                    # try harder by copying (which removes the strides)
+                    logging.debug("Failed to send data with zero-copy")
+                    data = numpy.require(data, requirements=["C_CONTIGUOUS"])
+                    self.pipe.send(memoryview(data), copy=False)
 
         # publish locally
         DataFlowBase.notify(self, data)
@@ -424,14 +918,19 @@ class DataFlowProxy(DataFlowBase, Pyro4.Proxy):
         """
         Pyro4.Proxy.__init__(self, uri)
         self._global_name = uri.sockname + "@" + uri.object
-        # Should be unique among all the subscribers of the real DataFlow
-        self._proxy_name = "%x/%x" % (os.getpid(), id(self))
+        self._proxy_name = self._get_proxy_name()
         DataFlowBase.__init__(self)
         self.max_discard = max_discard
 
-        self._ctx = None
-        self._commands = None
-        self._thread = None
+        self._dispatcher = None
+        self._subscription = None
+        self._deliverer = None
+        self._discarded = 0  # number of arrays discarded in a row
+        self._shm = None
+        self._md_decoder = None
+        self._dropped_unlogged = 0  # number of arrays dropped since last log
+        self._last_drop_log = 0
+        self._init_stats_report()
 
     def __getstate__(self):
         # must permit to recreate a proxy to a data-flow in a different container
@@ -444,12 +943,72 @@ class DataFlowProxy(DataFlowBase, Pyro4.Proxy):
         _core.load_roattributes(self, roattributes)
 
         self._global_name = self._pyroUri.sockname + "@" + self._pyroUri.object
-        self._proxy_name = "%x/%x" % (os.getpid(), id(self))
+        self._proxy_name = self._get_proxy_name()
         DataFlowBase.__init__(self)
 
-        self._ctx = None
-        self._commands = None
-        self._thread = None
+        self._dispatcher = None
+        self._subscription = None
+        self._deliverer = None
+        self._discarded = 0  # number of arrays discarded in a row
+        self._shm = None
+        self._md_decoder = None
+        self._dropped_unlogged = 0  # number of arrays dropped since last log
+        self._last_drop_log = 0
+        self._init_stats_report()
+
+    def _init_stats_report(self):
+        # The statistics are reported as a one-way call, so that it's fast
+        self._pyroOneway.add("reportStatistics")
+        self._reported_stats = (0, 0)  # received, dropped counters when last reported
+        self._last_stats_report = time.time()
+
+    def _report_statistics(self):
+        """
+        Send to the remote DataFlow the number of arrays received and dropped
+          since the previous report
+        """
+        received, dropped = self._stats.received, self._stats.dropped
+        prev_received, prev_dropped = self._reported_stats
+        self._reported_stats = received, dropped
+        self._last_stats_report = time.time()
+        if received == prev_received and dropped == prev_dropped:
+            return
+        try:
+            Pyro4.Proxy.__getattr__(self, "reportStatistics")(received - prev_received,
+                                                              dropped - prev_dropped)
+        except Exception as ex:
+            logging.debug("Failed to report statistics of dataflow %s: %s", self._global_name, ex)
+
+    def _get_proxy_name(self):
+        """
+        return (str): the name to subscribe to the remote DataFlow. It should
+          be unique among all the subscribers of the real DataFlow.
+          The DataFlow is always on the same computer (as it uses IPC), so if
+          the shared memory is accessible, the arrays can be passed this way.
+        """
+        name = "%x/%x" % (os.getpid(), id(self))
+        if _can_read_shm():
+            name = SHM_LISTENER_PREFIX + name
+        return name
+
+    def getStatistics(self):
+        """
+        See DataFlowBase.getStatistics(). The published_* values come from the
+        remote DataFlow, while the other values are about the arrays received
+        by this proxy.
+        """
+        self._report_statistics()
+        stats = Pyro4.Proxy.__getattr__(self, "getStatistics")()
+        local_stats = DataFlowBase.getStatistics(self)
+        del local_stats["published"], local_stats["published_bytes"]
+        del local_stats["subscribers_received"], local_stats["subscribers_dropped"]
+        stats.update(local_stats)
+        return stats
+
+    def resetStatistics(self):
+        Pyro4.Proxy.__getattr__(self, "resetStatistics")()
+        DataFlowBase.resetStatistics(self)
+        self._reported_stats = (0, 0)
 
     # .get() is a direct remote call
 
@@ -458,19 +1017,32 @@ class DataFlowProxy(DataFlowBase, Pyro4.Proxy):
     #.unsubscribe()
     #.notify()
 
-    def _create_thread(self):
-        self._ctx = zmq.Context(1) # apparently 0MQ reuse contexts
-        self._commands = self._ctx.socket(zmq.PAIR)
-        self._commands.bind("inproc://" + self._global_name)
-        self._thread = SubscribeProxyThread(self.notify, self._global_name, self.max_discard, self._ctx)
-        self._thread.start()
+    def _create_subscription(self):
+        self._dispatcher = get_dispatcher("DataFlow")
+        # Weak reference, so that the proxy can be garbage collected normally,
+        # and the dispatcher will then notice it can close the connection.
+        # TODO find out if rcvhwm does something and if it does, depend on max_discard
+        # (for now, we just set it to 0, the default, to never discard messages)
+        self._subscription = Subscription(self._global_name, WeakMethod(self._receive), rcvhwm=0)
+        # The listeners are called from a separate thread, so that they don't
+        # block the reception of the other DataFlows.
+        self._deliverer = Deliverer("DataFlow delivery for %s" % (self._global_name,),
+                                    WeakMethod(self._deliver))
+        self._dispatcher.connect(self._subscription)
+        self._shm = _SharedMemoryReader()
+        self._md_decoder = _MetadataDecoder(WeakMethod(self._fetch_md_snapshot))
+
+        # TODO: we need a more advance support for max_discards to be able to
+        # ensure all the data is received when the client needs it.
+        # API should be either:
+        #  *  .max_discard = XXX (= per dataflow)
+        #  * .subscribe(callback, discard=True) (per subscriber)
 
     def start_generate(self):
         # start the remote subscription
-        if not self._thread:
-            self._create_thread()
-        self._commands.send(b"SUB")
-        self._commands.recv()  # synchronise
+        if not self._subscription:
+            self._create_subscription()
+        self._dispatcher.subscribe(self._subscription)  # synchronous
 
         try:
             # send subscription to the actual dataflow and inform dataflow that this remote listener is interested
@@ -478,150 +1050,141 @@ class DataFlowProxy(DataFlowBase, Pyro4.Proxy):
             Pyro4.Proxy.__getattr__(self, "subscribe")(self._proxy_name)
         except Exception as ex:
             logging.error("Subscribing to the dataflow failed. %s", ex)
-            self._commands.send(b"UNSUB")  # asynchronous (necessary to not deadlock)
+            self._dispatcher.unsubscribe(self._subscription)  # asynchronous (necessary to not deadlock)
             raise
 
     def stop_generate(self):
         # stop the remote subscription
         Pyro4.Proxy.__getattr__(self, "unsubscribe")(self._proxy_name)
-        self._commands.send(b"UNSUB")  # asynchronous (necessary to not deadlock)
+        self._report_statistics()
+        self._dispatcher.unsubscribe(self._subscription)  # asynchronous (necessary to not deadlock)
 
-    def __del__(self):
-        try:
-            # end the thread (but it will stop as soon as it notices we are gone anyway)
-            if self._thread:
-                if self._thread.is_alive():
-                    if len(self._listeners):
-                        if logging:
-                            logging.debug("Stopping subscription while there "
-                                          "are still subscribers because dataflow '%s' is going out of context",
-                                          self._global_name)
-                        Pyro4.Proxy.__getattr__(self, "unsubscribe")(self._proxy_name)
-                    self._commands.send(b"STOP")
-                    self._thread.join(1)
-                self._commands.close()
-                # Not needed: called when garbage-collected and it's dangerous
-                # as it blocks until all connections are closed.
-                # self._ctx.term()
-        except Exception:
+    def _receive(self, socket):
+        """
+        Called by the dispatcher when a new array is available. It only reads
+        the message, the array is passed to the listeners by _deliver().
+        socket (0MQ socket): the socket of the subscription
+        """
+        # TODO: be more resilient if wrong data is received (can block forever)
+        array_format = socket.recv_pyobj()
+        array_mdmsg = socket.recv_pyobj()
+        array_buf = socket.recv(copy=False)
+        # Decode even if discarded, to not miss a full metadata
+        array_md = self._md_decoder.decode(array_mdmsg)
+        # logging.debug("Received new DataArray over ZMQ for %s", self._global_name)
+        self._stats.received += 1
+        self._stats.received_bytes += (int(numpy.prod(array_format["shape"])) *
+                                       numpy.dtype(array_format["dtype"]).itemsize)
+
+        array = None
+        if "shm" in array_format and self.max_discard == 0 and array_md is not None:
+            # All the arrays will be delivered, so read it now, before the
+            # shared memory is overwritten.
+            array = self._read_shm(array_format)
+            if array is None:
+                return
+        self._deliverer.put((array_format, array_mdmsg, array_md, array_buf, array))
+
+    def _deliver(self, msg, more):
+        """
+        Called by the deliverer to pass a received array to the listeners
+        msg (tuple): format, metadata message, metadata (or None), buffer and
+          array (or None), as received
+        more (bool): True if a newer array is already available
+        """
+        array_format, array_mdmsg, array_md, array_buf, array = msg
+        if time.time() > self._last_stats_report + STATS_REPORT_PERIOD:
+            self._report_statistics()
+        # more fresh data already?
+        if more and self._discarded < self.max_discard:
+            self._discarded += 1
+            self._drop()
+            # logging.debug("Discarding object received as a newer one is available")
+            return
+        self._discarded = 0
+        if array_md is None:
+            # Only happens just after subscribing, or if messages were lost
+            # => ask the full metadata to the DataFlow
+            array_md = self._md_decoder.decode(array_mdmsg, fetch=True)
+            if array_md is None:
+                logging.debug("Dataflow %s dropped an array received without its full metadata",
+                              self._global_name)
+                self._drop()
+                return
+
+        # TODO: any need to use zmq.utils.rebuffer.array_from_buffer()?
+        if array is not None:  # Already read from the shared memory
             pass
+        elif "shm" in array_format:
+            array = self._read_shm(array_format)
+            if array is None:
+                return
+        elif len(array_buf):
+            array = numpy.frombuffer(array_buf, dtype=array_format["dtype"])
+        else: # frombuffer doesn't support zero length array
+            array = numpy.empty((0,), dtype=array_format["dtype"])
+        array.shape = array_format["shape"]
+        darray = DataArray(array, metadata=array_md)
+
+        self.notify(darray)
+
+    def _fetch_md_snapshot(self, snapshot_id):
+        """
+        Get a full metadata from the remote DataFlow
+        snapshot_id (int): the ID of the full metadata
+        return (dict or None): the full metadata, or None if not available
+        """
         try:
-            Pyro4.Proxy.__del__(self)
-        except Exception:
-            pass # don't be too rough if that fails, it's not big deal anymore
-
+            return Pyro4.Proxy.__getattr__(self, "getMetadataSnapshot")(snapshot_id)
+        except Exception as ex:
+            logging.warning("Failed to get the metadata of dataflow %s: %s", self._global_name, ex)
+            return None
 
-class SubscribeProxyThread(threading.Thread):
-    def __init__(self, notifier, uri, max_discard, zmq_ctx):
+    def _read_shm(self, array_format):
         """
-        notifier (callable): method to call when a new array arrives
-        uri (string): unique string to identify the connection
-        max_discard (int)
-        zmq_ctx (0MQ context): available 0MQ context to use
+        Copy the array from the shared memory
+        array_format (dict): the format of the array, as received
+        return (numpy.ndarray or None): the array, or None if it's not
+          available anymore (in which case, it's counted as dropped)
         """
-        threading.Thread.__init__(self, name="zmq for dataflow " + uri)
-        self.daemon = True
-        self.uri = uri
-        self.max_discard = max_discard
-        self._ctx = zmq_ctx
-        # don't keep strong reference to notifier so that it can be garbage
-        # collected normally and it will let us know then that we can stop
-        self.w_notifier = WeakMethod(notifier)
-
-        # create a zmq synchronised channel to receive _commands
-        self._commands = zmq_ctx.socket(zmq.PAIR)
-        self._commands.connect("inproc://" + uri)
-
-        # create a zmq subscription to receive the data
-        self._data = zmq_ctx.socket(zmq.SUB)
-        # TODO find out if it does something and if it does, depend on max_discard
-        # (for now, we just set it to 0, the default, to never discard messages)
-        if hasattr(self._data, "rcvhwm"):  # zmq v3+
-            self._data.rcvhwm = 0
-        else:  # zmq v2
-            self._data.hwm = 0
-        self._data.connect("ipc://" + uri)
-
-        # TODO: we need a more advance support for max_discards to be able to
-        # ensure all the data is received when the client needs it.
-        # API should be either:
-        #  *  .max_discard = XXX (= per dataflow)
-        #  * .subscribe(callback, discard=True) (per subscriber)
-
-    def run(self):
+        array = self._shm.read(array_format["shm"], array_format["dtype"],
+                               array_format["shape"])
+        if array is None:
+            # Too late, it has already been overwritten
+            logging.debug("Dataflow %s dropped an array overwritten in shared memory",
+                          self._global_name)
+            self._drop()
+        return array
+
+    def _drop(self):
         """
-        Process messages for commands and data
+        Count one more array dropped, and log the total every second
         """
-        # Warning: this might run even when ending (aka "in a __del__() state")
-        # Which means: logging might be None, and zmq might not be working
-        # normally (apparently zmq.POLLIN == None during this time).
+        self._stats.dropped += 1
+        self._dropped_unlogged += 1
+        now = time.time()
+        if now > self._last_drop_log + 1:
+            logging.debug("Dataflow %s dropped %d arrays", self._global_name, self._dropped_unlogged)
+            self._dropped_unlogged = 0
+            self._last_drop_log = now
+
+    def __del__(self):
         try:
-            poller = zmq.Poller()
-            poller.register(self._commands, zmq.POLLIN)
-            poller.register(self._data, zmq.POLLIN)
-            discarded = 0
-            while True:
-                socks = dict(poller.poll())
-
-                # process commands
-                if self._commands in socks:
-                    message = self._commands.recv()
-                    if message == b"SUB":
-                        self._data.setsockopt(zmq.SUBSCRIBE, b'')
-                        logging.debug("Subscribed to remote dataflow %s", self.uri)
-                        self._commands.send(b"SUBD")
-                    elif message == b"UNSUB":
-                        self._data.setsockopt(zmq.UNSUBSCRIBE, b'')
-                        if logging:
-                            logging.debug("Unsubscribed from remote dataflow %s", self.uri)
-                        # no confirmation (async)
-                    elif message == b"STOP":
-                        return
-                    else:
-                        logging.warning("Received unknown message %s", message)
-
-                # receive data
-                if self._data in socks:
-                    # TODO: be more resilient if wrong data is received (can
-                    # block forever)
-                    array_format = self._data.recv_pyobj()
-                    array_md = self._data.recv_pyobj()
-                    array_buf = self._data.recv(copy=False)
-                    # logging.debug("Received new DataArray over ZMQ for %s", self.uri)
-                    # more fresh data already?
-                    if (self._data.getsockopt(zmq.EVENTS) & zmq.POLLIN and
-                        discarded < self.max_discard):
-                        discarded += 1
-                        # logging.debug("Discarding object received as a newer one is available")
-                        continue
-                    # TODO: only log the accumulated number every second, to avoid log flooding
-#                     if discarded:
-#                         logging.debug("Dataflow %s dropped %d arrays", self.uri, discarded)
-                    discarded = 0
-                    # TODO: any need to use zmq.utils.rebuffer.array_from_buffer()?
-                    if len(array_buf):
-                        array = numpy.frombuffer(array_buf, dtype=array_format["dtype"])
-                    else: # frombuffer doesn't support zero length array
-                        array = numpy.empty((0,), dtype=array_format["dtype"])
-                    array.shape = array_format["shape"]
-                    darray = DataArray(array, metadata=array_md)
-
-                    try:
-                        self.w_notifier(darray)
-                    except WeakRefLostError:
-                        return  # It's a sign there is nothing left to do
+            # stop receiving (but the dispatcher would notice we are gone anyway)
+            if self._subscription:
+                if len(self._listeners):
+                    if logging:
+                        logging.debug("Stopping subscription while there "
+                                      "are still subscribers because dataflow '%s' is going out of context",
+                                      self._global_name)
+                    Pyro4.Proxy.__getattr__(self, "unsubscribe")(self._proxy_name)
+                self._dispatcher.close(self._subscription)
         except Exception:
-            if logging:
-                logging.exception("Ending ZMQ thread due to exception")
-        finally:
-            try:
-                self._commands.close()
-            except Exception:
-                print("Exception closing ZMQ commands connection")
-            try:
-                self._data.close()
-            except Exception:
-                print("Exception closing ZMQ data connection")
+            pass
+        try:
+            Pyro4.Proxy.__del__(self)
+        except Exception:
+            pass # don't be too rough if that fails, it's not big deal anymore
 
 
 def unregister_dataflows(self):
@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+"""
+Created on 18 Oct 2026
+
+@author: agent
+
+Copyright © 2026 Delmic
+
+This file is part of Odemis.
+
+Odemis is free software: you can redistribute it and/or modify it under the terms
+of the GNU General Public License version 2 as published by the Free Software
+Foundation.
+
+Odemis is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+Odemis. If not, see http://www.gnu.org/licenses/.
+"""
+# Receives the 0MQ messages of all the remote VAs and DataFlows of a process.
+# Instead of having one thread (and one 0MQ context) per proxy, all the SUB
+# sockets are multiplexed in a single poll loop, per kind of object.
+# The messages can then be passed to the listeners from a separate thread per
+# object (Deliverer), so that a slow or blocking listener doesn't delay the
+# other objects.
+
+from __future__ import division, print_function
+
+import collections
+import functools
+import logging
+import os
+import queue
+import threading
+from odemis.util.weak import WeakRefLostError
+import zmq
+
+
+class Subscription(object):
+    """
+    Connection to one remote publisher (VA or DataFlow), managed by a
+    SubscriptionDispatcher.
+    Only the dispatcher thread should access the socket.
+    """
+
+    def __init__(self, uri, receiver, rcvhwm=None):
+        """
+        uri (str): unique string to identify the connection (ipc)
+        receiver (callable socket -> None): called (from the dispatcher thread)
+          every time a message is available. It should read (at least) one
+          message from the socket. If it raises WeakRefLostError, the
+          subscription is closed.
+        rcvhwm (None or int): receive high water mark of the socket, if it
+          should be changed from the default.
+        """
+        self.uri = uri
+        self.receiver = receiver
+        self.rcvhwm = rcvhwm
+        self.socket = None
+
+
+class SubscriptionDispatcher(object):
+    """
+    Process-wide receiver of the 0MQ messages from many publishers.
+    It has one thread which polls all the SUB sockets, and calls the
+    corresponding receiver. The (un)subscription requests are passed to that
+    thread via a queue, as 0MQ sockets are not thread-safe.
+    """
+
+    def __init__(self, name):
+        """
+        name (str): name of the thread
+        """
+        self._name = name
+        self._ctx = zmq.Context(1)
+        self._poller = zmq.Poller()
+        self._sockets = {}  # socket -> Subscription
+        self._commands = queue.Queue()
+        # A pipe, to wake up the thread when a command is queued
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        self._poller.register(self._wakeup_r, zmq.POLLIN)
+        self._thread = threading.Thread(target=self._run, name=name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _call(self, func, sub, sync=False):
+        """
+        Run the given function in the dispatcher thread
+        func (callable Subscription -> None)
+        sub (Subscription)
+        sync (bool): if True, wait until the function has been executed
+        """
+        if threading.current_thread() is self._thread:
+            # Typically, when a listener (un)subscribes from a callback
+            func(sub)
+            return
+
+        done = threading.Event() if sync else None
+        self._commands.put((func, sub, done))
+        os.write(self._wakeup_w, b"c")
+        if done:
+            done.wait()
+
+    def connect(self, sub):
+        """
+        Start receiving the messages of the given subscription. It's not
+        actually subscribed until subscribe() is called.
+        sub (Subscription)
+        """
+        self._call(self._connect, sub)
+
+    def subscribe(self, sub, topic=b""):
+        """
+        Start receiving the messages. Blocks until it's ready.
+        sub (Subscription): a connected subscription
+        topic (bytes): only receive the messages starting with this prefix.
+          By default, all the messages are received.
+        """
+        self._call(functools.partial(self._subscribe, topic=topic), sub, sync=True)
+
+    def unsubscribe(self, sub, topic=b""):
+        """
+        Stop receiving the messages (asynchronous)
+        sub (Subscription)
+        topic (bytes): same topic as passed to subscribe()
+        """
+        self._call(functools.partial(self._unsubscribe, topic=topic), sub)
+
+    def close(self, sub):
+        """
+        Disconnect the subscription (asynchronous)
+        sub (Subscription)
+        """
+        self._call(self._close, sub)
+
+    # The following methods are only called from the dispatcher thread
+    def _connect(self, sub):
+        if sub.socket is not None:
+            return
+        sub.socket = self._ctx.socket(zmq.SUB)
+        if sub.rcvhwm is not None:
+            sub.socket.rcvhwm = sub.rcvhwm
+        sub.socket.connect("ipc://" + sub.uri)
+        self._sockets[sub.socket] = sub
+        self._poller.register(sub.socket, zmq.POLLIN)
+
+    def _subscribe(self, sub, topic=b""):
+        self._connect(sub)
+        sub.socket.setsockopt(zmq.SUBSCRIBE, topic)
+        logging.debug("Subscribed to remote %s", sub.uri)
+
+    def _unsubscribe(self, sub, topic=b""):
+        if sub.socket is None:
+            return
+        sub.socket.setsockopt(zmq.UNSUBSCRIBE, topic)
+
+    def _close(self, sub):
+        if sub.socket is None:
+            return
+        self._poller.unregister(sub.socket)
+        del self._sockets[sub.socket]
+        sub.socket.close()
+        sub.socket = None
+
+    def _process_commands(self):
+        os.read(self._wakeup_r, 4096)
+        while True:
+            try:
+                func, sub, done = self._commands.get(block=False)
+            except queue.Empty:
+                return
+            try:
+                func(sub)
+            except Exception:
+                logging.exception("Failed to process command for %s", sub.uri)
+            finally:
+                if done:
+                    done.set()
+
+    def _run(self):
+        # Warning: this might run even when ending (aka "in a __del__() state")
+        # Which means: logging might be None, and zmq might not be working
+        # normally.
+        try:
+            while True:
+                events = self._poller.poll()
+                for s, _ in events:
+                    if s == self._wakeup_r:
+                        self._process_commands()
+                        continue
+
+                    sub = self._sockets.get(s)
+                    if sub is None:  # Closed in the mean time
+                        continue
+                    try:
+                        sub.receiver(s)
+                    except WeakRefLostError:
+                        # It's a sign there is nothing left to do
+                        self._close(sub)
+                    except Exception:
+                        logging.exception("Failed to receive message from %s", sub.uri)
+        except Exception:
+            if logging:
+                logging.exception("Ending ZMQ dispatcher %s due to exception", self._name)
+
+
+class Deliverer(object):
+    """
+    Passes the messages received by a dispatcher to a function, from a separate
+    thread. The messages are delivered in order. The thread is only running
+    while messages are being received, and stops after some idle time.
+    """
+
+    def __init__(self, name, deliver, idle_timeout=10):
+        """
+        name (str): name of the thread
+        deliver (callable (object, bool) -> None): called (from the delivery
+          thread) for each message. The second argument is True if newer
+          messages are already waiting. If it raises WeakRefLostError, all the
+          messages waiting are dropped.
+        idle_timeout (0<float): time (in s) without message after which the
+          thread stops.
+        """
+        self._name = name
+        self._deliver = deliver
+        self._idle_timeout = idle_timeout
+        self._queue = collections.deque()
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def put(self, msg):
+        """
+        Queue a message to be delivered
+        msg (object): passed as-is to the deliver function
+        """
+        with self._cond:
+            self._queue.append(msg)
+            # Note: after a fork, the thread object exists, but is not alive
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name=self._name)
+                self._thread.daemon = True
+                self._thread.start()
+            else:
+                self._cond.notify()
+
+    def __len__(self):
+        """
+        return (int): number of messages waiting to be delivered
+        """
+        return len(self._queue)
+
+    def _run(self):
+        try:
+            while True:
+                with self._cond:
+                    if not self._queue:
+                        self._cond.wait(self._idle_timeout)
+                        if not self._queue:
+                            self._thread = None
+                            return
+                    msg = self._queue.popleft()
+                    more = bool(self._queue)
+
+                try:
+                    self._deliver(msg, more)
+                except WeakRefLostError:
+                    with self._cond:
+                        self._queue.clear()
+                        self._thread = None
+                    return
+                except Exception:
+                    logging.exception("Failed to deliver message in %s", self._name)
+        except Exception:
+            # Can happen when ending the process
+            if logging:
+                logging.exception("Ending %s due to exception", self._name)
+
+
+_dispatchers = {}  # name -> SubscriptionDispatcher
+_dispatchers_pid = None  # PID of the process which created the dispatchers
+_dispatchers_lock = threading.Lock()
+
+
+def get_dispatcher(name):
+    """
+    Return the process-wide dispatcher for the given kind of objects.
+    name (str): kind of objects (eg, "VA" or "DataFlow"). Each kind has a
+      separate thread, so that a slow listener of a DataFlow doesn't delay the
+      VA updates.
+    return (SubscriptionDispatcher)
+    """
+    global _dispatchers_pid
+    with _dispatchers_lock:
+        # After a fork, the threads don't exist anymore => start from scratch
+        if _dispatchers_pid != os.getpid():
+            _dispatchers.clear()
+            _dispatchers_pid = os.getpid()
+
+        if name not in _dispatchers:
+            _dispatchers[name] = SubscriptionDispatcher("zmq dispatcher for %s" % (name,))
+        return _dispatchers[name]
@@ -25,20 +25,30 @@ from past.builtins import basestring, long
 import Pyro4
 from Pyro4.core import oneway
 import collections
+import copy
 import logging
 import numbers
 import numpy
 from odemis.util.weak import WeakMethod, WeakRefLostError
 import os
-import threading
 import types
 import sys
+import threading
+import time
 import zmq
 from scipy.spatial import distance
 
 from . import _core
+from ._dispatcher import Deliverer, Subscription, get_dispatcher
 from odemis.util import inspect_getmembers
 
+# 0MQ topics (first frame of each message) published by a VigilantAttribute
+TOPIC_VALUE = b"v"  # followed by the new value
+TOPIC_PROPERTY = b"p"  # followed by the name of the property (eg, range) which changed
+
+# Time after subscribing to the property changes, during which a change might
+# be missed, as 0MQ needs a little while before the subscription is effective.
+PROPERTY_SUBSCRIBE_DELAY = 0.5  # s
 
 class NotSettableError(AttributeError):
     pass
@@ -145,6 +155,10 @@ class VigilantAttribute(VigilantAttributeBase):
         self._global_name = None # to be filled when registered
         self._ctx = None
         self.pipe = None
+        # The messages are sent in two frames (topic + content), and notify()
+        # and _notify_property() can be called from different threads, so the
+        # frames must not interleave
+        self._pipe_lock = threading.Lock()
         self.debug = False  # If True, this VA will print a call stack when its value is set
         self.max_discard = max_discard
 
@@ -279,9 +293,10 @@ class VigilantAttribute(VigilantAttributeBase):
                 logging.info("Unregistering %s while still %d remote listeners", self, len(self._remote_listeners))
                 self._remote_listeners.clear()
 
-            if self.pipe:
-                self.pipe.close()
-                self.pipe = None
+            with self._pipe_lock:
+                if self.pipe:
+                    self.pipe.close()
+                    self.pipe = None
 
             if self._ctx:
                 self._ctx.term()
@@ -324,11 +339,29 @@ class VigilantAttribute(VigilantAttributeBase):
 
         # publish the data remotely
         if self._remote_listeners:
-            self.pipe.send_pyobj(v)
+            with self._pipe_lock:
+                self.pipe.send(TOPIC_VALUE, zmq.SNDMORE)
+                self.pipe.send_pyobj(v)
 
         # publish locally
         VigilantAttributeBase.notify(self, v)
 
+    def _notify_property(self, name):
+        """
+        Inform the remote proxies that a property of the VA (other than the
+          value) has changed, so that they update their cache.
+        It's sent independently of the remote subscribers to the value, as the
+          proxies listen to these changes separately.
+        name (str): name of the property (eg, "range" or "choices")
+        """
+        # Can be called from a mixin before the VA is initialised
+        if getattr(self, "pipe", None) is None:
+            return
+        with self._pipe_lock:
+            if self.pipe:
+                self.pipe.send(TOPIC_PROPERTY, zmq.SNDMORE)
+                self.pipe.send_pyobj(name)
+
     def __del__(self):
         self._unregister()
 
@@ -348,9 +381,11 @@ class VigilantAttributeProxy(VigilantAttributeBase, Pyro4.Proxy):
         self.max_discard = 100
         self.readonly = False # will be updated in __setstate__
 
-        self._ctx = None
-        self._commands = None
-        self._thread = None
+        self._dispatcher = None
+        self._subscription = None
+        self._deliverer = None
+        self._discarded = 0  # number of values discarded in a row
+        self._init_cache()
 
     def __getattr__(self, name):
         # Behaviour of .range and .choices remote attributes:
@@ -383,15 +418,84 @@ class VigilantAttributeProxy(VigilantAttributeBase, Pyro4.Proxy):
     @property
     def choices(self):
         # raises AttributeError if not found
-        value = Pyro4.Proxy.__getattr__(self, "_get_choices")()
-        return value
+        return self._get_cached_property("choices")
 
     # for continuous VA
     @property
     def range(self):
         # raises AttributeError if not found
-        value = Pyro4.Proxy.__getattr__(self, "_get_range")()
-        return value
+        return self._get_cached_property("range")
+
+    def _init_cache(self):
+        # The properties which rarely change (range and choices) are cached.
+        # To know when to invalidate them, the proxy listens to the property
+        # changes on a separate connection (so that it's independent of the
+        # subscription to the value).
+        self._cache = {}  # str -> value or AttributeError: name of property -> value
+        self._cache_gen = 0  # incremented every time the cache is invalidated
+        # Names of the properties read before the subscription was surely
+        # effective. They are read again once, after the subscription delay.
+        self._cache_unconfirmed = set()
+        self._prop_subscription = None
+        self._prop_subscription_time = 0
+
+    def _get_cached_property(self, name):
+        """
+        Return the value of a property of the remote VA, from the cache if
+          available.
+        name (str): name of the property (eg, "range" or "choices")
+        raise AttributeError: if the remote VA doesn't have such property
+        """
+        now = time.time()
+        if (name in self._cache_unconfirmed and
+            now > self._prop_subscription_time + PROPERTY_SUBSCRIBE_DELAY):
+            # A change might have been missed => read it again
+            self._cache.pop(name, None)
+            self._cache_unconfirmed.discard(name)
+
+        try:
+            value = self._cache[name]
+        except KeyError:
+            # Listen to the changes before reading the value, so that no change
+            # is missed. As 0MQ subscriptions take a little time to be
+            # effective, a change immediately after might still be missed, so
+            # in such case the value is read again later.
+            if not self._prop_subscription:
+                self._create_prop_subscription()
+            gen = self._cache_gen
+            try:
+                value = Pyro4.Proxy.__getattr__(self, "_get_" + name)()
+            except AttributeError:
+                # The VA doesn't have such property, and it will never have
+                value = AttributeError
+            if gen == self._cache_gen:  # Not invalidated in the meantime
+                self._cache[name] = value
+                if (value is not AttributeError and
+                    now < self._prop_subscription_time + PROPERTY_SUBSCRIBE_DELAY):
+                    self._cache_unconfirmed.add(name)
+
+        if value is AttributeError:
+            raise AttributeError("VA %s has no %s" % (self._global_name, name))
+        # Copy, so that the caller can safely modify it (eg, a dict of choices)
+        return copy.deepcopy(value)
+
+    def _create_prop_subscription(self):
+        if not self._dispatcher:
+            self._dispatcher = get_dispatcher("VA")
+        self._prop_subscription = Subscription(self._global_name, WeakMethod(self._receive_property))
+        self._dispatcher.subscribe(self._prop_subscription, TOPIC_PROPERTY)
+        self._prop_subscription_time = time.time()
+
+    def _receive_property(self, socket):
+        """
+        Called by the dispatcher when a property of the VA has changed
+        socket (0MQ socket): the socket of the property subscription
+        """
+        socket.recv()  # topic
+        name = socket.recv_pyobj()
+        self._cache_gen += 1
+        self._cache.pop(name, None)
+        self._cache_unconfirmed.discard(name)
 
     def __getstate__(self):
         # must permit to recreate a proxy in a different container
@@ -416,17 +520,24 @@ class VigilantAttributeProxy(VigilantAttributeBase, Pyro4.Proxy):
         self._global_name = self._pyroUri.sockname + "@" + self._pyroUri.object
         self._proxy_name = "%x/%x" % (os.getpid(), id(self))
 
-        self._ctx = None
-        self._commands = None
-        self._thread = None
-
-    def _create_thread(self):
-        logging.debug("Creating thread for VA %s", self._global_name)
-        self._ctx = zmq.Context(1) # apparently 0MQ reuse contexts
-        self._commands = self._ctx.socket(zmq.PAIR)
-        self._commands.bind("inproc://" + self._global_name)
-        self._thread = SubscribeProxyThread(self.notify, self._global_name, self.max_discard, self._ctx)
-        self._thread.start()
+        self._dispatcher = None
+        self._subscription = None
+        self._deliverer = None
+        self._discarded = 0
+        self._init_cache()
+
+    def _create_subscription(self):
+        logging.debug("Connecting to VA %s", self._global_name)
+        if not self._dispatcher:
+            self._dispatcher = get_dispatcher("VA")
+        # Weak reference, so that the proxy can be garbage collected normally,
+        # and the dispatcher will then notice it can close the connection.
+        self._subscription = Subscription(self._global_name, WeakMethod(self._receive))
+        # The listeners are called from a separate thread, so that a slow (or
+        # blocking) listener doesn't delay the updates of the other VAs.
+        self._deliverer = Deliverer("VA delivery for %s" % (self._global_name,),
+                                    WeakMethod(self._deliver))
+        self._dispatcher.connect(self._subscription)
 
     def subscribe(self, listener, init=False):
         count_before = len(self._listeners)
@@ -441,10 +552,9 @@ class VigilantAttributeProxy(VigilantAttributeBase, Pyro4.Proxy):
         """
         start the remote subscription
         """
-        if not self._thread:
-            self._create_thread()
-        self._commands.send(b"SUB")
-        self._commands.recv() # synchronise
+        if not self._subscription:
+            self._create_subscription()
+        self._dispatcher.subscribe(self._subscription, TOPIC_VALUE)  # synchronous
 
         # send subscription to the actual VA
         # a bit tricky because the underlying method gets created on the fly
@@ -460,23 +570,47 @@ class VigilantAttributeProxy(VigilantAttributeBase, Pyro4.Proxy):
         stop the remote subscription
         """
         Pyro4.Proxy.__getattr__(self, "unsubscribe")(self._proxy_name)
-        if self._commands:
-            self._commands.send(b"UNSUB")
+        if self._subscription:
+            self._dispatcher.unsubscribe(self._subscription, TOPIC_VALUE)
+
+    def _receive(self, socket):
+        """
+        Called by the dispatcher when a new value is available. It only reads
+        the message, the value is passed to the listeners by _deliver().
+        socket (0MQ socket): the socket of the subscription
+        """
+        socket.recv()  # topic
+        value = socket.recv_pyobj()
+        self._deliverer.put(value)
+
+    def _deliver(self, value, more):
+        """
+        Called by the deliverer to pass a received value to the listeners
+        value (object): the new value
+        more (bool): True if a newer value is already available
+        """
+        # more fresh data already?
+        if more and self._discarded < self.max_discard:
+            self._discarded += 1
+            return
+        if self._discarded:
+            logging.debug("VA discarded %d values", self._discarded)
+        self._discarded = 0
+
+        self.notify(value)
 
     def __del__(self):
-        # end the thread (but it will stop as soon as it notices we are gone anyway)
+        # stop receiving (but the dispatcher would notice we are gone anyway)
         try:
-            if self._thread:
-                if self._thread.is_alive():
-                    if len(self._listeners):
-                        logging.warning("Stopping subscription while there are still subscribers "
-                                        "because VA '%s' is going out of context",
-                                        self._global_name)
-                        Pyro4.Proxy.__getattr__(self, "unsubscribe")(self._proxy_name)
-                    self._commands.send(b"STOP")
-                    self._thread.join(1)
-                self._commands.close()
-            # self._ctx.term()
+            if self._subscription:
+                if len(self._listeners):
+                    logging.warning("Stopping subscription while there are still subscribers "
+                                    "because VA '%s' is going out of context",
+                                    self._global_name)
+                    Pyro4.Proxy.__getattr__(self, "unsubscribe")(self._proxy_name)
+                self._dispatcher.close(self._subscription)
+            if self._prop_subscription:
+                self._dispatcher.close(self._prop_subscription)
         except Exception:
             pass
 
@@ -486,76 +620,6 @@ class VigilantAttributeProxy(VigilantAttributeBase, Pyro4.Proxy):
             pass  # don't be too rough if that fails, it's not big deal anymore
 
 
-class SubscribeProxyThread(threading.Thread):
-    def __init__(self, notifier, uri, max_discard, zmq_ctx):
-        """
-        notifier (callable): method to call when a new value arrives
-        uri (string): unique string to identify the connection
-        max_discard (int)
-        zmq_ctx (0MQ context): available 0MQ context to use
-        """
-        threading.Thread.__init__(self, name="zmq for VA " + uri)
-        self.daemon = True
-        self.uri = uri
-        self.max_discard = max_discard
-        self._ctx = zmq_ctx
-        # don't keep strong reference to notifier so that it can be garbage
-        # collected normally and it will let us know then that we can stop
-        self.w_notifier = WeakMethod(notifier)
-
-        # create a zmq synchronised channel to receive commands
-        self._commands = zmq_ctx.socket(zmq.PAIR)
-        self._commands.connect("inproc://" + uri)
-
-        # create a zmq subscription to receive the data
-        self.data = zmq_ctx.socket(zmq.SUB)
-        self.data.connect("ipc://" + uri)
-
-    def run(self):
-        # Process messages for commands and data
-        poller = zmq.Poller()
-        poller.register(self._commands, zmq.POLLIN)
-        poller.register(self.data, zmq.POLLIN)
-        discarded = 0
-        while True:
-            socks = dict(poller.poll())
-
-            # process commands
-            if socks.get(self._commands) == zmq.POLLIN:
-                message = self._commands.recv()
-                if message == b"SUB":
-                    self.data.setsockopt(zmq.SUBSCRIBE, b'')
-                    self._commands.send(b"SUBD")
-                elif message == b"UNSUB":
-                    self.data.setsockopt(zmq.UNSUBSCRIBE, b'')
-                    # no confirmation (async)
-                elif message == b"STOP":
-                    self._commands.close()
-                    self.data.close()
-                    return
-
-            # receive data
-            if socks.get(self.data) == zmq.POLLIN:
-                value = self.data.recv_pyobj()
-                # more fresh data already?
-                if (
-                        self.data.getsockopt(zmq.EVENTS) & zmq.POLLIN and
-                        discarded < self.max_discard
-                ):
-                    discarded += 1
-                    continue
-                if discarded:
-                    logging.debug("VA discarded %d values", discarded)
-                discarded = 0
-
-                try:
-                    self.w_notifier(value)
-                except WeakRefLostError:
-                    self._commands.close()
-                    self.data.close()
-                    return
-
-
 def unregister_vigilant_attributes(self):
     for _, value in inspect_getmembers(self, lambda x: isinstance(x, VigilantAttribute)):
         value._unregister()
@@ -876,6 +940,7 @@ class Continuous(object):
             # range.
 
             self._range = new_range
+            self._notify_property("range")
             self._set_value(self.clip(self.value), must_notify=True)
         else:
             value = self.value
@@ -890,6 +955,7 @@ class Continuous(object):
                 raise IndexError(msg % (value, start, end))
 
             self._range = new_range
+            self._notify_property("range")
             self.notify(value)
 
     @property
@@ -979,6 +1045,7 @@ class Enumerated(object):
                 raise IndexError("Current value %s is not part of possible choices: %s." %
                                  (self.value, ", ".join([str(c) for c in new_choices])))
         self._choices = new_choices
+        self._notify_property("choices")
 
     @choices.setter
     def choices(self, value):
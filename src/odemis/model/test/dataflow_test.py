@@ -26,7 +26,10 @@ from __future__ import division, print_function
 import logging
 
 from Pyro4.core import oneway
+import numpy
 from odemis import model
+from odemis.model import _dataflow
+import os
 import pickle
 import threading
 import time
@@ -243,6 +246,37 @@ class TestDataFlow(unittest.TestCase):
         self.assertEqual(self.left2, 0)  # it should be done before left
         self.assertEqual(self.left, 0)
 
+    def test_statistics(self):
+        self.df = SimpleDataFlow()
+        self.size = (2, 2)
+        self.left = 3
+        self.df.subscribe(self.receive_data)
+        for i in range(10):
+            if self.left == 0:
+                break
+            time.sleep(0.2)
+
+        stats = self.df.getStatistics()
+        self.assertEqual(stats["delivered"], 3)
+        self.assertEqual(stats["published"], 0)  # No remote listener
+        self.assertGreater(stats["duration"], 0)
+        self.assertIsNone(stats["latency_avg"])  # No MD_ACQ_DATE
+        self.assertGreaterEqual(stats["callback_time_max"], stats["callback_time_avg"])
+
+        # The remote listeners report their counters
+        self.assertEqual(stats["subscribers_received"], 0)
+        self.df.reportStatistics(5, 2)
+        self.df.reportStatistics(3, 0)
+        stats = self.df.getStatistics()
+        self.assertEqual(stats["subscribers_received"], 8)
+        self.assertEqual(stats["subscribers_dropped"], 2)
+
+        self.df.resetStatistics()
+        stats = self.df.getStatistics()
+        self.assertEqual(stats["delivered"], 0)
+        self.assertEqual(stats["subscribers_received"], 0)
+        self.assertIsNone(stats["callback_time_avg"])
+
     def receive_data(self, dataflow, data):
         """
         callback for df
@@ -334,5 +368,215 @@ class TestDataFlow(unittest.TestCase):
         self.assertEqual(len(self.df._listeners), 0)
 
 
+@unittest.skipUnless(os.access(model.SHM_DIRECTORY, os.W_OK), "Shared memory not available")
+class TestSharedMemory(unittest.TestCase):
+
+    def test_write_read(self):
+        ring = _dataflow._SharedMemoryRing(1024 * 1024)
+        reader = _dataflow._SharedMemoryReader()
+        try:
+            self.assertTrue(os.path.exists(ring.path))
+            data = numpy.arange(512 * 512, dtype=numpy.uint16).reshape(512, 512)
+            loc = ring.write(data)
+            rdata = reader.read(loc, str(data.dtype), data.shape)
+            numpy.testing.assert_array_equal(rdata, data)
+
+            # Stridden arrays are copied contiguously
+            data = numpy.arange(400 * 400, dtype=numpy.float32).reshape(400, 400)[:, 5:]
+            loc = ring.write(data)
+            rdata = reader.read(loc, str(data.dtype), data.shape)
+            self.assertEqual(rdata.shape, (400, 395))
+            numpy.testing.assert_array_equal(rdata, data)
+        finally:
+            reader.close()
+            ring.close()
+        self.assertFalse(os.path.exists(ring.path))
+
+    def test_overwritten(self):
+        """
+        Arrays overwritten in the ring are not returned
+        """
+        ring = _dataflow._SharedMemoryRing(1024, length=2)
+        reader = _dataflow._SharedMemoryReader()
+        try:
+            locs = [ring.write(numpy.full((32,), i, dtype=numpy.uint8)) for i in range(3)]
+            # First slot has been reused
+            self.assertIsNone(reader.read(locs[0], "uint8", (32,)))
+            for i in (1, 2):
+                rdata = reader.read(locs[i], "uint8", (32,))
+                numpy.testing.assert_array_equal(rdata, i)
+        finally:
+            reader.close()
+            ring.close()
+
+        # Not possible to read anymore once the ring is closed
+        self.assertIsNone(reader.read(locs[2], "uint8", (32,)))
+
+    def test_df_negotiation(self):
+        """
+        The shared memory is only used when all the remote listeners support it
+        """
+        df = SimpleDataFlow()
+        big = numpy.zeros((512, 512), dtype=numpy.uint16)
+        small = numpy.zeros((2, 2), dtype=numpy.uint16)
+        try:
+            df._remote_listeners.add(model.SHM_LISTENER_PREFIX + "1/1")
+            self.assertIsNotNone(df._write_shm(big))
+            self.assertIsNone(df._write_shm(small))
+
+            df.max_discard = 0  # lossless => only via 0MQ
+            self.assertIsNone(df._write_shm(big))
+            df.max_discard = 100
+
+            df._remote_listeners.add("1/2")
+            self.assertIsNone(df._write_shm(big))
+        finally:
+            df._remote_listeners.clear()
+            df._close_shm()
+
+
+class TestMetadataEncoding(unittest.TestCase):
+
+    def test_delta(self):
+        enc = _dataflow._MetadataEncoder()
+        dec = _dataflow._MetadataDecoder()
+        wl = list(range(1000))
+        md = {model.MD_ACQ_DATE: 1.0, model.MD_WL_LIST: wl, model.MD_EXP_TIME: 0.1,
+              model.MD_GAIN: 2, model.MD_HW_NAME: "cam"}
+
+        msg = enc.encode(md)
+        self.assertTrue(msg[1])  # first one is always full
+        self.assertEqual(dec.decode(msg), md)
+
+        for i in range(2, 10):
+            md = md.copy()
+            md[model.MD_ACQ_DATE] = float(i)
+            msg = enc.encode(md)
+            self.assertFalse(msg[1])
+            self.assertEqual(msg[2], {model.MD_ACQ_DATE: float(i)})
+            self.assertEqual(dec.decode(msg), md)
+
+        # Modifying a value in-place is detected
+        wl[0] = -1
+        msg = enc.encode(md)
+        self.assertEqual(set(msg[2].keys()), {model.MD_ACQ_DATE, model.MD_WL_LIST})
+        self.assertEqual(dec.decode(msg), md)
+
+        # New key => full metadata
+        md[model.MD_BINNING] = (1, 1)
+        msg = enc.encode(md)
+        self.assertTrue(msg[1])
+        self.assertEqual(dec.decode(msg), md)
+
+    def test_missed_full(self):
+        """
+        A decoder which didn't receive the full metadata cannot decode
+        """
+        enc = _dataflow._MetadataEncoder()
+        dec = _dataflow._MetadataDecoder()
+        md = {model.MD_ACQ_DATE: 1.0, model.MD_EXP_TIME: 0.1, model.MD_GAIN: 2}
+        enc.encode(md)
+        md2 = dict(md)
+        md2[model.MD_ACQ_DATE] = 2.0
+        self.assertIsNone(dec.decode(enc.encode(md2)))
+
+        # After a reset, it's full again
+        enc.reset()
+        msg = enc.encode(md)
+        self.assertTrue(msg[1])
+        self.assertEqual(dec.decode(msg), md)
+
+    def test_fetch_missed_full(self):
+        """
+        A decoder which didn't receive the full metadata can get it from the encoder
+        """
+        enc = _dataflow._MetadataEncoder()
+        fetched = []
+
+        def fetch(snapshot_id):
+            fetched.append(snapshot_id)
+            return enc.get_snapshot(snapshot_id)
+
+        dec = _dataflow._MetadataDecoder(fetch)
+        md = {model.MD_ACQ_DATE: 1.0, model.MD_EXP_TIME: 0.1, model.MD_GAIN: 2}
+        snapshot_id = enc.encode(md)[0]
+        md2 = dict(md)
+        md2[model.MD_ACQ_DATE] = 2.0
+        msg = enc.encode(md2)
+        self.assertIsNone(dec.decode(msg))
+        self.assertEqual(fetched, [])
+        self.assertEqual(dec.decode(msg, fetch=True), md2)
+        self.assertEqual(fetched, [snapshot_id])
+
+        # The snapshot is now known, no need to fetch it again
+        md2[model.MD_ACQ_DATE] = 3.0
+        self.assertEqual(dec.decode(enc.encode(md2), fetch=True), md2)
+        self.assertEqual(fetched, [snapshot_id])
+
+        # Only the last snapshots are kept
+        self.assertIsNone(enc.get_snapshot(snapshot_id - 1))
+        for i in range(_dataflow.MD_SNAPSHOT_KEEP):
+            enc.reset()
+            enc.encode(md)
+        self.assertIsNone(enc.get_snapshot(snapshot_id))
+        # Not available => not asked again for the same snapshot
+        old_msg = (snapshot_id - 1, False, {model.MD_ACQ_DATE: 4.0})
+        dec = _dataflow._MetadataDecoder(fetch)
+        self.assertIsNone(dec.decode(old_msg, fetch=True))
+        self.assertIsNone(dec.decode(old_msg, fetch=True))
+        self.assertEqual(fetched, [snapshot_id, snapshot_id - 1])
+
+    def test_fetch_unlocked(self):
+        """
+        While the full metadata is fetched, the other messages can still be decoded
+        """
+        enc = _dataflow._MetadataEncoder()
+        fetching = threading.Event()
+        unblock = threading.Event()
+
+        def fetch(snapshot_id):
+            fetching.set()
+            unblock.wait(10)
+            return enc.get_snapshot(snapshot_id)
+
+        dec = _dataflow._MetadataDecoder(fetch)
+        md = {model.MD_ACQ_DATE: 1.0, model.MD_EXP_TIME: 0.1}
+        enc.encode(md)
+        md2 = dict(md)
+        md2[model.MD_ACQ_DATE] = 2.0
+        missed = enc.encode(md2)
+
+        results = []
+        t = threading.Thread(target=lambda: results.append(dec.decode(missed, fetch=True)))
+        t.start()
+        self.assertTrue(fetching.wait(5))
+        # A new full metadata is received while the fetch is blocked
+        enc.reset()
+        md3 = {model.MD_ACQ_DATE: 3.0, model.MD_GAIN: 2}
+        msg3 = enc.encode(md3)
+        self.assertTrue(msg3[1])  # full
+        self.assertEqual(dec.decode(msg3), md3)
+
+        unblock.set()
+        t.join(5)
+        self.assertEqual(results, [md2])
+        # The newer snapshot is kept
+        self.assertEqual(dec._snapshot_id, msg3[0])
+
+    def test_array_values(self):
+        enc = _dataflow._MetadataEncoder()
+        dec = _dataflow._MetadataDecoder()
+        md = {model.MD_ACQ_DATE: 1.0, "a": numpy.arange(10), "b": 1, "c": 2}
+        dec.decode(enc.encode(md))
+        md = dict(md)
+        md[model.MD_ACQ_DATE] = 2.0
+        msg = enc.encode(md)
+        self.assertEqual(set(msg[2].keys()), {model.MD_ACQ_DATE})
+        md["a"] = numpy.arange(10) * 2
+        msg = enc.encode(md)
+        self.assertEqual(set(msg[2].keys()), {model.MD_ACQ_DATE, "a"})
+        numpy.testing.assert_array_equal(dec.decode(msg)["a"], md["a"])
+
+
 if __name__ == "__main__":
     unittest.main()
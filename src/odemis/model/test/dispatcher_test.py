@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on 18 Oct 2026
+
+@author: agent
+
+Copyright © 2026 Delmic
+
+This file is part of Odemis.
+
+Odemis is free software: you can redistribute it and/or modify it under the terms
+of the GNU General Public License version 2 as published by the Free Software
+Foundation.
+
+Odemis is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+Odemis. If not, see http://www.gnu.org/licenses/.
+"""
+from __future__ import division, print_function
+
+import logging
+from odemis.model._dispatcher import Deliverer, Subscription, get_dispatcher
+from odemis.util.weak import WeakRefLostError
+import os
+import tempfile
+import threading
+import time
+import unittest
+import zmq
+
+
+logging.getLogger().setLevel(logging.DEBUG)
+
+
+class TestDispatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.ctx = zmq.Context(1)
+        self.pubs = []
+
+    def tearDown(self):
+        for p in self.pubs:
+            p.close()
+        self.ctx.term()
+
+    def _create_publisher(self):
+        """
+        return (str, socket): uri and PUB socket
+        """
+        uri = os.path.join(tempfile.gettempdir(), "test-dispatcher-%d-%d" % (os.getpid(), len(self.pubs)))
+        pub = self.ctx.socket(zmq.PUB)
+        pub.linger = 0
+        pub.bind("ipc://" + uri)
+        self.pubs.append(pub)
+        return uri, pub
+
+    def _publish(self, pub, values, received, expected):
+        """
+        Send values until they are received (as 0MQ subscriptions take a little
+        time to be effective)
+        """
+        for i in range(50):
+            for v in values:
+                pub.send_pyobj(v)
+            time.sleep(0.05)
+            if set(received) >= expected:
+                return
+        self.fail("Only received %s" % (received,))
+
+    def test_multiplex(self):
+        """
+        Several subscriptions are handled by the same thread
+        """
+        dispatcher = get_dispatcher("test")
+        self.assertIs(dispatcher, get_dispatcher("test"))
+
+        received = []
+        threads = set()
+
+        def receiver(socket):
+            received.append(socket.recv_pyobj())
+            threads.add(threading.current_thread())
+
+        subs = []
+        for i in range(10):
+            uri, pub = self._create_publisher()
+            sub = Subscription(uri, receiver)
+            dispatcher.connect(sub)
+            dispatcher.subscribe(sub)
+            subs.append(sub)
+
+        self._publish(self.pubs[0], [0], received, {0})
+        self._publish(self.pubs[9], [9], received, {0, 9})
+        self.assertEqual(len(threads), 1)
+
+        for sub in subs:
+            dispatcher.unsubscribe(sub)
+            dispatcher.close(sub)
+        time.sleep(0.1)
+        for sub in subs:
+            self.assertIsNone(sub.socket)
+
+    def test_subscribe_from_receiver(self):
+        """
+        Subscribing from a receiver (ie, from the dispatcher thread) doesn't
+        deadlock
+        """
+        dispatcher = get_dispatcher("test")
+        received = []
+        uri2, pub2 = self._create_publisher()
+        sub2 = Subscription(uri2, lambda s: received.append(s.recv_pyobj()))
+
+        def receiver1(socket):
+            v = socket.recv_pyobj()
+            if v == "sub":
+                dispatcher.subscribe(sub2)
+                received.append(v)
+
+        uri1, pub1 = self._create_publisher()
+        sub1 = Subscription(uri1, receiver1)
+        dispatcher.subscribe(sub1)
+
+        self._publish(pub1, ["sub"], received, {"sub"})
+        self._publish(pub2, [2], received, {"sub", 2})
+
+        dispatcher.close(sub1)
+        dispatcher.close(sub2)
+
+    def test_topic(self):
+        """
+        Only the messages of the subscribed topic are received
+        """
+        dispatcher = get_dispatcher("test")
+        received = []
+
+        def receiver(socket):
+            received.append(socket.recv_multipart())
+
+        uri, pub = self._create_publisher()
+        sub = Subscription(uri, receiver)
+        dispatcher.subscribe(sub, b"a")
+        for i in range(50):
+            pub.send_multipart([b"b", b"2"])
+            pub.send_multipart([b"a", b"1"])
+            time.sleep(0.05)
+            if received:
+                break
+        self.assertTrue(received)
+        self.assertTrue(all(m == [b"a", b"1"] for m in received))
+        dispatcher.close(sub)
+
+    def test_weakref_lost(self):
+        """
+        A receiver raising WeakRefLostError gets its subscription closed
+        """
+        dispatcher = get_dispatcher("test")
+        received = []
+
+        def receiver(socket):
+            received.append(socket.recv_pyobj())
+            raise WeakRefLostError()
+
+        uri, pub = self._create_publisher()
+        sub = Subscription(uri, receiver)
+        dispatcher.subscribe(sub)
+        self._publish(pub, [1], received, {1})
+        time.sleep(0.1)
+        self.assertIsNone(sub.socket)
+
+
+class TestDeliverer(unittest.TestCase):
+
+    def test_order(self):
+        """
+        The messages are delivered in order, with a flag if newer ones are waiting
+        """
+        delivered = []
+        started = threading.Event()
+        release = threading.Event()
+
+        def deliver(msg, more):
+            started.set()
+            release.wait(5)
+            delivered.append((msg, more))
+
+        d = Deliverer("test delivery", deliver, idle_timeout=0.5)
+        for i in range(3):
+            d.put(i)
+        # The first message is blocked in the delivery => the others are waiting
+        self.assertTrue(started.wait(5))
+        self.assertEqual(len(d), 2)
+        release.set()
+        for i in range(50):
+            if len(delivered) == 3:
+                break
+            time.sleep(0.05)
+        self.assertEqual(delivered, [(0, True), (1, True), (2, False)])
+
+        # The thread stops when idle, and is restarted at the next message
+        time.sleep(1)
+        self.assertFalse(any(t.name == "test delivery" for t in threading.enumerate()))
+        d.put(3)
+        time.sleep(0.1)
+        self.assertEqual(delivered[-1], (3, False))
+
+    def test_independent(self):
+        """
+        A blocked delivery doesn't prevent the delivery of the other deliverers
+        """
+        release = threading.Event()
+        delivered = []
+        d1 = Deliverer("test delivery 1", lambda m, more: release.wait(5))
+        d2 = Deliverer("test delivery 2", lambda m, more: delivered.append(m))
+        d1.put(1)
+        d2.put(2)
+        time.sleep(0.1)
+        self.assertEqual(delivered, [2])
+        release.set()
+
+
+if __name__ == "__main__":
+    unittest.main()
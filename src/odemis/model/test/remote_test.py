@@ -30,6 +30,7 @@ import logging
 import numpy
 from odemis import model
 from odemis.model import roattribute, oneway, isasync, VigilantAttributeBase
+from odemis.model._vattributes import PROPERTY_SUBSCRIBE_DELAY
 from odemis.util import mock, timeout, executeAsyncTask
 import os
 import pickle
@@ -534,6 +535,31 @@ class RemoteTest(unittest.TestCase):
         self.assertEqual(count_end, self.count)
         self.assertGreaterEqual(count_end, 1)
 
+    def test_dataflow_statistics(self):
+        """
+        The proxies report to the DataFlow how many arrays they received
+        """
+        self.count = 0
+        self.expected_shape = (2048, 2048)
+        self.data_arrays_sent = 0
+        df = self.comp.data
+        df.reset()
+        df.resetStatistics()
+
+        df.subscribe(self.receive_data)
+        time.sleep(0.5)
+        df.unsubscribe(self.receive_data)
+        time.sleep(0.1)  # The report is asynchronous
+        stats = df.getStatistics()
+        self.assertGreaterEqual(self.count, 1)
+        # All the arrays delivered were reported when unsubscribing
+        self.assertGreaterEqual(stats["subscribers_received"], self.count)
+        self.assertLessEqual(stats["subscribers_received"], stats["received"])
+
+        df.resetStatistics()
+        stats = df.getStatistics()
+        self.assertEqual(stats["subscribers_received"], 0)
+
     def test_synchronized_df(self):
         """
         Tests 2 dataflows, one synchronized on the event of acquisition started
@@ -616,6 +642,34 @@ class RemoteTest(unittest.TestCase):
         self.assertEqual(count_end, self.count)
         self.assertGreaterEqual(count_end, 1)
 
+    def test_dataflow_waiting_listener(self):
+        """
+        A listener waiting for the data of another DataFlow doesn't block it
+        """
+        self.comp.data.reset()
+        got_datas = threading.Event()
+        waited = []
+        self.count = 0
+
+        def receive_datas(dataflow, data):
+            self.count += 1
+            if self.count >= 5:
+                got_datas.set()
+
+        def receive_data_and_wait(dataflow, data):
+            dataflow.unsubscribe(receive_data_and_wait)
+            if not waited:
+                waited.append(got_datas.wait(5))
+
+        self.comp.data.subscribe(receive_data_and_wait)
+        self.comp.datas.subscribe(receive_datas)
+        for i in range(100):
+            if waited:
+                break
+            time.sleep(0.1)
+        self.comp.datas.unsubscribe(receive_datas)
+        self.assertEqual(waited, [True])
+
     def receive_data(self, dataflow, data):
         self.count += 1
         self.assertEqual(data.shape, self.expected_shape)
@@ -713,6 +767,38 @@ class RemoteTest(unittest.TestCase):
         except TypeError:
             pass # as it should be
 
+    def test_va_waiting_listener(self):
+        """
+        A listener waiting for the update of another VA doesn't block it
+        """
+        prop = self.comp.prop
+        enum = self.comp.enum
+        prop.value = 42
+        enum.value = "a"
+        enum_changed = threading.Event()
+        waited = []
+
+        def receive_enum(value):
+            if value == "c":
+                enum_changed.set()
+
+        def receive_prop_and_wait(value):
+            if not waited:
+                waited.append(enum_changed.wait(5))
+
+        prop.subscribe(receive_prop_and_wait)
+        enum.subscribe(receive_enum)
+        prop.value = 43
+        time.sleep(0.1)  # The prop listener is now waiting
+        enum.value = "c"
+        for i in range(100):
+            if waited:
+                break
+            time.sleep(0.1)
+        prop.unsubscribe(receive_prop_and_wait)
+        enum.unsubscribe(receive_enum)
+        self.assertEqual(waited, [True])
+
     def receive_va_update(self, value):
         self.called += 1
         self.last_value = value
@@ -752,6 +838,87 @@ class RemoteTest(unittest.TestCase):
         except IndexError:
             pass # as it should be
 
+    def test_range_cache(self):
+        """
+        The range is cached on the proxy, but still updated when it changes
+        """
+        cont = self.comp.cont
+        self.assertEqual(cont.range, (-1, 3.4))
+        self.assertEqual(cont.range, (-1, 3.4))
+        time.sleep(0.1)  # Give time for the subscription to the changes to be effective
+
+        self.comp.setContRange((-2, 10))
+        time.sleep(0.1)  # Give time for the change to be received
+        self.assertEqual(cont.range, (-2, 10))
+
+        self.assertFalse(hasattr(cont, "choices"))
+        self.assertFalse(hasattr(cont, "choices"))  # from the cache
+
+    def test_range_cache_missed(self):
+        """
+        The range read just after subscribing to the changes is read again later
+        """
+        cont = self.comp.cont
+        self.assertEqual(cont.range, (-1, 3.4))
+        # Simulate a change which happened before the subscription was effective
+        cont._cache["range"] = (0, 1)
+        self.assertEqual(cont.range, (0, 1))  # Still cached
+        time.sleep(PROPERTY_SUBSCRIBE_DELAY + 0.1)
+        self.assertEqual(cont.range, (-1, 3.4))
+
+        # Now it's read from the cache
+        cont._cache["range"] = (0, 1)
+        self.assertEqual(cont.range, (0, 1))
+        del cont._cache["range"]
+
+    def test_range_value_concurrent(self):
+        """
+        The range and value changes sent from different threads are all received
+        """
+        cont = self.comp.cont
+        received = []
+        cont.subscribe(received.append)
+        self.assertEqual(cont.range, (-1, 3.4))
+        time.sleep(PROPERTY_SUBSCRIBE_DELAY + 0.1)
+
+        def change_range():
+            for i in range(100):
+                self.comp.setContRange((-2, 10) if i % 2 else (-1, 3.4))
+
+        t = threading.Thread(target=change_range)
+        t.start()
+        for i in range(100):
+            cont.value = (i % 30) / 10
+        t.join()
+        time.sleep(0.2)  # Give time for the changes to be received
+        cont.unsubscribe(received.append)
+
+        self.assertEqual(cont.range, (-2, 10))
+        self.assertEqual(cont.value, 2.9)
+        self.assertTrue(received)
+        for v in received:
+            self.assertIsInstance(v, float)
+
+    def test_get_set_values(self):
+        """
+        Read and write multiple VAs in one call
+        """
+        vals = self.comp.getValues(["prop", "cont", "enum"])
+        self.assertEqual(vals, {"prop": 42, "cont": 2.0, "enum": "a"})
+
+        self.comp.setValues({"prop": 12, "enum": "c"})
+        self.assertEqual(self.comp.prop.value, 12)
+        self.assertEqual(self.comp.enum.value, "c")
+
+        # Same validation as when setting .value
+        with self.assertRaises(IndexError):
+            self.comp.setValues({"cont": 4.0})
+        with self.assertRaises(AttributeError):
+            self.comp.getValues(["prop", "ping"])
+        with self.assertRaises(AttributeError):
+            self.comp.setValues({"prop": 1, "doesnotexist": 2})
+        self.assertEqual(self.comp.prop.value, 12)  # Nothing set
+
     def test_list_va(self):
         # List
         l = self.comp.listval
@@ -845,6 +1012,9 @@ class MyComponent(model.Component):
         self.cut = model.IntVA(0, setter=self._setCut)
         self.listval = model.ListVA([2, 65])
 
+    def setContRange(self, rng):
+        self.cont.range = rng
+
     def _setCut(self, value):
         self.data.cut = value
         return self.data.cut
@@ -46,6 +46,9 @@ from concurrent import futures
 
 DEFAULT_SETTINGS_FILE = "/etc/odemis-settings.yaml"
 
+# Maximum number of components being instantiated simultaneously
+MAX_INSTANTIATION_THREADS = 8
+
 status_to_xtcode = {BACKEND_RUNNING: 0,
                     BACKEND_DEAD: 1,
                     BACKEND_STOPPED: 2,
@@ -76,6 +79,11 @@ class BackendContainer(model.Container):
         self._mdupdater = None
         self._inst_thread = None # thread running the component instantiation
         self._must_stop = threading.Event()
+        # Protects the read-modify-write of .ghosts and .alive of the microscope,
+        # and the persistent data, as the components are instantiated in parallel.
+        # It's also held while creating a container process, so that the
+        # process is never forked in the middle of such update.
+        self._inst_lock = threading.RLock()
         self._dry_run = dry_run
         # TODO: have an argument to ask for disabling parallel start? same as create_sub_containers?
 
@@ -83,7 +91,8 @@ class BackendContainer(model.Container):
         logging.debug("model instantiation file is: %s", self._model.name)
         try:
             self._instantiator = modelgen.Instantiator(model_file, settings_file, self,
-                                                       create_sub_containers, dry_run)
+                                                       create_sub_containers, dry_run,
+                                                       fork_lock=self._inst_lock)
             # save the model
             logging.info("model has been successfully parsed")
         except modelgen.ParseError as exp:
@@ -125,7 +134,7 @@ class BackendContainer(model.Container):
         """
         Update all metadata in ._persistent_data and write values to settings file.
         """
-        for comp in self._instantiator.components:
+        for comp in self._instantiator.components.copy():  # copy, as it can be updated concurrently
             _, md_names = self._instantiator.get_persistent(comp.name)
             md_values = comp.getMetadata()
             for md in md_names:
@@ -194,61 +203,82 @@ class BackendContainer(model.Container):
             # See http://bugs.python.org/issue6721
             # To ensure this is not happening, we wait long enough that all (2)
             # threads have started (and logging nothing) before creating new processes.
+            # Note: the components are instantiated in parallel, so processes
+            # might be created while other threads are logging. This relies
+            # on Python >= 3.7, which re-initialises the logging locks after fork.
+            # The creation of the processes is serialized with _inst_lock.
             time.sleep(1)
 
             mic = self._instantiator.microscope
             failed = set() # set of str: name of components that failed recently
-            while not self._must_stop.is_set():
-                # Try to start simultaneously all the components that are
-                # independent from each other
-                nexts = set()
-                while not nexts:
-                    instantiated = set(c.name for c in mic.alive.value) | {mic.name}
+            running = {}  # str -> Future: name of components being instantiated
+            executor = futures.ThreadPoolExecutor(max_workers=MAX_INSTANTIATION_THREADS)
+            try:
+                while not self._must_stop.is_set():
+                    # Start simultaneously all the components that are
+                    # independent from each other (and not already starting)
+                    with self._inst_lock:
+                        instantiated = set(c.name for c in mic.alive.value) | {mic.name}
                     nexts = self._instantiator.get_instantiables(instantiated)
-                    # If still some non-failed component, immediately try again,
-                    # otherwise give some time for things to get fixed or broken
-                    nexts -= failed
-                    if not nexts:
+                    nexts -= failed | set(running.keys())
+
+                    if nexts:
+                        logging.debug("Trying to instantiate comps: %s", ", ".join(nexts))
+                    for n in nexts:
+                        with self._inst_lock:
+                            ghosts = mic.ghosts.value.copy()
+                            if n not in ghosts:
+                                logging.warning("going to instantiate %s but not a ghost", n)
+                            ghosts[n] = ST_STARTING
+                            mic.ghosts.value = ghosts
+                        running[n] = executor.submit(self._instantiate_component, n)
+
+                    if not running:
+                        # If still some non-failed component, immediately try again,
+                        # otherwise give some time for things to get fixed or broken
                         if self._dry_run:
                             return # everything instantiated, good enough
 
                         if self._must_stop.wait(10):
                             return
                         failed = set() # not recent anymore
-
-                logging.debug("Trying to instantiate comps: %s", ", ".join(nexts))
-
-                for n in nexts:
-                    ghosts = mic.ghosts.value.copy()
-                    if n not in ghosts:
-                        logging.warning("going to instantiate %s but not a ghost", n)
-                    # TODO: run each of them in a future, so that they start
-                    # in parallel, and (bonus) when the future is done, check
-                    # immediately which component can be started. The only
-                    # difficulty is to ensure non-concurrent access to .ghosts
-                    # and .alive .
-                    try:
-                        ghosts[n] = ST_STARTING
-                        mic.ghosts.value = ghosts
-                        newcmps = self._instantiate_component(n)
+                        continue
+
+                    # As soon as one component is done, check whether its
+                    # dependents can be started. The timeout allows to regularly
+                    # check whether it should stop.
+                    done, _ = futures.wait(list(running.values()), timeout=1,
+                                           return_when=futures.FIRST_COMPLETED)
+                    for n, f in list(running.items()):
+                        if f not in done:
+                            continue
+                        del running[n]
+                        try:
+                            newcmps = f.result()
+                        except ValueError:
+                            if self._dry_run:
+                                raise
+                            # We now need to stop, but cannot call terminate()
+                            # directly, as it would deadlock, waiting for us
+                            logging.debug("Stopping instantiation due to unrecoverable error")
+                            threading.Thread(target=self.terminate).start()
+                            return
                         if self._must_stop.is_set():
                             # in case the termination was too late to stop these new component
-                            for c in newcmps:
-                                try:
-                                    c.terminate()
-                                except Exception:
-                                    logging.warning("Failed to terminate component '%s'", c.name, exc_info=True)
-                            break
-                    except ValueError:
-                        if self._dry_run:
-                            raise
-                        # We now need to stop, but cannot call terminate()
-                        # directly, as it would deadlock, waiting for us
-                        logging.debug("Stopping instantiation due to unrecoverable error")
-                        threading.Thread(target=self.terminate).start()
-                        return
-                    if not newcmps:
-                        failed.add(n)
+                            self._terminate_components(newcmps)
+                        elif not newcmps:
+                            failed.add(n)
+            finally:
+                # Wait for the components still starting, and stop them if it's
+                # too late (ie, the termination didn't see them)
+                for n, f in running.items():
+                    try:
+                        newcmps = f.result()
+                    except Exception:
+                        continue  # Already reported
+                    if self._must_stop.is_set():
+                        self._terminate_components(newcmps)
+                executor.shutdown(wait=False)
 
         except Exception:
             logging.exception("Instantiator thread failed")
@@ -256,6 +286,17 @@ class BackendContainer(model.Container):
         finally:
             logging.debug("Instantiator thread finished")
 
+    def _terminate_components(self, comps):
+        """
+        Stop the given components, ignoring any error
+        comps (set of HwComponent)
+        """
+        for c in comps:
+            try:
+                c.terminate()
+            except Exception:
+                logging.warning("Failed to terminate component '%s'", c.name, exc_info=True)
+
     def _instantiate_component(self, name):
         """
         Instantiate a component and handle the outcome
@@ -267,15 +308,16 @@ class BackendContainer(model.Container):
         # TODO: use the AST from the microscope (instead of the original one
         # in _instantiator) to allow modifying it online?
         mic = self._instantiator.microscope
-        ghosts = mic.ghosts.value.copy()
         try:
             comp = self._instantiator.instantiate_component(name)
         except model.HwError as exp:
             # HwError means: hardware problem, try again later
             logging.warning("Failed to start component %s due to device error: %s",
                             name, exp)
-            ghosts[name] = exp
-            mic.ghosts.value = ghosts
+            with self._inst_lock:
+                ghosts = mic.ghosts.value.copy()
+                ghosts[name] = exp
+                mic.ghosts.value = ghosts
             return set()
         except Exception as exp:
             # Anything else means: microscope file or driver is borked => give up
@@ -302,19 +344,21 @@ class BackendContainer(model.Container):
                 logging.warning("Component %s instantiated extra unexpected components %s",
                                 name, new_names - exp_names)
 
-            mic.alive.value = mic.alive.value | new_cmps
-            # update ghosts by removing all the new components
-            dchildren = self._instantiator.get_children_names(name)
-            for n in dchildren:
-                del ghosts[n]
+            with self._inst_lock:
+                mic.alive.value = mic.alive.value | new_cmps
+                # update ghosts by removing all the new components
+                ghosts = mic.ghosts.value.copy()
+                dchildren = self._instantiator.get_children_names(name)
+                for n in dchildren:
+                    del ghosts[n]
 
-            mic.ghosts.value = ghosts
+                mic.ghosts.value = ghosts
 
-            for c in new_cmps:
-                prop_names, _ = self._instantiator.get_persistent(c.name)
-                for prop_name in prop_names:
-                    self._observe_persistent_va(c, prop_name)
-            self._update_persistent_metadata()
+                for c in new_cmps:
+                    prop_names, _ = self._instantiator.get_persistent(c.name)
+                    for prop_name in prop_names:
+                        self._observe_persistent_va(c, prop_name)
+                self._update_persistent_metadata()
 
             return new_cmps
 
@@ -436,7 +480,8 @@ class BackendContainer(model.Container):
             logging.info("Terminate already called, so not running it again")
 
         # Save values of persistent properties and metadata
-        self._update_persistent_metadata()
+        with self._inst_lock:
+            self._update_persistent_metadata()
 
         # Stop the component instantiator, to be sure it'll not restart the components
         self._must_stop.set()
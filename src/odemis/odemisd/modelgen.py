@@ -31,6 +31,7 @@ import logging
 from odemis import model
 from odemis.util import mock
 import re
+import threading
 import yaml
 
 
@@ -142,7 +143,7 @@ class Instantiator(object):
     """
 
     def __init__(self, inst_file, settings_file=None, container=None, create_sub_containers=False,
-                 dry_run=False):
+                 dry_run=False, fork_lock=None):
         """
         inst_file (file): opened file that contains the YAML
         settings_file (file or None): opened settings file in YAML format.
@@ -154,6 +155,9 @@ class Instantiator(object):
           model without actually any driver contacting the hardware. It will also
           be stricter, and some issues which are normally just warnings will be
           considered errors.
+        fork_lock (None or Lock): lock held while creating a new container
+          process, so that the caller can prevent other threads from being in
+          the middle of a critical section during the fork.
         """
         self.ast = self._parse_instantiation_model(inst_file)  # AST of the model to instantiate
         self._can_persist = settings_file is not None
@@ -167,6 +171,11 @@ class Instantiator(object):
         self.sub_containers = {}  # container's name -> container: all the sub-containers created for the components
         self._comp_container = {}  # comp name -> container: the container that runs the given component
         self.create_sub_containers = create_sub_containers # flag for creating sub-containers
+        # Protects .components, .sub_containers and ._comp_container, as several
+        # components can be instantiated simultaneously from different threads
+        self._lock = threading.RLock()
+        # Only one container process is created at a time
+        self._fork_lock = fork_lock or threading.Lock()
         self.dry_run = dry_run # flag for instantiating mock version of the components
 
         self._preparate_microscope()
@@ -577,7 +586,8 @@ class Instantiator(object):
         #  * explicit creation: (dict str -> HwComponent) internal name -> comp
         #  * delegation: (dict str -> dict) internal name -> init arguments
         # anything else is passed as is
-        args = self._make_args(name)
+        with self._lock:
+            args = self._make_args(name)
 
         logging.debug("Going to instantiate %s (%s) with args %s",
                       name, class_name, args)
@@ -593,25 +603,43 @@ class Instantiator(object):
             args["_realcls"] = class_comp
             class_comp = mock.MockComponent
 
+        # The lock is not held during the actual creation of the component, as
+        # it can take a long time (and that's the part to run in parallel).
         try:
-            cont = self._get_container(name)
+            with self._lock:
+                cont = self._get_container(name)
             if cont is None:
                 # new container has the same name as the component
-                cont, comp = model.createInNewContainer(name, class_comp, args)
-                self.sub_containers[name] = cont
+                # Only the fork is serialized, the component is created in parallel
+                with self._fork_lock:
+                    cont = model.createNewContainer(name, validate=False)
+                try:
+                    comp = model.createInContainer(cont, class_comp, args)
+                except Exception:
+                    try:
+                        cont.terminate()  # Non blocking
+                    except Exception:
+                        logging.exception("Failed to stop the container %s after component failure",
+                                          name)
+                    raise
+                with self._lock:
+                    self.sub_containers[name] = cont
             else:
                 logging.debug("Creating %s in container %s", name, cont)
                 comp = model.createInContainer(cont, class_comp, args)
-            self._comp_container[name] = cont
+            with self._lock:
+                self._comp_container[name] = cont
         except Exception:
             logging.error("Error while instantiating component %s.", name)
             raise
 
-        self.components.add(comp)
-        # Add all the children, which were created by delegation, to our list of components.
-        self.components |= comp.children.value
-        for child in comp.children.value:
-            self._comp_container[child.name] = cont
+        children = comp.children.value
+        with self._lock:
+            self.components.add(comp)
+            # Add all the children, which were created by delegation, to our list of components.
+            self.components |= children
+            for child in children:
+                self._comp_container[child.name] = cont
 
         return comp
 
@@ -623,9 +651,10 @@ class Instantiator(object):
         Raises:
              LookupError: if no component is found
         """
-        for comp in self.components:
-            if comp.name == name:
-                return comp
+        with self._lock:
+            for comp in self.components:
+                if comp.name == name:
+                    return comp
         raise LookupError("No component named '%s' found" % name)
 
     def get_required_components(self, name):
@@ -844,9 +873,10 @@ class Instantiator(object):
             ValueError: if the component has already been instantiated
             KeyError: if component should be created by delegation
         """
-        for c in self.components:
-            if c.name == name:
-                raise ValueError("Trying to instantiate again component %s" % name)
+        with self._lock:
+            for c in self.components:
+                if c.name == name:
+                    raise ValueError("Trying to instantiate again component %s" % name)
 
         comp = self._instantiate_comp(name)
 
@@ -859,7 +889,8 @@ class Instantiator(object):
             self._update_metadata(c.name)
             self._update_affects(c.name)
         newchildren = set(c for c in newcmps if c.name in mchildren)
-        self.microscope.children.value = self.microscope.children.value | newchildren
+        with self._lock:
+            self.microscope.children.value = self.microscope.children.value | newchildren
 
         return comp
 
@@ -875,7 +906,8 @@ class Instantiator(object):
         """
         comps = set()
         if instantiated is None:
-            instantiated = set(c.name for c in self.components)
+            with self._lock:
+                instantiated = set(c.name for c in self.components)
         for n, attrs in self.ast.items():
             if n in instantiated: # should not be already instantiated
                 continue
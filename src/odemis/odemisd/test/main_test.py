@@ -224,6 +224,51 @@ class TestCommandLine(unittest.TestCase):
 
         os.remove("test.log")
 
+    @timeout(20)
+    def test_parallel_chained(self):
+        """
+        Test instantiating independent components in parallel, and chained ones
+        one after another
+        """
+        filename = "parallel-chained-sim.odm.yaml"
+        cmdline = "--log-level=2 --log-target=testdaemon.log --daemonize %s" % filename
+        ret = subprocess.call(ODEMISD_CMD + cmdline.split())
+        self.assertEqual(ret, 0, "trying to run '%s' gave status %d" % (cmdline, ret))
+
+        ret = self._wait_backend_starts(10)
+        self.assertEqual(ret, 0, "backend status check returned %d" % (ret,))
+
+        # All the components are alive, and none is left as ghost
+        mic = model.getMicroscope()
+        alive = {c.name for c in mic.alive.value}
+        self.assertEqual(alive, {"Stage A", "Stage B", "Nikon Super Duper",
+                                 "Base Stage", "Aligner", "Focus"})
+        self.assertEqual(mic.ghosts.value, {})
+
+        # stop the backend
+        cmdline = "odemisd --log-level=2 --log-target=test.log --kill"
+        ret = main.main(cmdline.split())
+        self.assertEqual(ret, 0, "trying to run '%s'" % cmdline)
+        time.sleep(5)  # give some time to stop
+        os.remove("test.log")
+
+        # Check the order of the instantiation: each batch of components
+        # started simultaneously is logged
+        batches = []
+        with open("testdaemon.log") as f:
+            for l in f:
+                _, sep, comps = l.partition("Trying to instantiate comps: ")
+                if sep:
+                    batches.append(set(comps.strip().split(", ")))
+        os.remove("testdaemon.log")
+        # The independent components are started together, and each component
+        # of the chain starts after its dependency
+        self.assertEqual(batches[0], {"Stage A", "Stage B", "Nikon Super Duper", "Base Stage"})
+        started = [n for b in batches for n in b]
+        self.assertEqual(len(started), len(set(started)), "Some components were started twice")
+        self.assertLess(started.index("Base Stage"), started.index("Aligner"))
+        self.assertLess(started.index("Aligner"), started.index("Focus"))
+
     @timeout(20)
     def test_multiple_parents_old(self):
         """Test creating component with multiple parents"""
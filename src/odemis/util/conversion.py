@@ -326,15 +326,17 @@ def get_tile_md_pos(i, tile_size, tileda, origda):
         It can be smaller than the tile_size in case
     origda (DataArray or DataArrayShadow): the original/raw DataArray. If
         no MD_POS is provided, the image is considered located at (0,0).
-    return (float, float): the center position
+    return (float, float) or (float, float, float): the center position (with
+      the same Z position as the original data, if it has one)
     """
     md = origda.metadata
     tile_md = tileda.metadata
-    md_pos = numpy.asarray(md.get(model.MD_POS, (0.0, 0.0)))
+    md_pos = numpy.asarray(md.get(model.MD_POS, (0.0, 0.0)), dtype=float)
     if model.MD_PIXEL_SIZE not in md or model.MD_PIXEL_SIZE not in tile_md:
         raise ValueError("MD_PIXEL_SIZE must be set")
-    orig_ps = numpy.asarray(md[model.MD_PIXEL_SIZE])
-    tile_ps = numpy.asarray(tile_md[model.MD_PIXEL_SIZE])
+    # Only X & Y matter (the Z pixel size and position are kept as-is)
+    orig_ps = numpy.asarray(md[model.MD_PIXEL_SIZE][:2])
+    tile_ps = numpy.asarray(tile_md[model.MD_PIXEL_SIZE][:2])
 
     dims = md.get(model.MD_DIMS, "CTZYX"[-origda.ndim::])
     img_shape = [origda.shape[dims.index('X')], origda.shape[dims.index('Y')]]
@@ -342,7 +344,9 @@ def get_tile_md_pos(i, tile_size, tileda, origda):
     # center of the image in pixels
     img_center = img_shape / 2
 
-    tile_shape = [tileda.shape[dims.index('X')], tileda.shape[dims.index('Y')]]
+    # The tile might have less dimensions than the original data (eg, a single plane)
+    tile_dims = tile_md.get(model.MD_DIMS, dims[-tileda.ndim:])
+    tile_shape = [tileda.shape[tile_dims.index('X')], tileda.shape[tile_dims.index('Y')]]
     # center of the tile in pixels
     tile_center_pixels = numpy.array([
         i[0] * tile_size[0] + tile_shape[0]/2,
@@ -365,7 +369,8 @@ def get_tile_md_pos(i, tile_size, tileda, origda):
     new_tile_pos_rel = tmat * tile_rel_to_img_center_pixels
     new_tile_pos_rel = numpy.ravel(new_tile_pos_rel)
     # calculate the final position of the tile, in world coordinates
-    tile_pos_world_final = md_pos + new_tile_pos_rel
+    tile_pos_world_final = md_pos.copy()
+    tile_pos_world_final[:2] += new_tile_pos_rel
     return tuple(tile_pos_world_final)
 
 
@@ -28,6 +28,7 @@ from odemis import dataio
 from odemis import model
 from odemis.acq import stream
 from odemis.model import MD_WL_LIST, MD_TIME_LIST
+from odemis.util import fileindex
 import os
 
 
@@ -114,8 +115,13 @@ def data_to_static_streams(data):
             # Now, either it's a flat greyscale image and we decide it's a SEM image,
             # or it's gone too weird and we try again on flat images
             if numpy.prod(d.shape[:-2]) != 1 and pxs is not None and len(pxs) != 3:
-                # FIXME: doesn't work currently if d is a DAS
-                subdas = _split_planes(d)
+                if hasattr(d, "maxzoom") and dims.endswith("YX"):
+                    # Pyramidal => keep the tile access, and don't read the data
+                    subdas = _split_plane_shadows(d)
+                else:
+                    if isinstance(d, model.DataArrayShadow):
+                        d = d.getData()
+                    subdas = _split_planes(d)
                 logging.info("Reprocessing data of shape %s into %d sub-data",
                              d.shape, len(subdas))
                 if len(subdas) > 30:
@@ -129,13 +135,20 @@ def data_to_static_streams(data):
             klass = stream.StaticSEMStream
 
         if issubclass(klass, stream.Static2DStream):
-            # FIXME: doesn't work currently if d is a DAS
             if numpy.prod(d.shape[:-3]) != 1:
                 logging.warning("Dropping dimensions from the data %s of shape %s",
                             name, d.shape)
                 #      T  Z  X  Y
                 #     d[0,0] -> d[0,0,:,:]
-                d = d[(0,) * (d.ndim - 2)]
+                index = (0,) * (d.ndim - 2)
+                if hasattr(d, "maxzoom") and dims.endswith("YX"):
+                    d = _PlaneShadow(d, index)
+                elif hasattr(d, "getSubData"):  # Only read the plane displayed
+                    d = d.getSubData(index)
+                else:
+                    if isinstance(d, model.DataArrayShadow):
+                        d = d.getData()
+                    d = d[index]
 
         stream_instance = klass(name, d)
         result_streams.append(stream_instance)
@@ -185,17 +198,74 @@ def _split_planes(data):
     return das
 
 
+class _PlaneShadow(model.DataArrayShadow):
+    """
+    One plane (YX) of a pyramidal DataArrayShadow with multiple planes (eg,
+    a Z stack). The data of the other planes is never read.
+    The original DataArrayShadow must support getTile(x, y, zoom, index=).
+    """
+
+    def __init__(self, das, index):
+        """
+        das (DataArrayShadow): the pyramidal data, with the dimensions YX last
+        index (tuple of 0<=int): the position of the plane in the high dimensions
+        """
+        self._das = das
+        self.index = tuple(index)
+        md = das.metadata.copy()
+        if model.MD_DIMS in md:
+            md[model.MD_DIMS] = md[model.MD_DIMS][-2:]
+        model.DataArrayShadow.__init__(self, das.shape[-2:], das.dtype, md,
+                                       das.maxzoom, das.tile_shape)
+
+    def getTile(self, x, y, zoom):
+        """
+        See DataArrayShadow.getTile()
+        """
+        return self._das.getTile(x, y, zoom, index=self.index)
+
+    def getData(self):
+        """
+        Fetches the whole plane, tile by tile
+        """
+        data = numpy.empty(self.shape, self.dtype)
+        tw, th = self.tile_shape
+        for y in range(0, self.shape[0], th):
+            for x in range(0, self.shape[1], tw):
+                tile = self.getTile(x // tw, y // th, 0)
+                data[y:y + tile.shape[0], x:x + tile.shape[1]] = tile
+        return model.DataArray(data, self.metadata.copy())
+
+
+def _split_plane_shadows(das):
+    """ Separate a pyramidal DataArrayShadow into one DataArrayShadow per plane
+
+    Args:
+        das: (DataArrayShadow) pyramidal data, with the dimensions YX last
+
+    Returns:
+        (list of DataArrayShadows): a pyramidal DataArrayShadow of each plane (YX)
+
+    """
+    return [_PlaneShadow(das, i) for i in numpy.ndindex(*das.shape[:-2])]
+
+
 def open_acquisition(filename, fmt=None):
     """
     Opens the data according to the type of file, and returns the opened data.
     If it's a pyramidal image, do not fetch the whole data from the image. If the image
     is not pyramidal, it reads the entire image and returns it
+    The file is recorded in the index of its folder (see util.fileindex), and
+    if it's already there, its format is not detected again.
     filename (string): Name of the file where the image is
     fmt (string): The format of the file
     return (list of DataArrays or DataArrayShadows): The opened acquisition source
     """
+    finfo = fileindex.lookup_info(filename)
     if fmt:
         converter = dataio.get_converter(fmt)
+    elif finfo is not None:
+        converter = dataio.get_converter(finfo.format)
     else:
         converter = dataio.find_fittest_converter(filename, mode=os.O_RDONLY)
     data = []
@@ -203,6 +273,10 @@ def open_acquisition(filename, fmt=None):
         if hasattr(converter, 'open_data'):
             acd = converter.open_data(filename)
             data = acd.content
+            # Only the converters with open_data() can provide the thumbnails
+            # without reading the file again
+            if finfo is None:
+                fileindex.record_info(filename, converter.FORMAT, data, acd.thumbnails)
         else:
             data = converter.read_data(filename)
     except Exception:
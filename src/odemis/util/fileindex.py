@@ -0,0 +1,440 @@
+# -*- coding: utf-8 -*-
+"""
+Created on 18 Oct 2026
+
+@author: agent
+
+Copyright © 2026 Delmic
+
+This file is part of Odemis.
+
+Odemis is free software: you can redistribute it and/or modify it under the terms
+of the GNU General Public License version 2 as published by the Free Software
+Foundation.
+
+Odemis is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+Odemis. If not, see http://www.gnu.org/licenses/.
+"""
+# Index of the acquisition files of a folder. For each file, it stores the
+# shape, dtype and main metadata of each data, as well as the thumbnails. This
+# allows to get an overview of the files, without opening each of them fully.
+# The index is an SQLite database, next to the files (or in the user cache, if
+# the folder is read-only). An entry is valid as long as the modification time
+# and the size of the file are unchanged.
+# The index is filled whenever a file is opened (open_acquisition()) or its
+# thumbnail read (read_thumbnail() of the TIFF and HDF5 converters), and then
+# used to avoid reading the file again.
+
+from __future__ import division
+
+from contextlib import contextmanager
+import errno
+import hashlib
+import json
+import logging
+import numpy
+from odemis import model
+import os
+import sqlite3
+from urllib.request import pathname2url
+
+INDEX_FILENAME = ".odemis-index.sqlite"
+# Where to store the index if the folder is not writable
+FALLBACK_DIR = "~/.cache/odemis/index"
+# To be increased whenever the content of the index changes
+INDEX_VERSION = 1
+
+# Metadata kept in the index (only values which can be stored as JSON)
+INDEXED_METADATA = (model.MD_POS, model.MD_PIXEL_SIZE, model.MD_ACQ_DATE,
+                    model.MD_ACQ_TYPE, model.MD_DESCRIPTION, model.MD_DIMS)
+
+
+class FileInfo(object):
+    """
+    The information about an acquisition file, as stored in the index
+    """
+
+    def __init__(self, fmt, shapes, dtypes, metadata, thumbnails):
+        """
+        fmt (str): name of the format of the file
+        shapes (list of tuples of int): shape of each data
+        dtypes (list of numpy.dtype): dtype of each data
+        metadata (list of dict str -> value): the main metadata of each data
+        thumbnails (list of DataArray): the thumbnails of the file
+        """
+        self.format = fmt
+        self.shapes = shapes
+        self.dtypes = dtypes
+        self.metadata = metadata
+        self.thumbnails = thumbnails
+
+
+def _md_to_json(md):
+    """
+    return (dict): the indexed metadata, which can be stored as JSON
+    """
+    jmd = {}
+    for k in INDEXED_METADATA:
+        if k in md:
+            try:
+                json.dumps(md[k])
+            except (TypeError, ValueError):
+                logging.debug("Skipping metadata %s which cannot be stored in the index", k)
+                continue
+            jmd[k] = md[k]
+    return jmd
+
+
+def _md_from_json(jmd):
+    # JSON converts tuples to lists
+    return {k: tuple(v) if isinstance(v, list) else v for k, v in jmd.items()}
+
+
+def _index_path(dirname, create):
+    """
+    Find the path of the index of a folder
+    dirname (str): the folder
+    create (bool): if False, only returns an index which already exists
+    return (str or None): the path to the index file, or None if not existing
+      and create is False
+    """
+    path = os.path.join(dirname, INDEX_FILENAME)
+    h = hashlib.sha1(os.path.abspath(dirname).encode("utf-8", "surrogateescape")).hexdigest()
+    fallback = os.path.join(os.path.expanduser(FALLBACK_DIR), h + ".sqlite")
+    if os.path.exists(path):
+        return path
+    elif os.path.exists(fallback):
+        return fallback
+    elif not create:
+        return None
+    elif os.access(dirname, os.W_OK):
+        return path
+    else:
+        try:
+            os.makedirs(os.path.dirname(fallback))
+        except OSError as ex:
+            if ex.errno != errno.EEXIST:
+                raise
+        return fallback
+
+
+class FolderIndex(object):
+    """
+    The index of a folder. It is safe to use from multiple threads (and
+    processes), as each operation uses its own connection to the database.
+    """
+
+    def __init__(self, dirname, readonly=False):
+        """
+        dirname (str): the folder containing the files
+        readonly (bool): if True, the index is only used to look up files
+          (with get()). It is never created nor modified.
+          Otherwise, the index is created (or recreated, if it's from an older
+          version) if needed.
+        raise LookupError: if readonly, and there is no index (of the current
+          version)
+        raise IOError: if the index cannot be opened or created
+        """
+        self.dirname = dirname
+        self.readonly = readonly
+        self.path = _index_path(dirname, create=not readonly)
+        if self.path is None:
+            raise LookupError("No index in %s" % (dirname,))
+
+        try:
+            with self._connect() as conn:
+                version = conn.execute("PRAGMA user_version").fetchone()[0]
+                if version != INDEX_VERSION:
+                    if readonly:
+                        raise LookupError("Index %s has version %d, instead of %d" %
+                                          (self.path, version, INDEX_VERSION))
+                    if version != 0:
+                        logging.info("Index %s has version %d, will recreate it", self.path, version)
+                    conn.execute("DROP TABLE IF EXISTS files")
+                    conn.execute("CREATE TABLE files (name TEXT PRIMARY KEY, mtime REAL NOT NULL, "
+                                 "size INTEGER NOT NULL, info TEXT NOT NULL, thumbnail BLOB)")
+                    conn.execute("PRAGMA user_version = %d" % (INDEX_VERSION,))
+        except sqlite3.Error as ex:
+            raise IOError("Failed to open index %s: %s" % (self.path, ex))
+
+    @contextmanager
+    def _connect(self):
+        """
+        Context manager to run a transaction on the database
+        """
+        if self.readonly:
+            # Fails instead of creating the database if it has been deleted
+            conn = sqlite3.connect("file:%s?mode=ro" % (pathname2url(self.path),),
+                                   uri=True, timeout=10)
+        else:
+            conn = sqlite3.connect(self.path, timeout=10)
+        try:
+            with conn:  # commits at the end (or rolls back on exception)
+                yield conn
+        finally:
+            conn.close()
+
+    def _stat(self, name):
+        """
+        return (float, int): mtime and size of the file
+        raise OSError: if the file doesn't exist
+        """
+        st = os.stat(os.path.join(self.dirname, name))
+        return st.st_mtime, st.st_size
+
+    def get(self, filename):
+        """
+        Look up a file in the index
+        filename (str): name of the file (in the folder of the index)
+        return (FileInfo or None): the information about the file, or None if
+          it's not in the index, or the file has changed since it was indexed.
+        """
+        name = os.path.basename(filename)
+        try:
+            mtime, size = self._stat(name)
+        except OSError:
+            return None
+
+        try:
+            with self._connect() as conn:
+                row = conn.execute("SELECT mtime, size, info, thumbnail FROM files WHERE name = ?",
+                                   (name,)).fetchone()
+        except sqlite3.Error:
+            logging.warning("Failed to read index %s", self.path, exc_info=True)
+            return None
+
+        if row is None or row[0] != mtime or row[1] != size:
+            return None
+        return self._decode(row[2], row[3])
+
+    def update(self, filename):
+        """
+        Index a file (again), if it has changed since the last time it was
+          indexed.
+        filename (str): name of the file (in the folder of the index)
+        return (FileInfo or None): the information about the file, or None if
+          it cannot be read
+        raise IOError: if the index is read-only
+        """
+        if self.readonly:
+            raise IOError("Index %s is opened read-only" % (self.path,))
+
+        finfo = self.get(filename)
+        if finfo is not None:
+            return finfo
+
+        name = os.path.basename(filename)
+        try:
+            finfo = _read_file_info(os.path.join(self.dirname, name))
+        except Exception:
+            logging.info("Failed to read file %s, will not index it", name, exc_info=True)
+            return None
+
+        self.store(name, finfo)
+        return finfo
+
+    def store(self, filename, finfo):
+        """
+        Store the information about a file, already known by the caller (eg,
+          because it has just opened the file).
+        filename (str): name of the file (in the folder of the index)
+        finfo (FileInfo): the information about the file
+        raise IOError: if the index is read-only
+        """
+        if self.readonly:
+            raise IOError("Index %s is opened read-only" % (self.path,))
+
+        name = os.path.basename(filename)
+        try:
+            mtime, size = self._stat(name)
+        except OSError:
+            logging.info("File %s doesn't exist, will not index it", name)
+            return
+
+        info, thumbnail = self._encode(finfo)
+        try:
+            with self._connect() as conn:
+                conn.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)",
+                             (name, mtime, size, info, thumbnail))
+        except sqlite3.Error:
+            logging.warning("Failed to update index %s", self.path, exc_info=True)
+
+    def update_all(self):
+        """
+        Index all the acquisition files of the folder which are not yet
+          indexed, or have changed. The entries of the files which don't exist
+          anymore are removed.
+        return (int): number of files (re)indexed
+        raise IOError: if the index is read-only
+        """
+        if self.readonly:
+            raise IOError("Index %s is opened read-only" % (self.path,))
+
+        names = [fn for fn in os.listdir(self.dirname)
+                 if not fn.startswith(".") and _is_readable_format(fn)]
+        try:
+            with self._connect() as conn:
+                indexed = {n: (m, s) for n, m, s in conn.execute("SELECT name, mtime, size FROM files")}
+                gone = set(indexed) - set(names)
+                conn.executemany("DELETE FROM files WHERE name = ?", [(n,) for n in gone])
+        except sqlite3.Error:
+            logging.warning("Failed to read index %s", self.path, exc_info=True)
+            indexed = {}
+
+        nupdated = 0
+        for n in sorted(names):
+            try:
+                if indexed.get(n) == self._stat(n):
+                    continue
+            except OSError:  # Deleted in the meantime
+                continue
+            if self.update(n) is not None:
+                nupdated += 1
+
+        logging.debug("Indexed %d files in %s", nupdated, self.dirname)
+        return nupdated
+
+    def _encode(self, finfo):
+        """
+        return (str, bytes): the info as JSON, and the thumbnails as raw data
+        """
+        thumbs = [numpy.ascontiguousarray(t) for t in finfo.thumbnails]
+        info = {"format": finfo.format,
+                "data": [{"shape": list(s), "dtype": numpy.dtype(d).str, "metadata": _md_to_json(md)}
+                         for s, d, md in zip(finfo.shapes, finfo.dtypes, finfo.metadata)],
+                "thumbnails": [{"shape": list(t.shape), "dtype": t.dtype.str,
+                                "metadata": _md_to_json(getattr(t, "metadata", {}))}
+                               for t in thumbs],
+                }
+        thumbnail = b"".join(t.tobytes() for t in thumbs)
+        return json.dumps(info), sqlite3.Binary(thumbnail)
+
+    def _decode(self, sinfo, thumbnail):
+        """
+        return (FileInfo): the information, as encoded by _encode()
+        """
+        info = json.loads(sinfo)
+        thumbs = []
+        offset = 0
+        buf = bytes(thumbnail) if thumbnail is not None else b""
+        for tinfo in info["thumbnails"]:
+            dtype = numpy.dtype(tinfo["dtype"])
+            count = int(numpy.prod(tinfo["shape"]))
+            a = numpy.frombuffer(buf, dtype=dtype, count=count, offset=offset)
+            offset += count * dtype.itemsize
+            thumbs.append(model.DataArray(a.reshape(tinfo["shape"]), _md_from_json(tinfo["metadata"])))
+
+        data = info["data"]
+        return FileInfo(info["format"],
+                        [tuple(d["shape"]) for d in data],
+                        [numpy.dtype(d["dtype"]) for d in data],
+                        [_md_from_json(d["metadata"]) for d in data],
+                        thumbs)
+
+
+def _is_readable_format(filename):
+    """
+    return (bool): True if the file has the extension of a format which can be read
+    """
+    from odemis import dataio
+    fmts = dataio.get_available_formats(os.O_RDONLY, allowlossy=True)
+    return any(filename.endswith(ext) for exts in fmts.values() for ext in exts)
+
+
+def _read_file_info(filename):
+    """
+    Open a file, to find the information to index
+    filename (str): full path to the file
+    return (FileInfo)
+    raise Exception: if the file cannot be opened
+    """
+    # Imported here, as some converters use this module
+    from odemis import dataio
+    converter = dataio.find_fittest_converter(filename, mode=os.O_RDONLY)
+    if hasattr(converter, "open_data"):
+        acd = converter.open_data(filename)
+        data = acd.content
+        thumbs = acd.thumbnails
+    else:
+        data = converter.read_data(filename)
+        try:
+            thumbs = converter.read_thumbnail(filename)
+        except Exception:
+            logging.debug("Failed to read thumbnail of %s", filename, exc_info=True)
+            thumbs = []
+
+    return _make_file_info(converter.FORMAT, data, thumbs)
+
+
+def _make_file_info(fmt, data, thumbnails):
+    """
+    fmt (str): name of the format of the file
+    data (list of DataArray or DataArrayShadow): the content of the file
+    thumbnails (list of DataArray or DataArrayShadow): the thumbnails of the file
+    return (FileInfo)
+    """
+    thumbs = [t.getData() if isinstance(t, model.DataArrayShadow) else t
+              for t in thumbnails]
+    return FileInfo(fmt,
+                    [tuple(d.shape) for d in data],
+                    [numpy.dtype(d.dtype) for d in data],
+                    [dict(d.metadata) for d in data],
+                    thumbs)
+
+
+def get_info(filename):
+    """
+    Get the information about an acquisition file, using the index of its
+      folder (which is created or updated if needed)
+    filename (str): path to the file
+    return (FileInfo or None): None if the file cannot be read
+    """
+    dirname = os.path.dirname(os.path.abspath(filename))
+    try:
+        index = FolderIndex(dirname)
+    except IOError:
+        logging.warning("Failed to access the index of %s", dirname, exc_info=True)
+        try:
+            return _read_file_info(filename)
+        except Exception:
+            logging.info("Failed to read file %s", filename, exc_info=True)
+            return None
+    return index.update(filename)
+
+
+def lookup_info(filename):
+    """
+    Look for the information about a file in the index of its folder, without
+      opening the file. The index is only read (never created or updated).
+    filename (str): path to the file
+    return (None or FileInfo): None if the file is not (or not anymore) in the index
+    """
+    dirname = os.path.dirname(os.path.abspath(filename))
+    try:
+        index = FolderIndex(dirname, readonly=True)
+    except (LookupError, IOError):
+        return None
+    return index.get(filename)
+
+
+def record_info(filename, fmt, data, thumbnails):
+    """
+    Store in the index of its folder the information about a file which the
+      caller has just opened, so that the file doesn't need to be read again.
+      Failures are only logged.
+    filename (str): path to the file
+    fmt (str): name of the format of the file
+    data (list of DataArray or DataArrayShadow): the content of the file
+    thumbnails (list of DataArray or DataArrayShadow): the thumbnails of the file
+    """
+    dirname = os.path.dirname(os.path.abspath(filename))
+    try:
+        index = FolderIndex(dirname)
+        index.store(filename, _make_file_info(fmt, data, thumbnails))
+    except Exception:
+        logging.warning("Failed to index file %s", filename, exc_info=True)
+
@@ -24,6 +24,7 @@ Odemis. If not, see http://www.gnu.org/licenses/.
 
 from __future__ import division
 
+from collections import OrderedDict
 import logging
 import math
 import numpy
@@ -31,6 +32,7 @@ from odemis import model
 import scipy.ndimage
 import cv2
 import copy 
+import threading
 from odemis.model import DataArray
 
 from odemis.model import MD_DWELL_TIME, MD_EXP_TIME, TINT_FIT_TO_RGB, TINT_RGB_AS_IS
@@ -248,12 +250,38 @@ def compactHistogram(hist, length):
 # for comparison, a.min() + a.max() are 0.01s for 2048x2048 array
 
 
-def histogram(data, irange=None):
+def _subsample(data, max_error):
+    """
+    Pick a subset of the data, regularly spread, big enough to compute an
+      histogram with the given accuracy.
+    data (numpy.ndarray of numbers): greyscale image
+    max_error (0 <= float): expected error (standard deviation) on the ratio of
+      values below any given value. 0 means no error allowed.
+    return (numpy.ndarray): a view on the data (or the data itself)
+    """
+    if max_error <= 0 or data.size == 0:
+        return data
+
+    # The ratio of values below a given value is estimated from a sample of n
+    # values with a standard deviation of sqrt(p(1-p)/n) <= 1 / (2 sqrt(n)).
+    nsamples = 1 / (4 * max_error ** 2)
+    step = int((data.size / nsamples) ** (1 / data.ndim))
+    if step < 2:
+        return data
+    return data[(slice(None, None, step),) * data.ndim]
+
+
+def histogram(data, irange=None, max_error=0):
     """
     Compute the histogram of the given image.
     data (numpy.ndarray of numbers): greyscale image
     irange (None or tuple of 2 unsigned int): min/max values to be found
       in the data. None => auto (min, max will be detected from the data)
+    max_error (0 <= float): if > 0, the histogram is computed on a regularly
+      spread subset of the data, big enough to have an expected error (standard
+      deviation) on the ratio of values below any given value smaller than
+      max_error. For example, with 1e-3, at most 250000 values are used.
+      The counts are then scaled back to the size of the data.
     return hist, edges:
      hist (ndarray 1D of 0<=int): number of pixels with the given value
       Note that the length of the returned histogram is not fixed. If irange
@@ -263,17 +291,20 @@ def histogram(data, irange=None):
        edges[1] is included in the bin. If irange is defined, it's the same
        values.
     """
+    data = data.view(numpy.ndarray)
+    fulldata = data
+    data = _subsample(data, max_error)
+
     if irange is None:
         if data.dtype.kind in "biu":
             idt = numpy.iinfo(data.dtype)
             irange = (idt.min, idt.max)
             if data.itemsize > 2:
                 # range is too big to be used as is => look really at the data
-                irange = (int(data.view(numpy.ndarray).min()),
-                          int(data.view(numpy.ndarray).max()))
+                irange = (int(data.min()), int(data.max()))
         else:
             # cast to ndarray to ensure a scalar (instead of a DataArray)
-            irange = (data.view(numpy.ndarray).min(), data.view(numpy.ndarray).max())
+            irange = (data.min(), data.max())
 
     # short-cuts (for the most usual types)
     if data.dtype.kind in "bu" and irange[0] == 0 and data.itemsize <= 2 and len(data) > 0:
@@ -292,9 +323,25 @@ def histogram(data, irange=None):
         else:
             # For floats, it will automatically find the minimum and maximum
             length = 256
-        hist, all_edges = numpy.histogram(data, bins=length, range=irange)
-        edges = (max(irange[0], all_edges[0]),
-                 min(irange[1], all_edges[-1]))
+
+        hist = None
+        if img_fast and irange[0] < irange[1]:
+            try:
+                hist = img_fast.histogram(data, irange, length)
+            except ValueError as exp:
+                logging.debug("Fast histogram cannot run: %s", exp)
+            except Exception:
+                logging.exception("Failed to use the fast histogram")
+        if hist is None:
+            hist, all_edges = numpy.histogram(data, bins=length, range=irange)
+            edges = (max(irange[0], all_edges[0]),
+                     min(irange[1], all_edges[-1]))
+        else:
+            edges = tuple(irange)
+
+    if data is not fulldata:
+        # Estimate the counts on the whole data
+        hist = numpy.rint(hist * (fulldata.size / data.size)).astype(hist.dtype)
 
     return hist, edges
 
@@ -342,6 +389,65 @@ def isClipping(data, drange=None):
 
 # TODO: try to do cumulative histogram value mapping (=histogram equalization)?
 # => might improve the greys, but might be "too" clever
+# Maximum number of colour map LUTs kept in the cache
+MAX_COLORMAP_LUTS = 16
+# id(Colormap) -> (Colormap, LUT), in order of last use
+_colormap_luts = OrderedDict()
+_colormap_luts_lock = threading.Lock()
+
+
+def _get_colormap_lut(cmap):
+    """
+    Compute the RGB colour of every entry of a colour map.
+    The result is cached, so that converting many images with the same colour
+    map (eg, when browsing a spectrum cube) doesn't re-evaluate it every time.
+    cmap (matplotlib.colors.Colormap): the colour map
+    return (numpy.ndarray of uint8, shape N3): RGB colour of each entry. It
+      must not be modified.
+    """
+    # Colormaps are not always hashable => use the id, and keep a reference to
+    # the colour map, so that the id cannot be reused by another object.
+    key = id(cmap)
+    with _colormap_luts_lock:
+        try:
+            lut = _colormap_luts.pop(key)[1]
+        except KeyError:
+            rgba = cmap(numpy.arange(cmap.N))
+            lut = numpy.empty((cmap.N, 3), dtype=numpy.uint8)
+            numpy.multiply(rgba[:, :3], 255, casting='unsafe', out=lut)
+            lut.flags.writeable = False
+            while len(_colormap_luts) >= MAX_COLORMAP_LUTS:
+                _colormap_luts.popitem(last=False)
+        _colormap_luts[key] = (cmap, lut)
+
+    return lut
+
+
+def _DataArray2RGBLUT(data, irange, lut):
+    """
+    Convert a greyscale image to RGB using a colour map LUT, in the same way as
+      matplotlib: the range is split into N bins of equal size, and NaN are black.
+    data (numpy.ndarray of shape YX): greyscale image
+    irange (2 numbers): min/max intensities mapped to the first/last colour
+    lut (numpy.ndarray of uint8, shape N3): RGB colour of each entry
+    return (numpy.ndarray of uint8, shape YX3): the RGB image
+    """
+    n = lut.shape[0]
+    if irange[0] < irange[1]:
+        fidx = (data - float(irange[0])) * (n / (float(irange[1]) - float(irange[0])))
+    else:  # Same as matplotlib: all the values are mapped to the first colour
+        fidx = numpy.zeros(data.shape)
+    numpy.clip(fidx, 0, n - 1, out=fidx)
+    nans = numpy.isnan(fidx)
+    hasnan = nans.any()
+    if hasnan:
+        fidx[nans] = 0
+    rgb = lut[fidx.astype(numpy.intp)]
+    if hasnan:
+        rgb[nans] = 0
+    return rgb
+
+
 def DataArray2RGB(data, irange=None, tint=(255, 255, 255)):
     """
     :param data: (numpy.ndarray of unsigned int) 2D image greyscale (unsigned
@@ -385,15 +491,16 @@ def DataArray2RGB(data, irange=None, tint=(255, 255, 255)):
     # Otherwise, continue with the old method
 
     if isinstance(tint, colors.Colormap):
-        # Normalize the data to the interval [0, 1.0]
+        if img_fast and irange[0] < irange[1]:
+            try:
+                return img_fast.DataArray2RGBLUT(data, irange, _get_colormap_lut(tint))
+            except ValueError as exp:
+                logging.info("Fast conversion cannot run: %s", exp)
+            except Exception:
+                logging.exception("Failed to use the fast conversion")
+
         # TODO: Add logarithmic normalization with LogNorm
-        # norm = colors.LogNorm(vmin=data.min(), vmax=data.max())
-        norm = colors.Normalize(vmin=irange[0], vmax=irange[1], clip=True)
-        rgb = tint(norm(data))  # returns an rgba array
-        rgb = rgb[:, :, :3]  # discard alpha channel
-        out = numpy.empty(rgb.shape, dtype=numpy.uint8)
-        numpy.multiply(rgb, 255, casting='unsafe', out=out)
-        return out
+        return _DataArray2RGBLUT(data, irange, _get_colormap_lut(tint))
 
     if data.dtype == numpy.uint8 and irange[0] == 0 and irange[1] == 255:
         # short-cut when data is already the same type
@@ -401,9 +508,7 @@ def DataArray2RGB(data, irange=None, tint=(255, 255, 255)):
         drescaled = data
         # TODO: also write short-cut for 16 bits by reading only the high byte?
     else:
-        # If data might go outside of the range, clip first
         if data.dtype.kind in "iu":
-            # no need to clip if irange is the whole possible range
             idt = numpy.iinfo(data.dtype)
             # Ensure B&W if there is only one value allowed
             if irange[0] >= irange[1]:
@@ -411,22 +516,26 @@ def DataArray2RGB(data, irange=None, tint=(255, 255, 255)):
                     irange = (irange[0] - 1, irange[0])
                 else:
                     irange = (irange[0], irange[0] + 1)
+        else: # floats et al.
+            # Ensure B&W if there is just one value allowed
+            if irange[0] >= irange[1]:
+                irange = (irange[0] - 1e-9, irange[0])
 
-            if img_fast:
-                try:
-                    # only (currently) supports uint16
-                    return img_fast.DataArray2RGB(data, irange, tint)
-                except ValueError as exp:
-                    logging.info("Fast conversion cannot run: %s", exp)
-                except Exception:
-                    logging.exception("Failed to use the fast conversion")
+        if img_fast:
+            try:
+                # Clip, scale and tint in a single pass (supports only some dtypes)
+                return img_fast.DataArray2RGB(data, irange, tint)
+            except ValueError as exp:
+                logging.info("Fast conversion cannot run: %s", exp)
+            except Exception:
+                logging.exception("Failed to use the fast conversion")
 
+        # If data might go outside of the range, clip first
+        if data.dtype.kind in "iu":
+            # no need to clip if irange is the whole possible range
             if irange[0] > idt.min or irange[1] < idt.max:
                 data = data.clip(*irange)
         else: # floats et al. => always clip
-            # Ensure B&W if there is just one value allowed
-            if irange[0] >= irange[1]:
-                irange = (irange[0] - 1e-9, irange[0])
             data = data.clip(*irange)
 
         dshift = data - irange[0]
@@ -1,4 +1,6 @@
 # -*- coding: utf-8 -*-
+# distutils: extra_compile_args = -fopenmp
+# distutils: extra_link_args = -fopenmp
 '''
 Created on 10 Mar 2014
 
@@ -18,98 +20,255 @@ You should have received a copy of the GNU General Public License along with Ode
 
 from __future__ import division
 import cython
+from cython.parallel import parallel, prange, threadid
 
 # import both numpy and the Cython declarations for numpy
 import numpy
 cimport numpy
+cimport openmp
+
+ctypedef fused data_t:
+    numpy.uint8_t
+    numpy.uint16_t
+    numpy.uint32_t
+    numpy.float32_t
+    numpy.float64_t
+
+# Below this number of pixels, it's not worthy to start multiple threads
+MIN_PARALLEL_SIZE = 256 * 256
 
-# TODO: use fused types to support multiple types (but needs Cython >= 0.20)
-ctypedef numpy.uint16_t uint16_t
 
 # nogil allows multi-threading but prevents use of any Python objects or call
-@cython.cdivision(True)
-cdef void cDataArray2RGB(uint16_t* data, int datalen, uint16_t irange0, uint16_t irange1,
-                         int* tint, numpy.uint8_t* ret) nogil:
-    cdef double b = 255. / <double>(irange1 - irange0)
-    cdef double br = (b * <double>tint[0]) / 255.
-    cdef double bg = (b * <double>tint[1]) / 255.
-    cdef double bb = (b * <double>tint[2]) / 255.
-
-    cdef numpy.uint8_t di
-    cdef double df
-    cdef int retpos = 0
-
-    if tint[0] == tint[1] == tint[2] == 255:
-        # optimised version, without tinting (about 2x faster)
-        for i in range(datalen):
-            # clip
-            if data[i] <= irange0:
-                di = 0
-            elif data[i] >= irange1:
-                di = 255
-            else:
-                di = <numpy.uint8_t> ((data[i] - irange0) * b + 0.5)
-            ret[retpos] = di
-            retpos += 1
-            ret[retpos] = di
-            retpos += 1
-            ret[retpos] = di
-            retpos += 1
-    else:
-        for i in range(datalen):
-            # clip
-            if data[i] <= irange0:
-                ret[retpos] = 0
-                retpos += 1
-                ret[retpos] = 0
-                retpos += 1
-                ret[retpos] = 0
-                retpos += 1
-            elif data[i] >= irange1:
-                ret[retpos] = tint[0]
-                retpos += 1
-                ret[retpos] = tint[1]
-                retpos += 1
-                ret[retpos] = tint[2]
-                retpos += 1
-            else:
-                df = (data[i] - irange0)
-                ret[retpos] = <numpy.uint8_t> (df * br + 0.5)
-                retpos += 1
-                ret[retpos] = <numpy.uint8_t> (df * bg + 0.5)
-                retpos += 1
-                ret[retpos] = <numpy.uint8_t> (df * bb + 0.5)
-                retpos += 1
-
-# This function is probably not needed, but I have no idea how to instantiate
-# a numpy array which can be passed as a pointer
+# Note: the fused memoryviews cannot be const with Cython 0.29, so the data
+# must be writable (even if it's never modified).
 @cython.boundscheck(False)
 @cython.wraparound(False)
-def wrapDataArray2RGB(numpy.ndarray[uint16_t, ndim=2] data not None,
-                  irange,
-                  tint,
-                  numpy.ndarray[numpy.uint8_t, ndim=3] ret not None):
-    cdef int ctint[3]
-    ctint[0] = tint[0]
-    ctint[1] = tint[1]
-    ctint[2] = tint[2]
-    cDataArray2RGB(&data[0,0], data.size, irange[0], irange[1], ctint, &ret[0,0,0])
+@cython.cdivision(True)
+cdef void cDataArray2RGB(data_t[:, ::1] data, double irange0, double irange1,
+                         double offset, numpy.uint8_t[:, ::1] lut,
+                         numpy.uint16_t[:, ::1] idxs,
+                         numpy.uint8_t[:, :, ::1] ret, int num_threads) nogil:
+    """
+    Convert each pixel to RGB: clip & scale to an index in the LUT, and copy
+      the corresponding RGB value. The rows are processed in parallel.
+    irange0, irange1: intensities mapped to the first and last entry of the LUT
+    offset: added to the scaled intensity before rounding down (0.5 to round
+      to the closest entry)
+    lut (N+1 x 3): RGB value for each entry. The extra last entry is for NaN.
+    idxs (T x X): buffer for the indices of a row, for each thread
+    num_threads: number of threads
+    """
+    cdef Py_ssize_t n = lut.shape[0] - 1
+    cdef double b = <double>(n - 1) / (irange1 - irange0)
+    cdef double lastidx = <double>(n - 1)
 
+    cdef Py_ssize_t i, j, width = data.shape[1]
+    cdef data_t* drow
+    cdef numpy.uint8_t* rrow
+    cdef const numpy.uint8_t* l = &lut[0, 0]
+    cdef const numpy.uint8_t* c
+    cdef numpy.uint16_t* idx
+    cdef double v
 
-def DataArray2RGB(data, irange, tint=(255, 255, 255)):
-    if not data.flags.c_contiguous:
-        raise ValueError("Optimised version only works with C-contiguous arrays")
-    if data.dtype != numpy.uint16:
-        # Note: cython automatically detects such errors, but it seems that with
-        # ctyhon 0.23, it can leak memory.
-        raise ValueError("Optimised version only works on uint16 (got %s)" % (data.dtype,))
-    # Note: we could also make an optimised version for F-contiguous arrays,
-    # but it's not clear when it'd be useful. For more complex arrays, it's also
-    # probably possible to generate a faster version than numpy, but I don't
-    # know how.
-    if irange[0] >= irange[1]:
+    with parallel(num_threads=num_threads):
+        idx = &idxs[threadid(), 0]
+        for i in prange(data.shape[0], schedule="static"):
+            drow = &data[i, 0]
+            rrow = &ret[i, 0, 0]
+            # First compute the index of each pixel of the row. It's written
+            # with conditional expressions (and not fmin/fmax, which are
+            # function calls), so that the compiler can vectorise the loop.
+            for j in range(width):
+                v = (<double>drow[j] - irange0) * b + offset
+                v = v if v > 0. else 0.  # Also NaN -> 0
+                v = v if v < lastidx else lastidx
+                idx[j] = <numpy.uint16_t> v
+                idx[j] = idx[j] if drow[j] == drow[j] else n  # NaN
+
+            # Then look up the colours
+            for j in range(width):
+                c = &l[3 * idx[j]]
+                rrow[3 * j] = c[0]
+                rrow[3 * j + 1] = c[1]
+                rrow[3 * j + 2] = c[2]
+
+
+def _wrapDataArray2RGB(data_t[:, ::1] data, irange, double offset,
+                       numpy.uint8_t[:, ::1] lut,
+                       numpy.uint16_t[:, ::1] idxs,
+                       numpy.uint8_t[:, :, ::1] ret):
+    cdef double irange0 = irange[0]
+    cdef double irange1 = irange[1]
+    cdef int num_threads = idxs.shape[0]
+    cDataArray2RGB(data, irange0, irange1, offset, lut, idxs, ret, num_threads)
+
+
+def _num_threads(data):
+    """
+    return (int): number of threads worthy to use to process the data
+    """
+    if data.size >= MIN_PARALLEL_SIZE:
+        return openmp.omp_get_max_threads()
+    else:
+        return 1
+
+
+def _writable(data):
+    """
+    Ensure the data can be passed as a (non const) memoryview
+    return (numpy.ndarray): the data, or a copy of it if it's read-only
+    """
+    if not data.flags.writeable:
+        return data.copy()
+    return data
+
+
+def _convert(data, irange, offset, lut):
+    """
+    data (ndarray of shape YX)
+    irange (2 numbers): min/max intensities mapped to the first/last entry of the LUT
+    offset (float): added to the scaled intensity before rounding down
+    lut (ndarray of uint8, shape N3): RGB colours
+    return (ndarray of uint8, shape YX3): the RGB image
+    """
+    if data.ndim != 2:
+        raise ValueError("Optimised version only works with 2D arrays")
+    # Note: cython automatically detects such errors, but it seems that with
+    # cython 0.23, it can leak memory.
+    if data.dtype not in (numpy.uint8, numpy.uint16, numpy.uint32,
+                          numpy.float32, numpy.float64):
+        raise ValueError("Optimised version doesn't support %s" % (data.dtype,))
+    if not float(irange[0]) < float(irange[1]):
         raise ValueError("irange needs to be a tuple of low/high values")
+    if not 2 <= lut.shape[0] <= 2 ** 16 - 1:
+        raise ValueError("LUT must have between 2 and 65535 entries")
+
+    # Note: for non C-contiguous arrays, a copy is still faster than the
+    # standard conversion.
+    data = _writable(numpy.ascontiguousarray(data))
+    # Add a black entry, for NaN
+    lutn = numpy.zeros((lut.shape[0] + 1, 3), dtype=numpy.uint8)
+    lutn[:-1] = lut
     ret = numpy.empty(data.shape + (3,), dtype=numpy.uint8)
-    wrapDataArray2RGB(data, irange, tint, ret)
+    idxs = numpy.empty((_num_threads(data), data.shape[1]), dtype=numpy.uint16)
+    _wrapDataArray2RGB(data, irange, offset, lutn, idxs, ret)
     return ret
 
+
+def DataArray2RGB(data, irange, tint=(255, 255, 255)):
+    """
+    Convert a greyscale image to RGB, by mapping the intensity range to 0->255
+      and then multiplying by the tint.
+    data (ndarray of shape YX): array of uint8, uint16, uint32, float32 or
+      float64
+    irange (2 numbers): min/max intensities mapped to black/white. Must be
+      min < max.
+    tint (3-tuple of 0 <= int < 256): RGB colour of the brightest pixels
+    return (ndarray of uint8, shape YX3): the RGB image
+    raise ValueError: if the data is not supported by the optimised version
+    """
+    # Each grey level (rounded) -> tinted colour
+    grey = numpy.arange(256, dtype=numpy.float64)
+    lut = numpy.empty((256, 3), dtype=numpy.uint8)
+    for c in range(3):
+        numpy.multiply(grey, tint[c] / 255, out=lut[:, c], casting="unsafe")
+    return _convert(data, irange, 0.5, lut)
+
+
+def DataArray2RGBLUT(data, irange, lut):
+    """
+    Convert a greyscale image to RGB, by mapping the intensity range to the
+      entries of a colour map. Like matplotlib, the range is split into N bins
+      of equal size, and NaN are black.
+    data (ndarray of shape YX): array of uint8, uint16, uint32, float32 or
+      float64
+    irange (2 numbers): min/max intensities mapped to the first/last colour.
+      Must be min < max.
+    lut (ndarray of uint8, shape N3): RGB colour for each entry of the colour map
+    return (ndarray of uint8, shape YX3): the RGB image
+    raise ValueError: if the data is not supported by the optimised version
+    """
+    if lut.ndim != 2 or lut.shape[1] != 3 or lut.dtype != numpy.uint8:
+        raise ValueError("LUT must be an array of uint8 of shape N x 3")
+    # The N bins have a width of (irange1 - irange0) / N, while the conversion
+    # maps irange to 0 -> N-1 => extend the range by one bin.
+    n = lut.shape[0]
+    irange = (float(irange[0]), irange[0] + (float(irange[1]) - irange[0]) * (n - 1) / n)
+    return _convert(data, irange, 0, lut)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void cHistogram(data_t[:, :] data, double[::1] edges,
+                     numpy.int64_t[:, ::1] hists, int num_threads) nogil:
+    """
+    Count the number of values in each bin. The rows are processed in
+      parallel, each thread having its own histogram.
+    edges (N+1): the edges of the bins. The values of the last edge are in the
+      last bin. The first and last edges are the lowest and highest values
+      counted.
+    hists (T x N): the histogram of each thread
+    """
+    cdef Py_ssize_t n = hists.shape[1]
+    cdef double irange0 = edges[0]
+    cdef double irange1 = edges[n]
+    cdef double b = n / (irange1 - irange0)
+    cdef Py_ssize_t i, j, k
+    cdef numpy.int64_t* h
+    cdef double v
+
+    with parallel(num_threads=num_threads):
+        h = &hists[threadid(), 0]
+        for i in prange(data.shape[0], schedule="static"):
+            for j in range(data.shape[1]):
+                v = <double>data[i, j]
+                if irange0 <= v <= irange1:  # Also discards NaN
+                    k = <Py_ssize_t>((v - irange0) * b)
+                    if k >= n:  # v == irange1
+                        k = n - 1
+                    # Same as numpy: the index computation can be off by one
+                    # close to the edges, so check against the actual edges.
+                    if v < edges[k]:
+                        k = k - 1
+                    elif k < n - 1 and v >= edges[k + 1]:
+                        k = k + 1
+                    h[k] += 1
+
+
+def _wrapHistogram(data_t[:, :] data, double[::1] edges, numpy.int64_t[:, ::1] hists):
+    cdef int num_threads = hists.shape[0]
+    cHistogram(data, edges, hists, num_threads)
+
+
+def histogram(data, irange, length):
+    """
+    Compute the histogram of an image, with bins of equal size. It gives the
+      same result as numpy.histogram(data, length, irange)[0].
+    data (ndarray of shape YX): array of uint8, uint16, uint32, float32 or
+      float64
+    irange (2 numbers): lowest and highest value counted. Must be min < max.
+    length (int > 0): number of bins
+    return (ndarray of int64 of shape N): number of values in each bin
+    raise ValueError: if the data is not supported by the optimised version
+    """
+    if data.ndim != 2:
+        raise ValueError("Optimised version only works with 2D arrays")
+    if data.dtype not in (numpy.uint8, numpy.uint16, numpy.uint32,
+                          numpy.float32, numpy.float64):
+        raise ValueError("Optimised version doesn't support %s" % (data.dtype,))
+    if not float(irange[0]) < float(irange[1]):
+        raise ValueError("irange needs to be a tuple of low/high values")
+    if length < 1:
+        raise ValueError("Histogram needs at least one bin")
+
+    # Compute the edges exactly as numpy.histogram(), in the same precision
+    edges_type = numpy.result_type(irange[0], irange[1], data)
+    if numpy.issubdtype(edges_type, numpy.integer):
+        edges_type = numpy.result_type(edges_type, float)
+    edges = numpy.linspace(irange[0], irange[1], length + 1, endpoint=True,
+                           dtype=edges_type).astype(numpy.float64)
+
+    hists = numpy.zeros((_num_threads(data), length), dtype=numpy.int64)
+    _wrapHistogram(_writable(data.view(numpy.ndarray)), edges, hists)
+    return hists.sum(axis=0)
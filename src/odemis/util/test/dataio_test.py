@@ -23,6 +23,7 @@ from odemis.acq import stream
 from odemis.dataio import tiff
 from odemis.util.dataio import data_to_static_streams, open_acquisition, \
     splitext
+import os
 import time
 import unittest
 
@@ -208,6 +209,35 @@ class TestDataIO(unittest.TestCase):
         self.assertEqual(fluo, 2)
         self.assertEqual(sem, 1)
 
+    def test_data_to_stream_pyramidal_planes(self):
+        """
+        Check data_to_static_streams with pyramidal data with multiple planes:
+        each plane is a separate stream, with tile access
+        """
+        FILENAME = u"test" + tiff.EXTENSIONS[0]
+        size = (1, 2, 1, 600, 700)
+        arr = numpy.random.randint(0, 1000, size).astype(numpy.uint16)
+        md = {model.MD_DIMS: "CTZYX",
+              model.MD_DESCRIPTION: "sem",
+              model.MD_PIXEL_SIZE: (1e-6, 1e-6),
+              model.MD_POS: (1e-3, 2e-3)}
+        tiff.export(FILENAME, model.DataArray(arr, md), pyramid=True)
+
+        rdata = open_acquisition(FILENAME)
+        sts = data_to_static_streams(rdata)
+        self.assertEqual(len(sts), 2)
+        for i, s in enumerate(sts):
+            self.assertIsInstance(s, stream.EMStream)
+            das = s.raw[0]
+            self.assertIsInstance(das, model.DataArrayShadow)
+            self.assertEqual(das.shape, size[-2:])
+            self.assertEqual(das.maxzoom, rdata[0].maxzoom)
+            tile = das.getTile(1, 0, 0)
+            numpy.testing.assert_array_equal(tile, arr[0, i, 0, :256, 256:512])
+            numpy.testing.assert_array_equal(das.getData(), arr[0, i, 0])
+
+        os.remove(FILENAME)
+
     def test_splitext(self):
         # input, output
         tio = (
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on 18 Oct 2026
+
+@author: agent
+
+Copyright © 2026 Delmic
+
+This file is part of Odemis.
+
+Odemis is free software: you can redistribute it and/or modify it under the terms
+of the GNU General Public License version 2 as published by the Free Software
+Foundation.
+
+Odemis is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+Odemis. If not, see http://www.gnu.org/licenses/.
+"""
+from __future__ import division
+
+import logging
+import numpy
+from odemis import model, dataio
+from odemis.dataio import tiff, hdf5
+from odemis.util import fileindex
+from odemis.util import dataio as udataio
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+logging.getLogger().setLevel(logging.DEBUG)
+
+
+class TestFolderIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        md = {model.MD_POS: (1e-3, -2e-3),
+              model.MD_PIXEL_SIZE: (1e-6, 1e-6),
+              model.MD_ACQ_DATE: time.time(),
+              model.MD_DESCRIPTION: "test",
+              model.MD_HW_NAME: "fake",  # Not indexed
+              }
+        self.data = model.DataArray(numpy.arange(200 * 300, dtype=numpy.uint16).reshape(200, 300), md)
+        self.thumb = model.DataArray(numpy.zeros((20, 30, 3), dtype=numpy.uint8))
+        self.thumb[:, :, 1] = 128
+        tiff.export(os.path.join(self.dirname, "a.ome.tiff"), self.data, thumbnail=self.thumb)
+        hdf5.export(os.path.join(self.dirname, "b.h5"), [self.data, self.data[:100]])
+        with open(os.path.join(self.dirname, "notes.txt"), "w") as f:
+            f.write("not an acquisition")
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def test_update(self):
+        index = fileindex.FolderIndex(self.dirname)
+        self.assertIsNone(index.get("a.ome.tiff"))
+        self.assertEqual(index.update_all(), 2)
+        self.assertTrue(os.path.exists(os.path.join(self.dirname, fileindex.INDEX_FILENAME)))
+        # Nothing changed => nothing to update
+        self.assertEqual(index.update_all(), 0)
+
+        finfo = index.get(os.path.join(self.dirname, "a.ome.tiff"))
+        self.assertEqual(finfo.format, tiff.FORMAT)
+        self.assertEqual(finfo.shapes, [(200, 300)])
+        self.assertEqual(finfo.dtypes, [numpy.dtype(numpy.uint16)])
+        md = finfo.metadata[0]
+        self.assertEqual(md[model.MD_POS], self.data.metadata[model.MD_POS])
+        self.assertEqual(md[model.MD_PIXEL_SIZE], self.data.metadata[model.MD_PIXEL_SIZE])
+        # TIFF stores the date to the second
+        self.assertAlmostEqual(md[model.MD_ACQ_DATE], self.data.metadata[model.MD_ACQ_DATE], delta=1)
+        self.assertNotIn(model.MD_HW_NAME, md)
+        self.assertEqual(len(finfo.thumbnails), 1)
+        numpy.testing.assert_array_equal(finfo.thumbnails[0], self.thumb)
+
+        # HDF5 always stores the data as CTZYX
+        finfo = index.get("b.h5")
+        self.assertEqual(finfo.shapes, [(1, 1, 1, 200, 300), (1, 1, 1, 100, 300)])
+
+        # A new index object reads the same database
+        roindex = fileindex.FolderIndex(self.dirname, readonly=True)
+        self.assertEqual(roindex.get("b.h5").shapes, [(1, 1, 1, 200, 300), (1, 1, 1, 100, 300)])
+        with self.assertRaises(IOError):
+            roindex.update_all()
+
+        # Modified file => only it is updated
+        hdf5.export(os.path.join(self.dirname, "b.h5"), [self.data[:50]])
+        os.utime(os.path.join(self.dirname, "b.h5"), (time.time() + 10, time.time() + 10))
+        self.assertIsNone(index.get("b.h5"))
+        self.assertEqual(index.update_all(), 1)
+        self.assertEqual(index.get("b.h5").shapes, [(1, 1, 1, 50, 300)])
+
+        # Deleted file
+        os.remove(os.path.join(self.dirname, "a.ome.tiff"))
+        self.assertEqual(index.update_all(), 0)
+        self.assertIsNone(index.get("a.ome.tiff"))
+
+    def test_thumbnail(self):
+        fn = os.path.join(self.dirname, "a.ome.tiff")
+        # No index => None, and nothing created
+        self.assertIsNone(fileindex.lookup_info(fn))
+        with self.assertRaises(LookupError):
+            fileindex.FolderIndex(self.dirname, readonly=True)
+        self.assertFalse(os.path.exists(os.path.join(self.dirname, fileindex.INDEX_FILENAME)))
+
+        # read_thumbnail() reads the file, and indexes it
+        thumbs = tiff.read_thumbnail(fn)
+        numpy.testing.assert_array_equal(thumbs[0], self.thumb)
+        finfo = fileindex.lookup_info(fn)
+        self.assertEqual(finfo.shapes, [(200, 300)])
+        numpy.testing.assert_array_equal(finfo.thumbnails[0], self.thumb)
+
+        # The next time, read_thumbnail() uses the index, and doesn't open the file
+        orig_open_data = tiff.open_data
+        try:
+            tiff.open_data = None
+            thumbs = tiff.read_thumbnail(fn)
+        finally:
+            tiff.open_data = orig_open_data
+        numpy.testing.assert_array_equal(thumbs[0], self.thumb)
+
+    def test_open_acquisition(self):
+        """
+        Opening a file records it in the index, which is then used to find its format
+        """
+        fn = os.path.join(self.dirname, "b.h5")
+        data = udataio.open_acquisition(fn)
+        self.assertEqual(len(data), 2)
+        finfo = fileindex.lookup_info(fn)
+        self.assertEqual(finfo.format, hdf5.FORMAT)
+        self.assertEqual(finfo.shapes, [d.shape for d in data])
+
+        # The format is not detected again
+        orig_find = dataio.find_fittest_converter
+        try:
+            dataio.find_fittest_converter = None
+            data = udataio.open_acquisition(fn)
+        finally:
+            dataio.find_fittest_converter = orig_find
+        self.assertEqual(len(data), 2)
+
+    def test_readonly_version(self):
+        """
+        An index of an other version is not used, and not modified, by a lookup
+        """
+        fn = os.path.join(self.dirname, "a.ome.tiff")
+        fileindex.get_info(fn)
+        index = fileindex.FolderIndex(self.dirname)
+        with index._connect() as conn:
+            conn.execute("PRAGMA user_version = %d" % (fileindex.INDEX_VERSION + 1,))
+        st = os.stat(index.path)
+
+        self.assertIsNone(fileindex.lookup_info(fn))
+        with self.assertRaises(LookupError):
+            fileindex.FolderIndex(self.dirname, readonly=True)
+        self.assertEqual(os.stat(index.path).st_mtime, st.st_mtime)
+        with index._connect() as conn:
+            self.assertEqual(conn.execute("SELECT COUNT(*) FROM files").fetchone()[0], 1)
+
+        # A writable index is recreated
+        index = fileindex.FolderIndex(self.dirname)
+        self.assertIsNone(index.get(fn))
+
+
+if __name__ == "__main__":
+    unittest.main()
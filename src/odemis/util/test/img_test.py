@@ -23,6 +23,7 @@ from __future__ import division, print_function
 
 from builtins import range
 import logging
+import matplotlib.colors as colors
 import numpy
 from odemis import model
 from odemis.dataio import tiff
@@ -289,6 +290,63 @@ class TestHistogram(unittest.TestCase):
         hist_forced, edges = img.histogram(grey_img, edges)
         numpy.testing.assert_array_equal(hist, hist_forced)
 
+    def test_fast(self):
+        """
+        Test the optimised histogram gives the same result as numpy
+        """
+        if img.img_fast is None:
+            self.skipTest("Fast histogram not available")
+
+        size = (1024, 965)
+        for dtype in (numpy.uint32, numpy.float32, numpy.float64):
+            grey_img = (numpy.random.random(size) * 50000).astype(dtype)
+            grey_img[0, 0] = 60000
+            # Put many values exactly on (and just around) the bin edges
+            all_edges = numpy.linspace(grey_img.min(), grey_img.max(), 257).astype(dtype)
+            grey_img[1, :257] = all_edges
+            if dtype != numpy.uint32:
+                inner_edges = all_edges[1:-1]
+                grey_img[2, :255] = numpy.nextafter(inner_edges, -numpy.inf, dtype=dtype)
+                grey_img[3, :255] = numpy.nextafter(inner_edges, numpy.inf, dtype=dtype)
+            hist, edges = img.histogram(grey_img)
+
+            img_fast = img.img_fast
+            img.img_fast = None
+            try:
+                hist_std, edges_std = img.histogram(grey_img)
+            finally:
+                img.img_fast = img_fast
+            self.assertEqual(edges, edges_std)
+            self.assertEqual(hist.sum(), grey_img.size)
+            numpy.testing.assert_array_equal(hist, hist_std)
+
+    def test_subsample(self):
+        """
+        Test the histogram computed on a subset of a large image
+        """
+        size = (4096, 3000)
+        grey_img = numpy.random.randint(0, 4096, size=size).astype(numpy.uint16)
+        grey_img[:, :1000] = 500
+        hist, edges = img.histogram(grey_img, (0, 4095))
+        hist_sub, edges_sub = img.histogram(grey_img, (0, 4095), max_error=1e-3)
+        self.assertEqual(edges_sub, edges)
+        self.assertEqual(hist_sub.shape, hist.shape)
+        self.assertAlmostEqual(hist_sub.sum(), grey_img.size, delta=grey_img.size * 1e-3)
+
+        # The cumulative ratio should be (about) within the error
+        cum = hist.cumsum() / hist.sum()
+        cum_sub = hist_sub.cumsum() / hist_sub.sum()
+        self.assertLess(numpy.abs(cum - cum_sub).max(), 5e-3)
+        irange = img.findOptimalRange(hist, edges, 1 / 256)
+        irange_sub = img.findOptimalRange(hist_sub, edges_sub, 1 / 256)
+        numpy.testing.assert_allclose(irange_sub, irange, atol=20)
+
+        # Small image => all the data is used
+        small_img = grey_img[:256, :256]
+        hist_sub, edges_sub = img.histogram(small_img, (0, 4095), max_error=1e-3)
+        hist, edges = img.histogram(small_img, (0, 4095))
+        numpy.testing.assert_array_equal(hist_sub, hist)
+
     def test_compact(self):
         """
         test the compactHistogram()
@@ -450,15 +508,30 @@ class TestDataArray2RGB(unittest.TestCase):
         self.assertGreater(hist[-1], 0)
         self.assertEqual(hist[-2], 0)
 
+    def _convert_std(self, data, irange, tint=(255, 255, 255)):
+        """
+        Run the standard (numpy-based) conversion
+        return (ndarray, float): RGB image, and the duration of the conversion
+        """
+        img_fast = img.img_fast
+        img.img_fast = None
+        try:
+            tstart = time.time()
+            rgb = img.DataArray2RGB(data, irange, tint)
+            return rgb, time.time() - tstart
+        finally:
+            img.img_fast = img_fast
+
     def test_fast(self):
         """Test the fast conversion"""
+        if img.img_fast is None:
+            self.skipTest("Fast conversion not available")
+
         data = numpy.ones((251, 200), dtype="uint16")
         data[:, :] = numpy.arange(200)
         data[2, :] = 56
         data[200, 2] = 3
 
-        data_nc = data.swapaxes(0, 1) # non-contiguous cannot be treated by fast conversion
-
         # convert to RGB
         hist, edges = img.histogram(data)
         irange = img.findOptimalRange(hist, edges, 1 / 256)
@@ -467,18 +540,73 @@ class TestDataArray2RGB(unittest.TestCase):
             rgb = img.DataArray2RGB(data, irange)
         fast_dur = time.time() - tstart
 
-        hist_nc, edges_nc = img.histogram(data_nc)
-        irange_nc = img.findOptimalRange(hist_nc, edges_nc, 1 / 256)
-        tstart = time.time()
+        std_dur = 0
         for i in range(10):
-            rgb_nc = img.DataArray2RGB(data_nc, irange_nc)
-        std_dur = time.time() - tstart
-        rgb_nc_back = rgb_nc.swapaxes(0, 1)
+            rgb_std, dur = self._convert_std(data, irange)
+            std_dur += dur
 
         print("Time fast conversion = %g s, standard = %g s" % (fast_dur, std_dur))
         self.assertLess(fast_dur, std_dur)
         # ±1, to handle the value shifts by the standard converter to handle floats
-        numpy.testing.assert_almost_equal(rgb, rgb_nc_back, decimal=0)
+        numpy.testing.assert_almost_equal(rgb, rgb_std, decimal=0)
+
+        # Non-contiguous arrays are also supported
+        data_nc = data.swapaxes(0, 1)
+        rgb_nc = img.DataArray2RGB(data_nc, irange)
+        numpy.testing.assert_equal(rgb, rgb_nc.swapaxes(0, 1))
+
+    def test_fast_dtypes(self):
+        """Test the fast conversion gives the same result as the standard one"""
+        if img.img_fast is None:
+            self.skipTest("Fast conversion not available")
+
+        for dtype in (numpy.uint8, numpy.uint32, numpy.float32, numpy.float64):
+            data = numpy.zeros((512, 300), dtype=dtype)
+            data[:, :] = numpy.arange(300) % 250
+            irange = (10, 200)
+            for tint in ((255, 255, 255), (0, 73, 255)):
+                rgb = img.DataArray2RGB(data, irange, tint)
+                rgb_std, _ = self._convert_std(data, irange, tint)
+                self.assertEqual(rgb.shape, data.shape + (3,))
+                self.assertLessEqual(numpy.abs(rgb.astype(int) - rgb_std).max(), 1,
+                                     "RGB differs for %s with tint %s" % (dtype, tint))
+
+    def test_fast_colormap(self):
+        """Test the fast conversion with a colour map"""
+        if img.img_fast is None:
+            self.skipTest("Fast conversion not available")
+
+        cmap = colors.LinearSegmentedColormap.from_list("test", [(0, 0, 1), (0, 1, 0), (1, 0, 0)])
+        for dtype in (numpy.uint16, numpy.float64):
+            data = numpy.zeros((512, 300), dtype=dtype)
+            data[:, :] = numpy.arange(300)
+            irange = (10, 200)
+            rgb = img.DataArray2RGB(data, irange, cmap)
+            rgb_std, _ = self._convert_std(data, irange, cmap)
+            numpy.testing.assert_equal(rgb, rgb_std)
+
+    def test_colormap(self):
+        """Test the conversion with a colour map gives the same result as matplotlib"""
+        cmap = colors.LinearSegmentedColormap.from_list("test", [(0, 0, 1), (0, 1, 0), (1, 0, 0)])
+        data = numpy.zeros((64, 300), dtype=numpy.float32)
+        data[:, :] = numpy.arange(300) + 0.25
+        data[0, 0] = float("nan")
+        irange = (10, 200)
+
+        norm = colors.Normalize(vmin=irange[0], vmax=irange[1], clip=True)
+        exp_rgb = numpy.empty(data.shape + (3,), dtype=numpy.uint8)
+        numpy.multiply(cmap(norm(data))[:, :, :3], 255, casting='unsafe', out=exp_rgb)
+        exp_rgb[0, 0] = 0  # NaN -> black
+
+        rgb, _ = self._convert_std(data, irange, cmap)
+        numpy.testing.assert_equal(rgb, exp_rgb)
+
+        # Same LUT is reused for the same colour map
+        lut = img._get_colormap_lut(cmap)
+        self.assertIs(img._get_colormap_lut(cmap), lut)
+        self.assertEqual(lut.shape, (cmap.N, 3))
+        cmap2 = colors.LinearSegmentedColormap.from_list("test2", [(0, 0, 0), (1, 1, 1)])
+        self.assertIsNot(img._get_colormap_lut(cmap2), lut)
 
     def test_tint(self):
         """test with tint (on the fast path)"""
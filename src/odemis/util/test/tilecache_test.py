@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on 18 Oct 2026
+
+@author: agent
+
+Copyright © 2026 Delmic
+
+This file is part of Odemis.
+
+Odemis is free software: you can redistribute it and/or modify it under the terms
+of the GNU General Public License version 2 as published by the Free Software
+Foundation.
+
+Odemis is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+Odemis. If not, see http://www.gnu.org/licenses/.
+"""
+from __future__ import division
+
+import gc
+import numpy
+from odemis import model
+from odemis.util.tilecache import LRUCache, TileCache, is_memmapped
+import os
+import tempfile
+import unittest
+
+
+class FakeDAS(model.DataArrayShadow):
+    """
+    Pyramidal DataArrayShadow, which counts the tiles read
+    """
+
+    def __init__(self):
+        model.DataArrayShadow.__init__(self, (1024, 1024), numpy.uint16,
+                                       maxzoom=2, tile_shape=(256, 256))
+        self.nreads = 0
+
+    def getData(self):
+        raise NotImplementedError()
+
+    def getTile(self, x, y, zoom):
+        self.nreads += 1
+        return model.DataArray(numpy.full((256, 256), x + y * 10 + zoom * 100, dtype=numpy.uint16))
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_eviction(self):
+        c = LRUCache(1000)
+        for i in range(4):
+            c.put(i, "v%d" % i, size=300)
+        # The first value doesn't fit anymore
+        self.assertEqual(len(c), 3)
+        self.assertEqual(c.nbytes, 900)
+        self.assertNotIn(0, c)
+
+        # Accessing 1 makes 2 the least recently used one
+        self.assertEqual(c.get(1), "v1")
+        c.put(4, "v4", size=300)
+        self.assertIn(1, c)
+        self.assertNotIn(2, c)
+
+        # Too big to be cached
+        c.put(5, "v5", size=1001)
+        self.assertNotIn(5, c)
+        self.assertEqual(len(c), 3)
+
+        # Replacing a value updates the size
+        c.put(4, "v4bis", size=100)
+        self.assertEqual(c.nbytes, 700)
+        self.assertEqual(c.get(4), "v4bis")
+
+        # Reducing the budget drops the oldest values
+        c.max_bytes = 400
+        self.assertEqual(c.nbytes, 400)
+        self.assertNotIn(3, c)
+
+        c.discard(4)
+        c.discard(4)  # No error if not present
+        self.assertEqual(c.nbytes, 300)
+
+        c.clear()
+        self.assertEqual(len(c), 0)
+        self.assertEqual(c.nbytes, 0)
+
+    def test_stats(self):
+        c = LRUCache(1000)
+        a = numpy.zeros(100, dtype=numpy.uint16)
+        c.put("a", a)  # size from .nbytes
+        self.assertIs(c.get("a"), a)
+        self.assertIsNone(c.get("b"))
+        self.assertEqual(c.get("b", 1), 1)
+        c.put("c", numpy.zeros(500, dtype=numpy.uint16))  # 1000 bytes => evicts "a"
+        st = c.stats()
+        self.assertEqual(st, {"hits": 1, "misses": 2, "evictions": 1, "count": 1,
+                              "nbytes": 1000, "max_bytes": 1000})
+
+
+class TestTileCache(unittest.TestCase):
+
+    def test_raw_rgb(self):
+        tc = TileCache(raw_bytes=256 * 256 * 2 * 4, rgb_bytes=256 * 256 * 3 * 2)
+        das = FakeDAS()
+        for i in range(3):
+            t = tc.get_tile(das, 1, 2, 0)
+        self.assertEqual(das.nreads, 1)
+        self.assertEqual(t[0, 0], 21)
+        self.assertIs(tc.get_raw(das, 1, 2, 0), t)
+        self.assertIsNone(tc.get_raw(das, 1, 2, 1))
+
+        # Projected tiles depend on the parameters
+        rgb = numpy.zeros((256, 256, 3), dtype=numpy.uint8)
+        tc.put_rgb(das, 1, 2, 0, ((255, 0, 0), (0, 100)), rgb)
+        self.assertTrue(tc.has_rgb(das, 1, 2, 0, ((255, 0, 0), (0, 100))))
+        self.assertIs(tc.get_rgb(das, 1, 2, 0, ((255, 0, 0), (0, 100))), rgb)
+        self.assertIsNone(tc.get_rgb(das, 1, 2, 0, ((255, 0, 0), (0, 200))))
+
+        # Each tier has its own budget
+        for x in range(4):
+            tc.get_tile(das, x, 0, 2)
+        self.assertEqual(len(tc.raw), 4)
+        self.assertEqual(len(tc.rgb), 1)
+
+        st = tc.stats()
+        self.assertEqual(st["raw"]["evictions"], 1)
+        self.assertEqual(st["rgb"]["hits"], 1)
+
+    def test_das_deleted(self):
+        """
+        The tiles of a DataArrayShadow are forgotten when it's deleted
+        """
+        tc = TileCache()
+        das1 = FakeDAS()
+        das2 = FakeDAS()
+        tc.get_tile(das1, 0, 0, 0)
+        tc.get_tile(das2, 0, 0, 0)
+        tc.put_rgb(das1, 0, 0, 0, None, numpy.zeros((256, 256, 3), dtype=numpy.uint8))
+        self.assertEqual(len(tc.raw), 2)
+
+        del das1
+        gc.collect()
+        # Cleaned up at the next access
+        das3 = FakeDAS()
+        tc.get_tile(das3, 0, 0, 0)
+        self.assertEqual(das3.nreads, 1)
+        self.assertEqual(len(tc.raw), 2)
+        self.assertEqual(len(tc.rgb), 0)
+
+    def test_memmap(self):
+        """
+        The tiles mapped from a file are not counted in the memory budget
+        """
+        tc = TileCache(raw_bytes=256 * 256 * 2 * 4)
+        das = FakeDAS()
+        fd, fn = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            m = numpy.memmap(fn, dtype=numpy.uint16, mode="w+", shape=(256, 300))
+            tile = model.DataArray(m[:, :256])
+            self.assertTrue(is_memmapped(tile))
+            self.assertFalse(is_memmapped(numpy.array(tile)))
+
+            tc.put_raw(das, 0, 0, 0, tile)
+            self.assertIsNone(tc.get_raw(das, 0, 0, 0))
+            self.assertEqual(tc.raw.nbytes, 0)
+
+            tc.get_tile(das, 1, 0, 0)  # Normal tile
+            self.assertEqual(tc.raw.nbytes, 256 * 256 * 2)
+            del m, tile
+        finally:
+            os.remove(fn)
+
+
+if __name__ == "__main__":
+    unittest.main()
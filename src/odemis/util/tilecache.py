@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+"""
+Created on 18 Oct 2026
+
+@author: agent
+
+Copyright © 2026 Delmic
+
+This file is part of Odemis.
+
+Odemis is free software: you can redistribute it and/or modify it under the terms
+of the GNU General Public License version 2 as published by the Free Software
+Foundation.
+
+Odemis is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+Odemis. If not, see http://www.gnu.org/licenses/.
+"""
+# Cache of the tiles of the pyramidal images (DataArrayShadow), shared by the
+# whole process. The raw tiles and the projected (RGB) tiles are kept in two
+# separate tiers, each with its own memory budget. When a tier is full, the
+# least recently used tiles are dropped.
+# Raw tiles mapped from the file (cf dataio.tiff) are not cached: they don't
+# use RAM of their own (the OS caches the file), and are cheap to map again.
+
+from __future__ import division
+
+from collections import OrderedDict, deque
+import logging
+import mmap
+import numpy
+import threading
+import weakref
+
+# Default memory budget of each tier, in bytes
+RAW_CACHE_SIZE = 256 * 2 ** 20
+RGB_CACHE_SIZE = 256 * 2 ** 20
+
+
+def is_memmapped(a):
+    """
+    a (numpy.ndarray): an array
+    return (bool): True if the data of the array is mapped from a file (ie,
+      the array is a numpy.memmap or a view on one)
+    """
+    while a is not None:
+        if isinstance(a, (numpy.memmap, mmap.mmap)):
+            return True
+        a = getattr(a, "base", None)
+    return False
+
+
+class LRUCache(object):
+    """
+    A dict-like cache, which holds values up to a total number of bytes. When
+    adding a new value would go over the budget, the least recently used values
+    are removed. It is thread-safe.
+    """
+
+    def __init__(self, max_bytes):
+        """
+        max_bytes (0<=int): maximum total size of the values (in bytes)
+        """
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (value, int: size in bytes), oldest first
+        self._nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def max_bytes(self):
+        return self._max_bytes
+
+    @max_bytes.setter
+    def max_bytes(self, value):
+        with self._lock:
+            self._max_bytes = value
+            self._shrink(value)
+
+    @property
+    def nbytes(self):
+        """
+        (int): total size of the values currently cached
+        """
+        return self._nbytes
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        # Doesn't count as an access
+        return key in self._entries
+
+    def get(self, key, default=None):
+        """
+        Look for a value in the cache, and mark it as the most recently used.
+        key (hashable): the key of the value
+        default: returned if the key is not present
+        return: the value, or default if not present
+        """
+        with self._lock:
+            try:
+                value, size = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._entries[key] = value, size  # Move to the end = most recent
+            self.hits += 1
+            return value
+
+    def put(self, key, value, size=None):
+        """
+        Store a value in the cache. If it doesn't fit in the budget, the least
+        recently used values are removed. A value bigger than the whole budget
+        is not stored.
+        key (hashable): the key of the value
+        value (object): the value to store
+        size (None or 0<=int): size in bytes of the value. If None, it's read
+          from the .nbytes attribute of the value (eg, a numpy array).
+        """
+        if size is None:
+            size = value.nbytes
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._nbytes -= old[1]
+            if size > self._max_bytes:
+                return
+            self._shrink(self._max_bytes - size)
+            self._entries[key] = value, size
+            self._nbytes += size
+
+    def discard(self, key):
+        """
+        Remove a value from the cache, if it is present
+        key (hashable): the key of the value
+        """
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._nbytes -= old[1]
+
+    def discard_if(self, cond):
+        """
+        Remove all the values which key matches a condition
+        cond (callable key -> bool): returns True if the value should be removed
+        """
+        with self._lock:
+            for k in [k for k in self._entries if cond(k)]:
+                self._nbytes -= self._entries.pop(k)[1]
+
+    def clear(self):
+        """
+        Remove all the values from the cache (the statistics are kept)
+        """
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
+
+    def _shrink(self, max_bytes):
+        """
+        Remove the least recently used values until the total size is at most max_bytes.
+        Must be called with the lock taken.
+        """
+        while self._nbytes > max_bytes:
+            _, (_, size) = self._entries.popitem(last=False)
+            self._nbytes -= size
+            self.evictions += 1
+
+    def stats(self):
+        """
+        return (dict str -> int): "hits", "misses", "evictions", "count" (number of
+          values currently cached), "nbytes" and "max_bytes"
+        """
+        with self._lock:
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions,
+                    "count": len(self._entries),
+                    "nbytes": self._nbytes,
+                    "max_bytes": self._max_bytes,
+                    }
+
+
+class TileCache(object):
+    """
+    Cache for the tiles of the DataArrayShadows, with one tier for the raw tiles
+    (as returned by getTile()), and one tier for the tiles projected to RGB. The
+    tiles of a DataArrayShadow are automatically removed when it is deleted.
+    """
+
+    def __init__(self, raw_bytes=RAW_CACHE_SIZE, rgb_bytes=RGB_CACHE_SIZE):
+        """
+        raw_bytes (0<=int): memory budget for the raw tiles (in bytes)
+        rgb_bytes (0<=int): memory budget for the projected tiles (in bytes)
+        """
+        self.raw = LRUCache(raw_bytes)
+        self.rgb = LRUCache(rgb_bytes)
+        # The DataArrayShadows are identified by their id(), as they are not
+        # always hashable, and the cache should not keep them alive.
+        self._das_refs = {}  # int (id) -> weakref to the DataArrayShadow
+        self._das_lock = threading.Lock()
+        # ids of the DataArrayShadows deleted, whose tiles are still to be removed.
+        # The weakref callback only records it, as it can be called at any
+        # time, including while a lock is held.
+        self._dead_das = deque()
+
+    def _das_id(self, das):
+        """
+        return (int): the identifier of the DataArrayShadow in the keys
+        """
+        # The id of a deleted DataArrayShadow can be reused => first forget about them
+        self._forget_dead()
+        das_id = id(das)
+        if das_id not in self._das_refs:
+            with self._das_lock:
+                if das_id not in self._das_refs:
+                    self._das_refs[das_id] = weakref.ref(das, lambda _, i=das_id: self._dead_das.append(i))
+        return das_id
+
+    def _forget_dead(self):
+        """
+        Remove all the tiles of the DataArrayShadows which have been deleted
+        """
+        while self._dead_das:
+            try:
+                das_id = self._dead_das.popleft()
+            except IndexError:  # Another thread was faster
+                break
+            with self._das_lock:
+                # Only if the id hasn't been reused in the meantime
+                ref = self._das_refs.get(das_id)
+                if ref is not None and ref() is None:
+                    del self._das_refs[das_id]
+            for tier in (self.raw, self.rgb):
+                tier.discard_if(lambda k: k[0] == das_id)
+
+    def get_raw(self, das, x, y, z):
+        """
+        das (DataArrayShadow): the image
+        x, y, z (int): position and zoom level of the tile, as in das.getTile()
+        return (DataArray or None): the raw tile, or None if not in the cache
+        """
+        return self.raw.get((self._das_id(das), x, y, z))
+
+    def put_raw(self, das, x, y, z, tile):
+        """
+        Store a raw tile. If the tile is mapped from the file, it's not stored.
+        das (DataArrayShadow): the image
+        x, y, z (int): position and zoom level of the tile
+        tile (DataArray): the tile, as returned by das.getTile()
+        """
+        if is_memmapped(tile):
+            return
+        self.raw.put((self._das_id(das), x, y, z), tile)
+
+    def get_rgb(self, das, x, y, z, params):
+        """
+        das (DataArrayShadow): the image
+        x, y, z (int): position and zoom level of the tile
+        params (hashable): settings of the projection (eg, tint, intensity range)
+        return (DataArray or None): the projected tile, or None if not in the cache
+        """
+        return self.rgb.get((self._das_id(das), x, y, z, params))
+
+    def put_rgb(self, das, x, y, z, params, tile):
+        """
+        Store a projected tile
+        das (DataArrayShadow): the image
+        x, y, z (int): position and zoom level of the tile
+        params (hashable): settings of the projection used to compute the tile
+        tile (DataArray): the projected tile
+        """
+        self.rgb.put((self._das_id(das), x, y, z, params), tile)
+
+    def has_raw(self, das, x, y, z):
+        """
+        return (bool): True if the raw tile is in the cache (it doesn't count
+          as an access)
+        """
+        return (self._das_id(das), x, y, z) in self.raw
+
+    def has_rgb(self, das, x, y, z, params):
+        """
+        return (bool): True if the projected tile is in the cache (it doesn't
+          count as an access)
+        """
+        return (self._das_id(das), x, y, z, params) in self.rgb
+
+    def get_tile(self, das, x, y, z):
+        """
+        Same as das.getTile(), but uses the raw tiles cache
+        return (DataArray): the raw tile
+        """
+        tile = self.get_raw(das, x, y, z)
+        if tile is None:
+            tile = das.getTile(x, y, z)
+            self.put_raw(das, x, y, z, tile)
+        return tile
+
+    def clear(self):
+        """
+        Remove all the tiles from the cache
+        """
+        self.raw.clear()
+        self.rgb.clear()
+
+    def stats(self):
+        """
+        return (dict str -> dict str -> int): the statistics of the "raw" and
+          "rgb" tiers, as in LRUCache.stats()
+        """
+        return {"raw": self.raw.stats(), "rgb": self.rgb.stats()}
+
+    def log_stats(self):
+        """
+        Log the statistics of the cache, to check its efficiency
+        """
+        for name, s in self.stats().items():
+            logging.debug("Tile cache %s: %d hits, %d misses, %d evictions, %d tiles using %d/%d MiB",
+                          name, s["hits"], s["misses"], s["evictions"], s["count"],
+                          s["nbytes"] // 2 ** 20, s["max_bytes"] // 2 ** 20)
+
+
+# The cache shared by all the projections of the process
+tile_cache = TileCache()